@@ -0,0 +1,18 @@
+"""
+module benchmarks
+
+Performance benchmarks for the snips_api parser and compiler, and a load
+generator for the player API.
+
+Exports:
+  Modules:
+    - storygen: writes synthetic scripts in the snips_parser input format
+    - run: times parser/compiler phases and checks them against a baseline
+    - pgtemp: starts a throwaway local PostgreSQL server for DB phases
+    - startup: tracks cold-start import time of the app
+    - loadgen: simulates concurrent players against the player API
+
+Usage:
+    $ python -m benchmarks.run --sizes 1000,100000
+    $ python -m benchmarks.run --update-baseline
+"""
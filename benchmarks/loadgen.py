@@ -0,0 +1,437 @@
+"""
+Load generator for the player API.
+
+Simulates concurrent players against a running webapp.py (or
+player_server.py): each player resumes a saved game, then walks the story
+by POSTing choices, picking among the choices its flags allow at random or
+with per-position weights. Players check every response against their own
+flag evaluation, so serving bugs show up as mismatches. When a player
+reaches the end of the story (or --max-steps), its saved game is reset and
+it starts over from the root snippet.
+
+The story graph is read from the same database the server uses (through
+db_tools, i.e. DATABASE_URL or --dsn). With --script, the script is compiled
+into that database first (re-initialising its schema), so a full local run
+needs nothing but a server pointed at the same database:
+
+    $ export DATABASE_URL=sqlite:////tmp/story.db
+    $ python -m benchmarks.storygen 1000 > /tmp/story.txt
+    $ python -m benchmarks.loadgen --script /tmp/story.txt --setup-only
+    $ python webapp.py &
+    $ python -m benchmarks.loadgen --players 50 --duration 30
+
+Saved games for the players are created before the run (named "loadgen-N")
+and deleted afterwards. Setup and resets go straight to the database and are
+not timed.
+
+Per endpoint, the report shows request count, errors (non-2xx responses and
+connection failures), throughput and latency percentiles. Exits with status 1
+if the error rate exceeds --max-error-rate or any mismatch was seen.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+from collections import Counter, OrderedDict
+
+from snips_api.flags import apply_modifications, parse_flag_op, passes_checks
+
+DEFAULT_URL = 'http://127.0.0.1:5000'
+GAME_NAME_PREFIX = 'loadgen-'
+MAX_FLAG_COLUMNS = 3
+PERCENTILES = [50, 90, 99]
+
+# The story's live revision, as players see it
+SNIPPETS_GRAPH_QUERY = """SELECT s.snip_id
+                          FROM snippets s
+                          JOIN stories st ON st.story_id = s.story_id
+                          WHERE s.story_id = %s
+                            AND s.added_in <= st.live_revision
+                            AND (s.removed_in IS NULL
+                                 OR s.removed_in > st.live_revision)
+                          ORDER BY s.snip_id"""
+CHOICES_GRAPH_QUERY = """SELECT c.snip_id, c.next_snip_id,
+                                c.mod_flg_1, c.mod_flg_2, c.mod_flg_3,
+                                c.check_flg_1, c.check_flg_2, c.check_flg_3
+                         FROM choices c
+                         JOIN stories st ON st.story_id = c.story_id
+                         WHERE c.story_id = %s
+                           AND c.added_in <= st.live_revision
+                           AND (c.removed_in IS NULL
+                                OR c.removed_in > st.live_revision)
+                         ORDER BY c.snip_id, c.choice_id"""
+RESET_GAME_QUERY = """UPDATE saved_games SET story_id = NULL,
+                      current_snip_id = NULL, flags = NULL
+                      WHERE game_id = %s"""
+
+
+class StoryGraph():
+    """Snippets and their choices, reduced to what a player needs.
+
+    Args:
+        root_snip_id: snip_id players start at, which is also the story_id.
+
+        choices: Dict of {snip_id: [(next_snip_id, checks, modifications)]}
+                 with choices in choice_index order and flag ops as
+                 (flag_name, operator, value) tuples.
+    """
+    def __init__(self, root_snip_id, choices):
+        self.root_snip_id = root_snip_id
+        self.choices = choices
+
+
+    @classmethod
+    def from_backend(cls, backend, root_snip_id=None):
+        """Loads a story's graph from a db_tools storage backend.
+
+        root_snip_id defaults to the lowest story_id.
+        """
+        if root_snip_id is None:
+            rows = backend.query("SELECT min(story_id) FROM stories")
+            root_snip_id = rows[0][0]
+        choices = OrderedDict((row[0], []) for row in backend.query(
+            SNIPPETS_GRAPH_QUERY, (root_snip_id,)))
+        if not choices:
+            raise ValueError('The database has no story {}'.format(
+                root_snip_id))
+        for row in backend.query(CHOICES_GRAPH_QUERY, (root_snip_id,)):
+            checks = [parse_flag_op(row['check_flg_{}'.format(i)])
+                      for i in range(1, MAX_FLAG_COLUMNS + 1)
+                      if row['check_flg_{}'.format(i)]]
+            mods = [parse_flag_op(row['mod_flg_{}'.format(i)])
+                    for i in range(1, MAX_FLAG_COLUMNS + 1)
+                    if row['mod_flg_{}'.format(i)]]
+            choices[row['snip_id']].append(
+                (row['next_snip_id'], checks, mods))
+        return cls(root_snip_id, choices)
+
+
+    def visible(self, snip_id, state):
+        """Returns the choice_indexes a player with `state` may pick"""
+        return [i for i, (_, checks, _) in
+                enumerate(self.choices.get(snip_id, []))
+                if passes_checks(checks, state)]
+
+
+    def follow(self, snip_id, choice_index, state):
+        """Returns (next_snip_id, new state) for a choice"""
+        next_snip_id, _, mods = self.choices[snip_id][choice_index]
+        return next_snip_id, apply_modifications(mods, state)
+
+
+
+def percentile(sorted_values, p):
+    """Nearest-rank percentile of an ascending list"""
+    if not sorted_values:
+        return None
+    rank = max(1, int(round(p / 100.0 * len(sorted_values))))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+
+class EndpointStats():
+    def __init__(self):
+        self.latencies = []
+        self.statuses = Counter()
+        self.errors = 0
+
+
+    def record(self, seconds, status):
+        """Records a request; status is None if no response was received"""
+        self.latencies.append(seconds)
+        self.statuses[status] += 1
+        if status is None or status >= 400:
+            self.errors += 1
+
+
+    def summary(self, elapsed):
+        latencies = sorted(self.latencies)
+        output = dict(
+            requests=len(latencies),
+            errors=self.errors,
+            error_rate=self.errors / len(latencies) if latencies else 0.0,
+            throughput=len(latencies) / elapsed if elapsed else 0.0,
+            statuses={str(k): v for k, v in self.statuses.items()},
+            max_ms=latencies[-1] * 1000 if latencies else None,
+        )
+        for p in PERCENTILES:
+            value = percentile(latencies, p)
+            output['p{}_ms'.format(p)] = (value * 1000 if value is not None
+                                          else None)
+        return output
+
+
+
+class LoadGenerator():
+    """Runs simulated players against a server.
+
+    Args:
+        graph: StoryGraph of the story the server serves.
+
+        base_url: Server URL, e.g. DEFAULT_URL.
+
+        game_ids: One saved game_id per player.
+
+        reset_game: Called with a game_id to reset it to "not started".
+
+        weights: Relative weights of choices by choice_index; the last
+                 weight applies to all further positions. None for uniform.
+
+        think_time: Mean seconds a player waits between requests
+                    (exponentially distributed). 0 for no wait.
+
+        max_steps: Choices per playthrough before a player starts over.
+
+        seed: Random seed.
+    """
+    def __init__(self, graph, base_url, game_ids, reset_game, weights=None,
+                 think_time=0.0, max_steps=200, seed=0):
+        self.graph = graph
+        self.base_url = base_url.rstrip('/')
+        self.game_ids = game_ids
+        self.reset_game = reset_game
+        self.weights = weights
+        self.think_time = think_time
+        self.max_steps = max_steps
+        self.seed = seed
+        self.stats = OrderedDict()
+        self.mismatches = 0
+        self.playthroughs = 0
+
+
+    def pick(self, rng, options):
+        if not self.weights:
+            return rng.choice(options)
+        weights = [self.weights[min(i, len(self.weights) - 1)]
+                   for i in options]
+        return rng.choices(options, weights)[0]
+
+
+    async def request(self, http, endpoint, method, path, body=None):
+        """Sends a request and records it under `endpoint`.
+
+        Returns:
+            Tuple of (status or None, parsed JSON body or None).
+        """
+        stats = self.stats.setdefault(endpoint, EndpointStats())
+        start = time.perf_counter()
+        status, data = None, None
+        try:
+            async with http.request(method, self.base_url + path,
+                                    json=body) as response:
+                status = response.status
+                if response.content_type == 'application/json':
+                    data = await response.json()
+                else:
+                    await response.read()
+        except Exception:
+            pass
+        stats.record(time.perf_counter() - start, status)
+        return status, data
+
+
+    async def think(self, rng):
+        if self.think_time > 0:
+            await asyncio.sleep(rng.expovariate(1.0 / self.think_time))
+
+
+    async def playthrough(self, http, game_id, rng, deadline):
+        """Plays one game from the root snippet until the story ends"""
+        await self.request(http, 'GET /api/game/<id>', 'GET',
+                           '/api/game/{}'.format(game_id))
+        story_id = snip_id = self.graph.root_snip_id
+        status, _ = await self.request(
+            http, 'GET /api/story/<id>/snippet/<id>', 'GET',
+            '/api/story/{}/snippet/{}'.format(story_id, snip_id))
+        if status != 200:
+            return
+
+        state = {}
+        for _ in range(self.max_steps):
+            options = self.graph.visible(snip_id, state)
+            if not options or time.monotonic() >= deadline:
+                return
+            choice_index = self.pick(rng, options)
+            await self.think(rng)
+
+            status, view = await self.request(
+                http, 'POST /api/game/<id>/choose', 'POST',
+                '/api/game/{}/choose'.format(game_id),
+                dict(story_id=story_id, snip_id=snip_id,
+                     choice_index=choice_index))
+            if status != 200:
+                return
+            snip_id, state = self.graph.follow(snip_id, choice_index, state)
+
+            served = [c['choice_index'] for c in view['choices']]
+            if (view['snip_id'] != snip_id or
+                    served != self.graph.visible(snip_id, state)):
+                self.mismatches += 1
+
+
+    async def player(self, http, game_id, deadline):
+        rng = random.Random('{}-{}'.format(self.seed, game_id))
+        loop = asyncio.get_event_loop()
+        while time.monotonic() < deadline:
+            await self.playthrough(http, game_id, rng, deadline)
+            self.playthroughs += 1
+            await loop.run_in_executor(None, self.reset_game, game_id)
+
+
+    async def run(self, duration, connections=100):
+        """Runs all players for `duration` seconds; returns the report"""
+        import aiohttp
+
+        deadline = time.monotonic() + duration
+        start = time.perf_counter()
+        connector = aiohttp.TCPConnector(limit=connections)
+        async with aiohttp.ClientSession(connector=connector) as http:
+            await asyncio.gather(*[self.player(http, game_id, deadline)
+                                   for game_id in self.game_ids])
+        return self.report(time.perf_counter() - start)
+
+
+    def report(self, elapsed):
+        endpoints = OrderedDict((name, stats.summary(elapsed))
+                                for name, stats in self.stats.items())
+        total = EndpointStats()
+        for stats in self.stats.values():
+            total.latencies += stats.latencies
+            total.statuses.update(stats.statuses)
+            total.errors += stats.errors
+        return dict(
+            players=len(self.game_ids),
+            elapsed=elapsed,
+            playthroughs=self.playthroughs,
+            mismatches=self.mismatches,
+            endpoints=endpoints,
+            total=total.summary(elapsed),
+        )
+
+
+
+def format_report(report):
+    def ms(value):
+        return '{:8.1f}'.format(value) if value is not None else '       -'
+
+    lines = ['{} players, {:.1f}s, {} playthroughs, {} mismatches'.format(
+        report['players'], report['elapsed'], report['playthroughs'],
+        report['mismatches'])]
+    lines.append('{:<30} {:>8} {:>7} {:>8} {:>8} {:>8} {:>8} {:>8}'.format(
+        'endpoint', 'requests', 'errors', 'req/s', 'p50 ms', 'p90 ms',
+        'p99 ms', 'max ms'))
+    rows = list(report['endpoints'].items()) + [('total', report['total'])]
+    for name, s in rows:
+        lines.append('{:<30} {:>8} {:>7} {:>8.1f} {} {} {} {}'.format(
+            name, s['requests'], s['errors'], s['throughput'],
+            ms(s['p50_ms']), ms(s['p90_ms']), ms(s['p99_ms']),
+            ms(s['max_ms'])))
+    return '\n'.join(lines)
+
+
+def create_games(backend, players):
+    """Creates one saved game per player; returns their game_ids"""
+    delete_games(backend)
+    backend.execute_statements([(
+        "INSERT INTO saved_games(my_name, my_fruit) VALUES (%s, %s)",
+        (GAME_NAME_PREFIX + str(i), 'loadgen')) for i in range(players)])
+    return [row[0] for row in backend.query(
+        "SELECT game_id FROM saved_games WHERE my_name LIKE %s "
+        "ORDER BY game_id", (GAME_NAME_PREFIX + '%',))]
+
+
+def delete_games(backend):
+    backend.execute_statements([(
+        "DELETE FROM saved_games WHERE my_name LIKE %s",
+        (GAME_NAME_PREFIX + '%',))])
+
+
+def load_script(backend, path):
+    """Re-initialises the database and compiles the script into it.
+
+    Returns the script's ROOT_SNIP_ID.
+    """
+    from snips_api import snips_parser
+
+    with open(path, encoding='utf-8') as f:
+        text = f.read()
+    backend.init_schema()
+    backend.execute_statements(snips_parser.parse(text, backend=backend))
+    _, directives = snips_parser.get_directives(text.splitlines())
+    return directives['ROOT_SNIP_ID']
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmarks.loadgen',
+        description='Simulate concurrent players against the player API.')
+    parser.add_argument('--url', default=DEFAULT_URL)
+    parser.add_argument('--dsn', help='database the server uses (default: '
+                                      'DATABASE_URL)')
+    parser.add_argument('--script', help='compile this script into the '
+                                         'database first (drops all data)')
+    parser.add_argument('--setup-only', action='store_true',
+                        help='only load --script, do not generate load')
+    parser.add_argument('--root', type=int, help='story (root snip_id) to '
+                        'play (default: ROOT_SNIP_ID of --script, else '
+                        'lowest)')
+    parser.add_argument('--players', type=int, default=10)
+    parser.add_argument('--duration', type=float, default=10.0,
+                        help='seconds')
+    parser.add_argument('--connections', type=int, default=100,
+                        help='max concurrent HTTP connections')
+    parser.add_argument('--think-ms', type=float, default=0.0,
+                        help='mean pause between a player\'s requests')
+    parser.add_argument('--weights', help='comma-separated choice weights '
+                        'by position, e.g. 3,1 (default: uniform)')
+    parser.add_argument('--max-steps', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--max-error-rate', type=float, default=0.01)
+    parser.add_argument('--output', help='also write the report as JSON')
+    args = parser.parse_args(argv)
+
+    if args.dsn:
+        os.environ['DATABASE_URL'] = args.dsn
+    from db_tools.backends import get_backend
+    backend = get_backend()
+
+    root = args.root
+    if args.script:
+        script_root = load_script(backend, args.script)
+        root = root if root is not None else script_root
+    if args.setup_only:
+        return 0
+
+    graph = StoryGraph.from_backend(backend, root)
+    weights = ([float(w) for w in args.weights.split(',')]
+               if args.weights else None)
+    game_ids = create_games(backend, args.players)
+    reset = lambda game_id: backend.execute_statements(
+        [(RESET_GAME_QUERY, (game_id,))])
+    generator = LoadGenerator(graph, args.url, game_ids, reset, weights,
+                              args.think_ms / 1000.0, args.max_steps,
+                              args.seed)
+    loop = asyncio.new_event_loop()
+    try:
+        report = loop.run_until_complete(
+            generator.run(args.duration, args.connections))
+    finally:
+        loop.close()
+        delete_games(backend)
+
+    print(format_report(report))
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+
+    failed = (report['total']['error_rate'] > args.max_error_rate or
+              report['mismatches'])
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,96 @@
+"""
+Throwaway local PostgreSQL server for benchmarks.
+
+Creates a fresh cluster in a temporary directory with `initdb`, starts it on
+a free port, and removes everything again when the context exits. Requires
+the PostgreSQL server binaries (`initdb`, `pg_ctl`) to be installed, either
+on the PATH or in the directory reported by `pg_config --bindir`.
+
+Usage:
+    with throwaway_postgres() as url:
+        os.environ['DATABASE_URL'] = url
+        ...
+"""
+
+import contextlib
+import os
+import shutil
+import socket
+import subprocess
+import tempfile
+
+
+class PostgresNotFound(Exception):
+    """The PostgreSQL server binaries could not be located"""
+
+
+def find_pg_bindir():
+    """Finds the directory containing initdb and pg_ctl.
+
+    Returns:
+        Absolute path to the directory, or None if not found.
+    """
+    initdb = shutil.which('initdb')
+    if initdb:
+        return os.path.dirname(initdb)
+
+    pg_config = shutil.which('pg_config')
+    if pg_config:
+        bindir = subprocess.check_output([pg_config, '--bindir'],
+                                         universal_newlines=True).strip()
+        if os.path.exists(os.path.join(bindir, 'initdb')):
+            return bindir
+    return None
+
+
+def _free_port():
+    with contextlib.closing(socket.socket()) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+@contextlib.contextmanager
+def throwaway_postgres(dbname='bench'):
+    """Runs a temporary PostgreSQL server for the duration of the context.
+
+    Args:
+        dbname: Name of the database to create.
+                Default: 'bench'
+
+    Yields:
+        Database URL of the form postgres://postgres@127.0.0.1:<port>/<db>
+
+    Raises:
+        PostgresNotFound if the server binaries are not installed.
+    """
+    bindir = find_pg_bindir()
+    if not bindir:
+        raise PostgresNotFound('initdb/pg_ctl not found; install the '
+                               'PostgreSQL server or pass --dsn')
+
+    def binary(name):
+        return os.path.join(bindir, name)
+
+    workdir = tempfile.mkdtemp(prefix='fyms-pg-')
+    datadir = os.path.join(workdir, 'data')
+    port = _free_port()
+    quiet = dict(stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    started = False
+    try:
+        subprocess.check_call([binary('initdb'), '-D', datadir, '-U',
+                               'postgres', '--auth=trust', '-E', 'UTF8'],
+                              **quiet)
+        options = '-p {} -k {} -c listen_addresses=127.0.0.1 -c fsync=off'
+        subprocess.check_call([binary('pg_ctl'), '-D', datadir, '-w',
+                               '-o', options.format(port, workdir),
+                               '-l', os.path.join(workdir, 'log'), 'start'],
+                              **quiet)
+        started = True
+        subprocess.check_call([binary('createdb'), '-h', '127.0.0.1', '-p',
+                               str(port), '-U', 'postgres', dbname], **quiet)
+        yield 'postgres://postgres@127.0.0.1:{}/{}'.format(port, dbname)
+    finally:
+        if started:
+            subprocess.call([binary('pg_ctl'), '-D', datadir, '-m', 'fast',
+                             'stop'], **quiet)
+        shutil.rmtree(workdir, ignore_errors=True)
@@ -0,0 +1,336 @@
+"""
+Benchmarks for the snips_api parser and compiler.
+
+Times these phases on synthetic stories (see storygen.py) of each size:
+    - parse_text:                snips_parser.parse_text()
+    - get_snippets_tree:         Snippet.get_snippets_tree() on the root
+    - snippet_chain_to_sql_data: compiler.snippet_chain_to_sql_data()
+
+For every phase and size, wall time, throughput (snippets per second) and
+peak traced memory are recorded. Results are compared against a JSON baseline
+and the run fails (exit status 1) if any phase is slower or uses more memory
+than the baseline by more than the threshold. Results with no baseline to
+compare against are reported; with --ci (the default when the CI environment
+variable is set) they fail the run (exit status 2), so that a missing or
+stale baseline file can't make the check pass without comparing anything.
+
+The compiler phase queries the database to resolve snip_ids, so it runs
+against a throwaway local PostgreSQL server (see pgtemp.py) unless a database
+URL is given with --dsn. If no server can be started, DB phases are skipped.
+
+Usage:
+    $ python -m benchmarks.run
+    $ python -m benchmarks.run --sizes 1000,100000 --threshold 0.25
+    $ python -m benchmarks.run --update-baseline
+    $ python -m benchmarks.run --ci                # fail without a baseline
+    $ python -m benchmarks.run --dsn postgres://postgres@localhost/bench
+    $ python -m benchmarks.run --dsn sqlite://     # embedded, in memory
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+from snips_api import snips_parser
+
+from .pgtemp import PostgresNotFound, throwaway_postgres
+from .storygen import generate_story
+
+basedir = os.path.abspath(os.path.dirname(__file__))
+
+BASELINE = os.path.join(basedir, 'baseline.json')
+DEFAULT_SIZES = [1000, 100000, 1000000]
+DEFAULT_THRESHOLD = 0.2
+
+PHASES = ['parse_text', 'get_snippets_tree', 'snippet_chain_to_sql_data']
+DB_PHASES = ['snippet_chain_to_sql_data']
+
+# Timings below this many seconds are too noisy to compare
+MIN_COMPARABLE_SECONDS = 0.05
+
+
+def measure(func, count, trace_memory=True):
+    """Runs func() and records its wall time and peak memory.
+
+    When trace_memory is set, func() is run a second time under tracemalloc
+    so that tracing overhead does not distort the timing.
+
+    Args:
+        func: Callable with no arguments.
+
+        count: Number of snippets processed by func(), for throughput.
+
+        trace_memory: Whether to measure peak memory.
+                      Default: True
+
+    Returns:
+        Tuple of (return value of the timed run, stats dict).
+    """
+    start = time.perf_counter()
+    result = func()
+    seconds = time.perf_counter() - start
+
+    peak = None
+    if trace_memory:
+        tracemalloc.start()
+        try:
+            func()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    stats = dict(
+        seconds=seconds,
+        snippets_per_sec=count / seconds if seconds else None,
+        peak_bytes=peak,
+    )
+    return result, stats
+
+
+def bench_size(size, phases, trace_memory=True, **story_options):
+    """Runs the selected phases on a generated story of `size` snippets.
+
+    Returns:
+        Dict of {phase: stats}.
+    """
+    text = generate_story(snippets=size, **story_options)
+    results = {}
+
+    # The parser prints a line per snippet, choice and flag; keep that out
+    # of the benchmark output (but not out of the timings).
+    with open(os.devnull, 'w') as devnull, \
+         contextlib.redirect_stdout(devnull):
+        (snippets, directives), results['parse_text'] = measure(
+            lambda: snips_parser.parse_text(text, use_cache=False), size,
+            trace_memory)
+
+        root = snippets[min(snippets.keys())][0]
+
+        def snippets_tree():
+            # Drop the tree cached by the orphan check in parse_text()
+            root.__dict__.pop('child_snippets', None)
+            return root.get_snippets_tree()
+
+        if 'get_snippets_tree' in phases:
+            _, results['get_snippets_tree'] = measure(
+                snippets_tree, size, trace_memory)
+
+        if 'snippet_chain_to_sql_data' in phases:
+            from snips_api import compiler
+            root.set_snip_id(directives['ROOT_SNIP_ID'])
+            _, results['snippet_chain_to_sql_data'] = measure(
+                lambda: compiler.snippet_chain_to_sql_data(root, 'timid'),
+                size, trace_memory)
+
+    return {phase: results[phase] for phase in phases if phase in results}
+
+
+def run_benchmarks(sizes, phases, trace_memory=True, **story_options):
+    """Runs all sizes and returns results keyed by "phase@size"."""
+    results = {}
+    for size in sizes:
+        print('Benchmarking {} snippets...'.format(size))
+        for phase, stats in bench_size(size, phases, trace_memory,
+                                       **story_options).items():
+            key = '{}@{}'.format(phase, size)
+            results[key] = stats
+            print('  {:<40} {}'.format(key, format_stats(stats)))
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Finds phases that regressed beyond the threshold.
+
+    Args:
+        results: Dict of {"phase@size": stats} from run_benchmarks().
+
+        baseline: Dict of the same shape, loaded from the baseline file.
+
+        threshold: Allowed relative slowdown/growth, e.g. 0.2 for 20%.
+
+    Returns:
+        List of human-readable regression descriptions.
+    """
+    regressions = []
+    for key, stats in sorted(results.items()):
+        base = baseline.get(key)
+        if not base:
+            continue
+
+        if (base['seconds'] >= MIN_COMPARABLE_SECONDS and
+            stats['seconds'] > base['seconds'] * (1 + threshold)
+        ):
+            regressions.append('{}: {:.3f}s vs baseline {:.3f}s'.format(
+                key, stats['seconds'], base['seconds']))
+
+        if (stats['peak_bytes'] and base.get('peak_bytes') and
+            stats['peak_bytes'] > base['peak_bytes'] * (1 + threshold)
+        ):
+            regressions.append('{}: peak {} vs baseline {}'.format(
+                key, _mib(stats['peak_bytes']), _mib(base['peak_bytes'])))
+    return regressions
+
+
+def missing_baselines(results, baseline):
+    """Lists the keys of results that the baseline has no entry for"""
+    return sorted(key for key in results if not baseline.get(key))
+
+
+def check_baseline(results, path, threshold, ci):
+    """Compares results with the baseline file and prints what it found.
+
+    Returns:
+        Exit status: 0 if all is well, 1 for regressions, 2 if `ci` is set
+        and some results have no baseline.
+    """
+    baseline = load_baseline(path)
+    missing = missing_baselines(results, baseline)
+    if missing:
+        print('No baseline in {} for: {}'.format(path, ', '.join(missing)))
+        print('Record one on this machine with --update-baseline')
+
+    regressions = compare(results, baseline, threshold)
+    if regressions:
+        print('Regressions beyond {:.0%}:'.format(threshold))
+        for r in regressions:
+            print('  ' + r)
+        return 1
+    if missing and ci:
+        return 2
+    return 0
+
+
+def add_baseline_arguments(parser):
+    parser.add_argument('--baseline', default=BASELINE)
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help='allowed relative regression (default: 0.2)')
+    parser.add_argument('--update-baseline', action='store_true',
+                        help='write results to the baseline file')
+    parser.add_argument('--ci', action='store_true',
+                        default=bool(os.environ.get('CI')),
+                        help='fail if a result has no baseline (default if '
+                             'CI is set)')
+
+
+def format_stats(stats):
+    rate = stats['snippets_per_sec']
+    out = '{:9.3f}s {:>14}'.format(
+        stats['seconds'],
+        '{:,.0f} snip/s'.format(rate) if rate else '-')
+    if stats['peak_bytes'] is not None:
+        out += '  peak ' + _mib(stats['peak_bytes'])
+    return out
+
+
+def _mib(num_bytes):
+    return '{:.1f} MiB'.format(num_bytes / 2 ** 20)
+
+
+def load_baseline(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_baseline(path, results):
+    baseline = load_baseline(path)
+    baseline.update(results)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(baseline, f, indent=2, sort_keys=True)
+        f.write('\n')
+
+
+@contextlib.contextmanager
+def database(dsn=None):
+    """Points DATABASE_URL at a database with a fresh schema.
+
+    Yields True if a database is available, otherwise False.
+    """
+    old_url = os.environ.get('DATABASE_URL')
+    with contextlib.ExitStack() as stack:
+        if not dsn:
+            try:
+                dsn = stack.enter_context(throwaway_postgres())
+            except PostgresNotFound as e:
+                print('Skipping DB phases: {}'.format(e))
+                yield False
+                return
+
+        import db_tools
+        from db_tools import backends, debugging
+        os.environ['DATABASE_URL'] = dsn
+        db_tools.reset_config()
+        backends.set_backend(None)
+        try:
+            debugging.init_db()
+            yield True
+        finally:
+            if old_url is None:
+                os.environ.pop('DATABASE_URL', None)
+            else:
+                os.environ['DATABASE_URL'] = old_url
+            db_tools.reset_config()
+            backends.set_backend(None)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmarks.run',
+        description='Benchmark the snips_api parser and compiler.')
+    parser.add_argument('--sizes', default=','.join(map(str, DEFAULT_SIZES)),
+                        help='comma-separated story sizes, in snippets')
+    parser.add_argument('--phases', default=','.join(PHASES),
+                        help='comma-separated phases to run')
+    parser.add_argument('--branching', type=int, default=2)
+    parser.add_argument('--flag-density', type=float, default=0.1)
+    parser.add_argument('--comment-density', type=float, default=0.05)
+    parser.add_argument('--long-text-ratio', type=float, default=0.01)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-memory', action='store_true',
+                        help='skip peak memory measurement')
+    parser.add_argument('--dsn', help='use this database instead of '
+                                      'starting a throwaway server')
+    add_baseline_arguments(parser)
+    parser.add_argument('--output', help='also write results to this file')
+    args = parser.parse_args(argv)
+
+    sizes = [int(s) for s in args.sizes.split(',')]
+    phases = [p for p in args.phases.split(',') if p]
+    for phase in phases:
+        if phase not in PHASES:
+            parser.error('unknown phase "{}" (use {})'.format(
+                phase, ', '.join(PHASES)))
+    story_options = dict(
+        branching=args.branching,
+        flag_density=args.flag_density,
+        comment_density=args.comment_density,
+        long_text_ratio=args.long_text_ratio,
+        seed=args.seed,
+    )
+
+    with contextlib.ExitStack() as stack:
+        if any(p in DB_PHASES for p in phases):
+            if not stack.enter_context(database(args.dsn)):
+                phases = [p for p in phases if p not in DB_PHASES]
+        results = run_benchmarks(sizes, phases, not args.no_memory,
+                                 **story_options)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.update_baseline:
+        save_baseline(args.baseline, results)
+        print('Baseline updated: {}'.format(args.baseline))
+        return 0
+
+    return check_baseline(results, args.baseline, args.threshold, args.ci)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,109 @@
+"""
+Cold-start benchmark.
+
+Measures how long a fresh interpreter takes to import the app's entry points,
+with no database configuration in the environment (importing must not need
+DATABASE_URL). Each target is imported several times in a new subprocess and
+the median is compared against the baseline shared with run.py, under keys
+like "startup:webapp".
+
+Usage:
+    $ python -m benchmarks.startup
+    $ python -m benchmarks.startup --update-baseline
+    $ python -m benchmarks.startup --ci            # fail without a baseline
+    $ python -m benchmarks.startup --importtime    # show slowest imports
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+from .run import add_baseline_arguments, check_baseline, format_stats, \
+                 save_baseline
+
+basedir = os.path.abspath(os.path.dirname(__file__))
+repodir = os.path.dirname(basedir)
+
+TARGETS = ['webapp', 'db_tools', 'snips_api.compiler']
+
+# Modules that must not be imported as a side effect of a cold start
+HEAVY_MODULES = ['pandas', 'sqlalchemy']
+
+
+def child_env():
+    env = dict(os.environ)
+    env.pop('DATABASE_URL', None)
+    env['PYTHONDONTWRITEBYTECODE'] = '1'
+    return env
+
+
+def time_import(module, runs=5):
+    """Imports `module` in `runs` fresh interpreters.
+
+    Returns:
+        Stats dict with the median wall time in seconds.
+    """
+    check = ('import sys, {0}; heavy = [m for m in {1!r} if m in sys.modules]'
+             '\nif heavy: sys.exit("{0} imported " + ", ".join(heavy))'
+            ).format(module, HEAVY_MODULES)
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        proc = subprocess.run([sys.executable, '-c', check], cwd=repodir,
+                              env=child_env(), stderr=subprocess.PIPE,
+                              universal_newlines=True)
+        timings.append(time.perf_counter() - start)
+        if proc.returncode:
+            raise RuntimeError('importing {} failed:\n{}'.format(
+                module, proc.stderr.strip()))
+    return dict(seconds=statistics.median(timings), snippets_per_sec=None,
+                peak_bytes=None)
+
+
+def slowest_imports(module, top=15):
+    """Returns the `top` slowest imports of `module` from -X importtime"""
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c',
+                           'import ' + module], cwd=repodir, env=child_env(),
+                          stderr=subprocess.PIPE, universal_newlines=True)
+    rows = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        rows.append((int(cumulative), name.rstrip()))
+    return sorted(rows, reverse=True)[:top]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmarks.startup',
+        description='Measure cold-start import time of the app.')
+    parser.add_argument('--targets', default=','.join(TARGETS))
+    parser.add_argument('--runs', type=int, default=5)
+    add_baseline_arguments(parser)
+    parser.add_argument('--importtime', action='store_true',
+                        help='list the slowest imports of each target')
+    args = parser.parse_args(argv)
+
+    results = {}
+    for module in args.targets.split(','):
+        key = 'startup:' + module
+        results[key] = time_import(module, args.runs)
+        print('  {:<40} {}'.format(key, format_stats(results[key])))
+        if args.importtime:
+            for usec, name in slowest_imports(module):
+                print('      {:>8.1f} ms  {}'.format(usec / 1000, name))
+
+    if args.update_baseline:
+        save_baseline(args.baseline, results)
+        print('Baseline updated: {}'.format(args.baseline))
+        return 0
+
+    return check_baseline(results, args.baseline, args.threshold, args.ci)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
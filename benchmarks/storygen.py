@@ -0,0 +1,131 @@
+"""
+Synthetic story generator for the snips_parser input format.
+
+The generated scripts are always valid parser input: every snippet except the
+last has at least one choice, the first choice of every snippet implicitly
+links to the next snippet (so no snippet is ever orphaned), and each choice
+gets at most one flag check and one flag modification.
+
+Usage:
+    from benchmarks.storygen import generate_story
+    text = generate_story(snippets=1000, branching=3, flag_density=0.2)
+
+    $ python -m benchmarks.storygen 1000 > story.txt
+"""
+
+import random
+import sys
+
+COMMENT_MARKER = '//'
+CHOICE_INDENT = ' ' * 4
+FLAG_INDENT = ' ' * 8
+
+WORDS = ('patient doctor ward nurse chart fever pulse john smith tablet '
+         'curtain bed morning night coffee blood pressure sigh look walk '
+         'quietly quickly suddenly again the a of to and with beside').split()
+FLAG_NAMES = ('bm_patient skin_thickness johndoe_death patient_deaths '
+              'tut_switch_track tut_board_annoyed').split()
+CHECK_OPERATORS = '== != <= >= < >'.split()
+MODIFY_OPERATORS = '= += -='.split()
+
+
+def generate_story(snippets=1000, branching=2, flag_density=0.1,
+                   comment_density=0.05, long_text_ratio=0.01,
+                   long_text_words=400, root_snip_id=1, seed=0):
+    """Generates a script with the given number of snippets.
+
+    Args:
+        snippets: Number of snippets to generate.
+
+        branching: Maximum number of choices per snippet. Each snippet gets
+                   between 1 and `branching` choices.
+                   Default: 2
+
+        flag_density: Probability that a choice carries a flag check and,
+                      independently, a flag modification.
+                      Default: 0.1
+
+        comment_density: Probability that a comment line is emitted before a
+                         snippet, and that a snippet line has an inline
+                         comment.
+                         Default: 0.05
+
+        long_text_ratio: Fraction of snippets with long game text.
+                         Default: 0.01
+
+        long_text_words: Number of words in a long game text.
+                         Default: 400
+
+        root_snip_id: Argument for the ROOT_SNIP_ID directive.
+                      Default: 1
+
+        seed: Seed for the random number generator, so that runs with the
+              same arguments produce the same text.
+              Default: 0
+
+    Returns:
+        String ready to be passed to snips_parser.parse_text().
+    """
+    return '\n'.join(iter_story_lines(
+        snippets, branching, flag_density, comment_density, long_text_ratio,
+        long_text_words, root_snip_id, seed)) + '\n'
+
+
+def iter_story_lines(snippets=1000, branching=2, flag_density=0.1,
+                     comment_density=0.05, long_text_ratio=0.01,
+                     long_text_words=400, root_snip_id=1, seed=0):
+    """Generates the lines of a script. See generate_story() for args."""
+    if snippets < 1:
+        raise ValueError('snippets must be at least 1')
+    if branching < 1:
+        raise ValueError('branching must be at least 1')
+
+    rng = random.Random(seed)
+
+    yield 'directive:COMMENT_MARKER {}'.format(COMMENT_MARKER)
+    yield 'directive:ROOT_SNIP_ID {}'.format(root_snip_id)
+
+    for ref_num in range(1, snippets + 1):
+        if rng.random() < comment_density:
+            yield ''
+            yield '{} {}'.format(COMMENT_MARKER, _sentence(rng, 6))
+
+        num_words = long_text_words if rng.random() < long_text_ratio else 12
+        line = '{}. {}'.format(ref_num, _sentence(rng, num_words))
+        if rng.random() < comment_density:
+            line += '  {} {}'.format(COMMENT_MARKER, _sentence(rng, 4))
+        yield line
+
+        if ref_num == snippets:
+            # Last snippet is a terminal snippet
+            break
+
+        for i in range(rng.randint(1, branching)):
+            label = _sentence(rng, 4)
+            if i == 0:
+                # First choice implicitly links to the next snippet, which
+                # keeps every snippet reachable from the root
+                yield CHOICE_INDENT + label
+            else:
+                target = rng.randint(1, snippets)
+                yield '{}{} -> ({})'.format(CHOICE_INDENT, label, target)
+
+            if rng.random() < flag_density:
+                yield '{}Requires {} {} {}'.format(
+                    FLAG_INDENT, rng.choice(FLAG_NAMES),
+                    rng.choice(CHECK_OPERATORS), rng.randint(0, 9))
+            if rng.random() < flag_density:
+                yield '{}{} {} {}'.format(
+                    FLAG_INDENT, rng.choice(FLAG_NAMES),
+                    rng.choice(MODIFY_OPERATORS), rng.randint(0, 9))
+
+
+def _sentence(rng, num_words):
+    words = [rng.choice(WORDS) for _ in range(num_words)]
+    return ' '.join(words).capitalize() + '.'
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    for line in iter_story_lines(count):
+        print(line)
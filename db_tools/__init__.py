@@ -1,24 +1,49 @@
 """
 module db_tools
 
+The database URL is resolved from the environment the first time a
+connection is made (or db_url() is called), not at import time. Importing
+db_tools therefore works without any database configuration.
+
 Exports:
   Classes:
     - AppDBConnection: database connection to the app database
     - AppCursor: context manager for executing simple queries
+  Functions:
+    - db_url(): the raw, unparsed URL to the PostgreSQL database
+    - db_parsed_url(): a urlparse ParseResult for the database URL
+    - reset_config(): forgets the resolved URL so it is re-read on next use
+  Modules:
+    - metrics: query latency/row count instrumentation for AppCursor
+    - backends: storage backends (PostgreSQL, embedded SQLite) used by the
+                compiler and db_downup
+    - columnar: Parquet/Arrow export and import of tables (needs pyarrow)
+    - snapshot: consistent whole-database snapshot archives and restores
+    - replicas: read replica routing with a replication lag guard
+    - revisions: copy-on-write story revisions and the live revision pointer
+    - request_profiler: sampling profiler for webapp requests
+    - validation: checks of uploaded tables before they replace data
+    - admission: request lanes that keep bulk debug routes from starving
+                 player routes
   Vars:
     - SCHEMA: absolute filepath to the database schema.sql
     - POSTGRES_ENVVAR: The name of the environment variable defining the 
                        PostgreSQL database URL the app will connect to.
                        For if we ever need multiple databases.
-    - DB_PARSED_URL: a urlparse ParseResult for the PostgreSQL database URL
-    - DB_URL = The raw, unparsed URL to the PostgreSQL database
 """
 
+import logging
 import os
+import threading
+import time
 import psycopg2
-from psycopg2.extras import DictCursor
 from urllib import parse
 
+from . import admission, metrics, replicas
+from .metrics import InstrumentedDictCursor
+
+logger = logging.getLogger(__name__)
+
 
 # Setup for creating exported vars
 basedir = os.path.abspath(os.path.dirname(__file__))
@@ -30,21 +55,55 @@ SCHEMA = os.path.join(basedir, 'schema.sql')
 # Name of the env var on Heroku containing the URL to the PostgreSQL db
 POSTGRES_ENVVAR = 'DATABASE_URL'
 
-# Retrieve URL in the env var
-DB_URL = os.environ[POSTGRES_ENVVAR]
+# Resolved lazily by db_url()/db_parsed_url()
+_config_lock = threading.Lock()
+_db_url = None
+_db_parsed_url = None
 
-# Create localhost URI if DB_URL uses $(whoami) to imply locally hosted db
-if DB_URL == r'postgres://$(whoami)':
-    _DEBUG_PW = os.environ.get('DEBUG_POSTGRES_PASSWORD', None)
-    if not _DEBUG_PW:
-        raise Exception("Password for local database user 'postgres' not "
-                        "defined. Please set your password in the "
-                        "environment variable 'DEBUG_POSTGRES_PASSWORD'.")
-    DB_URL = 'postgres://postgres:{}@localhost:5432'.format(_DEBUG_PW)
 
-# Parse URI into a ParseResult
-DB_PARSED_URL = parse.urlparse(DB_URL)
-print("Using database at {}".format(DB_PARSED_URL.hostname))
+def db_url():
+    """Returns the database URL, reading it from the environment on first use.
+
+    Raises KeyError if the environment variable is not defined.
+    """
+    global _db_url, _db_parsed_url
+    if _db_url is not None:
+        return _db_url
+
+    with _config_lock:
+        if _db_url is None:
+            # Retrieve URL in the env var
+            url = os.environ[POSTGRES_ENVVAR]
+
+            # Create localhost URI if url uses $(whoami) to imply locally
+            # hosted db
+            if url == r'postgres://$(whoami)':
+                debug_pw = os.environ.get('DEBUG_POSTGRES_PASSWORD', None)
+                if not debug_pw:
+                    raise Exception("Password for local database user "
+                                    "'postgres' not defined. Please set your "
+                                    "password in the environment variable "
+                                    "'DEBUG_POSTGRES_PASSWORD'.")
+                url = 'postgres://postgres:{}@localhost:5432'.format(debug_pw)
+
+            # Parse URI into a ParseResult
+            _db_parsed_url = parse.urlparse(url)
+            _db_url = url
+            logger.info("Using database at %s", _db_parsed_url.hostname)
+    return _db_url
+
+
+def db_parsed_url():
+    """Returns db_url() as a urlparse ParseResult."""
+    db_url()
+    return _db_parsed_url
+
+
+def reset_config():
+    """Forgets the resolved database URL, e.g. after changing DATABASE_URL."""
+    global _db_url, _db_parsed_url
+    with _config_lock:
+        _db_url = _db_parsed_url = None
 
 
 class AppDBConnection():
@@ -54,6 +113,9 @@ class AppDBConnection():
     always teardown connections after you're done with them.
     If you're not sure how cursors work, use the AppCursor instead.
 
+    With readonly=True, the connection may go to a read replica instead of
+    the primary (see db_tools.replicas); `replica` tells which, or is None.
+
     Usage: 
         conn = AppDBConnection()
         cur = conn.cursor
@@ -61,47 +123,88 @@ class AppDBConnection():
         cur.execute('query2')
         conn.teardown()  # Note: always teardown connections when you're done
     """
-    def __init__(self):
+    def __init__(self, readonly=False):
         self.cursors = []
-        # Connect to db
-        self._connect()
+        self.replica = None
+        # Requests in a limited lane share its connection slots
+        self._lane = admission.acquire_connection()
+        try:
+            # Connect to db
+            if readonly:
+                conn, self.replica = replicas.connect_replica(self._connect)
+                if conn is not None:
+                    self._conn = conn
+                    return
+            self._connect()
+        except BaseException:
+            admission.release_connection(self._lane)
+            raise
 
 
     @property
-    def cursor(self, factory=DictCursor):
+    def cursor(self, factory=InstrumentedDictCursor):
         """Provides a fresh db cursor.
 
         Args:
             factory: a psycopg2 extension cursor. See:
                      http://initd.org/psycopg/docs/AppDBConnection.html#AppDBConnection.cursor
-                     Default: psycopg2.extras.DictCursor
+                     Default: db_tools.metrics.InstrumentedDictCursor, a
+                     psycopg2.extras.DictCursor that records query metrics
 
         """
         return self._conn.cursor(cursor_factory=factory)
 
 
+    @property
+    def connection(self):
+        """The underlying psycopg2 connection, e.g. for set_session()"""
+        return self._conn
+
+
+    def server_cursor(self, name, itersize=2000):
+        """Provides a named (server-side) cursor for streaming large results.
+
+        Rows are sent from the server `itersize` at a time instead of all at
+        once. The cursor returns plain tuples and is not instrumented.
+        """
+        cur = self._conn.cursor(name=name)
+        cur.itersize = itersize
+        self.cursors.append(cur)
+        return cur
+
+
     def teardown(self):
         """Commits queries and closes the db connection."""
+        start = time.perf_counter()
         for cur in self.cursors:
             cur.close()
-        self._conn.commit()
-        self._conn.close()
-
-
-    def _connect(self):
-        """Setup the connection to the database."""
+        try:
+            self._conn.commit()
+            self._conn.close()
+        finally:
+            admission.release_connection(self._lane)
+            self._lane = None
+        metrics.record_teardown(time.perf_counter() - start)
+
+
+    def _connect(self, url=None):
+        """Setup the connection to the database (default: the primary)."""
+        url = url or db_parsed_url()
+        start = time.perf_counter()
         try:
             conn = psycopg2.connect(
-                database=DB_PARSED_URL.path[1:],
-                user=DB_PARSED_URL.username,
-                password=DB_PARSED_URL.password,
-                host=DB_PARSED_URL.hostname,
-                port=DB_PARSED_URL.port
+                database=url.path[1:],
+                user=url.username,
+                password=url.password,
+                host=url.hostname,
+                port=url.port
             )
             self._conn = conn
+            metrics.record_connect(time.perf_counter() - start)
             return self._conn
         except:
-            print("Failed to connect to database at", DB_PARSED_URL.hostname)
+            metrics.record_connect(time.perf_counter() - start, failed=True)
+            print("Failed to connect to database at", url.hostname)
             raise
 
 
@@ -112,9 +215,12 @@ class AppCursor(AppDBConnection):
     Exiting the `with` context will commit and close the connection for you.
 
     Usage:
-        with AppCursor as cur:
+        with AppCursor() as cur:
             cur.execute('query1')
             cur.execute('query1')
+
+        with AppCursor(readonly=True) as cur:  # may use a read replica
+            cur.execute('query1')
     """
     def __init__(self, *args, **kwargs):
         super(AppCursor, self).__init__(*args, **kwargs)
@@ -0,0 +1,332 @@
+"""
+Admission control for webapp requests.
+
+Every request runs in a lane. The bulk lane holds the debug table views,
+downloads and uploads, which read or write whole tables: at most
+BULK_CONCURRENCY of them run at once, and together they hold at most
+BULK_DB_CONNECTIONS database connections. Further bulk requests wait in a
+FIFO queue of BULK_QUEUE places for up to BULK_QUEUE_TIMEOUT seconds; a
+request that finds the queue full or times out is rejected, and the webapp
+answers 503 with a Retry-After estimated from the lane's recent service
+times. The remaining worker threads and database connections stay free
+for the player lane (everything else), which is not limited, only
+measured. Keep BULK_CONCURRENCY + BULK_QUEUE well below the web server's
+worker threads, since queued requests hold one each.
+
+Connections opened through AppDBConnection while a request is in a
+limited lane take one of the lane's connection slots until teardown;
+threads outside a lane (compile workers, the CLI) are not limited.
+
+/metrics reports per lane: requests running and queued, time spent
+queued, and rejections by reason (queue_full, timeout, connections).
+
+Settings (environment variables):
+    BULK_CONCURRENCY    -- bulk requests run at once. Default: 1
+    BULK_QUEUE          -- bulk requests that may wait. Default: 2
+    BULK_QUEUE_TIMEOUT  -- seconds a bulk request may wait for its turn,
+                           or for a connection. Default: 10
+    BULK_DB_CONNECTIONS -- connections the bulk lane holds at once.
+                           Default: 2
+
+Usage:
+    admission.enter('bulk')     # raises LaneFull if rejected
+    try:
+        ...
+    finally:
+        admission.leave()
+
+    with admission.admitted('bulk'):
+        ...
+"""
+
+import collections
+import contextlib
+import math
+import os
+import threading
+import time
+
+from .metrics import Histogram, _help, _histogram, _sample
+
+BULK, PLAYER = 'bulk', 'player'
+
+DEFAULT_BULK_CONCURRENCY = 1
+DEFAULT_BULK_QUEUE = 2
+DEFAULT_BULK_QUEUE_TIMEOUT = 10.0
+DEFAULT_BULK_DB_CONNECTIONS = 2
+
+# Upper bounds (seconds) of the queue wait histogram buckets
+WAIT_BUCKETS = (0.001, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+                30.0)
+# Service time assumed before a lane has finished a request, and the weight
+# of each new one in the moving average
+INITIAL_SERVICE_SECONDS = 1.0
+SERVICE_SMOOTHING = 0.2
+MAX_RETRY_AFTER = 120
+
+_local = threading.local()
+_lanes_lock = threading.Lock()
+_lanes = None
+
+
+class LaneFull(Exception):
+    """A request or connection was not admitted to a lane.
+
+    Attributes:
+        lane -- name of the lane
+        reason -- 'queue_full', 'timeout' or 'connections'
+        retry_after -- whole seconds after which a retry may succeed
+    """
+    def __init__(self, lane, reason, retry_after):
+        self.lane = lane
+        self.reason = reason
+        self.retry_after = retry_after
+        super().__init__('The {} lane is busy ({}); retry in {} s'.format(
+            lane, reason.replace('_', ' '), retry_after))
+
+
+
+class Lane():
+    """Requests of one kind, with an optional cap on concurrency.
+
+    Args:
+        name: Label of the lane in metrics.
+
+        concurrency: Requests that run at once; None for no limit.
+
+        queue: Requests that may wait for a place.
+
+        timeout: Seconds a request may wait for a place or a connection.
+
+        connections: Connections the lane's requests hold at once; None for
+                     no limit.
+    """
+    def __init__(self, name, concurrency=None, queue=0,
+                 timeout=DEFAULT_BULK_QUEUE_TIMEOUT, connections=None):
+        self.name = name
+        self.concurrency = concurrency
+        self.queue_size = queue
+        self.timeout = timeout
+        self.connections = connections
+        self.running = 0
+        self.connections_held = 0
+        self.service_seconds = INITIAL_SERVICE_SECONDS
+        self.wait = Histogram(WAIT_BUCKETS)
+        self.rejected = collections.Counter()
+        self._queue = collections.deque()
+        self._cond = threading.Condition()
+
+
+    @property
+    def queued(self):
+        return len(self._queue)
+
+
+    def acquire(self):
+        """Waits for a place in the lane, first come first served.
+
+        Raises:
+            LaneFull if the queue is full, or no place frees up within the
+            timeout.
+        """
+        start = time.perf_counter()
+        with self._cond:
+            if not self._queue and not self._is_full():
+                self.running += 1
+                self.wait.observe(0.0)
+                return
+            if len(self._queue) >= self.queue_size:
+                raise self._reject('queue_full')
+
+            ticket = object()
+            self._queue.append(ticket)
+            deadline = start + self.timeout
+            try:
+                while self._queue[0] is not ticket or self._is_full():
+                    remaining = deadline - time.perf_counter()
+                    if remaining <= 0:
+                        raise self._reject('timeout')
+                    self._cond.wait(remaining)
+            finally:
+                self._queue.remove(ticket)
+                # The next in line may be admitted now
+                self._cond.notify_all()
+            self.running += 1
+            self.wait.observe(time.perf_counter() - start)
+
+
+    def release(self, seconds):
+        """Frees the place of a request that ran for `seconds`"""
+        with self._cond:
+            self.running -= 1
+            self.service_seconds += SERVICE_SMOOTHING * (
+                seconds - self.service_seconds)
+            self._cond.notify_all()
+
+
+    def acquire_connection(self):
+        """Waits for one of the lane's connection slots.
+
+        Raises:
+            LaneFull if none frees up within the timeout.
+        """
+        if self.connections is None:
+            return
+        deadline = time.perf_counter() + self.timeout
+        with self._cond:
+            while self.connections_held >= self.connections:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    raise self._reject('connections')
+                self._cond.wait(remaining)
+            self.connections_held += 1
+
+
+    def release_connection(self):
+        if self.connections is None:
+            return
+        with self._cond:
+            self.connections_held -= 1
+            self._cond.notify_all()
+
+
+    def retry_after(self):
+        """Seconds until the requests ahead are likely done"""
+        if self.concurrency is None:
+            return 1
+        ahead = len(self._queue) + self.running + 1 - self.concurrency
+        seconds = self.service_seconds * max(ahead, 1) / self.concurrency
+        return min(MAX_RETRY_AFTER, max(1, math.ceil(seconds)))
+
+
+    def _is_full(self):
+        return self.concurrency is not None and self.running >= self.concurrency
+
+
+    def _reject(self, reason):
+        # Called with the condition held
+        self.rejected[reason] += 1
+        return LaneFull(self.name, reason, self.retry_after())
+
+
+
+def lanes_from_environment():
+    env = os.environ
+    return {
+        BULK: Lane(
+            BULK,
+            concurrency=int(env.get('BULK_CONCURRENCY',
+                                    DEFAULT_BULK_CONCURRENCY)),
+            queue=int(env.get('BULK_QUEUE', DEFAULT_BULK_QUEUE)),
+            timeout=float(env.get('BULK_QUEUE_TIMEOUT',
+                                  DEFAULT_BULK_QUEUE_TIMEOUT)),
+            connections=int(env.get('BULK_DB_CONNECTIONS',
+                                    DEFAULT_BULK_DB_CONNECTIONS))),
+        PLAYER: Lane(PLAYER),
+    }
+
+
+def lanes():
+    """Returns {name: Lane}, reading the environment once"""
+    global _lanes
+    if _lanes is None:
+        with _lanes_lock:
+            if _lanes is None:
+                _lanes = lanes_from_environment()
+    return _lanes
+
+
+def reset_lanes(new_lanes=None):
+    """Replaces the lanes; None re-reads the environment on next use"""
+    global _lanes
+    with _lanes_lock:
+        _lanes = new_lanes
+
+
+def enter(name):
+    """Admits the current thread's request to a lane, waiting if needed.
+
+    Raises:
+        LaneFull if the request is rejected.
+    """
+    lane = lanes()[name]
+    lane.acquire()
+    _local.lane = lane
+    _local.started = time.perf_counter()
+
+
+def leave():
+    """Frees the current thread's place in its lane, if it has one"""
+    lane = getattr(_local, 'lane', None)
+    if lane is None:
+        return
+    _local.lane = None
+    lane.release(time.perf_counter() - _local.started)
+
+
+@contextlib.contextmanager
+def admitted(name):
+    """Runs the body of the `with` in a lane"""
+    enter(name)
+    try:
+        yield
+    finally:
+        leave()
+
+
+def acquire_connection():
+    """Takes a connection slot of the current thread's lane.
+
+    Returns:
+        The Lane to pass to release_connection(), or None outside a lane.
+    """
+    lane = getattr(_local, 'lane', None)
+    if lane is not None:
+        lane.acquire_connection()
+    return lane
+
+
+def release_connection(lane):
+    if lane is not None:
+        lane.release_connection()
+
+
+def render_prometheus():
+    """Renders the lanes' metrics in the Prometheus text format"""
+    lines = []
+    current = sorted(lanes().items())
+    _help(lines, 'admission_lane_running', 'gauge',
+          'Requests running in the lane')
+    for name, lane in current:
+        lines.append(_sample('admission_lane_running', lane.running,
+                             lane=name))
+
+    _help(lines, 'admission_lane_queue_depth', 'gauge',
+          'Requests waiting for a place in the lane')
+    for name, lane in current:
+        lines.append(_sample('admission_lane_queue_depth', lane.queued,
+                             lane=name))
+
+    _help(lines, 'admission_lane_db_connections', 'gauge',
+          'Database connections held by requests in the lane')
+    for name, lane in current:
+        if lane.connections is not None:
+            lines.append(_sample('admission_lane_db_connections',
+                                 lane.connections_held, lane=name))
+
+    _help(lines, 'admission_lane_wait_seconds', 'histogram',
+          'Time admitted requests waited for a place in the lane')
+    for name, lane in current:
+        with lane._cond:
+            _histogram(lines, 'admission_lane_wait_seconds', lane.wait,
+                       lane=name)
+
+    _help(lines, 'admission_lane_rejected_total', 'counter',
+          'Requests turned away by the lane, by reason')
+    for name, lane in current:
+        with lane._cond:
+            rejected = sorted(lane.rejected.items())
+        for reason, count in rejected:
+            lines.append(_sample('admission_lane_rejected_total', count,
+                                 lane=name, reason=reason))
+    return '\n'.join(lines) + '\n'
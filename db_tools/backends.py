@@ -0,0 +1,1285 @@
+"""
+Storage backends for compiled stories.
+
+The compiler and db_downup talk to a StorageBackend instead of to PostgreSQL
+directly. Two implementations are provided:
+    - PostgresBackend: the app database, through AppCursor
+    - SQLiteBackend:   an embedded sqlite3 database, for tests, dry runs and
+                       local compiles without a database server
+
+The backend is chosen from the scheme of the database URL:
+    DATABASE_URL=postgres://...          -> PostgresBackend
+    DATABASE_URL=sqlite:///story.db      -> SQLiteBackend on a relative path
+    DATABASE_URL=sqlite:////tmp/story.db -> SQLiteBackend on an absolute path
+    DATABASE_URL=sqlite://               -> SQLiteBackend in memory
+
+Queries handed to execute_statements() use psycopg2's "%s" placeholders;
+SQLiteBackend translates them.
+
+Snippets and choices belong to a story (story_id, the snip_id of the
+story's root snippet); snip_ids are looked up and allocated within one
+story. PostgresBackend keeps each story in its own partitions of the two
+tables, created by the statements from story_partition_statements(). The
+rows of all revisions of a story are kept (see db_tools.revisions); the
+compiler's lookups see a story's latest revision, on which the next one is
+based, and search sees the live revision that players are served.
+
+PostgresBackend sends the debug reads (fetch_table(), download_table(),
+search(), exports) and query(..., replica=True) to a read replica when one
+is configured; see db_tools.replicas. Everything else, including the
+compiler's snip_id lookups, uses the primary.
+
+Usage:
+    from db_tools.backends import get_backend, SQLiteBackend
+
+    backend = SQLiteBackend()     # in-memory
+    backend.init_schema()
+    backend.execute_statements(snips_parser.parse(text, backend=backend))
+"""
+
+import csv
+import gzip
+import html
+import io
+import json
+import os.path
+import re
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from . import AppCursor, AppDBConnection, basedir, db_parsed_url, replicas
+
+SQLITE_SCHEMA = os.path.join(basedir, 'schema_sqlite.sql')
+POSTGRES_SCHEMA = os.path.join(basedir, 'schema.sql')
+
+# Number of used snip_ids fetched per round trip by iter_used_snipids()
+SNIPID_PAGE_SIZE = 1000
+
+# Tables partitioned by story_id
+STORY_TABLES = ('snippets', 'choices')
+# First key of the advisory locks taken while creating a story's partitions
+# (the second is the story_id)
+PARTITION_LOCK_CLASS = 4301
+
+# Rows per batch for iter_table_batches()
+TABLE_BATCH_SIZE = 10000
+
+# SQLite type affinity -> the PostgreSQL type name table_columns() reports
+SQLITE_AFFINITY_TYPES = [
+    ('INT', 'bigint'),
+    ('CHAR', 'text'), ('CLOB', 'text'), ('TEXT', 'text'),
+    ('BLOB', 'bytea'),
+    ('REAL', 'double precision'), ('FLOA', 'double precision'),
+    ('DOUB', 'double precision'),
+]
+
+# Control characters that search excerpts mark matches with, in place of
+# HTML tags, so that the text around them can be escaped (highlight_html())
+HIGHLIGHT_START, HIGHLIGHT_STOP = '\x02', '\x03'
+PG_HIGHLIGHT_OPTIONS = 'StartSel={}, StopSel={}'.format(HIGHLIGHT_START,
+                                                        HIGHLIGHT_STOP)
+
+# Ranked search over snippet texts and choice labels, inline or in texts,
+# in each story's live revision (see db_tools/revisions.py).
+# The to_tsvector() expressions match the GIN indexes in schema.sql.
+PG_SEARCH_QUERY = """
+WITH q AS (SELECT websearch_to_tsquery('english', %(query)s) AS query),
+hits AS (
+    SELECT s.story_id, s.snip_id, ts_rank(
+               to_tsvector('english', coalesce(s.game_text, '')), q.query
+           ) AS rank
+    FROM snippets s JOIN stories st ON st.story_id = s.story_id, q
+    WHERE to_tsvector('english', coalesce(s.game_text, '')) @@ q.query
+      AND s.added_in <= st.live_revision
+      AND (s.removed_in IS NULL OR s.removed_in > st.live_revision)
+  UNION ALL
+    SELECT s.story_id, s.snip_id,
+           ts_rank(to_tsvector('english', t.body), q.query)
+    FROM texts t JOIN snippets s ON s.text_id = t.text_id
+                 JOIN stories st ON st.story_id = s.story_id, q
+    WHERE to_tsvector('english', t.body) @@ q.query
+      AND s.added_in <= st.live_revision
+      AND (s.removed_in IS NULL OR s.removed_in > st.live_revision)
+  UNION ALL
+    SELECT c.story_id, c.snip_id, ts_rank(
+               to_tsvector('english', coalesce(c.choice_label, '')), q.query)
+    FROM choices c JOIN stories st ON st.story_id = c.story_id, q
+    WHERE to_tsvector('english', coalesce(c.choice_label, '')) @@ q.query
+      AND c.added_in <= st.live_revision
+      AND (c.removed_in IS NULL OR c.removed_in > st.live_revision)
+  UNION ALL
+    SELECT c.story_id, c.snip_id,
+           ts_rank(to_tsvector('english', t.body), q.query)
+    FROM texts t JOIN choices c ON c.label_id = t.text_id
+                 JOIN stories st ON st.story_id = c.story_id, q
+    WHERE to_tsvector('english', t.body) @@ q.query
+      AND c.added_in <= st.live_revision
+      AND (c.removed_in IS NULL OR c.removed_in > st.live_revision)
+),
+ranked AS (
+    SELECT story_id, snip_id, max(rank) AS rank, count(*) OVER () AS total
+    FROM hits GROUP BY story_id, snip_id
+    ORDER BY rank DESC, story_id, snip_id
+    LIMIT %(limit)s OFFSET %(offset)s
+)
+SELECT r.story_id, r.snip_id, r.rank, r.total,
+       ts_headline('english', coalesce(s.game_text, st.body), q.query,
+                   %(highlight)s) AS headline,
+       ARRAY(
+           SELECT ts_headline('english', coalesce(c.choice_label, ct.body),
+                              q.query, %(highlight)s)
+           FROM choices c LEFT JOIN texts ct ON ct.text_id = c.label_id
+           WHERE c.story_id = r.story_id AND c.snip_id = r.snip_id
+             AND c.added_in <= live.live_revision
+             AND (c.removed_in IS NULL OR c.removed_in > live.live_revision)
+             AND to_tsvector(
+               'english', coalesce(c.choice_label, ct.body)) @@ q.query
+           ORDER BY c.choice_id
+       ) AS labels
+FROM ranked r
+JOIN stories live ON live.story_id = r.story_id
+JOIN snippets s ON s.story_id = r.story_id AND s.snip_id = r.snip_id
+               AND s.added_in <= live.live_revision
+               AND (s.removed_in IS NULL OR s.removed_in > live.live_revision)
+LEFT JOIN texts st ON st.text_id = s.text_id
+CROSS JOIN q
+ORDER BY r.rank DESC, r.story_id, r.snip_id
+"""
+
+# Primary key (first), unique and foreign key constraints of a table, with
+# their columns in constraint order
+PG_CONSTRAINTS_QUERY = """
+SELECT con.contype,
+       ARRAY(SELECT a.attname::text
+             FROM unnest(con.conkey) WITH ORDINALITY AS k(attnum, n)
+             JOIN pg_attribute a ON a.attrelid = con.conrelid
+                                AND a.attnum = k.attnum
+             ORDER BY k.n) AS cols,
+       ref.relname::text AS ref_table,
+       ARRAY(SELECT a.attname::text
+             FROM unnest(con.confkey) WITH ORDINALITY AS k(attnum, n)
+             JOIN pg_attribute a ON a.attrelid = con.confrelid
+                                AND a.attnum = k.attnum
+             ORDER BY k.n) AS ref_cols
+FROM pg_constraint con
+LEFT JOIN pg_class ref ON ref.oid = con.confrelid
+WHERE con.conrelid = to_regclass(%s) AND con.contype IN ('p', 'u', 'f')
+ORDER BY con.contype <> 'p', con.conname
+"""
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_backend():
+    """Returns the backend for the configured database URL.
+
+    The backend is created on first use and reused afterwards.
+    """
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                _backend = backend_for_url(db_parsed_url())
+    return _backend
+
+
+def set_backend(backend):
+    """Overrides the backend returned by get_backend(); None to reset."""
+    global _backend
+    with _backend_lock:
+        _backend = backend
+
+
+def backend_for_url(parsed_url):
+    """Creates a backend from a urlparse ParseResult."""
+    if parsed_url.scheme == 'sqlite':
+        # Same convention as SQLAlchemy: the path follows the third slash
+        return SQLiteBackend(parsed_url.path[1:] or ':memory:')
+    return PostgresBackend()
+
+
+def check_table_name(table_name):
+    """Raises ValueError unless table_name is a plain SQL identifier."""
+    if not re.match(r'^[A-Za-z_][A-Za-z0-9_]*$', str(table_name)):
+        raise ValueError('Invalid table name {}'.format(repr(table_name)))
+    return table_name
+
+
+def story_column(table_name, columns):
+    """Returns the index of story_id in a story table's columns, or None for
+    other tables.
+
+    Raises:
+        ValueError if a story table's columns lack story_id.
+    """
+    if table_name not in STORY_TABLES:
+        return None
+    if 'story_id' not in columns:
+        raise ValueError('Rows of {} need a story_id'.format(table_name))
+    return list(columns).index('story_id')
+
+
+def story_select(table_name, story_id=None):
+    """Returns (sql, data) selecting a table's rows, or one story's rows"""
+    check_table_name(table_name)
+    sql = "SELECT * FROM {}".format(table_name)
+    if story_id is None:
+        return sql, ()
+    if table_name not in STORY_TABLES:
+        raise ValueError('Table {} does not belong to stories'.format(
+            table_name))
+    return sql + " WHERE story_id = %s", (story_id,)
+
+
+def search_rowid(story_id, snip_id):
+    """rowid of a snippet text in SQLite's search_fts (see
+    schema_sqlite.sql)"""
+    return (story_id << 32) | (snip_id & 0xffffffff)
+
+
+def highlight_html(excerpt):
+    """HTML-escapes a search excerpt and turns the HIGHLIGHT_START/STOP
+    markers around its matches into <b></b>"""
+    return (html.escape(excerpt).replace(HIGHLIGHT_START, '<b>')
+            .replace(HIGHLIGHT_STOP, '</b>'))
+
+
+def make_placeholders_for(iterable, using='%s'):
+    return ', '.join([using] * len(iterable))
+
+
+def fts5_query(text):
+    """Turns free text into an FTS5 query matching all of its words"""
+    return ' '.join('"{}"'.format(word) for word in re.findall(r'\w+', text))
+
+
+def copy_text_value(value):
+    """Formats a value for PostgreSQL's COPY text format"""
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        value = 't' if value else 'f'
+    elif isinstance(value, (bytes, bytearray, memoryview)):
+        value = '\\x' + bytes(value).hex()
+    elif isinstance(value, (dict, list)):
+        value = json.dumps(value)
+    return (str(value).replace('\\', '\\\\').replace('\t', '\\t')
+            .replace('\n', '\\n').replace('\r', '\\r'))
+
+
+_COPY_ESCAPES = {'t': '\t', 'n': '\n', 'r': '\r'}
+
+
+def copy_text_row(line):
+    """Parses a line of PostgreSQL's COPY text format into a list of values.
+
+    Values come back as strings (or None for NULL).
+    """
+    return [None if field == '\\N' else
+            re.sub(r'\\(.)', lambda m: _COPY_ESCAPES.get(m.group(1),
+                                                        m.group(1)), field)
+            for field in line.rstrip('\n').split('\t')]
+
+
+def rows_to_csv(table_name, headers, rows, csv_joinstr='|'):
+    """Formats a table in the pipe-delimited download format."""
+    output_strs = [table_name, csv_joinstr.join(headers)]
+    for row in rows:
+        output_strs.append(csv_joinstr.join(str(cell) for cell in row))
+    return '\n'.join(output_strs)
+
+
+def read_csv_rows(csv_file):
+    """Parses a file in the rows_to_csv() format.
+
+    Returns:
+        Tuple of (headers, rows). Values are strings, with None for empty
+        cells and 'None'.
+    """
+    text = csv_file.read()
+    if isinstance(text, bytes):
+        text = text.decode('utf-8')
+    reader = csv.reader(io.StringIO(text), delimiter='|')
+    next(reader, None)  # Table name line
+    headers = next(reader)
+    rows = [[None if cell in ('', 'None') else cell for cell in row]
+            for row in reader if row]
+    for col in headers:
+        check_table_name(col)
+    return headers, rows
+
+
+
+class StorageBackend():
+    """Interface for the storage the compiler and db_downup work against.
+
+    Subclasses must implement fetch_rows_with_snipids(), iter_used_snipids(),
+    query(), execute_statements(), search(), fetch_table(), download_table(),
+    upload_table(), table_columns(), table_constraints(),
+    iter_query_batches(), load_table(),
+    table_dependencies(), dump_tables(), restore_tables(), init_schema() and
+    execute_script().
+    """
+    def fetch_rows_with_snipids(self, story_id, snip_ids):
+        """Checks for each snip_id in `snip_ids` if the story has it already
+
+        Only the story's latest revision counts.
+
+        Returns a dict of {snip_id: (row or None)}
+        """
+        raise NotImplementedError
+
+
+    def iter_used_snipids(self, story_id, startfrom):
+        """Yields the snip_ids >= startfrom of the story's latest revision,
+        in order"""
+        raise NotImplementedError
+
+
+    def find_spare_snipids(self, story_id, startfrom, needed):
+        """Provides the `needed` lowest snip_ids >= startfrom that the story
+        does not use
+
+        Walks the used snip_ids in order and collects the gaps between them,
+        so the number of round trips depends on how many used snip_ids lie
+        in the way, not on how many snip_ids are needed.
+        """
+        free_ids = []
+        candidate = startfrom
+        if needed <= 0:
+            return free_ids
+        for used in self.iter_used_snipids(story_id, startfrom):
+            while candidate < used and len(free_ids) < needed:
+                free_ids.append(candidate)
+                candidate += 1
+            if len(free_ids) == needed:
+                break
+            candidate = used + 1
+        while len(free_ids) < needed:
+            free_ids.append(candidate)
+            candidate += 1
+        return free_ids
+
+
+    def story_partition_statements(self, story_id):
+        """Returns (sql, data) pairs that prepare storage for a new story.
+
+        The compiler runs them before a story's rows are inserted. The
+        default is none, for backends that do not partition by story.
+        """
+        return []
+
+
+    def lock_table_statements(self, table_name):
+        """Returns (sql, data) pairs that keep other transactions from
+        writing to a table until the current one ends; reads go on.
+
+        The default is none, for backends whose write transactions run one
+        at a time anyway.
+        """
+        return []
+
+
+    def query(self, sql, data=(), replica=False):
+        """Runs a single read query and returns all rows.
+
+        Rows support both index and column-name access. With replica=True
+        the query may run on a read replica (see db_tools.replicas), so it
+        can miss recent writes by other threads; use it for data that a
+        player's own requests do not change.
+        """
+        raise NotImplementedError
+
+
+    def execute_statements(self, statements):
+        """Executes (sql, data) pairs in a single transaction.
+
+        Returns:
+            List of the number of rows each statement changed.
+        """
+        raise NotImplementedError
+
+
+    def search(self, query, limit=20, offset=0):
+        """Full-text search over snippet texts and choice labels of each
+        story's live revision.
+
+        Args:
+            query: Words to look for. All of them must match.
+
+            limit, offset: Page of results to return.
+
+        Returns:
+            Dict with `total` (number of matching snippets) and `results`, a
+            list of dicts with story_id, snip_id, rank (higher is better),
+            headline
+            (an excerpt of the snippet text) and labels (the matching choice
+            labels). Both are HTML: the text is escaped and matches are
+            wrapped in <b></b>.
+        """
+        raise NotImplementedError
+
+
+    def fetch_table(self, table_name):
+        """Returns a list of table headers followed by all rows"""
+        raise NotImplementedError
+
+
+    def download_table(self, table_name, csv_joinstr='|'):
+        """Returns the table as a string in the pipe-delimited CSV format"""
+        raise NotImplementedError
+
+
+    def upload_table(self, table_name, csv):
+        """Replaces the table's data with the contents of a CSV file
+
+        This replaces all revisions of story tables; db_downup.upload_table()
+        adds new revisions instead.
+        """
+        raise NotImplementedError
+
+
+    def table_columns(self, table_name):
+        """Lists (column_name, type) of the table in column order.
+
+        Types are PostgreSQL type names (e.g. 'integer', 'text', 'jsonb').
+        Returns an empty list if the table does not exist.
+        """
+        raise NotImplementedError
+
+
+    def table_constraints(self, table_name):
+        """Describes the table's NOT NULL, key and foreign key constraints.
+
+        Returns:
+            Dict of:
+                not_null -- {column_name: whether it has a default}
+                unique   -- tuples of column names of the primary key (first)
+                            and the unique constraints
+                foreign_keys -- (columns, referenced table, referenced
+                            columns) tuples
+        """
+        raise NotImplementedError
+
+
+    def iter_table_batches(self, table_name, batch_size=TABLE_BATCH_SIZE,
+                           story_id=None):
+        """Yields all rows of the table as lists of up to batch_size tuples.
+
+        Column order is that of table_columns(). With `story_id`, only that
+        story's rows of a table in STORY_TABLES are read.
+        """
+        sql, data = story_select(table_name, story_id)
+        return self.iter_query_batches(sql, data, batch_size,
+                                       'export_{}'.format(table_name))
+
+
+    def iter_query_batches(self, sql, data=(), batch_size=TABLE_BATCH_SIZE,
+                           name='stream'):
+        """Yields the rows of a read-only query as lists of up to
+        batch_size tuples, without holding the whole result in memory.
+
+        PostgresBackend reads through a server-side cursor called `name` on
+        a connection of its own, so several queries can be streamed at once.
+        """
+        raise NotImplementedError
+
+
+    def load_table(self, table_name, columns, batches):
+        """Replaces the table's data with rows from an iterable of batches.
+
+        Unlike upload_table(), the table definition (types, constraints,
+        indexes) is kept. Everything happens in one transaction. For the
+        story tables only the stories that appear in the rows are replaced
+        (with their partitions created first, on PostgreSQL); the other
+        stories are kept. This replaces all revisions of those stories;
+        columnar.import_table() adds new revisions instead.
+
+        Args:
+            table_name: Table to load into.
+
+            columns: Column names the row tuples are ordered by.
+
+            batches: Iterable of lists of row tuples.
+
+        Returns:
+            Number of rows loaded.
+
+        Raises:
+            ValueError if the rows of a story table have no story_id.
+        """
+        raise NotImplementedError
+
+
+    def table_dependencies(self):
+        """Returns {table_name: set of tables it references} for all tables"""
+        raise NotImplementedError
+
+
+    def dump_tables(self, tables, path_for, workers=1):
+        """Writes tables to gzipped COPY text files from one consistent view.
+
+        Args:
+            tables: Names of the tables to dump.
+
+            path_for: Called with a table name; returns the file path to
+                write that table to.
+
+            workers: Number of tables to dump concurrently, where supported.
+
+        Returns:
+            Dict of {table_name: dict(columns=[...], rows=n)}.
+        """
+        raise NotImplementedError
+
+
+    def restore_tables(self, levels, path_for, columns, workers=1):
+        """Replaces the data of tables with files written by dump_tables().
+
+        The restore is atomic: if it fails, the tables keep their data.
+
+        Args:
+            levels: List of lists of table names. Tables in a level only
+                reference tables in earlier levels, so a level's tables can
+                be loaded concurrently once earlier levels are done.
+
+            path_for: Called with a table name; returns the file to read.
+
+            columns: Dict of {table_name: column names in file order}.
+
+            workers: Number of tables to load concurrently, where supported.
+
+        Returns:
+            Dict of {table_name: rows loaded}.
+        """
+        raise NotImplementedError
+
+
+    def init_schema(self):
+        """(Re-)creates all tables, dropping existing data"""
+        raise NotImplementedError
+
+
+    def execute_script(self, sql):
+        """Executes a string containing several SQL statements"""
+        raise NotImplementedError
+
+
+
+class PostgresBackend(StorageBackend):
+    """Backend for the PostgreSQL app database at DATABASE_URL"""
+    def fetch_rows_with_snipids(self, story_id, snip_ids):
+        output = {snip_id: None for snip_id in snip_ids}
+        if not snip_ids:
+            return output
+
+        query = """SELECT * FROM snippets
+                   WHERE story_id = %s AND removed_in IS NULL
+                     AND snip_id IN ({})""".format(
+            make_placeholders_for(snip_ids))
+        with AppCursor() as cur:
+            cur.execute(query, [story_id] + list(snip_ids))
+            rows = cur.fetchall()
+
+        output.update({row['snip_id']: row for row in rows})
+        return output
+
+
+    def iter_used_snipids(self, story_id, startfrom):
+        query = """SELECT snip_id FROM snippets
+                   WHERE story_id = %s AND snip_id >= %s
+                     AND removed_in IS NULL
+                   ORDER BY snip_id LIMIT %s"""
+        while True:
+            with AppCursor() as cur:
+                cur.execute(query, (story_id, startfrom, SNIPID_PAGE_SIZE))
+                page = [row[0] for row in cur]
+            yield from page
+            if len(page) < SNIPID_PAGE_SIZE:
+                return
+            startfrom = page[-1] + 1
+
+
+    def lock_table_statements(self, table_name):
+        return [("LOCK TABLE {} IN SHARE ROW EXCLUSIVE MODE".format(
+            check_table_name(table_name)), ())]
+
+
+    @staticmethod
+    def partition_name(table_name, story_id):
+        return '{}_story_{}'.format(table_name, int(story_id))
+
+
+    def story_partition_statements(self, story_id):
+        """See StorageBackend.story_partition_statements().
+
+        A new story's partitions are created detached and then attached,
+        which only takes a SHARE UPDATE EXCLUSIVE lock on the parent tables,
+        so other stories keep being read and compiled meanwhile. Stories
+        that already have partitions need no statements.
+
+        The statements take a transaction-level advisory lock on the story
+        and check again for each partition before creating it, so two
+        transactions preparing the same new story don't both create it.
+        """
+        story_id = int(story_id)
+        missing = [table for table in STORY_TABLES
+                   if not self.query("SELECT to_regclass(%s) IS NOT NULL",
+                                     (self.partition_name(table, story_id),)
+                                     )[0][0]]
+        if not missing:
+            return []
+
+        statements = [("SELECT pg_advisory_xact_lock(%s, %s)",
+                       (PARTITION_LOCK_CLASS, story_id))]
+        for table in missing:
+            partition = self.partition_name(table, story_id)
+            # No "%" in here: psycopg2 formats it even without parameters
+            statements.append(("""
+                DO $$
+                BEGIN
+                    IF to_regclass('{partition}') IS NULL THEN
+                        CREATE TABLE {partition} (LIKE {table}
+                            INCLUDING DEFAULTS INCLUDING CONSTRAINTS);
+                        ALTER TABLE {table} ATTACH PARTITION {partition}
+                            FOR VALUES IN ({story_id});
+                    END IF;
+                END
+                $$""".format(partition=partition, table=table,
+                             story_id=story_id), ()))
+        return statements
+
+
+    def query(self, sql, data=(), replica=False):
+        with AppCursor(readonly=replica) as cur:
+            cur.execute(sql, data)
+            return cur.fetchall()
+
+
+    def execute_statements(self, statements):
+        replicas.note_write()
+        rowcounts = []
+        with AppCursor() as cur:
+            for sql, data in statements:
+                cur.execute(sql, data)
+                rowcounts.append(cur.rowcount)
+        return rowcounts
+
+
+    def search(self, query, limit=20, offset=0):
+        params = dict(query=query, limit=limit, offset=offset,
+                      highlight=PG_HIGHLIGHT_OPTIONS)
+        rows = self.query(PG_SEARCH_QUERY, params, replica=True)
+        if rows:
+            total = rows[0]['total']
+        elif offset:
+            # Past the last page; the window count needs at least one row
+            first = self.query(PG_SEARCH_QUERY, dict(params, limit=1,
+                                                     offset=0), replica=True)
+            total = first[0]['total'] if first else 0
+        else:
+            total = 0
+        return dict(total=total, results=[
+            dict(story_id=row['story_id'], snip_id=row['snip_id'],
+                 rank=row['rank'], headline=highlight_html(row['headline']),
+                 labels=[highlight_html(label) for label in row['labels']])
+            for row in rows])
+
+
+    def fetch_table(self, table_name):
+        check_table_name(table_name)
+        with AppCursor(readonly=True) as cur:
+            cur.execute("SELECT * FROM {}".format(table_name))
+            return [[col.name for col in cur.description]] + [row for row in cur]
+
+
+    def download_table(self, table_name, csv_joinstr='|'):
+        check_table_name(table_name)
+        sql = """SELECT * FROM {};""".format(table_name)
+        with AppCursor(readonly=True) as cur:
+            cur.execute(sql)
+            table_heads = [col.name for col in cur.description]
+            return rows_to_csv(table_name, table_heads, cur, csv_joinstr)
+
+
+    def upload_table(self, table_name, csv):
+        check_table_name(table_name)
+        # pandas and SQLAlchemy are slow to import, so only load them when a
+        # table is actually uploaded
+        from sqlalchemy import create_engine
+        import pandas as pd
+        from . import db_url
+
+        replicas.note_write()
+        #Create a connection to the database
+        engine = create_engine(db_url())
+        #Reads the csv file to a pandas dataframe
+        #Skip first 2 rows; they are table name and header row
+        csv_data = pd.read_csv(csv, delimiter='|', skiprows=1, header=0)
+
+        #Insert Dataframe to sql
+        #If table exists, drop it. Cascade option drops foreign key dependents.
+        with AppCursor() as cur:
+            cur.execute("DROP TABLE IF EXISTS {} CASCADE;".format(table_name))
+
+        #Recreate table, and insert data. Create if does not exist.
+        csv_data.to_sql(table_name, engine, index=False)
+
+
+    def table_columns(self, table_name):
+        rows = self.query("""SELECT column_name, data_type
+                             FROM information_schema.columns
+                             WHERE table_schema = current_schema()
+                               AND table_name = %s
+                             ORDER BY ordinal_position""", (table_name,),
+                          replica=True)
+        return [(row[0], row[1]) for row in rows]
+
+
+    def table_constraints(self, table_name):
+        check_table_name(table_name)
+        not_null = {row[0]: row[1] for row in self.query(
+            """SELECT column_name,
+                      column_default IS NOT NULL OR is_identity = 'YES'
+               FROM information_schema.columns
+               WHERE table_schema = current_schema() AND table_name = %s
+                 AND is_nullable = 'NO'""", (table_name,), replica=True)}
+        unique, foreign_keys = [], []
+        for row in self.query(PG_CONSTRAINTS_QUERY, (table_name,),
+                              replica=True):
+            if row['contype'] == 'f':
+                foreign_keys.append((tuple(row['cols']), row['ref_table'],
+                                     tuple(row['ref_cols'])))
+            else:
+                unique.append(tuple(row['cols']))
+        return dict(not_null=not_null, unique=unique,
+                    foreign_keys=foreign_keys)
+
+
+    def iter_query_batches(self, sql, data=(), batch_size=TABLE_BATCH_SIZE,
+                           name='stream'):
+        conn = AppDBConnection(readonly=True)
+        try:
+            cur = conn.server_cursor(name, itersize=batch_size)
+            # A story_id condition prunes the scan to the story's partition
+            cur.execute(sql, data)
+            while True:
+                rows = cur.fetchmany(batch_size)
+                if not rows:
+                    return
+                yield rows
+        finally:
+            conn.teardown()
+
+
+    def load_table(self, table_name, columns, batches):
+        check_table_name(table_name)
+        for col in columns:
+            check_table_name(col)
+        copy = "COPY {} ({}) FROM STDIN".format(table_name, ', '.join(columns))
+
+        story_col = story_column(table_name, columns)
+
+        replicas.note_write()
+        total = 0
+        with AppCursor() as cur:
+            try:
+                if story_col is None:
+                    cur.execute("DELETE FROM {}".format(table_name))
+                loaded = set()
+                for rows in batches:
+                    if story_col is not None:
+                        new = {row[story_col] for row in rows} - loaded
+                        for story_id in sorted(new):
+                            for sql, data in self.story_partition_statements(
+                                    story_id):
+                                cur.execute(sql, data)
+                        if new:
+                            cur.execute("DELETE FROM {} WHERE story_id = "
+                                        "ANY(%s)".format(table_name),
+                                        (sorted(new),))
+                        loaded |= new
+                    buf = io.StringIO()
+                    for row in rows:
+                        buf.write('\t'.join(copy_text_value(v) for v in row))
+                        buf.write('\n')
+                    buf.seek(0)
+                    cur.copy_expert(copy, buf)
+                    total += len(rows)
+
+                self._reset_sequences(cur, table_name, columns)
+            except BaseException:
+                # AppCursor commits on exit; don't keep a partial load
+                cur.connection.rollback()
+                raise
+        return total
+
+
+    @staticmethod
+    def _reset_sequences(cur, table_name, columns):
+        """Moves serial sequences past ids that were loaded explicitly"""
+        for col in columns:
+            cur.execute("SELECT pg_get_serial_sequence(%s, %s)",
+                        (table_name, col))
+            sequence = cur.fetchone()[0]
+            if sequence:
+                cur.execute("""SELECT setval(%s, coalesce(max({}), 0) + 1, false)
+                               FROM {}""".format(col, table_name), (sequence,))
+
+
+    def table_dependencies(self):
+        # Partitions are dumped and restored through their parent table
+        tables = self.query("""SELECT c.relname FROM pg_class c
+                               JOIN pg_namespace n ON n.oid = c.relnamespace
+                               WHERE n.nspname = current_schema()
+                                 AND c.relkind IN ('r', 'p')
+                                 AND NOT c.relispartition""")
+        output = {row[0]: set() for row in tables}
+        references = self.query("""
+            SELECT tc.table_name, ccu.table_name AS parent
+            FROM information_schema.table_constraints tc
+            JOIN information_schema.constraint_column_usage ccu
+              ON ccu.constraint_name = tc.constraint_name
+             AND ccu.constraint_schema = tc.constraint_schema
+            WHERE tc.constraint_type = 'FOREIGN KEY'
+              AND tc.table_schema = current_schema()""")
+        for row in references:
+            if row[0] in output:
+                output[row[0]].add(row[1])
+        return output
+
+
+    def dump_tables(self, tables, path_for, workers=4):
+        """See StorageBackend.dump_tables().
+
+        One REPEATABLE READ transaction exports its snapshot with
+        pg_export_snapshot(); each worker connection imports it with SET
+        TRANSACTION SNAPSHOT, so all tables are read as of the same moment.
+        """
+        columns = {}
+        for table in tables:
+            columns[check_table_name(table)] = [
+                col for col, _ in self.table_columns(table)]
+
+        coordinator = AppDBConnection()
+        try:
+            coordinator.connection.set_session(
+                isolation_level='REPEATABLE READ', readonly=True)
+            cur = coordinator.cursor
+            cur.execute("SELECT pg_export_snapshot()")
+            snapshot_id = cur.fetchone()[0]
+
+            def dump(table):
+                conn = AppDBConnection()
+                try:
+                    conn.connection.set_session(
+                        isolation_level='REPEATABLE READ', readonly=True)
+                    cur = conn.cursor
+                    cur.execute("SET TRANSACTION SNAPSHOT %s", (snapshot_id,))
+                    with gzip.open(path_for(table), 'wt',
+                                   encoding='utf-8') as f:
+                        # COPY ... TO cannot read partitioned tables directly
+                        cur.copy_expert("COPY (SELECT {} FROM {}) TO STDOUT"
+                                        .format(', '.join(columns[table]),
+                                                table), f)
+                    return cur.rowcount
+                finally:
+                    conn.teardown()
+
+            # The coordinator's transaction must stay open until every
+            # worker has imported the snapshot
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                counts = dict(zip(tables, pool.map(dump, tables)))
+        finally:
+            coordinator.teardown()
+        return {table: dict(columns=columns[table], rows=counts[table])
+                for table in tables}
+
+
+    def restore_tables(self, levels, path_for, columns, workers=4):
+        """See StorageBackend.restore_tables().
+
+        Everything happens in one transaction on one connection, so a
+        failed restore leaves the tables as they were: all tables are
+        emptied with one TRUNCATE, partitions are created for the stories
+        in the snippets file, and the tables are loaded level by level with
+        COPY, with constraints deferred to commit. `workers` is ignored.
+        The TRUNCATE locks the tables until the restore commits.
+        """
+        tables = [table for level in levels for table in level]
+        for table in tables:
+            check_table_name(table)
+            for col in columns[table]:
+                check_table_name(col)
+        story_ids = set()
+        if 'snippets' in tables:
+            story_col = columns['snippets'].index('story_id')
+            with gzip.open(path_for('snippets'), 'rt', encoding='utf-8') as f:
+                story_ids = {int(copy_text_row(line)[story_col])
+                             for line in f}
+
+        replicas.note_write()
+        counts = {}
+        with AppCursor() as cur:
+            try:
+                cur.execute("SET CONSTRAINTS ALL DEFERRED")
+                cur.execute("TRUNCATE {}".format(', '.join(tables)))
+                for story_id in sorted(story_ids):
+                    for sql, data in self.story_partition_statements(
+                            story_id):
+                        cur.execute(sql, data)
+                for table in tables:
+                    with gzip.open(path_for(table), 'rt',
+                                   encoding='utf-8') as f:
+                        cur.copy_expert("COPY {} ({}) FROM STDIN".format(
+                            table, ', '.join(columns[table])), f)
+                    counts[table] = cur.rowcount
+                    self._reset_sequences(cur, table, columns[table])
+            except BaseException:
+                # AppCursor commits on exit; don't keep a partial restore
+                cur.connection.rollback()
+                raise
+        return counts
+
+
+    def init_schema(self):
+        with open(POSTGRES_SCHEMA, encoding='utf-8') as f:
+            self.execute_script(f.read())
+
+
+    def execute_script(self, sql):
+        replicas.note_write()
+        with AppCursor() as cur:
+            cur.execute(sql)
+
+
+
+class SQLiteBackend(StorageBackend):
+    """Embedded backend storing the story in a sqlite3 database.
+
+    Args:
+        path: Path to the database file, or ':memory:' for an in-memory
+              database that lives as long as this object.
+              Default: ':memory:'
+    """
+    def __init__(self, path=':memory:'):
+        self.path = path
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+
+
+    @staticmethod
+    def translate(sql):
+        """Converts psycopg2 "%s" placeholders to sqlite3 "?" placeholders"""
+        return sql.replace('%s', '?')
+
+
+    def _query(self, sql, data=()):
+        with self._lock:
+            return self._conn.execute(self.translate(sql), data).fetchall()
+
+
+    def fetch_rows_with_snipids(self, story_id, snip_ids):
+        output = {snip_id: None for snip_id in snip_ids}
+        if not snip_ids:
+            return output
+
+        query = """SELECT * FROM snippets
+                   WHERE story_id = %s AND removed_in IS NULL
+                     AND snip_id IN ({})""".format(
+            make_placeholders_for(snip_ids))
+        output.update({row['snip_id']: row for row in
+                       self._query(query, [story_id] + list(snip_ids))})
+        return output
+
+
+    def iter_used_snipids(self, story_id, startfrom):
+        query = """SELECT snip_id FROM snippets
+                   WHERE story_id = %s AND snip_id >= %s
+                     AND removed_in IS NULL
+                   ORDER BY snip_id LIMIT %s"""
+        while True:
+            page = [row[0] for row in self._query(
+                query, (story_id, startfrom, SNIPID_PAGE_SIZE))]
+            yield from page
+            if len(page) < SNIPID_PAGE_SIZE:
+                return
+            startfrom = page[-1] + 1
+
+
+    def query(self, sql, data=(), replica=False):
+        return self._query(sql, data)
+
+
+    def execute_statements(self, statements):
+        rowcounts = []
+        with self._lock, self._conn:
+            for sql, data in statements:
+                rowcounts.append(
+                    self._conn.execute(self.translate(sql), data).rowcount)
+        return rowcounts
+
+
+    def search(self, query, limit=20, offset=0):
+        match = fts5_query(query)
+        if not match:
+            return dict(total=0, results=[])
+        total = self._query("""SELECT count(*) FROM (
+                                   SELECT DISTINCT story_id, snip_id
+                                   FROM search_fts WHERE search_fts MATCH ?)
+                            """, (match,))[0][0]
+        # bm25 ranks are negative; lower is better
+        page = self._query("""SELECT story_id, snip_id, min(rank) AS rank
+                              FROM search_fts WHERE search_fts MATCH ?
+                              GROUP BY story_id, snip_id
+                              ORDER BY rank, story_id, snip_id
+                              LIMIT ? OFFSET ?""", (match, limit, offset))
+        if not page:
+            return dict(total=total, results=[])
+
+        results = {(row['story_id'], row['snip_id']): dict(
+                       story_id=row['story_id'], snip_id=row['snip_id'],
+                       rank=-row['rank'], headline=None, labels=[])
+                   for row in page}
+        # Highlights only for the rows on this page
+        matches = self._query("""
+            SELECT rowid, story_id, snip_id,
+                   snippet(search_fts, 0, ?, ?, '...', 32) AS excerpt
+            FROM search_fts WHERE search_fts MATCH ?
+              AND (story_id, snip_id) IN (VALUES {})
+            ORDER BY rowid DESC""".format(
+                make_placeholders_for(results, '(?, ?)')),
+            [HIGHLIGHT_START, HIGHLIGHT_STOP, match] +
+            [v for key in results for v in key])
+        for row in matches:
+            result = results[(row['story_id'], row['snip_id'])]
+            # Labels have negative rowids
+            if row['rowid'] >= 0:
+                result['headline'] = highlight_html(row['excerpt'])
+            else:
+                result['labels'].append(highlight_html(row['excerpt']))
+        for result in results.values():
+            if result['headline'] is None:
+                # Matched on labels only
+                result['headline'] = highlight_html(self._query(
+                    """SELECT body FROM search_fts WHERE rowid = ?""",
+                    (search_rowid(result['story_id'],
+                                  result['snip_id']),))[0]['body'])
+        return dict(total=total, results=[
+            results[(row['story_id'], row['snip_id'])] for row in page])
+
+
+    def fetch_table(self, table_name):
+        check_table_name(table_name)
+        with self._lock:
+            cur = self._conn.execute("SELECT * FROM {}".format(table_name))
+            return ([[col[0] for col in cur.description]] +
+                    [list(row) for row in cur])
+
+
+    def download_table(self, table_name, csv_joinstr='|'):
+        table = self.fetch_table(table_name)
+        return rows_to_csv(table_name, table[0], table[1:], csv_joinstr)
+
+
+    def upload_table(self, table_name, csv_file):
+        check_table_name(table_name)
+        headers, rows = read_csv_rows(csv_file)
+        insert = 'INSERT INTO {}({}) VALUES ({})'.format(
+            table_name, ', '.join(headers), make_placeholders_for(headers, '?'))
+        with self._lock, self._conn:
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS {} ({})'.format(
+                    table_name, ', '.join(headers)))
+            self._conn.execute('DELETE FROM {}'.format(table_name))
+            self._conn.executemany(insert, rows)
+
+
+    @staticmethod
+    def affinity_type(declared):
+        """Maps a declared SQLite column type to a PostgreSQL type name"""
+        upper = declared.upper()
+        for fragment, pg_type in SQLITE_AFFINITY_TYPES:
+            if fragment in upper:
+                return pg_type
+        return declared.lower() or 'text'
+
+
+    def table_columns(self, table_name):
+        check_table_name(table_name)
+        rows = self._query("PRAGMA table_info({})".format(table_name))
+        return [(row['name'], self.affinity_type(row['type'])) for row in rows]
+
+
+    def table_constraints(self, table_name):
+        check_table_name(table_name)
+        columns = self._query("PRAGMA table_info({})".format(table_name))
+        # An "integer PRIMARY KEY" is the rowid, which NULL inserts assign
+        not_null = {row['name']: row['dflt_value'] is not None
+                    for row in columns if row['notnull']}
+        primary_key = tuple(row['name'] for row in
+                            sorted(columns, key=lambda row: row['pk'])
+                            if row['pk'])
+        unique = [primary_key] if primary_key else []
+        for index in self._query("PRAGMA index_list({})".format(table_name)):
+            if index['unique'] and index['origin'] == 'u':
+                unique.append(tuple(row['name'] for row in self._query(
+                    'PRAGMA index_info("{}")'.format(index['name']))))
+
+        references = {}
+        for row in self._query("PRAGMA foreign_key_list({})".format(
+                table_name)):
+            references.setdefault(row['id'], []).append(row)
+        foreign_keys = []
+        for _, rows in sorted(references.items()):
+            rows.sort(key=lambda row: row['seq'])
+            ref_table = rows[0]['table']
+            ref_cols = tuple(row['to'] for row in rows)
+            if None in ref_cols:
+                # REFERENCES without columns: the referenced primary key
+                ref_cols = self.table_constraints(ref_table)['unique'][0]
+            foreign_keys.append((tuple(row['from'] for row in rows),
+                                 ref_table, ref_cols))
+        return dict(not_null=not_null, unique=unique,
+                    foreign_keys=foreign_keys)
+
+
+    def iter_query_batches(self, sql, data=(), batch_size=TABLE_BATCH_SIZE,
+                           name='stream'):
+        with self._lock:
+            cur = self._conn.execute(self.translate(sql), data)
+        while True:
+            with self._lock:
+                rows = cur.fetchmany(batch_size)
+            if not rows:
+                return
+            yield [tuple(row) for row in rows]
+
+
+    def load_table(self, table_name, columns, batches):
+        check_table_name(table_name)
+        for col in columns:
+            check_table_name(col)
+        insert = 'INSERT INTO {}({}) VALUES ({})'.format(
+            table_name, ', '.join(columns), make_placeholders_for(columns, '?'))
+
+        story_col = story_column(table_name, columns)
+
+        total = 0
+        with self._lock, self._conn:
+            if story_col is None:
+                self._conn.execute("DELETE FROM {}".format(table_name))
+            loaded = set()
+            for rows in batches:
+                if story_col is not None:
+                    new = sorted({row[story_col] for row in rows} - loaded)
+                    self._conn.executemany(
+                        "DELETE FROM {} WHERE story_id = ?".format(table_name),
+                        [(story_id,) for story_id in new])
+                    loaded.update(new)
+                self._conn.executemany(insert, rows)
+                total += len(rows)
+        return total
+
+
+    def table_dependencies(self):
+        tables = self._query("""SELECT name, sql FROM sqlite_master
+                                WHERE type = 'table'
+                                  AND name NOT LIKE 'sqlite_%'""")
+        virtual = [row['name'] for row in tables
+                   if row['sql'].upper().startswith('CREATE VIRTUAL')]
+        output = {}
+        for row in tables:
+            name = row['name']
+            # Virtual tables (full-text search) and their shadow tables are
+            # rebuilt by triggers
+            if any(name == v or name.startswith(v + '_') for v in virtual):
+                continue
+            output[name] = {fk['table'] for fk in self._query(
+                "PRAGMA foreign_key_list({})".format(check_table_name(name)))}
+        return output
+
+
+    def dump_tables(self, tables, path_for, workers=1):
+        """See StorageBackend.dump_tables(). Reads all tables in one
+        transaction on the backend's connection; `workers` is ignored.
+        """
+        output = {}
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                for table in tables:
+                    columns = [col for col, _ in self.table_columns(table)]
+                    cur = self._conn.execute("SELECT {} FROM {}".format(
+                        ', '.join(columns), check_table_name(table)))
+                    rows = 0
+                    with gzip.open(path_for(table), 'wt',
+                                   encoding='utf-8') as f:
+                        for row in cur:
+                            f.write('\t'.join(copy_text_value(v) for v in row))
+                            f.write('\n')
+                            rows += 1
+                    output[table] = dict(columns=columns, rows=rows)
+            finally:
+                self._conn.rollback()
+        return output
+
+
+    def restore_tables(self, levels, path_for, columns, workers=1):
+        """See StorageBackend.restore_tables(). Restores in one transaction
+        with foreign key checks deferred, so a failed restore leaves the
+        tables as they were; `workers` is ignored.
+        """
+        tables = [table for level in levels for table in level]
+        binary = {}
+        for table in tables:
+            types = dict(self.table_columns(table))
+            binary[table] = [i for i, col in enumerate(columns[table])
+                             if types.get(col) == 'bytea']
+        counts = {}
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.execute("PRAGMA defer_foreign_keys = ON")
+                for table in reversed(tables):
+                    self._conn.execute("DELETE FROM {}".format(
+                        check_table_name(table)))
+                for table in tables:
+                    for col in columns[table]:
+                        check_table_name(col)
+                    insert = 'INSERT INTO {}({}) VALUES ({})'.format(
+                        table, ', '.join(columns[table]),
+                        make_placeholders_for(columns[table], '?'))
+                    with gzip.open(path_for(table), 'rt',
+                                   encoding='utf-8') as f:
+                        rows = [copy_text_row(line) for line in f]
+                    for row in rows:
+                        # bytea is hex-encoded ("\\x...") in the COPY format
+                        for i in binary[table]:
+                            if row[i] is not None:
+                                row[i] = bytes.fromhex(row[i][2:])
+                    self._conn.executemany(insert, rows)
+                    counts[table] = len(rows)
+            except BaseException:
+                self._conn.rollback()
+                raise
+            self._conn.commit()
+        return counts
+
+
+    def init_schema(self):
+        with open(SQLITE_SCHEMA, encoding='utf-8') as f:
+            self.execute_script(f.read())
+
+
+    def execute_script(self, sql):
+        with self._lock:
+            self._conn.executescript(sql)
+
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,310 @@
+"""
+Parquet and Arrow export/import of database tables.
+
+An alternative to the pipe-delimited CSV of db_downup that keeps column
+types, NULLs and any text (including "|" and newlines) intact. Rows are
+streamed from the backend in batches (a server-side cursor on PostgreSQL)
+and written as one record batch / row group each, so tables of any size are
+exported in bounded memory. Imports read the file batch by batch straight
+into the backend's bulk loader (COPY on PostgreSQL) and keep the table's
+definition, unlike upload_table() which recreates the table from the CSV.
+Imports of snippets or choices add story revisions instead (see
+db_tools/revisions.py). Files are validated like CSV uploads before
+anything is loaded (see validate_file() and db_tools/validation.py).
+
+Column types come from the database schema (see TYPE_MAP); json/jsonb
+values are exported as JSON strings.
+
+Needs the optional pyarrow package.
+
+Formats:
+    parquet -- Apache Parquet file (*.parquet)
+    arrow   -- Arrow IPC file, aka Feather v2 (*.arrow, *.feather)
+
+Usage:
+    $ python -m db_tools.columnar export snippets snippets.parquet
+    $ python -m db_tools.columnar export choices story.parquet --story 123
+    $ python -m db_tools.columnar import snippets snippets.parquet
+
+    from db_tools import columnar
+    columnar.export_table('snippets', 'snippets.parquet')
+    columnar.import_table('snippets', 'snippets.parquet')
+"""
+
+import argparse
+import json
+import os.path
+import sys
+
+from . import revisions, validation
+from .backends import (STORY_TABLES, TABLE_BATCH_SIZE, check_table_name,
+                       get_backend)
+
+FORMATS = ('parquet', 'arrow')
+EXTENSIONS = {
+    '.parquet': 'parquet',
+    '.arrow': 'arrow',
+    '.feather': 'arrow',
+}
+
+# PostgreSQL type name -> name of the pyarrow type factory. Types not listed
+# here are exported as strings.
+TYPE_MAP = {
+    'smallint': 'int16',
+    'integer': 'int32',
+    'bigint': 'int64',
+    'real': 'float32',
+    'double precision': 'float64',
+    'boolean': 'bool_',
+    'bytea': 'binary',
+    'date': 'date32',
+    'text': 'string',
+    'character varying': 'string',
+    'json': 'string',
+    'jsonb': 'string',
+}
+
+
+def _pyarrow():
+    # pyarrow is optional and slow to import; only load it when needed
+    try:
+        import pyarrow
+        import pyarrow.compute
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError('Parquet/Arrow export needs the pyarrow package '
+                          '(pip install pyarrow)')
+    return pyarrow
+
+
+def format_for_path(path, fmt=None):
+    """Returns `fmt`, or the format implied by the file extension of `path`"""
+    if fmt is None:
+        fmt = EXTENSIONS.get(os.path.splitext(str(path))[1].lower())
+    if fmt not in FORMATS:
+        raise ValueError('Unknown columnar format {} (expected one of '
+                         '{})'.format(repr(fmt), ', '.join(FORMATS)))
+    return fmt
+
+
+def arrow_type(sql_type):
+    """Maps a PostgreSQL type name to a pyarrow DataType"""
+    pa = _pyarrow()
+    if sql_type.startswith('timestamp'):
+        if 'with time zone' in sql_type:
+            return pa.timestamp('us', tz='UTC')
+        return pa.timestamp('us')
+    return getattr(pa, TYPE_MAP.get(sql_type, 'string'))()
+
+
+def table_schema(columns):
+    """Builds a pyarrow Schema from backend.table_columns() output"""
+    pa = _pyarrow()
+    return pa.schema([pa.field(name, arrow_type(sql_type))
+                      for name, sql_type in columns])
+
+
+def _to_arrow_value(value, is_string):
+    if value is None or not is_string or isinstance(value, str):
+        return value
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+    return str(value)
+
+
+def rows_to_batch(rows, schema):
+    """Converts a list of row tuples into a pyarrow RecordBatch"""
+    pa = _pyarrow()
+    columns = list(zip(*rows)) if rows else [()] * len(schema)
+    arrays = []
+    for field, values in zip(schema, columns):
+        is_string = pa.types.is_string(field.type)
+        is_binary = pa.types.is_binary(field.type)
+        if is_string or is_binary:
+            values = [bytes(v) if is_binary and isinstance(v, memoryview)
+                      else _to_arrow_value(v, is_string) for v in values]
+        arrays.append(pa.array(values, type=field.type))
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def export_table(table_name, path, fmt=None, batch_size=TABLE_BATCH_SIZE,
+                 backend=None, story_id=None):
+    """Writes a table to a Parquet or Arrow file.
+
+    Args:
+        table_name: Table to export.
+
+        path: Output file path or writable binary file object.
+
+        fmt: 'parquet' or 'arrow'. Default: from the extension of `path`.
+
+        batch_size: Rows per record batch (and Parquet row group).
+
+        backend: StorageBackend to read from. Default: get_backend()
+
+        story_id: Only export this story's rows (snippets and choices only).
+
+    Returns:
+        Number of rows written.
+    """
+    pa = _pyarrow()
+    fmt = format_for_path(path, fmt)
+    backend = backend or get_backend()
+    columns = backend.table_columns(check_table_name(table_name))
+    if not columns:
+        raise ValueError('No table named {}'.format(repr(table_name)))
+
+    schema = table_schema(columns)
+    if fmt == 'parquet':
+        writer = pa.parquet.ParquetWriter(path, schema)
+        write = lambda batch: writer.write_table(
+            pa.Table.from_batches([batch]))
+    else:
+        writer = pa.ipc.new_file(path, schema)
+        write = writer.write_batch
+
+    total = 0
+    try:
+        for rows in backend.iter_table_batches(table_name, batch_size,
+                                               story_id):
+            write(rows_to_batch(rows, schema))
+            total += len(rows)
+    finally:
+        writer.close()
+    return total
+
+
+def iter_file_batches(path, fmt=None, batch_size=TABLE_BATCH_SIZE):
+    """Yields the pyarrow RecordBatches of a Parquet or Arrow file"""
+    pa = _pyarrow()
+    fmt = format_for_path(path, fmt)
+    if fmt == 'parquet':
+        yield from pa.parquet.ParquetFile(path).iter_batches(batch_size)
+    else:
+        reader = pa.ipc.open_file(path)
+        for i in range(reader.num_record_batches):
+            yield reader.get_batch(i)
+
+
+def _batch_rows(batch):
+    return list(zip(*[column.to_pylist() for column in batch.columns]))
+
+
+def batch_frame(batch):
+    """Converts a RecordBatch into a DataFrame of strings and NAs, the
+    form validation.validate_batches() checks"""
+    import pandas as pd
+    pa = _pyarrow()
+    columns = {}
+    for name, column in zip(batch.schema.names, batch.columns):
+        # Binary values are not checked and need not be valid UTF-8
+        if not pa.types.is_binary(column.type):
+            column = pa.compute.cast(column, pa.string())
+        columns[name] = column.to_pandas()
+    return pd.DataFrame(columns, columns=batch.schema.names)
+
+
+def validate_file(table_name, path, fmt=None, batch_size=TABLE_BATCH_SIZE,
+                  backend=None):
+    """Checks a Parquet or Arrow file like a CSV upload.
+
+    Returns:
+        List of violation dicts; see validation.validate_upload().
+    """
+    pa = _pyarrow()
+    fmt = format_for_path(path, fmt)
+    if fmt == 'parquet':
+        headers = pa.parquet.ParquetFile(path).schema_arrow.names
+    else:
+        headers = pa.ipc.open_file(path).schema.names
+    batches = (batch_frame(batch)
+               for batch in iter_file_batches(path, fmt, batch_size))
+    return validation.validate_batches(table_name, headers, batches, backend)
+
+
+def import_table(table_name, path, fmt=None, batch_size=TABLE_BATCH_SIZE,
+                 backend=None, validate=True):
+    """Replaces a table's data with the rows of a Parquet or Arrow file.
+
+    The file's columns must all exist in the table; table columns missing
+    from the file get their defaults. Files of snippets or choices add a
+    live revision to each story they contain, like a CSV upload (see
+    revisions.rows_statements()), so they are read into memory whole.
+
+    Args:
+        validate: Whether to check the file first (see validate_file()),
+            which reads it twice.
+
+        See export_table() for the others; `path` may also be a readable,
+        seekable binary file.
+
+    Returns:
+        Number of rows loaded.
+
+    Raises:
+        validation.UploadValidationError listing every problem found, in
+        which case nothing is changed.
+    """
+    fmt = format_for_path(path, fmt)
+    backend = backend or get_backend()
+    if validate:
+        violations = validate_file(table_name, path, fmt, batch_size,
+                                   backend)
+        if violations:
+            raise validation.UploadValidationError(table_name, violations)
+        if hasattr(path, 'seek'):
+            path.seek(0)
+    table_cols = [name for name, _ in
+                  backend.table_columns(check_table_name(table_name))]
+    if not table_cols:
+        raise ValueError('No table named {}'.format(repr(table_name)))
+
+    batches = iter_file_batches(path, fmt, batch_size)
+    first = next(batches, None)
+    if first is None:
+        return backend.load_table(table_name, table_cols, [])
+    columns = first.schema.names
+    unknown = [name for name in columns if name not in table_cols]
+    if unknown:
+        raise ValueError('Table {} has no column(s) {}'.format(
+            table_name, ', '.join(unknown)))
+
+    def rows():
+        yield _batch_rows(first)
+        for batch in batches:
+            yield _batch_rows(batch)
+    if table_name in STORY_TABLES:
+        story_rows = [row for batch in rows() for row in batch]
+        statements, _ = revisions.rows_statements(table_name, columns,
+                                                  story_rows, backend)
+        backend.execute_statements(statements)
+        return len(story_rows)
+    return backend.load_table(table_name, columns, rows())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m db_tools.columnar',
+        description='Exports/imports tables as Parquet or Arrow files.')
+    parser.add_argument('action', choices=['export', 'import'])
+    parser.add_argument('table')
+    parser.add_argument('path')
+    parser.add_argument('--format', choices=FORMATS, default=None,
+                        help='default: from the file extension')
+    parser.add_argument('--batch-size', type=int, default=TABLE_BATCH_SIZE)
+    parser.add_argument('--story', type=int, default=None,
+                        help='export only this story_id (snippets, choices)')
+    args = parser.parse_args(argv)
+
+    if args.action == 'export':
+        rows = export_table(args.table, args.path, args.format,
+                            args.batch_size, story_id=args.story)
+    else:
+        rows = import_table(args.table, args.path, args.format,
+                            args.batch_size)
+    print('{}ed {} rows'.format(args.action, rows), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
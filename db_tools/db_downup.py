@@ -1,6 +1,7 @@
-from . import AppCursor, DB_URL
-from sqlalchemy import create_engine
-import pandas as pd
+import io
+
+from . import revisions, validation
+from .backends import STORY_TABLES, get_backend
 
 
 def fetch_table(table_name):
@@ -12,9 +13,7 @@ def fetch_table(table_name):
     Returns:
         List of table headers and rows extracted from DictResult.
     """
-    with AppCursor() as cur:
-        cur.execute("SELECT * FROM {}".format(table_name))
-        return [[col.name for col in cur.description]] + [row for row in cur]
+    return get_backend().fetch_table(table_name)
 
 
 def download_table(table_name, csv_joinstr='|'):
@@ -30,34 +29,19 @@ def download_table(table_name, csv_joinstr='|'):
         String ready to be dumped into a CSV file.
         First line of string contains table headers.
     """
-    #Create a list to store table values, including table name and headers
-    #table name
-    output_strs = [table_name]
-
-    #Query DB for selected table via cursor
-    sql = """SELECT * FROM {};""".format(table_name)
-    with AppCursor() as cur:
-        cur.execute(sql)
-    
-        #table headers
-        table_heads = [col.name for col in cur.description]
-        output_strs.append(
-            csv_joinstr.join(table_heads)
-        )
-
-        #table data
-        for row in cur:
-            output_strs.append(
-                csv_joinstr.join(str(cell) for cell in row)
-            )
-
-    #returns the output string list joined by \n
-    return '\n'.join(output_strs)
+    return get_backend().download_table(table_name, csv_joinstr)
     #.js will package to a csv file and push to client (To be done)
 
 
 def upload_table(table_name, csv):
     """Uploads a CSV file into the given table, replacing existing data.
+
+    Uploading snippets or choices keeps the existing rows: each story in
+    the file gets a new revision holding the uploaded rows, which goes live
+    (see revisions.upload_statements()).
+
+    The file is validated against the schema and the tables it references
+    first (see validation.py); nothing is changed if it has problems.
     
     Args:
         table_name: String identifying the table to overwrite.
@@ -66,20 +50,17 @@ def upload_table(table_name, csv):
 
     Returns:
         None
-    """
-    #Create a connection to the database
-    engine = create_engine(DB_URL)
-    #Reads the csv file to a pandas dataframe
-    #Skip first 2 rows; they are table name and header row
-    csv_data = pd.read_csv(csv, delimiter='|', skiprows=1, header=0)
-    
-    #Insert Dataframe to sql
-    #If table exists, drop it. Cascade option drops foreign key dependents.
-    with AppCursor() as cur:
-        cur.execute("DROP TABLE IF EXISTS {} CASCADE;".format(table_name))
 
-    #Recreate table, and insert data. Create if does not exist.
-    csv_data.to_sql(table_name, engine, index=False)
+    Raises:
+        validation.UploadValidationError listing every problem found.
+    """
+    backend = get_backend()
+    text = validation.read_text(csv)
+    validation.check_upload(table_name, text, backend)
+    csv = io.StringIO(text)
+    if table_name in STORY_TABLES:
+        statements, _ = revisions.upload_statements(table_name, csv, backend)
+        backend.execute_statements(statements)
+        return
+    backend.upload_table(table_name, csv)
     return
-
-
@@ -9,21 +9,22 @@ Contains debugging functions:
 """
 
 import os.path
-from . import AppCursor
+from .backends import get_backend
 
 basedir = os.path.abspath(os.path.dirname(__file__))
 
 def exec_file_to_db(abs_filepath):
     with open(abs_filepath, encoding='utf-8') as f:
         content = f.read()
-    with AppCursor() as cur:
-        cur.execute(content)
+    get_backend().execute_script(content)
 
 
 def init_db():
-    abspath = os.path.join(basedir, 'schema.sql')
-    exec_file_to_db(abspath)
+    get_backend().init_schema()
 
 def load_sample():
+    # The sample story (story_id 1) needs its partitions first
+    backend = get_backend()
+    backend.execute_statements(backend.story_partition_statements(1))
     abspath = os.path.join(basedir, 'sample.sql')
     exec_file_to_db(abspath)
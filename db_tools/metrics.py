@@ -0,0 +1,300 @@
+"""
+Query instrumentation for db_tools.
+
+Every cursor handed out by AppDBConnection is an InstrumentedDictCursor, which
+records per-statement-template latency histograms, row counts and errors.
+Connection setup and teardown times are recorded as well. Statements slower
+than a threshold are logged, optionally together with their EXPLAIN plan.
+
+Statements are grouped by their "source", a label describing what issued
+them (e.g. the Flask endpoint or the compiler step). Set it with:
+
+    with metrics.source('compiler.assign_ids'):
+        ...
+
+Settings (environment variables):
+    DB_SLOW_QUERY_MS      -- log statements slower than this many
+                             milliseconds. Default: 500. Set to 0 to disable.
+    DB_SLOW_QUERY_EXPLAIN -- set to 1 to also log the EXPLAIN plan of slow
+                             statements. Default: 0
+
+Exports:
+  Classes:
+    - InstrumentedDictCursor: DictCursor that records statement metrics
+    - Histogram: cumulative-bucket latency histogram
+  Functions:
+    - source(): context manager labelling statements issued inside it
+    - set_source(): sets the label for the current thread
+    - normalize_statement(): reduces a query to its statement template
+    - render_prometheus(): all metrics in Prometheus text format
+    - reset(): clears all recorded metrics
+"""
+
+import contextlib
+import logging
+import os
+import re
+import threading
+import time
+
+from psycopg2.extras import DictCursor
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds (seconds) of the latency histogram buckets
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+           2.5, 5.0, 10.0)
+
+SLOW_QUERY_MS = float(os.environ.get('DB_SLOW_QUERY_MS', 500))
+SLOW_QUERY_EXPLAIN = os.environ.get('DB_SLOW_QUERY_EXPLAIN', '0') == '1'
+
+MAX_TEMPLATE_LENGTH = 200
+NO_SOURCE = 'none'
+
+_EXPLAINABLE = ('select', 'insert', 'update', 'delete', 'with')
+
+_local = threading.local()
+_lock = threading.Lock()
+
+
+class Histogram():
+    """Cumulative histogram with fixed bucket upper bounds"""
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+
+    def cumulative(self):
+        """Yields (upper bound, cumulative count), ending with +Inf"""
+        total = 0
+        for bound, n in zip(self.buckets, self.counts):
+            total += n
+            yield bound, total
+        yield float('inf'), self.count
+
+
+
+class StatementStats():
+    """Metrics recorded for one (source, statement template) pair"""
+    def __init__(self):
+        self.latency = Histogram()
+        self.rows = 0
+        self.errors = 0
+
+
+
+class _Registry():
+    def __init__(self):
+        self.statements = {}
+        self.connect = Histogram()
+        self.teardown = Histogram()
+        self.connect_errors = 0
+
+
+_registry = _Registry()
+
+
+def reset():
+    """Clears all recorded metrics"""
+    global _registry
+    with _lock:
+        _registry = _Registry()
+
+
+def set_source(name):
+    """Sets the source label for statements issued by this thread"""
+    _local.source = name or NO_SOURCE
+
+
+def current_source():
+    return getattr(_local, 'source', NO_SOURCE)
+
+
+@contextlib.contextmanager
+def source(name):
+    """Labels statements issued inside the context with `name`"""
+    previous = current_source()
+    set_source(name)
+    try:
+        yield
+    finally:
+        set_source(previous)
+
+
+def normalize_statement(sql):
+    """Reduces a query to a template shared by all queries of its shape.
+
+    Collapses whitespace, placeholder lists and literals so that e.g.
+    "... IN (%s, %s, %s)" and "... IN (%s, %s)" are counted together.
+    """
+    if isinstance(sql, bytes):
+        sql = sql.decode('utf-8', 'replace')
+    sql = str(sql)
+    sql = re.sub(r'\s+', ' ', sql).strip()
+    sql = re.sub(r"'(?:[^']|'')*'", '?', sql)
+    sql = re.sub(r'\b\d+(?:\.\d+)?\b', '?', sql)
+    sql = re.sub(r'(?:%s|\?)(?:\s*,\s*(?:%s|\?))+', '...', sql)
+    sql = re.sub(r'\([^()]*\)(?:\s*,\s*\([^()]*\))+', '(...), ...', sql)
+    if len(sql) > MAX_TEMPLATE_LENGTH:
+        sql = sql[:MAX_TEMPLATE_LENGTH - 3] + '...'
+    return sql
+
+
+def record_statement(template, seconds, rows, failed=False):
+    key = (current_source(), template)
+    with _lock:
+        stats = _registry.statements.get(key)
+        if stats is None:
+            stats = _registry.statements[key] = StatementStats()
+        stats.latency.observe(seconds)
+        if failed:
+            stats.errors += 1
+        elif rows and rows > 0:
+            stats.rows += rows
+
+
+def record_connect(seconds, failed=False):
+    with _lock:
+        if failed:
+            _registry.connect_errors += 1
+        else:
+            _registry.connect.observe(seconds)
+
+
+def record_teardown(seconds):
+    with _lock:
+        _registry.teardown.observe(seconds)
+
+
+
+class InstrumentedDictCursor(DictCursor):
+    """DictCursor that records the latency and row count of each statement"""
+    def execute(self, query, vars=None):
+        return self._timed(super(InstrumentedDictCursor, self).execute,
+                           query, vars)
+
+
+    def executemany(self, query, vars_list):
+        return self._timed(super(InstrumentedDictCursor, self).executemany,
+                           query, vars_list, explain=False)
+
+
+    def _timed(self, method, query, vars, explain=True):
+        start = time.perf_counter()
+        try:
+            result = method(query, vars)
+        except Exception:
+            record_statement(normalize_statement(query),
+                             time.perf_counter() - start, 0, failed=True)
+            raise
+        seconds = time.perf_counter() - start
+        record_statement(normalize_statement(query), seconds, self.rowcount)
+
+        if SLOW_QUERY_MS and seconds * 1000 >= SLOW_QUERY_MS:
+            self._log_slow(query, vars, seconds, explain)
+        return result
+
+
+    def _log_slow(self, query, vars, seconds, explain):
+        plan = ''
+        if (explain and SLOW_QUERY_EXPLAIN and
+            str(query).lstrip().lower().startswith(_EXPLAINABLE)
+        ):
+            plan = '\n' + explain_plan(self.connection, query, vars)
+        logger.warning('Slow query (%.1f ms, source %s): %s%s',
+                       seconds * 1000, current_source(),
+                       normalize_statement(query), plan)
+
+
+
+def explain_plan(conn, query, vars=None):
+    """Returns the EXPLAIN output of `query` as a string.
+
+    Runs on a plain cursor so that the EXPLAIN is not itself recorded.
+    """
+    try:
+        with conn.cursor() as cur:
+            cur.execute('EXPLAIN ' + str(query), vars)
+            return '\n'.join(row[0] for row in cur.fetchall())
+    except Exception as e:
+        return '(EXPLAIN failed: {})'.format(e)
+
+
+def render_prometheus():
+    """Renders all metrics in the Prometheus text exposition format"""
+    with _lock:
+        statements = sorted(_registry.statements.items())
+        connect = _registry.connect
+        teardown = _registry.teardown
+        connect_errors = _registry.connect_errors
+
+        lines = []
+        _help(lines, 'db_query_duration_seconds', 'histogram',
+              'Latency of statements executed through AppCursor')
+        for (src, template), stats in statements:
+            _histogram(lines, 'db_query_duration_seconds', stats.latency,
+                       source=src, statement=template)
+
+        _help(lines, 'db_query_rows_total', 'counter',
+              'Rows returned or affected by statements')
+        for (src, template), stats in statements:
+            lines.append(_sample('db_query_rows_total', stats.rows,
+                                 source=src, statement=template))
+
+        _help(lines, 'db_query_errors_total', 'counter',
+              'Statements that raised an error')
+        for (src, template), stats in statements:
+            lines.append(_sample('db_query_errors_total', stats.errors,
+                                 source=src, statement=template))
+
+        _help(lines, 'db_connect_duration_seconds', 'histogram',
+              'Time taken to open a database connection')
+        _histogram(lines, 'db_connect_duration_seconds', connect)
+
+        _help(lines, 'db_connect_errors_total', 'counter',
+              'Failed attempts to open a database connection')
+        lines.append(_sample('db_connect_errors_total', connect_errors))
+
+        _help(lines, 'db_teardown_duration_seconds', 'histogram',
+              'Time taken to commit and close a database connection')
+        _histogram(lines, 'db_teardown_duration_seconds', teardown)
+
+    return '\n'.join(lines) + '\n'
+
+
+def _help(lines, name, kind, text):
+    lines.append('# HELP {} {}'.format(name, text))
+    lines.append('# TYPE {} {}'.format(name, kind))
+
+
+def _histogram(lines, name, hist, **labels):
+    for bound, count in hist.cumulative():
+        le = '+Inf' if bound == float('inf') else repr(bound)
+        lines.append(_sample(name + '_bucket', count, le=le, **labels))
+    lines.append(_sample(name + '_sum', hist.sum, **labels))
+    lines.append(_sample(name + '_count', hist.count, **labels))
+
+
+def _sample(name, value, **labels):
+    if labels:
+        name += '{' + ','.join(
+            '{}="{}"'.format(k, _escape(v)) for k, v in sorted(labels.items())
+        ) + '}'
+    return '{} {}'.format(name, value)
+
+
+def _escape(value):
+    return (str(value).replace('\\', r'\\')
+                      .replace('"', r'\"')
+                      .replace('\n', r'\n'))
@@ -0,0 +1,192 @@
+"""
+Read replicas and read/write routing for db_tools.
+
+Connections opened with AppDBConnection(readonly=True) go to a streaming
+replica of the app database if one is configured and caught up, and to the
+primary (DATABASE_URL) otherwise. Writes, compiles and anything not marked
+read-only always use the primary.
+
+Reads see the caller's own writes: once a thread has written through a
+storage backend (see note_write()), its reads go to the primary until
+begin_request() is called, which the webapp does at the start of every
+request. Command line tools never call it, so after their first write they
+stay on the primary.
+
+Replication lag guard: each replica's lag is measured on the connection
+being handed out, at most every REPLICA_LAG_CHECK seconds. A replica that
+is more than REPLICA_MAX_LAG seconds behind, or cannot be reached, is
+skipped until its next check; if no replica is usable, reads fall back to
+the primary.
+
+Settings (environment variables):
+    DATABASE_REPLICA_URLS -- comma-separated postgres:// URLs of replicas.
+                             Default: none (everything uses the primary)
+    REPLICA_MAX_LAG       -- seconds. Default: 5
+    REPLICA_LAG_CHECK     -- seconds between lag checks. Default: 1
+
+Usage:
+    with AppCursor(readonly=True) as cur:   # replica if usable
+        cur.execute('SELECT ...')
+
+    replicas.begin_request()                # new read-your-writes scope
+"""
+
+import itertools
+import logging
+import os
+import threading
+import time
+from urllib import parse
+
+logger = logging.getLogger(__name__)
+
+REPLICA_ENVVAR = 'DATABASE_REPLICA_URLS'
+DEFAULT_MAX_LAG = 5.0
+DEFAULT_LAG_CHECK = 1.0
+
+# Seconds the replica is behind the primary. A replica that is streaming
+# and has replayed everything it received counts as current even if the
+# primary has been idle. One whose WAL receiver is not streaming (e.g. cut
+# off from the primary) is only as current as its last replayed
+# transaction; NULL (never replayed anything) counts as unusable. The
+# receiver's status is only visible to roles with pg_read_all_stats;
+# without it, every replica is judged by its last replayed transaction.
+LAG_QUERY = """SELECT CASE
+    WHEN NOT pg_is_in_recovery() THEN 0
+    WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn()
+         AND EXISTS (SELECT 1 FROM pg_stat_wal_receiver
+                     WHERE status = 'streaming') THEN 0
+    ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+END AS lag"""
+
+_local = threading.local()
+_config_lock = threading.Lock()
+_replicas = None
+
+
+class ReplicaState():
+    """A replica's URL and what its last lag check found"""
+    def __init__(self, url, max_lag=DEFAULT_MAX_LAG,
+                 check_interval=DEFAULT_LAG_CHECK):
+        self.url = url
+        self.parsed_url = parse.urlparse(url)
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.lag = None
+        self.checked_at = None
+
+
+    @property
+    def usable(self):
+        return self.lag is not None and self.lag <= self.max_lag
+
+
+    def check_due(self, now=None):
+        if self.checked_at is None:
+            return True
+        now = time.monotonic() if now is None else now
+        return now - self.checked_at >= self.check_interval
+
+
+    def record(self, lag, now=None):
+        """Stores a lag measurement; None means the check failed"""
+        was_usable = self.usable
+        self.lag = None if lag is None else float(lag)
+        self.checked_at = time.monotonic() if now is None else now
+        if was_usable and not self.usable:
+            logger.warning("Replica %s skipped (lag: %s, max: %s)",
+                           self.parsed_url.hostname, self.lag, self.max_lag)
+        elif self.usable and not was_usable:
+            logger.info("Replica %s in use (lag: %s)",
+                        self.parsed_url.hostname, self.lag)
+
+
+    def __repr__(self):
+        return '<ReplicaState {} lag={}>'.format(self.parsed_url.hostname,
+                                                 self.lag)
+
+
+
+def replicas():
+    """Returns the configured ReplicaStates, reading the environment once"""
+    global _replicas
+    if _replicas is None:
+        with _config_lock:
+            if _replicas is None:
+                urls = [u.strip() for u in
+                        os.environ.get(REPLICA_ENVVAR, '').split(',')
+                        if u.strip()]
+                max_lag = float(os.environ.get('REPLICA_MAX_LAG',
+                                               DEFAULT_MAX_LAG))
+                interval = float(os.environ.get('REPLICA_LAG_CHECK',
+                                                DEFAULT_LAG_CHECK))
+                _replicas = [ReplicaState(url, max_lag, interval)
+                             for url in urls]
+    return _replicas
+
+
+def reset_config(states=None):
+    """Forgets the configured replicas, or replaces them with `states`"""
+    global _replicas
+    with _config_lock:
+        _replicas = states
+
+
+def begin_request():
+    """Starts a new read-your-writes scope for the current thread"""
+    _local.wrote = False
+
+
+def note_write():
+    """Sends the current thread's reads to the primary until begin_request()"""
+    _local.wrote = True
+
+
+def reads_use_primary():
+    return getattr(_local, 'wrote', False)
+
+
+# Turns of connect_replica(); next() on a count is atomic
+_turns = itertools.count(1)
+
+
+def connect_replica(connect):
+    """Opens a connection to a usable replica, checking lag when due.
+
+    Replicas are tried round-robin.
+
+    Args:
+        connect: Called with a urlparse ParseResult; returns a new psycopg2
+            connection or raises.
+
+    Returns:
+        Tuple of (connection, ReplicaState), or (None, None) if the read
+        should go to the primary.
+    """
+    states = replicas()
+    if not states or reads_use_primary():
+        return None, None
+    start = next(_turns) % len(states)
+    for state in states[start:] + states[:start]:
+        due = state.check_due()
+        if not state.usable and not due:
+            continue
+        try:
+            conn = connect(state.parsed_url)
+        except Exception:
+            state.record(None)
+            continue
+        if due:
+            try:
+                cur = conn.cursor()
+                cur.execute(LAG_QUERY)
+                state.record(cur.fetchone()[0])
+                cur.close()
+                # Don't hold the check's transaction open on the replica
+                conn.rollback()
+            except Exception:
+                state.record(None)
+        if state.usable:
+            return conn, state
+        conn.close()
+    return None, None
@@ -0,0 +1,291 @@
+"""
+Sampling profiler for webapp requests.
+
+A sampled request is profiled by a background thread that records the
+request thread's Python stack every PROFILE_INTERVAL_MS, so the request
+itself runs at full speed; nothing is traced. A request is sampled with
+probability PROFILE_SAMPLE_RATE, or always if it carries the PROFILE_HEADER
+header set to PROFILE_TOKEN. With sampling off, a request costs a header
+lookup and a comparison.
+
+Finished profiles are kept in memory: the PROFILE_KEEP slowest per route,
+so a burst of fast requests never pushes out the slow ones worth looking
+at. The webapp serves them from /debug/profiles, which needs the token
+(header or ?token=) and is disabled if PROFILE_TOKEN is not set. Profiles
+come as JSON, or with ?format=folded as folded stacks ("a;b;c 12" per
+line), the input of flamegraph.pl and speedscope.
+
+Settings (environment variables):
+    PROFILE_SAMPLE_RATE -- fraction of requests to profile, 0 to 1.
+                           Default: 0
+    PROFILE_TOKEN       -- secret for the header and the endpoint.
+                           Default: none (header and endpoint disabled)
+    PROFILE_HEADER      -- request header that forces profiling.
+                           Default: X-Profile
+    PROFILE_INTERVAL_MS -- milliseconds between samples. Default: 5
+    PROFILE_KEEP        -- profiles kept per route. Default: 10
+
+Usage:
+    request_profiler.begin_request(request.endpoint, request.method,
+                                   request.path, request.headers)
+    ...
+    request_profiler.end_request()
+
+    request_profiler.profiles(route='api_game')   # slowest first
+    request_profiler.folded(profiles)             # flamegraph input
+"""
+
+import heapq
+import hmac
+import itertools
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+
+DEFAULT_HEADER = 'X-Profile'
+DEFAULT_INTERVAL_MS = 5.0
+DEFAULT_KEEP = 10
+# Bounds on memory for long requests and for unexpected routes
+MAX_SAMPLES = 20000
+MAX_ROUTES = 200
+NO_ROUTE = '<none>'
+
+_local = threading.local()
+_config_lock = threading.Lock()
+_config = None
+
+
+class ProfilerConfig():
+    """Settings read from the environment"""
+    def __init__(self, sample_rate=0.0, token=None, header=DEFAULT_HEADER,
+                 interval=DEFAULT_INTERVAL_MS / 1000, keep=DEFAULT_KEEP):
+        self.sample_rate = sample_rate
+        self.token = token or None
+        self.header = header
+        self.interval = interval
+        self.keep = keep
+        self.sampler = Sampler(interval)
+        self.store = ProfileStore(keep)
+
+
+    @classmethod
+    def from_environment(cls):
+        return cls(
+            sample_rate=float(os.environ.get('PROFILE_SAMPLE_RATE', 0)),
+            token=os.environ.get('PROFILE_TOKEN'),
+            header=os.environ.get('PROFILE_HEADER', DEFAULT_HEADER),
+            interval=float(os.environ.get('PROFILE_INTERVAL_MS',
+                                          DEFAULT_INTERVAL_MS)) / 1000,
+            keep=int(os.environ.get('PROFILE_KEEP', DEFAULT_KEEP)))
+
+
+    @property
+    def enabled(self):
+        return self.sample_rate > 0 or self.token is not None
+
+
+    def check_token(self, value):
+        """Whether `value` is the configured token"""
+        return (self.token is not None and value is not None and
+                hmac.compare_digest(value.encode('utf-8'),
+                                    self.token.encode('utf-8')))
+
+
+
+class RequestProfile():
+    """Stack samples taken while one request was handled.
+
+    Attributes:
+        samples -- Counter of {stack: count}, each stack a tuple of frame
+                   names from the outermost call in.
+    """
+    def __init__(self, route, method, path):
+        self.route = route
+        self.method = method
+        self.path = path
+        self.started_at = time.time()
+        self.seconds = None
+        self.samples = Counter()
+        self.sample_count = 0
+        self._start = time.perf_counter()
+
+
+    def add_sample(self, frame):
+        if self.sample_count >= MAX_SAMPLES:
+            return
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append('{} ({}:{})'.format(code.co_name, code.co_filename,
+                                             code.co_firstlineno))
+            frame = frame.f_back
+        stack.reverse()
+        self.samples[tuple(stack)] += 1
+        self.sample_count += 1
+
+
+    def finish(self):
+        self.seconds = time.perf_counter() - self._start
+
+
+    def as_dict(self):
+        return dict(route=self.route, method=self.method, path=self.path,
+                    started_at=self.started_at, seconds=self.seconds,
+                    sample_count=self.sample_count,
+                    stacks=[dict(stack=list(stack), count=n)
+                            for stack, n in self.samples.most_common()])
+
+
+
+class Sampler():
+    """Background thread sampling the stacks of registered threads.
+
+    The thread runs only while at least one profile is active.
+    """
+    def __init__(self, interval):
+        self.interval = interval
+        self._active = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+
+    def add(self, thread_id, profile):
+        with self._lock:
+            self._active[thread_id] = profile
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name='request-profiler', daemon=True)
+                self._thread.start()
+
+
+    def remove(self, thread_id):
+        with self._lock:
+            self._active.pop(thread_id, None)
+
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                if not self._active:
+                    self._thread = None
+                    return
+                active = list(self._active.items())
+            frames = sys._current_frames()
+            for thread_id, profile in active:
+                frame = frames.get(thread_id)
+                if frame is not None:
+                    profile.add_sample(frame)
+
+
+
+class ProfileStore():
+    """The `keep` slowest finished profiles of each route"""
+    def __init__(self, keep=DEFAULT_KEEP):
+        self.keep = keep
+        self._routes = {}
+        self._lock = threading.Lock()
+        self._order = itertools.count()
+
+
+    def add(self, profile):
+        # Min-heaps of (seconds, insertion order, profile)
+        entry = (profile.seconds, next(self._order), profile)
+        with self._lock:
+            heap = self._routes.get(profile.route)
+            if heap is None:
+                if len(self._routes) >= MAX_ROUTES:
+                    return
+                heap = self._routes[profile.route] = []
+            if len(heap) < self.keep:
+                heapq.heappush(heap, entry)
+            else:
+                heapq.heappushpop(heap, entry)
+
+
+    def profiles(self, route=None):
+        """Returns the kept profiles, of one route or all, slowest first"""
+        with self._lock:
+            if route is None:
+                entries = [e for heap in self._routes.values() for e in heap]
+            else:
+                entries = list(self._routes.get(route, ()))
+        return [profile for _, _, profile in sorted(entries, reverse=True)]
+
+
+    def clear(self):
+        with self._lock:
+            self._routes = {}
+
+
+
+def config():
+    """Returns the ProfilerConfig, reading the environment once"""
+    global _config
+    if _config is None:
+        with _config_lock:
+            if _config is None:
+                _config = ProfilerConfig.from_environment()
+    return _config
+
+
+def reset_config(new_config=None):
+    """Replaces the configuration; None re-reads the environment on next use"""
+    global _config
+    with _config_lock:
+        _config = new_config
+
+
+def should_profile(headers):
+    """Whether to profile a request with the given headers"""
+    conf = config()
+    if not conf.enabled:
+        return False
+    if conf.token is not None and conf.check_token(headers.get(conf.header)):
+        return True
+    return conf.sample_rate > 0 and random.random() < conf.sample_rate
+
+
+def begin_request(route, method, path, headers):
+    """Starts profiling the current thread's request if it is sampled"""
+    _local.profile = None
+    if not should_profile(headers):
+        return
+    profile = RequestProfile(route or NO_ROUTE, method, path)
+    _local.profile = profile
+    config().sampler.add(threading.get_ident(), profile)
+
+
+def end_request():
+    """Stops profiling the current thread's request and keeps the profile.
+
+    Returns:
+        The RequestProfile, or None if the request was not sampled.
+    """
+    profile = getattr(_local, 'profile', None)
+    if profile is None:
+        return None
+    _local.profile = None
+    conf = config()
+    conf.sampler.remove(threading.get_ident())
+    profile.finish()
+    conf.store.add(profile)
+    return profile
+
+
+def profiles(route=None):
+    """Returns the kept RequestProfiles, slowest first"""
+    return config().store.profiles(route)
+
+
+def folded(profiles):
+    """Merges profiles into folded stack lines, rooted at their route"""
+    stacks = Counter()
+    for profile in profiles:
+        for stack, n in profile.samples.items():
+            stacks[(profile.route,) + stack] += n
+    return ''.join('{} {}\n'.format(';'.join(stack), n)
+                   for stack, n in sorted(stacks.items()))
@@ -0,0 +1,291 @@
+"""
+Copy-on-write story revisions.
+
+Compiling a story, or uploading one of the story tables, creates a new
+revision of each story it touches instead of replacing rows. Rows of
+snippets and choices record the revision they were added in (added_in) and
+the first revision they are no longer part of (removed_in; NULL while they
+are part of the latest revision, the head). A new revision only writes the
+rows that differ from the head and shares all others with earlier
+revisions, and rows are never deleted, so every revision can still be read.
+
+A snippet row is replaced when its text changes. A snippet's choices are
+replaced as a group when any of them changes, so that choice_id order stays
+the order the choices were compiled in.
+
+The stories table points at the revision of each story that players are
+served, its live revision. Creating a revision makes it live; going back to
+an earlier one, e.g. to roll back a bad deploy, is a single UPDATE of the
+pointer and leaves all rows alone. The player-side queries read the pointer
+with the snippet row and return it as the snippet's `revision` (see
+snips_api/runtime.py), so caches can key on (story_id, revision, snip_id).
+
+Revisions are numbered from 1 within each story, and a new revision is
+always based on the head, even while an older revision is live. Two
+revisions of the same story created at the same time conflict on the
+primary key of story_revisions, and the second transaction fails.
+
+Usage:
+    statements, revision = revision_statements(
+        story_id, snippets={snip_id: row}, choices={snip_id: [rows]})
+    get_backend().execute_statements(statements)
+
+    set_live_revision(123, 2)   # serve revision 2 of story 123 again
+
+    $ python -m db_tools.revisions list 123
+    $ python -m db_tools.revisions live 123 2
+"""
+
+import argparse
+import sys
+
+from .backends import (STORY_TABLES, get_backend, make_placeholders_for,
+                       read_csv_rows)
+
+# Columns that make up a snippet's and a choice's content
+SNIPPET_COLUMNS = ('game_text', 'text_id')
+CHOICE_COLUMNS = ('choice_label', 'label_id', 'next_snip_id',
+                  'mod_flg_1', 'mod_flg_2', 'mod_flg_3',
+                  'check_flg_1', 'check_flg_2', 'check_flg_3')
+# Columns of uploaded CSV files that hold integers
+INT_COLUMNS = ('story_id', 'snip_id', 'text_id', 'label_id', 'next_snip_id')
+
+# Rows per INSERT statement
+INSERT_BATCH_SIZE = 500
+
+HEAD_REVISION_QUERY = """SELECT max(revision) FROM story_revisions
+                         WHERE story_id = %s"""
+LIVE_REVISION_QUERY = """SELECT live_revision FROM stories
+                         WHERE story_id = %s"""
+REVISIONS_QUERY = """SELECT r.revision, r.created_at, r.source,
+                            r.revision = s.live_revision AS live
+                     FROM story_revisions r
+                     LEFT JOIN stories s ON s.story_id = r.story_id
+                     WHERE r.story_id = %s ORDER BY r.revision"""
+HEAD_SNIPPETS_QUERY = """SELECT snip_id, game_text, text_id FROM snippets
+                         WHERE story_id = %s AND removed_in IS NULL"""
+HEAD_CHOICES_QUERY = """SELECT snip_id, {} FROM choices
+                        WHERE story_id = %s AND removed_in IS NULL
+                        ORDER BY snip_id, choice_id""".format(
+    ', '.join(CHOICE_COLUMNS))
+# Statements that compiles emit are kept on one line each
+INSERT_REVISION_QUERY = ("""INSERT INTO story_revisions(story_id, revision, """
+                         """source) VALUES (%s, %s, %s)""")
+SET_LIVE_QUERY = ("""INSERT INTO stories(story_id, live_revision) """
+                  """VALUES (%s, %s) ON CONFLICT (story_id) """
+                  """DO UPDATE SET live_revision = excluded.live_revision""")
+
+
+def head_revision(story_id, backend=None):
+    """Returns the story's latest revision, or 0 if it has none"""
+    backend = get_backend() if backend is None else backend
+    return backend.query(HEAD_REVISION_QUERY, (story_id,))[0][0] or 0
+
+
+def live_revision(story_id, backend=None):
+    """Returns the revision of the story that players are served, or None"""
+    backend = get_backend() if backend is None else backend
+    rows = backend.query(LIVE_REVISION_QUERY, (story_id,))
+    return rows[0][0] if rows else None
+
+
+def list_revisions(story_id, backend=None):
+    """Returns dicts of revision, created_at, source and live, oldest first"""
+    backend = get_backend() if backend is None else backend
+    return [dict(revision=row['revision'], created_at=row['created_at'],
+                 source=row['source'], live=bool(row['live']))
+            for row in backend.query(REVISIONS_QUERY, (story_id,))]
+
+
+def set_live_revision(story_id, revision, backend=None):
+    """Points the story at one of its revisions.
+
+    Raises:
+        ValueError if the story has no such revision.
+    """
+    backend = get_backend() if backend is None else backend
+    if not 0 < revision <= head_revision(story_id, backend):
+        raise ValueError('Story {} has no revision {}'.format(story_id,
+                                                               revision))
+    backend.execute_statements([(SET_LIVE_QUERY, (story_id, revision))])
+
+
+def revision_statements(story_id, snippets=None, choices=None, backend=None,
+                        source='compile'):
+    """Compiles the statements that create and go live with a new revision.
+
+    Args:
+        story_id: Story to add a revision to.
+
+        snippets: All snippets of the new revision, as {snip_id: mapping of
+            SNIPPET_COLUMNS}; missing columns are NULL. None keeps the
+            head's snippets.
+
+        choices: All choices of the new revision, as {snip_id: list of
+            mappings of CHOICE_COLUMNS in choice order}. None keeps the
+            head's choices.
+
+        backend: Storage backend to read the head from. Defaults to the
+            configured backend.
+
+        source: What created the revision, e.g. 'compile' or 'upload'.
+
+    Returns:
+        Tuple of (list of (sql, data), new revision number).
+    """
+    backend = get_backend() if backend is None else backend
+    revision = head_revision(story_id, backend) + 1
+    statements = [(INSERT_REVISION_QUERY, [story_id, revision, source])]
+
+    if snippets is not None:
+        head = {row['snip_id']: [row_values(row, SNIPPET_COLUMNS)]
+                for row in backend.query(HEAD_SNIPPETS_QUERY, (story_id,))}
+        new = {snip_id: [row_values(row, SNIPPET_COLUMNS)]
+               for snip_id, row in snippets.items()}
+        statements.extend(diff_statements('snippets', SNIPPET_COLUMNS,
+                                          story_id, revision, head, new))
+
+    if choices is not None:
+        head = {}
+        for row in backend.query(HEAD_CHOICES_QUERY, (story_id,)):
+            head.setdefault(row['snip_id'], []).append(
+                row_values(row, CHOICE_COLUMNS))
+        new = {snip_id: [row_values(row, CHOICE_COLUMNS) for row in rows]
+               for snip_id, rows in choices.items() if rows}
+        statements.extend(diff_statements('choices', CHOICE_COLUMNS,
+                                          story_id, revision, head, new))
+
+    statements.append((SET_LIVE_QUERY, [story_id, revision]))
+    return statements, revision
+
+
+def row_values(row, columns):
+    """Returns a row's values for `columns` as a tuple, None if missing"""
+    return tuple(row[col] if col in row.keys() else None for col in columns)
+
+
+def diff_statements(table_name, columns, story_id, revision, head, new):
+    """Closes the head's changed row groups and inserts their replacements.
+
+    `head` and `new` map snip_ids to lists of value tuples for `columns`. A
+    snip_id's rows are replaced unless its list is unchanged, and closed if
+    it is not in `new`.
+    """
+    changed = sorted(snip_id for snip_id, group in new.items()
+                     if head.get(snip_id) != group)
+    closed = sorted(set(changed).intersection(head)
+                    .union(set(head).difference(new)))
+
+    statements = []
+    if closed:
+        statements.append((
+            ("""UPDATE {} SET removed_in = %s WHERE story_id = %s """
+             """AND removed_in IS NULL AND snip_id IN ({})""").format(
+                table_name, make_placeholders_for(closed)),
+            [revision, story_id] + closed))
+
+    rows = [(story_id, snip_id) + values + (revision,)
+            for snip_id in changed for values in new[snip_id]]
+    cols = ('story_id', 'snip_id') + tuple(columns) + ('added_in',)
+    row_placeholders = '({})'.format(make_placeholders_for(cols))
+    for start in range(0, len(rows), INSERT_BATCH_SIZE):
+        batch = rows[start:start + INSERT_BATCH_SIZE]
+        statements.append((
+            """INSERT INTO {}({}) VALUES {}""".format(
+                table_name, ', '.join(cols),
+                make_placeholders_for(batch, row_placeholders)),
+            [value for row in batch for value in row]))
+    return statements
+
+
+def upload_statements(table_name, csv_file, backend=None):
+    """Compiles a new revision of each story in an uploaded story table.
+
+    The file is in the download format (see backends.rows_to_csv()) and
+    holds the new rows of every story it mentions; the stories' other
+    table is kept. Rows marked as removed (removed_in set) are skipped, so
+    a downloaded table uploads as the head of each story.
+
+    Returns:
+        Tuple of (list of (sql, data), {story_id: new revision}).
+    """
+    headers, rows = read_csv_rows(csv_file)
+    return rows_statements(table_name, headers, rows, backend)
+
+
+def rows_statements(table_name, headers, rows, backend=None):
+    """Compiles a new revision of each story in rows of a story table.
+
+    Like upload_statements(), for rows that are already parsed, e.g. the
+    record batches of a columnar import.
+
+    Args:
+        table_name: 'snippets' or 'choices'.
+
+        headers: Column names of the rows.
+
+        rows: Sequences of values in `headers` order, each story's choices
+            in choice order.
+
+        backend: Storage backend to read the heads from.
+
+    Returns:
+        Tuple of (list of (sql, data), {story_id: new revision}).
+    """
+    if table_name not in STORY_TABLES:
+        raise ValueError('Table {} does not belong to stories'.format(
+            table_name))
+    for col in ('story_id', 'snip_id'):
+        if col not in headers:
+            raise ValueError('Uploaded {} has no {} column'.format(
+                table_name, col))
+
+    stories = {}
+    for values in rows:
+        row = dict(zip(headers, values))
+        if row.get('removed_in') is not None:
+            continue
+        for col in INT_COLUMNS:
+            if row.get(col) is not None:
+                row[col] = int(row[col])
+        story = stories.setdefault(row['story_id'], {})
+        if table_name == 'snippets':
+            story[row['snip_id']] = row
+        else:
+            story.setdefault(row['snip_id'], []).append(row)
+
+    statements, revisions = [], {}
+    for story_id, story_rows in sorted(stories.items()):
+        kwargs = {table_name: story_rows}
+        story_statements, revisions[story_id] = revision_statements(
+            story_id, backend=backend, source='upload', **kwargs)
+        statements.extend(story_statements)
+    return statements, revisions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m db_tools.revisions',
+        description='Lists story revisions or switches the live one.')
+    parser.add_argument('action', choices=['list', 'live'])
+    parser.add_argument('story_id', type=int)
+    parser.add_argument('revision', type=int, nargs='?',
+                        help='revision to serve (live)')
+    args = parser.parse_args(argv)
+
+    if args.action == 'list':
+        for rev in list_revisions(args.story_id):
+            print('{}{:>6}  {}  {}'.format('*' if rev['live'] else ' ',
+                                           rev['revision'], rev['created_at'],
+                                           rev['source']))
+    elif args.revision is None:
+        parser.error('live needs a revision')
+    else:
+        set_live_revision(args.story_id, args.revision)
+        print('Story {} is live at revision {}'.format(args.story_id,
+                                                       args.revision),
+              file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -9,40 +9,45 @@ VALUES
 
 
 
+-- The sample story's root is snippet 1, so its story_id is 1. Its rows
+-- are all in revision 1 (the default of added_in), which is live.
+INSERT INTO story_revisions(story_id, revision, source) VALUES (1, 1, 'sample');
+INSERT INTO stories(story_id, live_revision) VALUES (1, 1);
+
 INSERT INTO
-    snippets(snip_id, game_text)
+    snippets(story_id, snip_id, game_text)
 VALUES
-    (1, 'I looked at the tablet Dr. Hanson had given to me. It contained a list of patients I was tasked with checking on.'),
-    (2, '“John Doe. Ward 1A. Admitted on {date} {time}. Severe diarrhea and vomiting. Follow up required”  The details of my first patient was displayed on the screen next to a picture of a plump young man.'),
-    (3, 'I walked up to the first bed in the ward and drew the curtains. I almost thought I had the wrong person until I noticed the nameplate behind the bedrest. The illness has certainly taken a toll on John.'),
-    (4, 'John stares at you, his eyes seemingly lifeless.'),
-    (5, '"Not too good, doctor. Not too good."'),
-    (6, '"What?"'),
-    (7, '"..."');
+    (1, 1, 'I looked at the tablet Dr. Hanson had given to me. It contained a list of patients I was tasked with checking on.'),
+    (1, 2, '“John Doe. Ward 1A. Admitted on {date} {time}. Severe diarrhea and vomiting. Follow up required”  The details of my first patient was displayed on the screen next to a picture of a plump young man.'),
+    (1, 3, 'I walked up to the first bed in the ward and drew the curtains. I almost thought I had the wrong person until I noticed the nameplate behind the bedrest. The illness has certainly taken a toll on John.'),
+    (1, 4, 'John stares at you, his eyes seemingly lifeless.'),
+    (1, 5, '"Not too good, doctor. Not too good."'),
+    (1, 6, '"What?"'),
+    (1, 7, '"..."');
 
 
 
 INSERT INTO
     choices(
-        choice_label, snip_id, next_snip_id,
+        story_id, choice_label, snip_id, next_snip_id,
         mod_flg_1, mod_flg_2, mod_flg_3, 
         check_flg_1, check_flg_2, check_flg_3
     )
 VALUES
     (
-        'How are you feeling?', 4, 5,
+        1, 'How are you feeling?', 4, 5,
         null, null, null,
         null, null, null
     ), (
-        'You look great today.', 4, 6,
+        1, 'You look great today.', 4, 6,
         'bm_patient += 1', null, null,
         null, null, null
     ), (
-        'You look wonderful!', 6, 7,
+        1, 'You look wonderful!', 6, 7,
         'bm_patient += 1', null, null,
         null, null, null
     ), (
-        'How are you feeling?', 6, 5,
+        1, 'How are you feeling?', 6, 5,
         null, null, null,
         null, null, null
     );
\ No newline at end of file
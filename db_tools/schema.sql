@@ -1,23 +1,94 @@
+-- Foreign keys are DEFERRABLE so that bulk restores (db_tools.snapshot) can
+-- check them at commit time.
+
 DROP TABLE IF EXISTS saved_games;
+-- my_name compares by code point (C collation, like SQLite's default),
+-- so that one index serves exact names, name prefixes and name order.
+-- saved_at is bumped by every save (see snips_api/saves.py).
 CREATE TABLE "saved_games" (
     game_id serial PRIMARY KEY,
-    my_name text NOT NULL,
+    my_name text COLLATE "C" NOT NULL,
     my_fruit text NOT NULL,
     flag1 int,
     flag2 int,
-    flag3 int
+    flag3 int,
+    story_id int,
+    current_snip_id int,
+    flags bytea,
+    saved_at timestamptz NOT NULL DEFAULT now()
+);
+CREATE INDEX saved_games_name_idx ON saved_games
+    (my_name, saved_at DESC, game_id DESC);
+CREATE INDEX saved_games_recent_idx ON saved_games
+    (saved_at DESC, game_id DESC);
+
+-- Slots of flag names in saved_games.flags, a packed array of 64-bit ints
+-- (see snips_api/flags.py). Filled by the compiler; slots are never reused.
+DROP TABLE IF EXISTS flag_registry;
+CREATE TABLE "flag_registry" (
+    flag_id int PRIMARY KEY,
+    flag_name text UNIQUE NOT NULL
+);
+
+-- Strings shared by snippets and choices, keyed by content hash
+-- (see snips_api/texts.py). Each row holds either its text inline or a
+-- reference into texts.
+DROP TABLE IF EXISTS texts CASCADE;
+CREATE TABLE "texts" (
+    text_id bigint PRIMARY KEY,
+    body text not null
+);
+
+-- Revisions of each story and the one players are served (see
+-- db_tools/revisions.py). Switching the live revision is one UPDATE of
+-- stories.live_revision.
+DROP TABLE IF EXISTS stories;
+DROP TABLE IF EXISTS story_revisions CASCADE;
+CREATE TABLE "story_revisions" (
+    story_id int not null,
+    revision int not null CHECK (revision > 0),
+    created_at timestamptz not null DEFAULT now(),
+    source text not null,
+    PRIMARY KEY (story_id, revision)
 );
 
+CREATE TABLE "stories" (
+    story_id int PRIMARY KEY,
+    live_revision int not null,
+    FOREIGN KEY (story_id, live_revision)
+        REFERENCES story_revisions(story_id, revision) DEFERRABLE
+);
+
+-- Stories are partitions. A story's id is the snip_id of its root snippet;
+-- snip_ids are unique within a story, and snippets and choices are
+-- partitioned by story_id, one partition per story (see
+-- PostgresBackend.story_partition_statements(), run by the compiler), so
+-- compiling or exporting one story never scans or locks another.
+--
+-- Rows are shared by the story revisions from added_in up to, but not
+-- including, removed_in (NULL: still in the latest revision). A snip_id has
+-- one row per version, so choices cannot reference snippets by key; the
+-- compiler checks the links instead.
 DROP TABLE IF EXISTS snippets CASCADE;
 CREATE TABLE "snippets" (
-    snip_id serial PRIMARY KEY,
-    game_text text not null
-);
+    story_id int not null CHECK (story_id >= 0),
+    snip_id int not null,
+    game_text text,
+    text_id bigint REFERENCES texts(text_id) DEFERRABLE,
+    added_in int not null DEFAULT 1,
+    removed_in int,
+    CHECK ((game_text IS NULL) <> (text_id IS NULL)),
+    PRIMARY KEY (story_id, snip_id, added_in),
+    FOREIGN KEY (story_id, added_in)
+        REFERENCES story_revisions(story_id, revision) DEFERRABLE
+) PARTITION BY LIST (story_id);
 
 DROP TABLE IF EXISTS choices;
 CREATE TABLE "choices" (
-    choice_id serial PRIMARY KEY,
-    choice_label text not null,
+    story_id int not null,
+    choice_id serial,
+    choice_label text,
+    label_id bigint REFERENCES texts(text_id) DEFERRABLE,
     snip_id int not null,
     next_snip_id int not null,
     
@@ -28,7 +99,25 @@ CREATE TABLE "choices" (
     check_flg_1 text,
     check_flg_2 text,
     check_flg_3 text,
+
+    added_in int not null DEFAULT 1,
+    removed_in int,
     
-    FOREIGN KEY (snip_id) REFERENCES snippets(snip_id),
-    FOREIGN KEY (next_snip_id) REFERENCES snippets(snip_id)
-);
\ No newline at end of file
+    CHECK ((choice_label IS NULL) <> (label_id IS NULL)),
+    PRIMARY KEY (story_id, choice_id),
+    FOREIGN KEY (story_id, added_in)
+        REFERENCES story_revisions(story_id, revision) DEFERRABLE
+) PARTITION BY LIST (story_id);
+
+-- Full-text search (see db_tools.backends.PostgresBackend.search). The
+-- indexed expressions must match the ones in PG_SEARCH_QUERY exactly, or the
+-- planner will not use the indexes.
+CREATE INDEX snippets_search_idx ON snippets
+    USING GIN (to_tsvector('english', coalesce(game_text, '')));
+CREATE INDEX choices_search_idx ON choices
+    USING GIN (to_tsvector('english', coalesce(choice_label, '')));
+CREATE INDEX texts_search_idx ON texts
+    USING GIN (to_tsvector('english', body));
+CREATE INDEX snippets_text_id_idx ON snippets (text_id);
+CREATE INDEX choices_label_id_idx ON choices (label_id);
+CREATE INDEX choices_snip_id_idx ON choices (story_id, snip_id);
@@ -0,0 +1,229 @@
+-- SQLite equivalent of schema.sql, used by db_tools.backends.SQLiteBackend.
+-- Keep the two files in step when changing the schema.
+
+DROP TABLE IF EXISTS saved_games;
+-- saved_at is bumped by every save (see snips_api/saves.py).
+CREATE TABLE "saved_games" (
+    game_id integer PRIMARY KEY,
+    my_name text NOT NULL,
+    my_fruit text NOT NULL,
+    flag1 int,
+    flag2 int,
+    flag3 int,
+    story_id int,
+    current_snip_id int,
+    flags blob,
+    saved_at text NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+CREATE INDEX saved_games_name_idx ON saved_games
+    (my_name, saved_at DESC, game_id DESC);
+CREATE INDEX saved_games_recent_idx ON saved_games
+    (saved_at DESC, game_id DESC);
+
+-- Slots of flag names in saved_games.flags, a packed array of 64-bit ints
+-- (see snips_api/flags.py). Filled by the compiler; slots are never reused.
+DROP TABLE IF EXISTS flag_registry;
+CREATE TABLE "flag_registry" (
+    flag_id int PRIMARY KEY,
+    flag_name text UNIQUE NOT NULL
+);
+
+DROP TABLE IF EXISTS choices;
+DROP TABLE IF EXISTS snippets;
+DROP TABLE IF EXISTS stories;
+DROP TABLE IF EXISTS story_revisions;
+DROP TABLE IF EXISTS texts;
+CREATE TABLE "texts" (
+    text_id integer PRIMARY KEY,
+    body text not null
+);
+
+-- Revisions of each story and the one players are served (see
+-- db_tools/revisions.py).
+CREATE TABLE "story_revisions" (
+    story_id int not null,
+    revision int not null CHECK (revision > 0),
+    created_at text not null DEFAULT CURRENT_TIMESTAMP,
+    source text not null,
+    PRIMARY KEY (story_id, revision)
+);
+
+CREATE TABLE "stories" (
+    story_id int PRIMARY KEY,
+    live_revision int not null,
+    FOREIGN KEY (story_id, live_revision)
+        REFERENCES story_revisions(story_id, revision)
+);
+
+-- A story's id is the snip_id of its root snippet, and snip_ids are unique
+-- within a story. SQLite has no partitioning; the (story_id, ...) primary
+-- keys keep each story's rows together in the indexes instead.
+-- Rows belong to the story revisions from added_in up to, but not
+-- including, removed_in (NULL: still in the latest revision).
+CREATE TABLE "snippets" (
+    story_id int not null CHECK (story_id >= 0),
+    snip_id int not null,
+    game_text text,
+    text_id integer REFERENCES texts(text_id),
+    added_in int not null DEFAULT 1,
+    removed_in int,
+    CHECK ((game_text IS NULL) <> (text_id IS NULL)),
+    PRIMARY KEY (story_id, snip_id, added_in),
+    FOREIGN KEY (story_id, added_in)
+        REFERENCES story_revisions(story_id, revision)
+);
+
+CREATE TABLE "choices" (
+    choice_id integer PRIMARY KEY,
+    story_id int not null,
+    choice_label text,
+    label_id integer REFERENCES texts(text_id),
+    snip_id int not null,
+    next_snip_id int not null,
+
+    mod_flg_1 text,
+    mod_flg_2 text,
+    mod_flg_3 text,
+
+    check_flg_1 text,
+    check_flg_2 text,
+    check_flg_3 text,
+
+    added_in int not null DEFAULT 1,
+    removed_in int,
+
+    CHECK ((choice_label IS NULL) <> (label_id IS NULL)),
+    FOREIGN KEY (story_id, added_in)
+        REFERENCES story_revisions(story_id, revision)
+);
+CREATE INDEX choices_story_idx ON choices (story_id, snip_id);
+
+-- Full-text search (see db_tools.backends.SQLiteBackend.search), kept up to
+-- date by triggers. Only the rows of each story's live revision are indexed:
+-- rows are indexed as they are written if they are visible in it, and a
+-- story's entries are rebuilt whenever its live revision changes. Snippet
+-- texts are stored with rowid = (story_id << 32) | snip_id, which is never
+-- negative, and choice labels with rowid = -choice_id.
+DROP TABLE IF EXISTS search_fts;
+CREATE VIRTUAL TABLE search_fts USING fts5(
+    body,
+    story_id UNINDEXED,
+    snip_id UNINDEXED,
+    tokenize = 'porter unicode61'
+);
+
+CREATE TRIGGER snippets_search_insert AFTER INSERT ON snippets
+WHEN EXISTS (SELECT 1 FROM stories st WHERE st.story_id = new.story_id
+               AND new.added_in <= st.live_revision
+               AND (new.removed_in IS NULL
+                    OR new.removed_in > st.live_revision)) BEGIN
+    INSERT INTO search_fts(rowid, body, story_id, snip_id) VALUES (
+        (new.story_id << 32) | (new.snip_id & 4294967295),
+        coalesce(new.game_text,
+                 (SELECT body FROM texts WHERE text_id = new.text_id)),
+        new.story_id, new.snip_id);
+END;
+
+CREATE TRIGGER snippets_search_delete AFTER DELETE ON snippets
+WHEN EXISTS (SELECT 1 FROM stories st WHERE st.story_id = old.story_id
+               AND old.added_in <= st.live_revision
+               AND (old.removed_in IS NULL
+                    OR old.removed_in > st.live_revision)) BEGIN
+    DELETE FROM search_fts
+    WHERE rowid = (old.story_id << 32) | (old.snip_id & 4294967295);
+END;
+
+CREATE TRIGGER snippets_search_update AFTER UPDATE ON snippets BEGIN
+    DELETE FROM search_fts
+    WHERE rowid = (old.story_id << 32) | (old.snip_id & 4294967295)
+      AND EXISTS (SELECT 1 FROM stories st WHERE st.story_id = old.story_id
+                    AND old.added_in <= st.live_revision
+                    AND (old.removed_in IS NULL
+                         OR old.removed_in > st.live_revision));
+    INSERT INTO search_fts(rowid, body, story_id, snip_id)
+    SELECT (new.story_id << 32) | (new.snip_id & 4294967295),
+           coalesce(new.game_text,
+                    (SELECT body FROM texts WHERE text_id = new.text_id)),
+           new.story_id, new.snip_id
+    FROM stories st WHERE st.story_id = new.story_id
+      AND new.added_in <= st.live_revision
+      AND (new.removed_in IS NULL OR new.removed_in > st.live_revision);
+END;
+
+CREATE TRIGGER choices_search_insert AFTER INSERT ON choices
+WHEN EXISTS (SELECT 1 FROM stories st WHERE st.story_id = new.story_id
+               AND new.added_in <= st.live_revision
+               AND (new.removed_in IS NULL
+                    OR new.removed_in > st.live_revision)) BEGIN
+    INSERT INTO search_fts(rowid, body, story_id, snip_id) VALUES (
+        -new.choice_id,
+        coalesce(new.choice_label,
+                 (SELECT body FROM texts WHERE text_id = new.label_id)),
+        new.story_id, new.snip_id);
+END;
+
+CREATE TRIGGER choices_search_delete AFTER DELETE ON choices BEGIN
+    DELETE FROM search_fts WHERE rowid = -old.choice_id;
+END;
+
+CREATE TRIGGER choices_search_update AFTER UPDATE ON choices BEGIN
+    DELETE FROM search_fts WHERE rowid = -old.choice_id;
+    INSERT INTO search_fts(rowid, body, story_id, snip_id)
+    SELECT -new.choice_id,
+           coalesce(new.choice_label,
+                    (SELECT body FROM texts WHERE text_id = new.label_id)),
+           new.story_id, new.snip_id
+    FROM stories st WHERE st.story_id = new.story_id
+      AND new.added_in <= st.live_revision
+      AND (new.removed_in IS NULL OR new.removed_in > st.live_revision);
+END;
+
+-- Going live with a revision, or back to an earlier one
+CREATE TRIGGER stories_search_insert AFTER INSERT ON stories BEGIN
+    DELETE FROM search_fts
+    WHERE rowid BETWEEN new.story_id << 32
+                    AND (new.story_id << 32) | 4294967295
+       OR rowid IN (SELECT -choice_id FROM choices
+                    WHERE story_id = new.story_id);
+    INSERT INTO search_fts(rowid, body, story_id, snip_id)
+    SELECT (s.story_id << 32) | (s.snip_id & 4294967295),
+           coalesce(s.game_text, t.body), s.story_id, s.snip_id
+    FROM snippets s LEFT JOIN texts t ON t.text_id = s.text_id
+    WHERE s.story_id = new.story_id AND s.added_in <= new.live_revision
+      AND (s.removed_in IS NULL OR s.removed_in > new.live_revision);
+    INSERT INTO search_fts(rowid, body, story_id, snip_id)
+    SELECT -c.choice_id, coalesce(c.choice_label, t.body),
+           c.story_id, c.snip_id
+    FROM choices c LEFT JOIN texts t ON t.text_id = c.label_id
+    WHERE c.story_id = new.story_id AND c.added_in <= new.live_revision
+      AND (c.removed_in IS NULL OR c.removed_in > new.live_revision);
+END;
+
+CREATE TRIGGER stories_search_update AFTER UPDATE OF live_revision ON stories
+BEGIN
+    DELETE FROM search_fts
+    WHERE rowid BETWEEN new.story_id << 32
+                    AND (new.story_id << 32) | 4294967295
+       OR rowid IN (SELECT -choice_id FROM choices
+                    WHERE story_id = new.story_id);
+    INSERT INTO search_fts(rowid, body, story_id, snip_id)
+    SELECT (s.story_id << 32) | (s.snip_id & 4294967295),
+           coalesce(s.game_text, t.body), s.story_id, s.snip_id
+    FROM snippets s LEFT JOIN texts t ON t.text_id = s.text_id
+    WHERE s.story_id = new.story_id AND s.added_in <= new.live_revision
+      AND (s.removed_in IS NULL OR s.removed_in > new.live_revision);
+    INSERT INTO search_fts(rowid, body, story_id, snip_id)
+    SELECT -c.choice_id, coalesce(c.choice_label, t.body),
+           c.story_id, c.snip_id
+    FROM choices c LEFT JOIN texts t ON t.text_id = c.label_id
+    WHERE c.story_id = new.story_id AND c.added_in <= new.live_revision
+      AND (c.removed_in IS NULL OR c.removed_in > new.live_revision);
+END;
+
+CREATE TRIGGER stories_search_delete AFTER DELETE ON stories BEGIN
+    DELETE FROM search_fts
+    WHERE rowid BETWEEN old.story_id << 32
+                    AND (old.story_id << 32) | 4294967295
+       OR rowid IN (SELECT -choice_id FROM choices
+                    WHERE story_id = old.story_id);
+END;
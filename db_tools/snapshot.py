@@ -0,0 +1,191 @@
+"""
+Consistent whole-database snapshots.
+
+create_snapshot() dumps every table as of one moment into a single archive;
+restore_snapshot() loads such an archive back. Unlike downloading tables one
+by one from the debug pages, snippets and choices in a snapshot always agree
+with each other.
+
+On PostgreSQL, tables are dumped in parallel: one REPEATABLE READ
+transaction exports its snapshot and every worker connection reads through
+it. Restores load tables level by level in foreign key dependency order,
+in a single transaction with constraints deferred to commit, so a failed
+restore changes nothing. On SQLite, dumps also run in a single transaction.
+
+Archive layout (an uncompressed tar file):
+    manifest.json       -- format, version, creation time and per table its
+                           columns, row count, dependencies and file name
+    <table>.copy.gz     -- gzipped PostgreSQL COPY text format
+
+Usage:
+    $ python -m db_tools.snapshot create backup.tar [--workers 4]
+    $ python -m db_tools.snapshot restore backup.tar
+"""
+
+import argparse
+import datetime
+import json
+import os
+import os.path
+import sys
+import tarfile
+import tempfile
+
+from .backends import get_backend
+
+ARCHIVE_FORMAT = 'fyms-snapshot'
+VERSION = 1
+MANIFEST = 'manifest.json'
+DEFAULT_WORKERS = 4
+
+
+class SnapshotError(Exception):
+    """The archive is not a readable snapshot"""
+
+
+
+def dependency_levels(dependencies):
+    """Groups tables so that each only references tables in earlier groups.
+
+    Args:
+        dependencies: Dict of {table_name: tables it references}. References
+            to tables outside the dict and to the table itself are ignored.
+
+    Returns:
+        List of sorted lists of table names.
+
+    Raises:
+        ValueError if tables reference each other in a cycle.
+    """
+    remaining = {table: set(parents) & set(dependencies) - {table}
+                 for table, parents in dependencies.items()}
+    levels = []
+    while remaining:
+        level = sorted(t for t, parents in remaining.items() if not parents)
+        if not level:
+            raise ValueError('Tables {} reference each other in a cycle'
+                             .format(', '.join(sorted(remaining))))
+        levels.append(level)
+        for table in level:
+            del remaining[table]
+        for parents in remaining.values():
+            parents.difference_update(level)
+    return levels
+
+
+def _member_name(table):
+    return '{}.copy.gz'.format(table)
+
+
+def create_snapshot(path, workers=DEFAULT_WORKERS, backend=None):
+    """Dumps all tables into a snapshot archive at `path`.
+
+    The archive is written to a temporary file and renamed into place.
+
+    Returns:
+        The manifest dict.
+    """
+    backend = backend or get_backend()
+    dependencies = backend.table_dependencies()
+    tables = [t for level in dependency_levels(dependencies) for t in level]
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path_for = lambda table: os.path.join(tmpdir, _member_name(table))
+        dumped = backend.dump_tables(tables, path_for, workers)
+        manifest = dict(
+            format=ARCHIVE_FORMAT,
+            version=VERSION,
+            created=datetime.datetime.utcnow().isoformat() + 'Z',
+            tables=[dict(name=table,
+                         columns=dumped[table]['columns'],
+                         rows=dumped[table]['rows'],
+                         depends_on=sorted(dependencies[table] - {table}),
+                         file=_member_name(table))
+                    for table in tables],
+        )
+        manifest_path = os.path.join(tmpdir, MANIFEST)
+        with open(manifest_path, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, indent=2)
+
+        dirname = os.path.dirname(os.path.abspath(path))
+        fd, tmp_path = tempfile.mkstemp(dir=dirname, prefix='.snapshot-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                with tarfile.open(fileobj=f, mode='w') as archive:
+                    archive.add(manifest_path, MANIFEST)
+                    for table in tables:
+                        archive.add(path_for(table), _member_name(table))
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+    return manifest
+
+
+def read_manifest(archive):
+    """Reads and checks the manifest of an open tarfile"""
+    try:
+        manifest = json.load(archive.extractfile(MANIFEST))
+    except (KeyError, ValueError):
+        raise SnapshotError('{} has no valid {}'.format(archive.name,
+                                                         MANIFEST))
+    if manifest.get('format') != ARCHIVE_FORMAT:
+        raise SnapshotError('{} is not a snapshot archive'.format(
+            archive.name))
+    if manifest.get('version') != VERSION:
+        raise SnapshotError('{} has snapshot version {} (expected {})'.format(
+            archive.name, manifest.get('version'), VERSION))
+    return manifest
+
+
+def restore_snapshot(path, workers=DEFAULT_WORKERS, backend=None):
+    """Replaces the data of every table in the snapshot at `path`.
+
+    Tables that are not in the snapshot are left alone.
+
+    Returns:
+        Dict of {table_name: rows loaded}.
+    """
+    backend = backend or get_backend()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        with tarfile.open(path, mode='r') as archive:
+            manifest = read_manifest(archive)
+            tables = manifest['tables']
+            for table in tables:
+                member = archive.getmember(table['file'])
+                if not member.isfile() or os.path.basename(
+                        member.name) != member.name:
+                    raise SnapshotError('Bad archive member {}'.format(
+                        member.name))
+                archive.extract(member, tmpdir)
+
+        levels = dependency_levels({t['name']: set(t['depends_on'])
+                                    for t in tables})
+        files = {t['name']: os.path.join(tmpdir, t['file']) for t in tables}
+        columns = {t['name']: t['columns'] for t in tables}
+        return backend.restore_tables(levels, files.__getitem__, columns,
+                                      workers)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m db_tools.snapshot',
+        description='Creates or restores a consistent snapshot of all '
+                    'tables.')
+    parser.add_argument('action', choices=['create', 'restore'])
+    parser.add_argument('path')
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS,
+                        help='tables dumped concurrently (PostgreSQL)')
+    args = parser.parse_args(argv)
+
+    if args.action == 'create':
+        manifest = create_snapshot(args.path, args.workers)
+        counts = {t['name']: t['rows'] for t in manifest['tables']}
+    else:
+        counts = restore_snapshot(args.path, args.workers)
+    for table, rows in counts.items():
+        print('{:<20} {:>10} rows'.format(table, rows), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,559 @@
+"""
+unittests for the db_tools module
+
+
+Usage:
+
+    $ python firstyearmedicalstudent/runtests.py
+"""
+
+
+import gzip
+import io
+import importlib.util
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+from . import (admission, columnar, db_downup, metrics, replicas,
+               request_profiler, revisions, snapshot, validation)
+from .backends import SQLiteBackend, set_backend
+
+HAVE_PYARROW = importlib.util.find_spec('pyarrow') is not None
+
+
+def live_stories(*story_ids):
+    """Statements that give stories a live revision 1, which search sees"""
+    return [('INSERT INTO story_revisions(story_id, revision, source) '
+             'VALUES (%s, %s, %s)', [story_id, 1, 'test'])
+            for story_id in story_ids] + [
+            ('INSERT INTO stories(story_id, live_revision) VALUES (%s, %s)',
+             [story_id, 1]) for story_id in story_ids]
+
+
+class MetricsTestCase(unittest.TestCase):
+    def setUp(self):
+        metrics.reset()
+
+    def test_normalize_statement(self):
+        n = metrics.normalize_statement
+        self.assertEqual(
+            n('SELECT * FROM snippets WHERE snip_id IN (%s, %s, %s)'),
+            n('SELECT *   FROM snippets\n WHERE snip_id IN (%s, %s)'))
+        self.assertEqual(
+            n('INSERT INTO snippets(snip_id, game_text) VALUES '
+              '(%s, %s), (%s, %s), (%s, %s)'),
+            'INSERT INTO snippets(snip_id, game_text) VALUES (...), ...')
+        self.assertEqual(n("SELECT 1 FROM t WHERE name = 'x''y'"),
+                         'SELECT ? FROM t WHERE name = ?')
+
+    def test_histogram(self):
+        h = metrics.Histogram(buckets=(0.1, 1.0))
+        for v in (0.05, 0.5, 0.5, 5):
+            h.observe(v)
+        self.assertEqual(list(h.cumulative()),
+                         [(0.1, 1), (1.0, 3), (float('inf'), 4)])
+
+    def test_render_prometheus(self):
+        with metrics.source('debug_database'):
+            metrics.record_statement('SELECT * FROM "snippets"', 0.002, 7)
+        metrics.record_connect(0.01)
+        text = metrics.render_prometheus()
+        labels = 'source="debug_database",statement="SELECT * FROM \\"snippets\\""'
+        self.assertIn('db_query_rows_total{%s} 7' % labels, text)
+        self.assertIn('db_query_duration_seconds_count{%s} 1' % labels, text)
+        self.assertIn('db_connect_duration_seconds_count 1', text)
+
+
+class SQLiteBackendTestCase(unittest.TestCase):
+    def setUp(self):
+        self.backend = SQLiteBackend()
+        self.backend.init_schema()
+        self.backend.execute_statements(live_stories(10, 20) + [(
+            'INSERT INTO snippets(story_id, snip_id, game_text) VALUES '
+            '(%s, %s, %s), (%s, %s, %s), (%s, %s, %s), (%s, %s, %s)',
+            [10, 10, 'a', 10, 11, 'b', 10, 13, 'c|d', 20, 12, 'other'],
+        )])
+
+    def test_find_spare_snipids(self):
+        self.assertEqual(self.backend.find_spare_snipids(10, 10, 3),
+                         [12, 14, 15])
+        self.assertEqual(self.backend.find_spare_snipids(10, 1, 2), [1, 2])
+        self.assertEqual(self.backend.find_spare_snipids(10, 10, 0), [])
+        # Other stories' snip_ids don't count
+        self.assertEqual(self.backend.find_spare_snipids(20, 10, 3),
+                         [10, 11, 13])
+
+    def test_fetch_rows_with_snipids(self):
+        rows = self.backend.fetch_rows_with_snipids(10, [10, 12])
+        self.assertEqual(rows[10]['game_text'], 'a')
+        self.assertIsNone(rows[12])
+        rows = self.backend.fetch_rows_with_snipids(20, [10, 12])
+        self.assertIsNone(rows[10])
+        self.assertEqual(rows[12]['game_text'], 'other')
+
+    def test_download_upload_roundtrip(self):
+        self.backend.execute_statements([(
+            'INSERT INTO saved_games(my_name, my_fruit, flag1, saved_at) '
+            'VALUES (%s, %s, %s, %s)',
+            ['Patsy', 'coconut', 5, '2020-01-01 10:00:00'])])
+        csv = self.backend.download_table('saved_games')
+        self.assertEqual(csv.splitlines()[:2], [
+            'saved_games', 'game_id|my_name|my_fruit|flag1|flag2|flag3|'
+                           'story_id|current_snip_id|flags|saved_at'])
+
+        self.backend.upload_table('saved_games', io.StringIO(csv))
+        self.assertEqual(self.backend.fetch_table('saved_games')[1],
+                         [1, 'Patsy', 'coconut', 5, None, None, None, None,
+                          None, '2020-01-01 10:00:00'])
+
+    def test_search(self):
+        self.backend.execute_statements([
+            ('INSERT INTO texts(text_id, body) VALUES (%s, %s)',
+             [7, 'John: "Doctors never listen."']),
+            ('INSERT INTO snippets(story_id, snip_id, text_id) '
+             'VALUES (%s, %s, %s)', [10, 20, 7]),
+            ('INSERT INTO choices(story_id, choice_label, snip_id, '
+             'next_snip_id) VALUES (%s, %s, %s, %s)',
+             [10, 'Ask the doctor', 11, 20]),
+        ])
+        found = self.backend.search('doctor')
+        self.assertEqual(found['total'], 2)
+        by_id = {r['snip_id']: r for r in found['results']}
+        self.assertEqual(by_id[20]['story_id'], 10)
+        self.assertEqual(by_id[20]['headline'],
+                         'John: &quot;<b>Doctors</b> never listen.&quot;')
+        self.assertEqual(by_id[11]['headline'], 'b')
+        self.assertEqual(by_id[11]['labels'], ['Ask the <b>doctor</b>'])
+
+        page = self.backend.search('doctor', limit=1, offset=1)
+        self.assertEqual(page['total'], 2)
+        self.assertEqual(len(page['results']), 1)
+        self.assertEqual(self.backend.search('doctor listen')['total'], 1)
+
+        # Excerpts are HTML with only the highlights as tags
+        self.backend.execute_statements([
+            ('INSERT INTO snippets(story_id, snip_id, game_text) '
+             'VALUES (%s, %s, %s)',
+             [10, 30, '<script>alert("doctor")</script>'])])
+        self.assertEqual(
+            self.backend.search('alert')['results'][0]['headline'],
+            '&lt;script&gt;<b>alert</b>(&quot;doctor&quot;)&lt;/script&gt;')
+        self.backend.execute_statements([
+            ('DELETE FROM snippets WHERE snip_id = %s', [30])])
+
+        # The index follows deletes
+        self.backend.execute_statements([
+            ('DELETE FROM choices WHERE snip_id = %s', [11])])
+        self.assertEqual(self.backend.search('doctor')['total'], 1)
+
+    def test_rejects_bad_table_name(self):
+        with self.assertRaises(ValueError):
+            self.backend.fetch_table('snippets; DROP TABLE choices')
+
+
+class _FakeReplica():
+    """Stands in for a psycopg2 connection to a replica with a given lag"""
+    def __init__(self, lag):
+        self.lag = lag
+        self.closed = False
+
+    def cursor(self):
+        return self
+
+    def execute(self, sql):
+        self.sql = sql
+
+    def fetchone(self):
+        return (self.lag,)
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+class ReplicaRoutingTestCase(unittest.TestCase):
+    def setUp(self):
+        self.lags = {}
+        self.states = [replicas.ReplicaState('postgres://u@replica{}/db'
+                                             .format(i), max_lag=5,
+                                             check_interval=60)
+                       for i in (1, 2)]
+        replicas.reset_config(self.states)
+        replicas.begin_request()
+
+    def tearDown(self):
+        replicas.reset_config()
+        replicas.begin_request()
+
+    def connect(self, url):
+        lag = self.lags[url.hostname]
+        if lag is None:
+            raise OSError('connection refused')
+        return _FakeReplica(lag)
+
+    def test_lag_guard(self):
+        self.lags = dict(replica1=30, replica2=None)
+        self.assertEqual(replicas.connect_replica(self.connect), (None, None))
+        self.assertEqual([s.usable for s in self.states], [False, False])
+
+        # Skipped replicas are not retried before their next check
+        self.lags = dict(replica1=0, replica2=0)
+        self.assertEqual(replicas.connect_replica(self.connect), (None, None))
+        for state in self.states:
+            state.checked_at -= 60
+        conn, state = replicas.connect_replica(self.connect)
+        self.assertEqual(conn.lag, 0)
+        self.assertTrue(state.usable)
+
+    def test_read_your_writes(self):
+        self.lags = dict(replica1=1, replica2=1)
+        self.assertIsNotNone(replicas.connect_replica(self.connect)[0])
+        replicas.note_write()
+        self.assertEqual(replicas.connect_replica(self.connect), (None, None))
+        replicas.begin_request()
+        self.assertIsNotNone(replicas.connect_replica(self.connect)[0])
+
+
+def _slow_handler():
+    time.sleep(0.05)
+
+
+class RequestProfilerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.conf = request_profiler.ProfilerConfig(token='secret',
+                                                    interval=0.001, keep=2)
+        request_profiler.reset_config(self.conf)
+
+    def tearDown(self):
+        request_profiler.reset_config()
+
+    def test_samples_requests_with_token(self):
+        request_profiler.begin_request('api_game', 'GET', '/api/game/1', {})
+        self.assertIsNone(request_profiler.end_request())
+
+        request_profiler.begin_request('api_game', 'GET', '/api/game/1',
+                                       {'X-Profile': 'wrong'})
+        self.assertIsNone(request_profiler.end_request())
+
+        request_profiler.begin_request('api_game', 'GET', '/api/game/1',
+                                       {'X-Profile': 'secret'})
+        _slow_handler()
+        profile = request_profiler.end_request()
+        self.assertGreater(profile.sample_count, 0)
+        self.assertIn('_slow_handler', request_profiler.folded([profile]))
+        self.assertTrue(request_profiler.folded([profile])
+                        .startswith('api_game;'))
+
+    def test_keeps_slowest_per_route(self):
+        for route, seconds in [('a', 1), ('a', 3), ('a', 2), ('b', 0.5)]:
+            profile = request_profiler.RequestProfile(route, 'GET', '/')
+            profile.seconds = seconds
+            self.conf.store.add(profile)
+        self.assertEqual([p.seconds for p in request_profiler.profiles('a')],
+                         [3, 2])
+        self.assertEqual([p.route for p in request_profiler.profiles()],
+                         ['a', 'a', 'b'])
+
+
+@unittest.skipUnless(HAVE_PYARROW, 'pyarrow is not installed')
+class ColumnarTestCase(unittest.TestCase):
+    def setUp(self):
+        self.backend = SQLiteBackend()
+        self.backend.init_schema()
+        self.backend.execute_statements(live_stories(1, 5) + [
+            ('INSERT INTO texts(text_id, body) VALUES (%s, %s)',
+             [-2 ** 62, 'shared']),
+            ('INSERT INTO snippets(story_id, snip_id, game_text) VALUES '
+             '(%s, %s, %s), (%s, %s, %s)', [1, 1, 'a|b\nc', 1, 2, '']),
+            ('INSERT INTO snippets(story_id, snip_id, text_id) '
+             'VALUES (%s, %s, %s)', [1, 3, -2 ** 62]),
+            ('INSERT INTO snippets(story_id, snip_id, game_text) '
+             'VALUES (%s, %s, %s)', [5, 1, 'other story']),
+        ])
+
+    def roundtrip(self, fmt):
+        target = SQLiteBackend()
+        target.init_schema()
+        for table_name in ('texts', 'snippets'):
+            buf = io.BytesIO()
+            rows = columnar.export_table(table_name, buf, fmt, batch_size=2,
+                                         backend=self.backend)
+            buf.seek(0)
+            self.assertEqual(columnar.import_table(table_name, buf, fmt,
+                                                   backend=target), rows)
+        self.assertEqual(rows, 4)
+        self.assertEqual(target.fetch_table('texts'),
+                         self.backend.fetch_table('texts'))
+        query = ('SELECT story_id, snip_id, game_text, text_id '
+                 'FROM snippets ORDER BY story_id, snip_id')
+        self.assertEqual([tuple(row) for row in target.query(query)],
+                         [tuple(row) for row in self.backend.query(query)])
+        # Each story went live, and the search index triggers saw the rows
+        self.assertEqual(revisions.live_revision(5, target), 1)
+        self.assertEqual(target.search('shared')['total'], 1)
+
+    def test_export_story(self):
+        buf = io.BytesIO()
+        self.assertEqual(columnar.export_table('snippets', buf, 'arrow',
+                                               backend=self.backend,
+                                               story_id=5), 1)
+        with self.assertRaises(ValueError):
+            columnar.export_table('texts', io.BytesIO(), 'arrow',
+                                  backend=self.backend, story_id=5)
+
+    def test_import_adds_revisions(self):
+        buf = io.BytesIO()
+        columnar.export_table('snippets', buf, 'arrow', backend=self.backend,
+                              story_id=5)
+        self.backend.execute_statements([
+            ('UPDATE snippets SET game_text = %s WHERE story_id = %s',
+             ['edited', 5])])
+        buf.seek(0)
+        self.assertEqual(columnar.import_table('snippets', buf, 'arrow',
+                                               backend=self.backend), 1)
+        self.assertEqual(revisions.live_revision(5, self.backend), 2)
+        self.assertEqual(revisions.head_revision(1, self.backend), 1)
+        head = self.backend.query(revisions.HEAD_SNIPPETS_QUERY, (5,))
+        self.assertEqual([row['game_text'] for row in head], ['other story'])
+
+        # The edited row is kept in revision 1, which can go live again
+        revisions.set_live_revision(5, 1, self.backend)
+        self.assertEqual(len(self.backend.fetch_table('snippets')) - 1, 5)
+
+    def test_import_validated(self):
+        import pyarrow as pa
+        import webapp
+        set_backend(self.backend)
+        self.addCleanup(set_backend, None)
+        buf = io.BytesIO()
+        table = pa.table({'story_id': [5, 5], 'snip_id': [1, 1],
+                          'choice_label': ['Go', 'Stay'],
+                          'next_snip_id': [1, 9]})
+        with pa.ipc.new_file(buf, table.schema) as writer:
+            writer.write_table(table)
+        before = self.backend.fetch_table('choices')
+
+        buf.seek(0)
+        with self.assertRaises(validation.UploadValidationError) as cm:
+            columnar.import_table('choices', buf, 'arrow')
+        self.assertEqual([(v['check'], v['columns'], v['rows'])
+                          for v in cm.exception.violations],
+                         [('reference', ['story_id', 'next_snip_id'], [2])])
+
+        client = webapp.app.test_client()
+        response = client.post('/database/choices/upload', data={
+            'file': (io.BytesIO(buf.getvalue()), 'choices.arrow')})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.get_json()['violations'],
+                         cm.exception.violations)
+        response = client.post('/database/choices/upload', data={
+            'file': (io.BytesIO(b'not parquet'), 'choices.parquet')})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.backend.fetch_table('choices'), before)
+        self.assertEqual(revisions.head_revision(5, self.backend), 1)
+
+    def test_parquet_roundtrip(self):
+        self.roundtrip('parquet')
+
+    def test_arrow_roundtrip(self):
+        self.roundtrip('arrow')
+
+    def test_schema_types(self):
+        schema = columnar.table_schema(self.backend.table_columns('choices'))
+        self.assertEqual(str(schema.field('snip_id').type), 'int64')
+        self.assertEqual(str(schema.field('choice_label').type), 'string')
+        with self.assertRaises(ValueError):
+            columnar.format_for_path('snippets.csv')
+
+
+class SnapshotTestCase(unittest.TestCase):
+    def setUp(self):
+        self.backend = SQLiteBackend()
+        self.backend.init_schema()
+        self.backend.execute_statements(live_stories(1) + [
+            ('INSERT INTO texts(text_id, body) VALUES (%s, %s)', [7, 'Next']),
+            ('INSERT INTO snippets(story_id, snip_id, game_text) VALUES '
+             '(%s, %s, %s), (%s, %s, %s)',
+             [1, 1, 'tab\there', 1, 2, 'back\\slash\nline']),
+            ('INSERT INTO choices(story_id, label_id, snip_id, next_snip_id) '
+             'VALUES (%s, %s, %s, %s)', [1, 7, 1, 2]),
+            ('INSERT INTO saved_games(my_name, my_fruit, flags) '
+             'VALUES (%s, %s, %s)', ['Patsy', 'coconut', b'\x01\t\n\\']),
+        ])
+        fd, self.path = tempfile.mkstemp(suffix='.tar')
+        os.close(fd)
+
+    def tearDown(self):
+        os.unlink(self.path)
+
+    def test_dependency_levels(self):
+        deps = self.backend.table_dependencies()
+        self.assertNotIn('search_fts', deps)
+        self.assertEqual(snapshot.dependency_levels(deps),
+                         [['flag_registry', 'saved_games', 'story_revisions',
+                           'texts'],
+                          ['choices', 'snippets', 'stories']])
+        with self.assertRaises(ValueError):
+            snapshot.dependency_levels({'a': {'b'}, 'b': {'a'}})
+
+    def test_snapshot_roundtrip(self):
+        tables = ['texts', 'snippets', 'choices', 'saved_games']
+        before = {t: self.backend.fetch_table(t) for t in tables}
+        manifest = snapshot.create_snapshot(self.path, backend=self.backend)
+        self.assertEqual({t['name']: t['rows'] for t in manifest['tables']},
+                         dict(texts=1, snippets=2, choices=1, saved_games=1,
+                              flag_registry=0, story_revisions=1, stories=1))
+
+        self.backend.execute_statements([
+            ('DELETE FROM choices', ()),
+            ('UPDATE snippets SET game_text = %s', ['changed']),
+        ])
+        counts = snapshot.restore_snapshot(self.path, backend=self.backend)
+        self.assertEqual(counts['snippets'], 2)
+        self.assertEqual({t: self.backend.fetch_table(t) for t in tables},
+                         before)
+        self.assertEqual(self.backend.search('next')['total'], 1)
+
+
+    def test_failed_restore_changes_nothing(self):
+        before = self.backend.fetch_table('texts')
+        with tempfile.TemporaryDirectory() as tmpdir:
+            def path_for(table):
+                return os.path.join(tmpdir, table + '.gz')
+            with gzip.open(path_for('texts'), 'wt') as f:
+                f.write('8\tOther\n')
+            # One column short
+            with gzip.open(path_for('flag_registry'), 'wt') as f:
+                f.write('1\n')
+            with self.assertRaises(Exception):
+                self.backend.restore_tables(
+                    [['texts', 'flag_registry']], path_for,
+                    dict(texts=['text_id', 'body'],
+                         flag_registry=['flag_id', 'flag_name']))
+        self.assertEqual(self.backend.fetch_table('texts'), before)
+
+
+class AdmissionTestCase(unittest.TestCase):
+    def setUp(self):
+        self.lane = admission.Lane('bulk', concurrency=1, queue=1,
+                                   timeout=0.05, connections=1)
+        admission.reset_lanes({'bulk': self.lane,
+                               'player': admission.Lane('player')})
+
+    def tearDown(self):
+        admission.reset_lanes()
+
+    def test_queues_then_rejects(self):
+        admission.enter('bulk')
+        with self.assertRaises(admission.LaneFull) as cm:
+            admission.enter('bulk')
+        self.assertEqual(cm.exception.reason, 'timeout')
+        self.assertGreaterEqual(cm.exception.retry_after, 1)
+
+        # A waiting request is admitted once the running one leaves
+        waiter = threading.Thread(target=self.lane.acquire)
+        self.lane.timeout = 5
+        waiter.start()
+        while not self.lane.queued:
+            time.sleep(0.001)
+        with self.assertRaises(admission.LaneFull) as cm:
+            self.lane.acquire()
+        self.assertEqual(cm.exception.reason, 'queue_full')
+        admission.leave()
+        waiter.join()
+        self.assertEqual((self.lane.running, self.lane.queued), (1, 0))
+        self.lane.release(0.1)
+
+        with admission.admitted('player'):
+            pass
+        text = admission.render_prometheus()
+        self.assertIn('admission_lane_queue_depth{lane="bulk"} 0', text)
+        self.assertIn('admission_lane_wait_seconds_count{lane="bulk"} 2',
+                      text)
+        self.assertIn('admission_lane_rejected_total{lane="bulk",'
+                      'reason="queue_full"} 1', text)
+
+    def test_connection_slots(self):
+        self.assertIsNone(admission.acquire_connection())
+        with admission.admitted('bulk'):
+            lane = admission.acquire_connection()
+            self.assertIs(lane, self.lane)
+            with self.assertRaises(admission.LaneFull) as cm:
+                admission.acquire_connection()
+            self.assertEqual(cm.exception.reason, 'connections')
+            admission.release_connection(lane)
+            self.assertEqual(self.lane.connections_held, 0)
+
+
+class UploadValidationTestCase(unittest.TestCase):
+    def setUp(self):
+        self.backend = SQLiteBackend()
+        self.backend.init_schema()
+        self.backend.execute_statements([
+            ('INSERT INTO texts(text_id, body) VALUES (%s, %s)', [7, 'Go']),
+            ('INSERT INTO story_revisions(story_id, revision, source) '
+             'VALUES (%s, %s, %s)', [10, 1, 'compile']),
+            ('INSERT INTO snippets(story_id, snip_id, game_text) VALUES '
+             '(%s, %s, %s), (%s, %s, %s), (%s, %s, %s)',
+             [10, 10, 'a', 10, 11, 'b', 10, 12, 'c']),
+            ('INSERT INTO choices(story_id, label_id, snip_id, next_snip_id) '
+             'VALUES (%s, %s, %s, %s), (%s, %s, %s, %s)',
+             [10, 7, 10, 11, 10, 7, 11, 12]),
+        ])
+
+    def checks(self, table_name, csv, **kwargs):
+        return [(v['check'], v['columns'], v['rows']) for v in
+                validation.validate_upload(table_name, csv, self.backend,
+                                           **kwargs)]
+
+    def test_downloads_are_valid(self):
+        for table in ('texts', 'snippets', 'choices'):
+            csv = self.backend.download_table(table)
+            self.assertEqual(self.checks(table, csv), [])
+            self.assertEqual(self.checks(table, csv, add_revision=False), [])
+
+    def test_choices(self):
+        csv = self.backend.download_table('choices') + (
+            '\n3|10|None|7|10|99|None|None|None|None|None|None|1|None'
+            '\n4|10|None|8|12|x|None|None|None|None|None|None|1|None'
+            '\n5|10|None|7|12|None|None|None|None|None|None|None|1|2')
+        self.assertEqual(self.checks('choices', csv), [
+            ('type', ['next_snip_id'], [4]),
+            ('reference', ['label_id'], [4]),
+            ('reference', ['story_id', 'next_snip_id'], [3])])
+        # Replacing the table keeps removed rows, which need a next_snip_id
+        self.assertIn(('not_null', ['next_snip_id'], [5]),
+                      self.checks('choices', csv, add_revision=False))
+
+    def test_snippets(self):
+        csv = self.backend.download_table('snippets').replace(
+            '10|12|c|', '10|11|c|')
+        self.assertEqual(self.checks('snippets', csv), [
+            ('unique', ['story_id', 'snip_id'], [2, 3]),
+            ('referenced', ['story_id', 'next_snip_id'], [])])
+        self.assertEqual(self.checks('saved_games',
+                                     'saved_games\ngame_id|my_name|fruit\n'
+                                     'a|None|x'), [
+            ('column', ['fruit'], []), ('column', ['my_fruit'], []),
+            ('type', ['game_id'], [1]), ('not_null', ['my_name'], [1])])
+
+    def test_upload_rejected_before_changes(self):
+        set_backend(self.backend)
+        self.addCleanup(set_backend, None)
+        before = self.backend.fetch_table('texts')
+        with self.assertRaises(validation.UploadValidationError) as cm:
+            db_downup.upload_table('texts', io.StringIO(
+                'texts\ntext_id|body\n8|Hi\n8|Ho'))
+        self.assertEqual([v['check'] for v in cm.exception.violations],
+                         ['unique', 'referenced'])
+        self.assertEqual(self.backend.fetch_table('texts'), before)
+
+        db_downup.upload_table('texts', io.StringIO(
+            'texts\ntext_id|body\n7|Go on'))
+        self.assertEqual(self.backend.fetch_table('texts')[1:],
+                         [[7, 'Go on']])
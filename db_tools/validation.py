@@ -0,0 +1,552 @@
+"""
+Validation of uploaded tables before they touch live data.
+
+A CSV upload replaces a table (PostgresBackend drops it with CASCADE), or
+adds story revisions that nothing checks for dangling choices. db_downup
+therefore validates an upload first and reports every problem in it at
+once, before anything is changed:
+    - columns the table does not have, and NOT NULL columns without a
+      default that the file lacks
+    - values that do not parse as their column's type (integers in range,
+      numbers, booleans, dates and timestamps)
+    - NULLs in NOT NULL columns
+    - repeated primary keys and unique values
+    - foreign keys, and the snip_id and next_snip_id of choices, that match
+      no row of the referenced table
+    - rows of other tables that reference keys the upload would remove
+
+The file is read with pandas in batches of VALIDATION_BATCH_SIZE rows and
+each check works on whole columns. Key columns are collected across
+batches and checked with one duplicated() / anti-join each; foreign keys
+are deduplicated first and looked up in the referenced table
+LOOKUP_BATCH_SIZE keys per query, so a check costs a few queries however
+many rows reference the same keys. Memory grows with the key columns of
+the upload, not its texts.
+
+Parquet and Arrow uploads (see columnar.py) are checked the same way,
+with their record batches converted to strings (see validate_batches()).
+
+Uploads of snippets and choices through db_downup add story revisions
+(see revisions.upload_statements()). For these, rows marked as removed are
+skipped, snip_ids must be unique within a story, and references are
+checked against the head revision of the stories (see
+revision_upload_rules()).
+
+Usage:
+    violations = validate_upload('choices', csv_file)   # list of dicts
+    check_upload('choices', csv_file)   # raises UploadValidationError
+
+    $ python -m db_tools.validation choices choices.csv
+"""
+
+import argparse
+import csv
+import io
+import sys
+
+from .backends import (STORY_TABLES, check_table_name, get_backend,
+                       make_placeholders_for)
+
+VALIDATION_BATCH_SIZE = 50000
+# Keys per query when looking up foreign keys
+LOOKUP_BATCH_SIZE = 500
+# Row numbers listed per violation
+MAX_REPORTED_ROWS = 10
+
+# Cells read as NULL, as by backends.read_csv_rows()
+NULL_VALUES = ('', 'None')
+
+INTEGER_PATTERN = r'[+-]?\d+'
+INTEGER_BOUNDS = {
+    'smallint': 2 ** 15,
+    'integer': 2 ** 31,
+    'bigint': 2 ** 63,
+}
+NUMBER_TYPES = ('real', 'double precision', 'numeric')
+BOOLEAN_VALUES = ('t', 'f', 'true', 'false', '1', '0')
+TIME_TYPES = ('date', 'timestamp with time zone',
+              'timestamp without time zone')
+
+# References the schema cannot declare: choices point at snippets by
+# snip_id within their story, and snippets are partitioned and versioned.
+# (table, columns, referenced table, referenced columns)
+STORY_REFERENCES = [
+    ('choices', ('story_id', 'snip_id'), 'snippets', ('story_id', 'snip_id')),
+    ('choices', ('story_id', 'next_snip_id'),
+     'snippets', ('story_id', 'snip_id')),
+]
+# Columns of story tables that revisions.upload_statements() ignores
+REVISION_IGNORED_COLUMNS = ('choice_id', 'added_in', 'removed_in')
+# Keys of the rows in each story's new revision
+REVISION_UNIQUE = {
+    'snippets': [('story_id', 'snip_id')],
+    'choices': [],
+}
+HEAD_CONDITION = 'removed_in IS NULL'
+
+
+
+class UploadValidationError(ValueError):
+    """An upload failed validation; `violations` lists why"""
+    def __init__(self, table_name, violations):
+        self.table_name = table_name
+        self.violations = violations
+        super().__init__('Upload of {} has {} problem(s):\n{}'.format(
+            table_name, len(violations),
+            '\n'.join(v['message'] for v in violations)))
+
+
+
+class Reference():
+    """A reference from columns of one table to a key of another.
+
+    `condition` limits the rows of the referenced table that count, and
+    `referrer_condition` the rows of the referencing table.
+    """
+    def __init__(self, table, columns, ref_table, ref_columns,
+                 condition=None, referrer_condition=None):
+        self.table = table
+        self.columns = tuple(columns)
+        self.ref_table = ref_table
+        self.ref_columns = tuple(ref_columns)
+        self.condition = condition
+        self.referrer_condition = referrer_condition
+
+
+    def describe(self):
+        return '{}({}) -> {}({})'.format(
+            self.table, ', '.join(self.columns),
+            self.ref_table, ', '.join(self.ref_columns))
+
+
+
+def violation(check, columns, count, rows, message):
+    """Builds a violation dict; rows are 1-based data row numbers"""
+    return dict(check=check, columns=list(columns), count=int(count),
+                rows=[int(row) for row in rows[:MAX_REPORTED_ROWS]],
+                message=message)
+
+
+def format_rows(rows, count):
+    listed = ', '.join(str(int(row)) for row in rows[:MAX_REPORTED_ROWS])
+    if count > MAX_REPORTED_ROWS:
+        listed += ', ...'
+    return '(row{} {})'.format('s' if count > 1 else '', listed)
+
+
+def format_key(values):
+    values = [plain(v) for v in values]
+    return repr(values[0]) if len(values) == 1 else repr(tuple(values))
+
+
+def plain(value):
+    """Turns numpy and pandas scalars into the Python values drivers take"""
+    return value.item() if hasattr(value, 'item') else value
+
+
+def revision_upload_rules(table_name, tables):
+    """Adjusts the constraints of a story table for a revision upload.
+
+    Args:
+        table_name: 'snippets' or 'choices'.
+
+        tables: {table_name: table_constraints()} of the schema.
+
+    Returns:
+        Tuple of (unique, list of outgoing References, list of incoming
+        References).
+    """
+    outgoing = [Reference(table_name, cols, ref_table, ref_cols)
+                for cols, ref_table, ref_cols in
+                tables[table_name]['foreign_keys']
+                if not set(cols).intersection(REVISION_IGNORED_COLUMNS)]
+    incoming = []
+    for table, cols, ref_table, ref_cols in STORY_REFERENCES:
+        if table == table_name:
+            # The story's other table is kept from its head revision
+            outgoing.append(Reference(table, cols, ref_table, ref_cols,
+                                      condition=HEAD_CONDITION))
+        elif ref_table == table_name:
+            incoming.append(Reference(table, cols, ref_table, ref_cols,
+                                      referrer_condition=HEAD_CONDITION))
+    return REVISION_UNIQUE[table_name], outgoing, incoming
+
+
+def replace_upload_rules(table_name, tables):
+    """The constraints of a table whose rows the upload replaces.
+
+    Returns:
+        Tuple of (unique, list of outgoing References, list of incoming
+        References).
+    """
+    outgoing = [Reference(table_name, cols, ref_table, ref_cols)
+                for cols, ref_table, ref_cols in
+                tables[table_name]['foreign_keys']]
+    incoming = []
+    for table, constraints in sorted(tables.items()):
+        incoming.extend(Reference(table, cols, ref_table, ref_cols)
+                        for cols, ref_table, ref_cols in
+                        constraints['foreign_keys']
+                        if ref_table == table_name and table != table_name)
+    for table, cols, ref_table, ref_cols in STORY_REFERENCES:
+        if table == table_name:
+            outgoing.append(Reference(table, cols, ref_table, ref_cols))
+        elif ref_table == table_name:
+            incoming.append(Reference(table, cols, ref_table, ref_cols))
+    return tables[table_name]['unique'], outgoing, incoming
+
+
+def read_text(csv_file):
+    text = csv_file.read()
+    if isinstance(text, bytes):
+        text = text.decode('utf-8')
+    return text
+
+
+def read_headers(text):
+    """Returns the column names of a file in the download format"""
+    reader = csv.reader(io.StringIO(text), delimiter='|')
+    next(reader, None)  # Table name line
+    headers = next(reader, None)
+    if not headers:
+        raise ValueError('Upload has no header line')
+    for col in headers:
+        check_table_name(col)
+    return headers
+
+
+def iter_batches(text, headers, batch_size=VALIDATION_BATCH_SIZE):
+    """Yields the rows of an upload as DataFrames of strings and NAs"""
+    import pandas as pd
+    reader = pd.read_csv(io.StringIO(text), sep='|', skiprows=2,
+                         header=None, names=headers, dtype=str,
+                         keep_default_na=False, chunksize=batch_size)
+    for batch in reader:
+        yield batch.mask(batch.isin(NULL_VALUES))
+
+
+def integer_keys(series):
+    """Integer column values as nullable Int64; invalid values become NA"""
+    import pandas as pd
+    numbers = pd.to_numeric(series.where(series.str.fullmatch(
+        INTEGER_PATTERN, na=False)), errors='coerce')
+    return numbers.where(numbers.abs() < 2 ** 63).astype('Int64')
+
+
+def invalid_values(series, pg_type):
+    """Returns a boolean Series marking values `pg_type` cannot hold"""
+    import pandas as pd
+    present = series.notna()
+    if pg_type in INTEGER_BOUNDS:
+        valid = series.str.fullmatch(INTEGER_PATTERN, na=False)
+        numbers = pd.to_numeric(series.where(valid), errors='coerce')
+        bound = INTEGER_BOUNDS[pg_type]
+        valid &= (numbers >= -bound) & (numbers < bound)
+    elif pg_type in NUMBER_TYPES:
+        valid = pd.to_numeric(series, errors='coerce').notna()
+    elif pg_type == 'boolean':
+        valid = series.str.strip().str.lower().isin(BOOLEAN_VALUES)
+    elif pg_type in TIME_TYPES:
+        valid = pd.to_datetime(series, errors='coerce', format='ISO8601',
+                               utc=True).notna()
+    else:
+        return pd.Series(False, index=series.index)
+    return present & ~valid
+
+
+def key_frame(frame, columns, types):
+    """Returns key columns as comparable values, dropping incomplete keys.
+
+    Integer columns become Int64, so uploaded strings compare with the
+    database's ints; other values are compared as strings.
+    """
+    keys = frame[list(columns)].copy()
+    for col in columns:
+        if types.get(col) in INTEGER_BOUNDS:
+            keys[col] = integer_keys(keys[col].astype('string'))
+        else:
+            keys[col] = keys[col].astype('string')
+    return keys.dropna()
+
+
+def fetch_existing(backend, ref, keys, types):
+    """Looks up which of the distinct `keys` exist in ref.ref_table.
+
+    Returns:
+        DataFrame of the found keys, with keys' column names.
+    """
+    import pandas as pd
+    cols = list(keys.columns)
+    names = ['k{}'.format(i) for i in range(len(cols))]
+    # Joining a VALUES list lets both databases probe the key's index
+    sql = """WITH keys({}) AS (VALUES {{}})
+             SELECT {} FROM keys JOIN {} r ON {}""".format(
+        ', '.join(names),
+        ', '.join('keys.' + name for name in names),
+        check_table_name(ref.ref_table),
+        ' AND '.join('r.{} = keys.{}'.format(check_table_name(col), name)
+                     for col, name in zip(ref.ref_columns, names)))
+    if ref.condition:
+        sql += ' AND r.' + ref.condition
+    row_placeholders = '({})'.format(make_placeholders_for(cols))
+    found = []
+    # Python ints and strs, which the database drivers take
+    rows = keys.to_numpy(dtype=object).tolist()
+    for start in range(0, len(rows), LOOKUP_BATCH_SIZE):
+        batch = rows[start:start + LOOKUP_BATCH_SIZE]
+        found.extend(tuple(row) for row in backend.query(
+            sql.format(make_placeholders_for(batch, row_placeholders)),
+            [v for row in batch for v in row]))
+    existing = pd.DataFrame(found, columns=cols).astype('string')
+    return key_frame(existing, cols, types)
+
+
+def missing_keys(keys, existing):
+    """Anti-join: the rows of `keys` with no match in `existing`"""
+    cols = [col for col in keys.columns if col != '_row']
+    merged = keys.merge(existing.drop_duplicates(), on=cols, how='left',
+                        indicator=True)
+    return merged[merged['_merge'] == 'left_only']
+
+
+def iter_referrers(backend, ref, stories=None):
+    """Yields DataFrames of the distinct keys rows of ref.table reference"""
+    import pandas as pd
+    cols = ', '.join(check_table_name(col) for col in ref.columns)
+    conditions = ['{} IS NOT NULL'.format(col) for col in ref.columns]
+    data = []
+    if ref.referrer_condition:
+        conditions.append(ref.referrer_condition)
+    if stories is not None:
+        conditions.append('story_id IN ({})'.format(
+            make_placeholders_for(stories)))
+        data.extend(stories)
+    sql = """SELECT DISTINCT {} FROM {} WHERE {}""".format(
+        cols, check_table_name(ref.table), ' AND '.join(conditions))
+    for rows in backend.iter_query_batches(sql, data,
+                                           name='validate_referrers'):
+        yield pd.DataFrame([tuple(row) for row in rows],
+                           columns=list(ref.ref_columns)).astype('string')
+
+
+def validate_upload(table_name, csv_file, backend=None, add_revision=None):
+    """Checks an upload against the table's schema and referenced tables.
+
+    Nothing is written. A table that does not exist yet is not checked.
+
+    Args:
+        table_name: Table the file is uploaded to.
+
+        csv_file: File-like object or string in the download format (see
+            backends.rows_to_csv()).
+
+        backend: StorageBackend to check against. Default: the configured
+            one
+
+        add_revision: Whether the upload adds story revisions (see
+            revisions.upload_statements()) rather than replacing rows.
+            Default: whether the table is in STORY_TABLES
+
+    Returns:
+        List of violation dicts of check ('column', 'type', 'not_null',
+        'unique', 'reference' or 'referenced'), columns, count, rows (the
+        first data row numbers, starting at 1) and message.
+    """
+    text = csv_file if isinstance(csv_file, str) else read_text(csv_file)
+    headers = read_headers(text)
+    return validate_batches(table_name, headers, iter_batches(text, headers),
+                            backend, add_revision)
+
+
+def validate_batches(table_name, headers, batches, backend=None,
+                     add_revision=None):
+    """Checks an upload that is already read into DataFrames.
+
+    Like validate_upload(), for files in other formats, e.g. the record
+    batches of a columnar import.
+
+    Args:
+        headers: Column names of the upload.
+
+        batches: Iterable of DataFrames with `headers` columns, holding
+            values as strings and NULLs as NA, as by iter_batches().
+
+        See validate_upload() for the others.
+
+    Returns:
+        List of violation dicts; see validate_upload().
+    """
+    import pandas as pd
+    check_table_name(table_name)
+    backend = get_backend() if backend is None else backend
+    if add_revision is None:
+        add_revision = table_name in STORY_TABLES
+
+    types = dict(backend.table_columns(table_name))
+    if not types:
+        return []
+    tables = {table: backend.table_constraints(table)
+              for table in backend.table_dependencies()}
+    tables.setdefault(table_name, backend.table_constraints(table_name))
+    ignored = REVISION_IGNORED_COLUMNS if add_revision else ()
+    if add_revision:
+        unique, outgoing, incoming = revision_upload_rules(table_name, tables)
+    else:
+        unique, outgoing, incoming = replace_upload_rules(table_name, tables)
+
+    violations = []
+    unknown = [col for col in headers if col not in types]
+    if unknown:
+        violations.append(violation(
+            'column', unknown, len(unknown), [],
+            '{} has no column {}'.format(table_name, ', '.join(unknown))))
+    not_null = {col: has_default for col, has_default
+                in tables[table_name]['not_null'].items()
+                if col not in ignored}
+    absent = [col for col, has_default in not_null.items()
+              if not has_default and col not in headers]
+    if absent:
+        violations.append(violation(
+            'column', absent, len(absent), [],
+            'Upload lacks NOT NULL column {}'.format(', '.join(absent))))
+
+    checked = [col for col in headers if col in types and col not in ignored]
+    unique = [cols for cols in unique if set(cols) <= set(headers)]
+    outgoing = [ref for ref in outgoing if set(ref.columns) <= set(headers)]
+    key_columns = sorted({col for cols in unique for col in cols}
+                         .union(col for ref in outgoing
+                                for col in ref.columns)
+                         .union(col for ref in incoming
+                                for col in ref.ref_columns
+                                if col in headers)
+                         .union(['story_id'] if 'story_id' in headers
+                                else []))
+
+    # Per-column checks batch by batch; key columns are kept for the rest
+    bad_rows = {}   # (check, column) -> list of row number arrays
+    keys = []
+    row_count = 0
+    for batch in batches:
+        rows = pd.RangeIndex(row_count + 1, row_count + len(batch) + 1)
+        batch.index = rows
+        row_count += len(batch)
+        if add_revision and 'removed_in' in headers:
+            batch = batch[batch['removed_in'].isna()]
+        for col in checked:
+            invalid = invalid_values(batch[col], types[col])
+            if invalid.any():
+                bad_rows.setdefault(('type', col), []).append(
+                    batch.index[invalid.to_numpy()])
+            if col in not_null:
+                nulls = batch[col].isna()
+                if nulls.any():
+                    bad_rows.setdefault(('not_null', col), []).append(
+                        batch.index[nulls.to_numpy()])
+        keys.append(batch[key_columns])
+
+    for (check, col), parts in bad_rows.items():
+        rows = [row for part in parts for row in part]
+        if check == 'type':
+            message = '{} value(s) of {} are not {} {}'.format(
+                len(rows), col, types[col], format_rows(rows, len(rows)))
+        else:
+            message = '{} is NULL in {} row(s) {}'.format(
+                col, len(rows), format_rows(rows, len(rows)))
+        violations.append(violation(check, [col], len(rows), rows, message))
+
+    keys = (pd.concat(keys) if keys else
+            pd.DataFrame(columns=key_columns, dtype='string'))
+
+    for cols in unique:
+        frame = key_frame(keys, cols, types)
+        repeated = frame[frame.duplicated(keep=False)]
+        if len(repeated):
+            rows = list(repeated.index)
+            violations.append(violation(
+                'unique', cols, len(rows), rows,
+                '{} rows repeat a ({}) key, e.g. {} {}'.format(
+                    len(rows), ', '.join(cols),
+                    format_key(repeated.iloc[0]),
+                    format_rows(rows, len(rows)))))
+
+    for ref in outgoing:
+        frame = key_frame(keys, ref.columns, types)
+        frame['_row'] = frame.index
+        distinct = frame[list(ref.columns)].drop_duplicates()
+        if ref.ref_table == table_name:
+            existing = key_frame(keys, ref.ref_columns, types)
+            existing.columns = list(ref.columns)
+        else:
+            existing = fetch_existing(backend, ref, distinct, types)
+        missing = missing_keys(frame, existing)
+        if len(missing):
+            rows = list(missing['_row'])
+            violations.append(violation(
+                'reference', ref.columns, len(rows), rows,
+                '{} row(s) reference no {} row: {}, e.g. {} {}'.format(
+                    len(rows), ref.ref_table, ref.describe(),
+                    format_key(missing.iloc[0][list(ref.columns)]),
+                    format_rows(rows, len(rows)))))
+
+    for ref in incoming:
+        if not set(ref.ref_columns) <= set(headers):
+            continue
+        stories = None
+        if add_revision:
+            # Only the uploaded stories get a new revision
+            stories = [plain(v) for v in
+                       key_frame(keys, ('story_id',), types)['story_id']
+                       .unique()]
+            if not stories:
+                continue
+        uploaded = key_frame(keys, ref.ref_columns, types)
+        missing = []
+        for referrers in iter_referrers(backend, ref, stories):
+            referrers = key_frame(referrers, ref.ref_columns, types)
+            found = missing_keys(referrers, uploaded)
+            missing.extend(found[list(ref.ref_columns)].itertuples(
+                index=False))
+        if missing:
+            violations.append(violation(
+                'referenced', ref.columns, len(missing), [],
+                '{} ({}) keys that {} references are missing from the '
+                'upload: {}, e.g. {}'.format(
+                    len(missing), ', '.join(ref.ref_columns), ref.table,
+                    ref.describe(), format_key(missing[0]))))
+    return violations
+
+
+def check_upload(table_name, csv_file, backend=None, add_revision=None):
+    """Validates an upload; see validate_upload().
+
+    Raises:
+        UploadValidationError if there are violations.
+    """
+    violations = validate_upload(table_name, csv_file, backend, add_revision)
+    if violations:
+        raise UploadValidationError(table_name, violations)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m db_tools.validation',
+        description='Checks a CSV file before uploading it to a table.')
+    parser.add_argument('table_name')
+    parser.add_argument('path')
+    parser.add_argument('--replace', action='store_true',
+                        help='check a story table as replaced, not as new '
+                             'revisions')
+    args = parser.parse_args(argv)
+
+    with open(args.path, encoding='utf-8') as f:
+        violations = validate_upload(args.table_name, f,
+                                     add_revision=False if args.replace
+                                     else None)
+    for v in violations:
+        print(v['message'])
+    print('{} problem(s)'.format(len(violations)), file=sys.stderr)
+    return 1 if violations else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,338 @@
+"""
+Asynchronous server for player traffic.
+
+Serves the player-facing read path (snippet lookups, saved games, choices)
+from an asyncio event loop with its own asyncpg connection pool, so a player
+waiting on the database costs a coroutine instead of a thread. The routes and
+responses are the same as the /api/ routes in webapp.py, which keeps serving
+the debug and admin pages; run both side by side and send /api/ traffic here.
+
+Settings (environment variables):
+    DATABASE_URL     -- same as for webapp.py (PostgreSQL only)
+    STORY_BUNDLE     -- serve snippets from this bundle file (see
+                        snips_api/bundle.py) instead of the database
+    PLAYER_PORT      -- port to listen on. Default: 5001
+    PLAYER_POOL_MIN  -- minimum pooled database connections. Default: 2
+    PLAYER_POOL_MAX  -- maximum pooled database connections. Default: 20
+    DATABASE_REPLICA_URLS, REPLICA_MAX_LAG, REPLICA_LAG_CHECK
+                     -- snippet lookups use a second pool on the first
+                        replica while it is caught up (see
+                        db_tools/replicas.py); saved games always use the
+                        primary
+
+Usage:
+    $ python player_server.py
+"""
+
+# Standard libary
+import logging
+import os
+
+# Third-party modules
+from aiohttp import web
+import asyncpg
+
+# Local modules
+from db_tools import db_url, replicas
+from db_tools.backends import PostgresBackend
+from snips_api import runtime
+from snips_api.flags import (FLAG_REGISTRY_QUERY, FlagRegistry,
+                             generate_sql_for_flags)
+from snips_api.runtime import GameError, to_numbered_params
+from snips_api.texts import TextCache
+
+SNIPPET_QUERY = to_numbered_params(runtime.SNIPPET_QUERY)
+CHOICES_QUERY = to_numbered_params(runtime.CHOICES_QUERY)
+LOAD_GAME_QUERY = to_numbered_params(runtime.LOAD_GAME_QUERY)
+SAVE_GAME_QUERY = to_numbered_params(runtime.SAVE_GAME_QUERY)
+TEXTS_QUERY = """SELECT text_id, body FROM texts
+                 WHERE text_id = ANY($1::bigint[])"""
+SNIPPETS_QUERY = to_numbered_params(runtime.SNIPPETS_QUERY.replace(
+    'IN ({})', '= ANY(%s::int[])'))
+CHOICES_OF_SNIPPETS_QUERY = to_numbered_params(
+    runtime.CHOICES_OF_SNIPPETS_QUERY.replace('IN ({})', '= ANY(%s::int[])'))
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncDatabaseSource():
+    """Reads snippets through the asyncpg pool, or a replica's pool
+
+    `replica` is the replica's db_tools.replicas.ReplicaState; its lag is
+    checked through `replica_pool` when due.
+    """
+    def __init__(self, pool, text_cache=None, replica_pool=None,
+                 replica=None):
+        self.pool = pool
+        self.text_cache = TextCache() if text_cache is None else text_cache
+        self.replica_pool = replica_pool
+        self.replica = replica
+
+
+    async def read_pool(self):
+        """Returns the replica's pool if it is caught up, else the primary's"""
+        if self.replica_pool is None:
+            return self.pool
+        if self.replica.check_due():
+            try:
+                self.replica.record(
+                    await self.replica_pool.fetchval(replicas.LAG_QUERY))
+            except (OSError, asyncpg.PostgresError):
+                self.replica.record(None)
+        return self.replica_pool if self.replica.usable else self.pool
+
+
+    async def get_snippet(self, story_id, snip_id):
+        pool = await self.read_pool()
+        async with pool.acquire() as conn:
+            row = await conn.fetchrow(SNIPPET_QUERY, story_id, snip_id)
+            if row is None:
+                return None
+            revision = row['revision']
+            choice_rows = await conn.fetch(CHOICES_QUERY, story_id, snip_id,
+                                           revision, revision)
+            texts = await self._get_texts(
+                conn, runtime.referenced_text_ids(row, choice_rows))
+        return runtime.snippet_from_rows(row, choice_rows, texts)
+
+
+    async def get_snippets(self, story_id, snip_ids):
+        if not snip_ids:
+            return {}
+        pool = await self.read_pool()
+        async with pool.acquire() as conn:
+            rows = await conn.fetch(SNIPPETS_QUERY, story_id, snip_ids)
+            if not rows:
+                return {}
+            revision = rows[0]['revision']
+            choices = runtime.group_choice_rows(await conn.fetch(
+                CHOICES_OF_SNIPPETS_QUERY, story_id, revision, revision,
+                snip_ids))
+            ids = []
+            for row in rows:
+                ids.extend(runtime.referenced_text_ids(
+                    row, choices.get(row['snip_id'], [])))
+            texts = await self._get_texts(conn, ids)
+        return {row['snip_id']: runtime.snippet_from_rows(
+                    row, choices.get(row['snip_id'], []), texts)
+                for row in rows}
+
+
+    async def _get_texts(self, conn, ids):
+        texts, missing = self.text_cache.lookup(ids)
+        if missing:
+            fetched = [(r['text_id'], r['body'])
+                       for r in await conn.fetch(TEXTS_QUERY, missing)]
+            self.text_cache.add(fetched)
+            texts.update(fetched)
+        return texts
+
+
+
+class AsyncBundleSource():
+    """Reads snippets from a story bundle; lookups never block on I/O"""
+    def __init__(self, path):
+        self.source = runtime.BundleSource(path)
+
+
+    async def get_snippet(self, story_id, snip_id):
+        return self.source.get_snippet(story_id, snip_id)
+
+
+    async def get_snippets(self, story_id, snip_ids):
+        return self.source.get_snippets(story_id, snip_ids)
+
+
+
+class AsyncFlagCodec():
+    """Packs flag states, reloading the flag registry when it is outdated"""
+    def __init__(self, pool):
+        self.pool = pool
+        self.registry = None
+
+
+    async def load_registry(self):
+        self.registry = FlagRegistry.from_rows(
+            await self.pool.fetch(FLAG_REGISTRY_QUERY))
+        return self.registry
+
+
+    async def decode(self, value):
+        registry = self.registry or await self.load_registry()
+        if not registry.can_unpack(value):
+            registry = await self.load_registry()
+        return registry.unpack(value)
+
+
+    async def encode(self, state):
+        registry = self.registry or await self.load_registry()
+        if not registry.can_pack(state):
+            registry = await self.load_registry()
+        if not registry.can_pack(state):
+            await self.register(sorted(set(state) - set(registry.slots)))
+            registry = await self.load_registry()
+        return registry.pack(state)
+
+
+    async def register(self, names):
+        """Registers flags that a state uses but the registry lacks"""
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                for sql, data in generate_sql_for_flags(names,
+                                                        PostgresBackend()):
+                    await conn.execute(to_numbered_params(sql), *data)
+
+
+
+async def load_game(pool, game_id):
+    row = await pool.fetchrow(LOAD_GAME_QUERY, game_id)
+    if row is None:
+        raise GameError('No saved game {}'.format(game_id), status=404)
+    return row
+
+
+async def get_snippet_or_404(source, story_id, snip_id):
+    snippet = await source.get_snippet(story_id, snip_id)
+    if snippet is None:
+        raise GameError('No snippet {} in story {}'.format(snip_id, story_id),
+                        status=404)
+    return snippet
+
+
+async def prefetch(request, view, snippet, state, game):
+    """Async counterpart of runtime.prefetch(), for ?prefetch=<depth>"""
+    depth, max_bytes = runtime.prefetch_limits(
+        request.query.get('prefetch'))
+    if not depth:
+        return view
+    steps = runtime.prefetch_steps(view, snippet, state, game, depth,
+                                   max_bytes)
+    try:
+        snip_ids = next(steps)
+        while True:
+            snip_ids = steps.send(await request.app['source'].get_snippets(
+                snippet['story_id'], snip_ids))
+    except StopIteration:
+        pass
+    return view
+
+
+async def api_snippet(request):
+    snippet = await get_snippet_or_404(request.app['source'],
+                                       int(request.match_info['story_id']),
+                                       int(request.match_info['snip_id']))
+    return web.json_response(snippet)
+
+
+async def api_game(request):
+    game = await load_game(request.app['pool'],
+                           int(request.match_info['game_id']))
+    state = await request.app['flags'].decode(game['flags'])
+    view = None
+    if game['current_snip_id'] is not None:
+        snippet = await request.app['source'].get_snippet(
+            game['story_id'], game['current_snip_id'])
+        if snippet is not None:
+            view = await prefetch(request,
+                                  runtime.player_view(snippet, state, game),
+                                  snippet, state, game)
+    return web.json_response(dict(
+        game_id=game['game_id'],
+        my_name=game['my_name'],
+        story_id=game['story_id'],
+        snippet=view,
+    ))
+
+
+async def api_choose(request):
+    game_id = int(request.match_info['game_id'])
+    try:
+        body = await request.json()
+        snip_id = int(body['snip_id'])
+        choice_index = int(body['choice_index'])
+        story_id = body.get('story_id')
+        story_id = None if story_id is None else int(story_id)
+    except (KeyError, TypeError, ValueError):
+        raise GameError('Expected JSON with snip_id and choice_index')
+
+    pool, source = request.app['pool'], request.app['source']
+    game = await load_game(pool, game_id)
+    story_id = runtime.game_story_id(game, story_id)
+    runtime.check_position(game, snip_id)
+
+    snippet = await get_snippet_or_404(source, story_id, snip_id)
+    state = await request.app['flags'].decode(game['flags'])
+    next_snip_id, state = runtime.choose(snippet, choice_index, state)
+    next_snippet = await get_snippet_or_404(source, story_id, next_snip_id)
+
+    status = await pool.execute(SAVE_GAME_QUERY, story_id, next_snip_id,
+                                await request.app['flags'].encode(state),
+                                game_id, game['story_id'],
+                                game['current_snip_id'])
+    # "UPDATE <rows>"
+    if status.split()[-1] == '0':
+        raise runtime.stale_save_error(game_id, snip_id)
+    view = runtime.player_view(next_snippet, state, game)
+    return web.json_response(await prefetch(request, view, next_snippet,
+                                            state, game))
+
+
+@web.middleware
+async def game_errors(request, handler):
+    try:
+        return await handler(request)
+    except GameError as e:
+        return web.json_response(dict(error=str(e)), status=e.status)
+
+
+async def open_pool(app):
+    app['pool'] = await asyncpg.create_pool(
+        dsn=db_url(),
+        min_size=int(os.environ.get('PLAYER_POOL_MIN', 2)),
+        max_size=int(os.environ.get('PLAYER_POOL_MAX', 20)),
+    )
+    app['flags'] = AsyncFlagCodec(app['pool'])
+    app['replica_pool'] = replica = None
+    bundle_path = os.environ.get(runtime.BUNDLE_ENVVAR)
+    if bundle_path:
+        app['source'] = AsyncBundleSource(bundle_path)
+        return
+
+    if replicas.replicas():
+        replica = replicas.replicas()[0]
+        try:
+            app['replica_pool'] = await asyncpg.create_pool(
+                dsn=replica.url,
+                min_size=0,
+                max_size=int(os.environ.get('PLAYER_POOL_MAX', 20)),
+            )
+        except (OSError, asyncpg.PostgresError):
+            logger.exception("Replica %s unavailable; reading from the "
+                             "primary", replica.parsed_url.hostname)
+    app['source'] = AsyncDatabaseSource(
+        app['pool'], replica_pool=app['replica_pool'], replica=replica)
+
+
+async def close_pool(app):
+    await app['pool'].close()
+    if app['replica_pool'] is not None:
+        await app['replica_pool'].close()
+
+
+def make_app():
+    app = web.Application(middlewares=[game_errors])
+    app.on_startup.append(open_pool)
+    app.on_cleanup.append(close_pool)
+    app.router.add_get(r'/api/story/{story_id:\d+}/snippet/{snip_id:\d+}',
+                       api_snippet)
+    app.router.add_get(r'/api/game/{game_id:\d+}', api_game)
+    app.router.add_post(r'/api/game/{game_id:\d+}/choose', api_choose)
+    return app
+
+
+if __name__ == '__main__':
+    # Figure out if debugging is wanted
+    debugging = int(os.environ.get('FLASK_DEBUG', 0))
+    host = '127.0.0.1' if debugging else '0.0.0.0'
+    web.run_app(make_app(), host=host,
+                port=int(os.environ.get('PLAYER_PORT', 5001)))
@@ -1,6 +1,13 @@
+import sys
 import unittest
 
+import db_tools.tests
 import snips_api.tests
 
 
-unittest.main(snips_api.tests)
+suite = unittest.TestSuite(
+    unittest.defaultTestLoader.loadTestsFromModule(module)
+    for module in (snips_api.tests, db_tools.tests)
+)
+result = unittest.TextTestRunner().run(suite)
+sys.exit(not result.wasSuccessful())
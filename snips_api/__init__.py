@@ -13,6 +13,7 @@ def pprint_generator(gen, maxcols=60):
         pprint_generator(gen)
     """
     def trunc(t):
+        t = str(t)
         if len(t) > maxcols:
             t = t[:maxcols - 3] + '...'
         return t
@@ -22,7 +23,7 @@ def pprint_generator(gen, maxcols=60):
         if 'INSERT INTO snippets' in sql:
             d = list(data)
             for i in range(len(d)// 2):
-                print('   ', d[i * 2 + 1], trunc(d[i * 2]))
+                print('   ', d[i * 2], trunc(d[i * 2 + 1]))
         else:
             print('   ', data)
 
@@ -0,0 +1,108 @@
+"""
+Command-line entry point for the snips_api parser.
+
+Usage:
+    $ python -m snips_api script.txt             # print generated statements
+    $ python -m snips_api script.txt --check     # parse only, no database
+    $ python -m snips_api script.txt --execute   # commit to the database
+    $ DATABASE_URL=sqlite:///story.db python -m snips_api script.txt --execute
+    $ python -m snips_api script.txt --profile   # also print phase timings
+    $ python -m snips_api script.txt --execute --bundle story.bundle
+    $ python -m snips_api script.txt --profile-json report.json
+    $ python -m snips_api script.txt --no-cache  # don't use the parse cache
+"""
+
+import argparse
+import contextlib
+import json
+import sys
+
+from . import pprint_generator, profiling, snips_parser
+from .bundle import StagedBundle
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m snips_api',
+        description='Parse a snippet script and compile it into SQL.')
+    parser.add_argument('script', help='path to the script ("-" for stdin)')
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--check', action='store_true',
+                      help='only parse and link the script; does not need '
+                           'a database connection')
+    mode.add_argument('--execute', action='store_true',
+                      help='execute the generated statements in the '
+                           'database at DATABASE_URL')
+    parser.add_argument('--bundle', metavar='PATH',
+                        help='also write the compiled story to a bundle '
+                             'file at PATH (replaced atomically, with '
+                             '--execute once the statements are committed)')
+    parser.add_argument('--profile', action='store_true',
+                        help='print per-phase timings and counters to stderr')
+    parser.add_argument('--profile-json', metavar='PATH',
+                        help='write the profile report to PATH as JSON')
+    parser.add_argument('--trace-allocations', action='store_true',
+                        help='also measure memory allocated in each phase')
+    parser.add_argument('--no-cache', dest='use_cache', action='store_false',
+                        help='always parse the script, bypassing the on-disk '
+                             'parse cache')
+    args = parser.parse_args(argv)
+
+    text = read_script(args.script)
+
+    staged = (StagedBundle(args.bundle) if args.bundle
+              else contextlib.nullcontext())
+    with profiling.profile(args.trace_allocations) as prof, staged as bundle:
+        if args.check:
+            snippets, _ = snips_parser.parse_text(text, args.use_cache)
+            print('OK: {} snippets'.format(len(snippets)))
+        elif args.execute:
+            statements = list(snips_parser.parse(
+                text, bundle=bundle, use_cache=args.use_cache))
+            execute(statements)
+            # The bundle replaces the old one only once the database has the
+            # same snip_ids
+            if bundle is not None:
+                bundle.commit()
+            print('Executed {} statements'.format(len(statements)))
+            warn_orphans(text, args.use_cache)
+        else:
+            pprint_generator(snips_parser.parse(
+                text, bundle=bundle, use_cache=args.use_cache))
+            if bundle is not None:
+                bundle.commit()
+
+    if args.profile:
+        print(prof.format_report(), file=sys.stderr)
+    if args.profile_json:
+        with open(args.profile_json, 'w', encoding='utf-8') as f:
+            json.dump(prof.report(), f, indent=2)
+    return 0
+
+
+def read_script(path):
+    if path == '-':
+        return sys.stdin.read()
+    with open(path, encoding='utf-8') as f:
+        return f.read()
+
+
+def execute(statements):
+    from db_tools.backends import get_backend
+    with profiling.phase('execute'):
+        get_backend().execute_statements(statements)
+
+
+def warn_orphans(text, use_cache=True):
+    """Reports snippets of the executed story that its root cannot reach"""
+    from . import compiler
+    _, directives = snips_parser.parse_text(text, use_cache)
+    orphans = compiler.find_orphans(directives['ROOT_SNIP_ID'])
+    if orphans:
+        print('Warning: {} snippet(s) of story {} are unreachable: {}'.format(
+            len(orphans), directives['ROOT_SNIP_ID'],
+            ', '.join(str(snip_id) for snip_id in orphans)), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,330 @@
+"""
+Compiled story bundles.
+
+A bundle is a single binary file holding a compiled story: fixed-width
+snippet and choice records, pre-parsed flag operations and a string table.
+Readers mmap the file and answer lookups straight from the mapped pages, so
+every worker process serving the same bundle shares one copy in the OS page
+cache. Bundles are written to a temporary file and renamed into place, so
+deploying a new story version is an atomic file swap. A StagedBundle holds
+the temporary file back until the caller commits it, e.g. once the same
+compile's statements are committed to the database.
+
+Layout (all integers little-endian):
+
+    header     HEADER struct, see below
+    snippets   n_snippets x SNIPPET records, sorted by snip_id
+    choices    n_choices  x CHOICE records, grouped by snippet
+    flag ops   n_flagops  x FLAGOP records, grouped by choice (checks first)
+    strings    UTF-8 string table; identical strings are stored once
+
+Usage:
+    write_bundle('story.bundle', root_snip_id, snips, dict_snip_to_id)
+
+    with StagedBundle('story.bundle') as staged:
+        staged.write(root_snip_id, snips, dict_snip_to_id)
+        ...                 # the file is only replaced by:
+        staged.commit()
+
+    story = open_bundle('story.bundle')  # reopens if the file was replaced
+    story.get_snippet(123)
+
+A bundle holds one story, whose story_id is its root_snip_id.
+"""
+
+import mmap
+import os
+import struct
+import tempfile
+import threading
+from bisect import bisect_left
+
+from .flags import OPERATORS, OPERATOR_CODES, parse_flag_op
+
+MAGIC = b'FYMSTORY'
+VERSION = 1
+
+# magic, version, root_snip_id, n_snippets, n_choices, n_flagops,
+# snippets offset, choices offset, flag ops offset, strings offset
+HEADER = struct.Struct('<8sIqIIIQQQQ')
+# snip_id, text offset, text length, first choice, number of choices
+SNIPPET = struct.Struct('<qIIII')
+# snip_id, next_snip_id, label offset, label length, first flag op,
+# number of checks, number of modifications
+CHOICE = struct.Struct('<qqIIIHH')
+# flag name offset, flag name length, operator code, value
+FLAGOP = struct.Struct('<IIB3xi')
+
+
+class BundleError(Exception):
+    """The file is not a readable story bundle"""
+
+
+
+class _StringTable():
+    def __init__(self):
+        self.data = bytearray()
+        self.offsets = {}
+
+
+    def add(self, s):
+        """Returns (offset, length) of the UTF-8 encoded string"""
+        if s not in self.offsets:
+            encoded = s.encode('utf-8')
+            self.offsets[s] = (len(self.data), len(encoded))
+            self.data += encoded
+        return self.offsets[s]
+
+
+
+def encode_bundle(root_snip_id, snips, dict_snip_to_id):
+    """Encodes compiled snippets into bundle bytes.
+
+    Args:
+        root_snip_id: snip_id of the story's first snippet.
+
+        snips: List of Snippet objects, e.g. from get_snippets_tree().
+
+        dict_snip_to_id: Dict of {Snippet: snip_id} from the compiler.
+
+    Returns:
+        bytes
+    """
+    strings = _StringTable()
+    snippet_recs = []
+    choice_recs = []
+    flagop_recs = []
+
+    for snip in sorted(snips, key=lambda s: dict_snip_to_id[s]):
+        snip_id = dict_snip_to_id[snip]
+        text_off, text_len = strings.add(snip.text)
+        snippet_recs.append(SNIPPET.pack(
+            snip_id, text_off, text_len, len(choice_recs), len(snip.choices)))
+
+        for choice in snip.choices:
+            checks = [parse_flag_op(e) for e in choice.check_flags]
+            mods = [parse_flag_op(e) for e in choice.modifies_flags]
+            label_off, label_len = strings.add(str(choice.label))
+            choice_recs.append(CHOICE.pack(
+                snip_id, dict_snip_to_id[choice.next_snippet],
+                label_off, label_len, len(flagop_recs),
+                len(checks), len(mods)))
+            for flag_name, oper, value in checks + mods:
+                name_off, name_len = strings.add(flag_name)
+                flagop_recs.append(FLAGOP.pack(
+                    name_off, name_len, OPERATOR_CODES[oper], value))
+
+    snippets_off = HEADER.size
+    choices_off = snippets_off + SNIPPET.size * len(snippet_recs)
+    flagops_off = choices_off + CHOICE.size * len(choice_recs)
+    strings_off = flagops_off + FLAGOP.size * len(flagop_recs)
+    header = HEADER.pack(MAGIC, VERSION, root_snip_id, len(snippet_recs),
+                         len(choice_recs), len(flagop_recs), snippets_off,
+                         choices_off, flagops_off, strings_off)
+    return b''.join([header] + snippet_recs + choice_recs + flagop_recs +
+                    [bytes(strings.data)])
+
+
+def write_bundle(path, root_snip_id, snips, dict_snip_to_id):
+    """Writes a bundle to `path`, atomically replacing any existing file.
+
+    See encode_bundle() for the arguments.
+    """
+    with StagedBundle(path) as staged:
+        staged.write(root_snip_id, snips, dict_snip_to_id)
+        staged.commit()
+
+
+
+class StagedBundle():
+    """A bundle written next to `path` that replaces it only on commit().
+
+    Leaving the `with` block without committing deletes the staged file.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.tmp_path = None
+
+
+    def write(self, root_snip_id, snips, dict_snip_to_id):
+        """Writes the staged file; see encode_bundle() for the arguments"""
+        data = encode_bundle(root_snip_id, snips, dict_snip_to_id)
+        self.discard()
+        dirname = os.path.dirname(os.path.abspath(self.path))
+        fd, self.tmp_path = tempfile.mkstemp(dir=dirname, prefix='.bundle-')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+
+
+    def commit(self):
+        """Atomically replaces the file at `path` with the staged one"""
+        if self.tmp_path is None:
+            raise BundleError('No bundle staged for {}'.format(self.path))
+        os.replace(self.tmp_path, self.path)
+        self.tmp_path = None
+
+
+    def discard(self):
+        if self.tmp_path is not None:
+            os.unlink(self.tmp_path)
+            self.tmp_path = None
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc_info):
+        self.discard()
+
+
+
+class StoryBundle():
+    """Read-only, memory-mapped view of a bundle file.
+
+    Lookups decode only the records they touch. The mapping stays valid
+    even if the file is replaced on disk; use open_bundle() to pick up new
+    versions.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            self.identity = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+            if stat.st_size < HEADER.size:
+                raise BundleError('{} is too small to be a bundle'.format(
+                    path))
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._buf = memoryview(self._mmap)
+
+        (magic, version, self.root_snip_id, self.n_snippets, self.n_choices,
+         self.n_flagops, self._snippets_off, self._choices_off,
+         self._flagops_off, self._strings_off) = HEADER.unpack_from(self._buf)
+        if magic != MAGIC:
+            raise BundleError('{} is not a story bundle'.format(path))
+        if version != VERSION:
+            raise BundleError('{} has bundle version {} (expected {})'.format(
+                path, version, VERSION))
+        self.story_id = self.root_snip_id
+
+        # Sorted snip_ids for bisect; the only per-process copy of the data
+        self._snip_ids = _SnipIdColumn(self)
+
+
+    def __len__(self):
+        return self.n_snippets
+
+
+    def __contains__(self, snip_id):
+        return self._find(snip_id) is not None
+
+
+    def snip_ids(self):
+        for i in range(self.n_snippets):
+            yield self._snip_ids[i]
+
+
+    def _find(self, snip_id):
+        i = bisect_left(self._snip_ids, snip_id)
+        if i < self.n_snippets and self._snip_ids[i] == snip_id:
+            return i
+        return None
+
+
+    def _string(self, offset, length):
+        start = self._strings_off + offset
+        return str(self._buf[start:start + length], 'utf-8')
+
+
+    def get_snippet(self, snip_id):
+        """Looks up a snippet and its choices.
+
+        Returns:
+            Dict with keys story_id, snip_id, game_text and choices, or None
+            if the bundle does not contain the snip_id. Each choice is a dict
+            with keys choice_index, label, next_snip_id, check_flags and
+            modifies_flags; flag lists hold (flag_name, operator, value).
+        """
+        i = self._find(snip_id)
+        if i is None:
+            return None
+        _, text_off, text_len, first_choice, n_choices = SNIPPET.unpack_from(
+            self._buf, self._snippets_off + i * SNIPPET.size)
+
+        choices = []
+        for index in range(n_choices):
+            (_, next_snip_id, label_off, label_len, first_op, n_checks,
+             n_mods) = CHOICE.unpack_from(
+                self._buf, self._choices_off +
+                (first_choice + index) * CHOICE.size)
+            ops = [self._flagop(first_op + k) for k in range(n_checks + n_mods)]
+            choices.append(dict(
+                choice_index=index,
+                label=self._string(label_off, label_len),
+                next_snip_id=next_snip_id,
+                check_flags=ops[:n_checks],
+                modifies_flags=ops[n_checks:],
+            ))
+        return dict(
+            story_id=self.story_id,
+            snip_id=snip_id,
+            game_text=self._string(text_off, text_len),
+            choices=choices,
+        )
+
+
+    def _flagop(self, k):
+        name_off, name_len, code, value = FLAGOP.unpack_from(
+            self._buf, self._flagops_off + k * FLAGOP.size)
+        return (self._string(name_off, name_len), OPERATORS[code], value)
+
+
+    def close(self):
+        self._snip_ids = None
+        self._buf.release()
+        self._mmap.close()
+
+
+
+class _SnipIdColumn():
+    """Sequence view of the snip_id column, for bisect without copying"""
+    def __init__(self, bundle):
+        self._buf = bundle._buf
+        self._off = bundle._snippets_off
+        self._len = bundle.n_snippets
+
+
+    def __len__(self):
+        return self._len
+
+
+    def __getitem__(self, i):
+        return struct.unpack_from('<q', self._buf,
+                                  self._off + i * SNIPPET.size)[0]
+
+
+
+_open_bundles = {}
+_open_lock = threading.Lock()
+
+
+def open_bundle(path):
+    """Returns a StoryBundle for `path`, reusing an open one if possible.
+
+    The file is stat()ed on each call; if it was replaced since it was
+    opened, the new version is mapped and returned.
+    """
+    stat = os.stat(path)
+    identity = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+    bundle = _open_bundles.get(path)
+    if bundle is not None and bundle.identity == identity:
+        return bundle
+    with _open_lock:
+        bundle = _open_bundles.get(path)
+        if bundle is None or bundle.identity != identity:
+            # The previous mapping is left for in-flight readers and the
+            # garbage collector
+            bundle = _open_bundles[path] = StoryBundle(path)
+    return bundle
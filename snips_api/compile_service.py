@@ -0,0 +1,325 @@
+"""
+Compile jobs for the webapp's /api/compile endpoints.
+
+Scripts are parsed and compiled in a pool of worker processes, so a large
+script never blocks a web worker, and each job records the per-phase
+profile of its compile (see profiling.py). A job is identified by the
+SHA-256 of its script: submitting a script that is already queued, running
+or compiled but not committed returns the existing job instead of
+compiling it again. Failed and committed jobs are not reused, since the
+next compile of the same script depends on what is in the database.
+
+Compiled statements are only written to the database when the job is
+committed, either on request or right after compiling if submitted with
+commit=True. Commits after compiling run on a thread of their own, never
+on the executor's result thread, which would hold up the results of other
+jobs. The statements go through backend.execute_statements() in a
+single transaction; a job compiled before another revision of its story
+was committed fails to commit (see db_tools/revisions.py) and has to be
+submitted again.
+
+Job states:
+    queued    -- waiting for a worker
+    running   -- being compiled
+    done      -- compiled; statements are ready to commit
+    committing -- the statements are being executed
+    failed    -- the script has errors, or the compile or commit failed
+    committed -- the statements were executed
+
+Jobs live in the memory of one web process; they are dropped JOB_TTL
+seconds after finishing, or when more than MAX_JOBS are kept.
+
+Settings (environment variables):
+    COMPILE_WORKERS -- worker processes. Default: number of CPUs
+    COMPILE_JOB_TTL -- seconds finished jobs are kept. Default: 3600
+
+Usage:
+    service = compile_service.get_service()
+    job = service.submit(text, commit=False)
+    service.job(job.job_id).as_dict()
+    service.commit(job.job_id)
+"""
+
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from . import profiling, snips_parser
+from .exceptions import (ChoiceError, CompilerError, ParserError,
+                         SnippetError)
+from .templates import TemplateError
+from db_tools.backends import get_backend
+
+DEFAULT_JOB_TTL = 3600
+MAX_JOBS = 1000
+
+# Errors in the script, reported with the job rather than as crashes
+SCRIPT_ERRORS = (ParserError, CompilerError, SnippetError, ChoiceError,
+                 TemplateError)
+
+QUEUED, RUNNING, DONE, COMMITTING, FAILED, COMMITTED = (
+    'queued', 'running', 'done', 'committing', 'failed', 'committed')
+
+_service = None
+_service_lock = threading.Lock()
+
+
+class JobStateError(Exception):
+    """The job cannot be committed in its current state"""
+
+
+
+def script_hash(text):
+    """Returns the job_id of a script"""
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def compile_script(text, backend=None, use_cache=True):
+    """Parses and compiles a script, catching errors in it.
+
+    Runs in a worker process; `backend` is only passed when the service
+    runs jobs in threads.
+
+    Returns:
+        Dict of report (profiling.Profiler.report()) and either statements,
+        a list of (sql, data), or error, a dict of type and message.
+    """
+    with profiling.profile() as prof:
+        try:
+            statements = list(snips_parser.parse(text, backend=backend,
+                                                 use_cache=use_cache))
+        except SCRIPT_ERRORS as e:
+            return dict(report=prof.report(),
+                        error=dict(type=type(e).__name__, message=str(e)))
+    return dict(report=prof.report(), statements=statements)
+
+
+
+class CompileJob():
+    """A submitted script and what became of it"""
+    def __init__(self, job_id, commit=False):
+        self.job_id = job_id
+        self.commit_when_done = commit
+        self.submitted_at = time.time()
+        self.finished_at = None
+        self.future = None
+        self.statements = None
+        self.statement_count = None
+        self.report = None
+        self.error = None
+        self.committing = False
+        self.committed = False
+        self.commit_seconds = None
+        self._settled = threading.Event()
+
+
+    def wait(self, timeout=None):
+        """Waits until the job is compiled (and committed if requested).
+
+        Returns:
+            False if `timeout` seconds passed first, else True.
+        """
+        return self._settled.wait(timeout)
+
+
+    @property
+    def status(self):
+        if self.committed:
+            return COMMITTED
+        if self.error is not None:
+            return FAILED
+        if self.committing:
+            return COMMITTING
+        if self.statements is not None:
+            return DONE
+        if self.future is not None and self.future.running():
+            return RUNNING
+        return QUEUED
+
+
+    def as_dict(self):
+        """Returns the job as a JSON-serializable dict, without statements"""
+        phases = [dict(name=p['name'], calls=p['calls'], seconds=p['seconds'])
+                  for p in (self.report or {}).get('phases', [])]
+        if self.commit_seconds is not None:
+            phases.append(dict(name='commit', calls=1,
+                               seconds=self.commit_seconds))
+        return dict(
+            job_id=self.job_id, status=self.status,
+            submitted_at=self.submitted_at, finished_at=self.finished_at,
+            statements=self.statement_count,
+            phases=phases,
+            counters=(self.report or {}).get('counters', {}),
+            error=self.error)
+
+
+
+class CompileService():
+    """Compiles scripts in an executor and keeps their jobs.
+
+    Args:
+        executor: concurrent.futures executor to compile in. Default: a
+                  ProcessPoolExecutor with COMPILE_WORKERS processes.
+
+        backend: StorageBackend to commit to, and to compile against if the
+                 executor runs jobs in threads. Default: the configured
+                 backend (workers processes use their own).
+
+        job_ttl: Seconds finished jobs are kept.
+
+        commit_executor: Executor that runs the commits of jobs submitted
+                 with commit=True. Default: one thread, so that they
+                 commit in the order they finish compiling.
+    """
+    def __init__(self, executor=None, backend=None, job_ttl=None,
+                 commit_executor=None):
+        if executor is None:
+            workers = os.environ.get('COMPILE_WORKERS')
+            executor = ProcessPoolExecutor(int(workers) if workers else None)
+        if job_ttl is None:
+            job_ttl = float(os.environ.get('COMPILE_JOB_TTL',
+                                           DEFAULT_JOB_TTL))
+        if commit_executor is None:
+            commit_executor = ThreadPoolExecutor(
+                1, thread_name_prefix='compile-commit')
+        self.executor = executor
+        self.commit_executor = commit_executor
+        self.backend = backend
+        # Backends hold connections and locks, which cannot be sent to
+        # worker processes
+        self._compile_backend = (None if isinstance(executor,
+                                                    ProcessPoolExecutor)
+                                 else backend)
+        self.job_ttl = job_ttl
+        self._jobs = OrderedDict()
+        self._lock = threading.RLock()
+
+
+    def submit(self, text, commit=False):
+        """Queues a script for compiling, or returns its existing job.
+
+        Set `commit` to commit the statements once they are compiled.
+        """
+        job_id = script_hash(text)
+        with self._lock:
+            self._expire()
+            job = self._jobs.get(job_id)
+            if job is not None and job.status in (QUEUED, RUNNING, DONE,
+                                                   COMMITTING):
+                commit_now = commit and job.status == DONE
+                job.commit_when_done = job.commit_when_done or commit
+                future = None
+            else:
+                commit_now = False
+                job = self._jobs[job_id] = CompileJob(job_id, commit)
+                self._jobs.move_to_end(job_id)
+                future = job.future = self.executor.submit(
+                    compile_script, text, self._compile_backend)
+        # A future that is already done runs the callback right here, which
+        # must not happen while holding the lock
+        if future is not None:
+            future.add_done_callback(lambda future: self._finish(job, future))
+        if commit_now:
+            self._commit_quietly(job)
+        return job
+
+
+    def job(self, job_id):
+        """Returns the CompileJob with `job_id`, or None"""
+        with self._lock:
+            self._expire()
+            return self._jobs.get(job_id)
+
+
+    def commit(self, job_id):
+        """Executes a compiled job's statements.
+
+        Raises:
+            KeyError if there is no such job.
+            JobStateError unless the job is done.
+        """
+        with self._lock:
+            job = self._jobs[job_id]
+            if job.status != DONE:
+                raise JobStateError('Job {} is {}, not {}'.format(
+                    job_id, job.status, DONE))
+            job.committing = True
+
+        # Other jobs stay readable while the transaction runs
+        backend = self.backend if self.backend is not None else get_backend()
+        start = time.perf_counter()
+        try:
+            backend.execute_statements(job.statements)
+        except Exception as e:
+            error = dict(type=type(e).__name__, message=str(e))
+        else:
+            error = None
+        with self._lock:
+            job.commit_seconds = time.perf_counter() - start
+            job.finished_at = time.time()
+            job.committing = False
+            job.error = error
+            if error is None:
+                job.committed = True
+                job.statements = None
+        job._settled.set()
+        return job
+
+
+    def _finish(self, job, future):
+        with self._lock:
+            job.finished_at = time.time()
+            exc = future.exception()
+            if exc is not None:
+                job.error = dict(type=type(exc).__name__, message=str(exc))
+            else:
+                result = future.result()
+                job.report = result['report']
+                job.error = result.get('error')
+                job.statements = result.get('statements')
+            if job.statements is None or not job.commit_when_done:
+                job.statement_count = (None if job.statements is None
+                                       else len(job.statements))
+                job._settled.set()
+                return
+            job.statement_count = len(job.statements)
+        # This runs on the executor's result thread; keep it free
+        self.commit_executor.submit(self._commit_quietly, job)
+
+
+    def _commit_quietly(self, job):
+        """Commits a job unless someone else already did"""
+        try:
+            self.commit(job.job_id)
+        except JobStateError:
+            pass
+
+
+    def _expire(self):
+        """Drops finished jobs past the TTL, and the oldest past MAX_JOBS"""
+        now = time.time()
+        for job_id, job in list(self._jobs.items()):
+            finished = job.status in (DONE, FAILED, COMMITTED)
+            if finished and (now - job.finished_at > self.job_ttl or
+                             len(self._jobs) > MAX_JOBS):
+                del self._jobs[job_id]
+
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+        # After the executor, whose last jobs may still queue commits
+        self.commit_executor.shutdown(wait=True)
+
+
+
+def get_service():
+    """Returns the webapp's CompileService, creating it on first use"""
+    global _service
+    if _service is None:
+        with _service_lock:
+            if _service is None:
+                _service = CompileService()
+    return _service
@@ -1,16 +1,67 @@
 """
 Compiler used by components.Snippet.generate_chain_sql()
+
+A compiled story is identified by its story_id, the snip_id of its root
+snippet. snip_ids are looked up, allocated and replaced within that story
+only; other stories' rows are never read or locked.
+
+Each compile adds a revision to the story (see db_tools/revisions.py) and
+makes it live: only the snippets and choice lists that differ from the
+story's latest revision are written, and the rows of earlier revisions are
+kept for rolling back.
 """
 
+from . import profiling
+from .flags import generate_sql_for_flags, story_flag_names
+from .templates import TemplateError, validate_snippets
+from .texts import generate_sql_for_texts, text_id
 from .exceptions import *
-from db_tools import AppDBConnection, AppCursor
+from db_tools import metrics
+from db_tools.backends import get_backend
+from db_tools.revisions import revision_statements
 
 from itertools import zip_longest
 
-
-def snippet_chain_to_sql_data(snip, insert_method='timid'):
+# Snippets of a revision of a story (default: the live one) that its root
+# snippet cannot reach
+ORPHANS_QUERY = """WITH RECURSIVE live(revision) AS (
+                       SELECT COALESCE(%s, live_revision) FROM stories
+                       WHERE story_id = %s
+                   ), reachable(snip_id) AS (
+                       SELECT %s
+                     UNION
+                       SELECT c.next_snip_id
+                       FROM choices c JOIN reachable r ON c.snip_id = r.snip_id
+                       JOIN live ON c.added_in <= live.revision
+                         AND (c.removed_in IS NULL
+                              OR c.removed_in > live.revision)
+                       WHERE c.story_id = %s
+                   )
+                   SELECT s.snip_id FROM snippets s
+                   JOIN live ON s.added_in <= live.revision
+                     AND (s.removed_in IS NULL OR s.removed_in > live.revision)
+                   WHERE s.story_id = %s
+                     AND s.snip_id NOT IN (SELECT snip_id FROM reachable)
+                   ORDER BY s.snip_id"""
+
+
+def snippet_chain_to_sql_data(snip, insert_method='timid', backend=None,
+                              bundle=None, dedup_text=False):
     """Creates SQL for all snippets reachable from the given 'root snippet'
 
+    The story's id is the root's snip_id.
+
+    `backend` is the db_tools.backends.StorageBackend used to look up
+    existing and spare snip_ids. Defaults to the configured backend.
+
+    If `bundle` (a bundle.StagedBundle) is given, the compiled snippets are
+    also written to it using the same snip_ids. The caller commits it once
+    the returned statements are committed, so the bundle never holds
+    snip_ids that the database does not.
+
+    If `dedup_text` is True, snippet texts and choice labels are stored once
+    each in the texts table and referenced by text_id (see texts.py).
+
     Returns a list of (query, data) tuples.
     """
     try:
@@ -19,34 +70,70 @@ def snippet_chain_to_sql_data(snip, insert_method='timid'):
         raise CompilerError('The starting snippet has invalid snip_id '
                             '(expected int, got {})'.format(str(snip.snip_id))
                            )
+    story_id = int(snip.snip_id)
+    if story_id < 0:
+        raise CompilerError('The starting snippet\'s snip_id is the story id '
+                            'and must not be negative (got {})'.format(
+                                story_id))
 
     # Collate unique snippets starting with the root
     # get_snippets_network() returns list of unique snippets connected to the
     # 'root' node, including the root node itself
-    snips = snip.get_snippets_tree()
+    with profiling.phase('snippets_tree'):
+        snips = snip.get_snippets_tree()
+
+    # Snippets built in code skip the parser's placeholder check
+    try:
+        validate_snippets(snips)
+    except TemplateError as e:
+        raise CompilerError(str(e))
 
     
     # Assign snip_ids to snippets
     # Snippets with valid int(snippet.snip_id) will use that snip_id
     # Snippets with pending snip_id will be assigned an unused on in the db
-    dict_snip_to_id, ids_to_drop = assign_ids(snips, insert_method)
+    with profiling.phase('assign_ids'):
+        dict_snip_to_id = assign_ids(snips, insert_method, backend)
+        with metrics.source('compiler.partitions'):
+            partition_sql = (backend or get_backend()
+                             ).story_partition_statements(story_id)
+
+    if bundle is not None:
+        with profiling.phase('write_bundle'):
+            bundle.write(int(snip.snip_id), snips, dict_snip_to_id)
+
+    with profiling.phase('revision'):
+        # The new revision's rows, diffed against the latest revision
+        with metrics.source('compiler.revision'):
+            revision_sql, _ = revision_statements(
+                story_id,
+                snippet_rows(snips, dict_snip_to_id, dedup_text),
+                choice_rows(snips, dict_snip_to_id, dedup_text),
+                backend)
+
+    with profiling.phase('generate_sql'):
+        # output is a list of (query, data) tuples
+        output = list(partition_sql)
+        if dedup_text:
+            texts_sql = generate_sql_for_texts(collect_strings(snips))
+            if texts_sql:
+                output.append(texts_sql)
+        output.extend(revision_sql)
+        output.extend(generate_sql_for_flags(story_flag_names(snips),
+                                             backend or get_backend()))
+        profiling.count('statements', len(output))
 
-    drop_query = """DELETE FROM snippets WHERE snip_id in ({})""".format(
-        make_placeholders_for(ids_to_drop))
+    return output
 
-    # output is a list of (query, data) tuples
-    output = []
-    if ids_to_drop:
-        output.append((drop_query, ids_to_drop))
-    output.append(generate_sql_for_snippets(snips, dict_snip_to_id))
-    for query, data in generate_sql_for_choices(snips, dict_snip_to_id):
-        output.append((query, data))
 
-    return output
+def assign_ids(snips, insert_method, backend=None):
+    """Matches snippets with spare snip_ids
 
+    With insert_method 'rough', declared snip_ids that the story already has
+    are replaced in the new revision; with 'timid', they raise TimidError.
 
-def assign_ids(snips, insert_method):
-    """Matches snippets with spare snip_ids and identifies snip_ids to drop"""
+    Returns a dict of {Snippet: snip_id}.
+    """
     # Complain if first snippet has no snip_id to count up from
     try:
         root_id = int(snips[0].snip_id)
@@ -71,27 +158,27 @@ def assign_ids(snips, insert_method):
         else:
             pending_snip_id.append(snip)
     
-    drop_snip_ids = []
     # Fetch rows that contain snip_ids in declared_snip_id
-    for row in fetch_rows_with_snipids(
-        [snippet.snip_id for snippet in declared_snip_id]
-    ).values():
-        if row:
-            exiting_snip_id = row['snip_id']
-            # Complain if encountering resistance when timidly inserting
-            if insert_method == 'timid':
-                raise TimidError(exiting_snip_id)
-            elif insert_method == 'rough':
-                drop_snip_ids.append(exiting_snip_id)
+    with metrics.source('compiler.assign_ids'):
+        existing_rows = fetch_rows_with_snipids(
+            root_id, [snippet.snip_id for snippet in declared_snip_id],
+            backend)
+    for row in existing_rows.values():
+        # Complain if encountering resistance when timidly inserting
+        if row and insert_method == 'timid':
+            raise TimidError(row['snip_id'])
 
     # If using rough insert, it doesn't matter if rows already exist among
-    # the declared snip_ids, because we will overwrite those rows.
+    # the declared snip_ids, because the new revision replaces those rows.
     # If we made it this far, just map all the snippets to a snip_id
     # (by finding spare snip_ids and using the declared snip_ids)
 
     # Find spare snip_ids for the snippets who are pending one
-    spare_ids = find_spare_snipids(startfrom=root_id+1, 
-                                   needed=len(pending_snip_id))
+    with metrics.source('compiler.find_spare_snipids'):
+        spare_ids = find_spare_snipids(root_id, startfrom=root_id+1,
+                                       needed=len(pending_snip_id),
+                                       backend=backend)
+    profiling.count('allocated_ids', len(spare_ids))
 
     # Map the snippets to the snip_ids they will adopt
     output = dict()
@@ -102,131 +189,84 @@ def assign_ids(snips, insert_method):
 
     # SAN check
     assert(len(snips) == len(output))
-    return output, drop_snip_ids
+    return output
 
 
-def fetch_rows_with_snipids(list_snip_ids):
-    """Checks for each snip_id in `list_snip_ids` if a record exists already
+def fetch_rows_with_snipids(story_id, list_snip_ids, backend=None):
+    """Checks for each snip_id in `list_snip_ids` if the story has it already
 
     Returns a dict of {snip_id: (row or None)}
     """
-    output = {snip_id: None for snip_id in list_snip_ids}
-    
-    query = """SELECT * FROM snippets WHERE snip_id IN ({})""".format(
-        make_placeholders_for(list_snip_ids))
-    with AppCursor() as cur:
-        cur.execute(query, list_snip_ids)
-        rows = cur.fetchall()
-    
-    existing_rows = {row['snip_id']: row for row in rows}
-    output.update(existing_rows)
-    return output
+    profiling.count('db_calls')
+    return (backend or get_backend()).fetch_rows_with_snipids(story_id,
+                                                              list_snip_ids)
 
 
-def find_spare_snipids(startfrom, needed):
-    """Provides list containing snip_ids that are unused in the db"""
-    free_ids = []
-    found = 0
-    while found < needed:
-        # Each loop defines a list of 100 candidate snip_ids
-        candidate_snipids = list(range(startfrom, startfrom+100))
-
-        # fetch_rows_with_snipids() returns a dict of {row['snip_id']: row}
-        # Fetch rows that contain any of our candidates
-        existing_snip_ids = [
-            snip_id for snip_id, row in 
-            fetch_rows_with_snipids(candidate_snipids).items()
-            if row is not None
-        ]
-
-        # If none of the candidates exist in the db:
-        if not existing_snip_ids:
-            # Transfer as many snip_ids from candidate_snipids as we need/can
-            for candidate in candidate_snipids:
-                if found < needed:
-                    free_ids.append(candidate)
-                    found += 1
-                else:
-                    break
-        
-        # But if some candidates are already used in the db:
-        else:
-            # Remove existing snip_ids from candidate_snipids
-            for i in existing_snip_ids:
-                candidate_snipids.remove(i)
-
-            # Transfer as many snip_ids from candidate_snipids as we need/can
-            for candidate in candidate_snipids:
-                if found < needed:
-                    free_ids.append(candidate)
-                    found += 1
-                else:
-                    break
-        # For next loop in `while`, start from the next 100 candidates
-        startfrom += 100
-    
+def find_spare_snipids(story_id, startfrom, needed, backend=None):
+    """Provides list containing snip_ids that are unused in the story"""
+    profiling.count('db_calls')
+    free_ids = (backend or get_backend()).find_spare_snipids(
+        story_id, startfrom, needed)
+
     # Once we're done finding candidates, do a SAN check
     assert(len(free_ids) == needed)
     return free_ids
 
 
-def generate_sql_for_snippets(snips, dict_snip_to_id):
-    """Compiles query and data for inserting into snippets table
+def find_orphans(story_id, backend=None, revision=None):
+    """Lists the snip_ids of the story's live revision, or of `revision`,
+    that its root cannot reach
 
-    Returns a single tuple of (sql, values). `values` is a list of values
-    that are data to bind to the returned query.
+    Only the story's rows are read.
     """
-    # `placeholders` is a list of n copies of '(%s, %s)' where n = len(snips)
-    # They are placeholders for actual values that are merged into the query
-    # when the query is executed to the database via psycopg2
-    sql = """INSERT INTO snippets(snip_id, game_text) VALUES {}""".format(
-        make_placeholders_for(snips, using='(%s, %s)'))
-    
-    # `values` is a flat (non-nested) list of values to merge into sql
-    values = []
-    for snippet, snip_id in dict_snip_to_id.items():
-        values.append(snippet.text)
-        values.append(snip_id)
-    
-    return (sql, values)
+    return [row[0] for row in (backend or get_backend()).query(
+        ORPHANS_QUERY, (revision,) + (story_id,) * 4)]
 
 
-def generate_sql_for_choices(snips, dict_snip_to_id):
-    """Compiles query and data for inserting into choices table
+def collect_strings(snips):
+    """Lists the snippet texts and choice labels of `snips`, in order"""
+    strings = []
+    for snip in snips:
+        strings.append(snip.text)
+        strings.extend(str(choice.label) for choice in snip.choices)
+    return strings
+
 
-    Returns a list of (sql, data) tuples. The `data` in each tuple is a list
-    of values that are data to bind to the returned query.
+def snippet_rows(snips, dict_snip_to_id, dedup_text=False):
+    """Translates snippets into rows of the snippets table
+
+    With `dedup_text`, the text_id column is filled instead of game_text.
+
+    Returns a dict of {snip_id: {col_name: value}}
     """
-    # choices_data is a list of dictionaries
-    # dict key is column name and dict value is the insert value
-    choices_data = []
-    for snip in snips:
-        for choice in snip.choices:
-            choices_data.append(
-                extract_col_data_from_choice(choice, dict_snip_to_id)
-            )
-            
-    output = []
-    for choice_dict in choices_data:
-        # `cols` is a string containing table columns to insert to
-        cols = ', '.join(choice_dict.keys())
-        sql = """INSERT INTO choices({}) VALUES ({})""".format(
-            cols, make_placeholders_for(choice_dict.keys()))
-        
-        data = list(choice_dict.values())
-        output.append((sql, data))
+    text_col = 'text_id' if dedup_text else 'game_text'
+    return {int(dict_snip_to_id[snip]): {
+                text_col: text_id(snip.text) if dedup_text else snip.text}
+            for snip in snips}
 
-    return output
+
+def choice_rows(snips, dict_snip_to_id, dedup_text=False):
+    """Translates the choices of snippets into rows of the choices table
+
+    Returns a dict of {snip_id: [{col_name: value}, ...]}, with each
+    snippet's choices in order.
+    """
+    return {int(dict_snip_to_id[snip]): [
+                extract_col_data_from_choice(choice, dict_snip_to_id,
+                                             dedup_text)
+                for choice in snip.choices]
+            for snip in snips}
 
 
 def make_placeholders_for(iterable, using='%s'):
     return ', '.join([using] * len(iterable))
 
 
-def extract_col_data_from_choice(choice, dict_snip_to_id):
+def extract_col_data_from_choice(choice, dict_snip_to_id, dedup_text=False):
     """Translates choice attributes into table fields
 
     Resolves attributes into appropriate datatypes e.g. snip -> snip.snip_id
+    With `dedup_text`, the label is stored as label_id instead of choice_label.
     
     Returns:
         {col_name: attrib}
@@ -238,7 +278,10 @@ def extract_col_data_from_choice(choice, dict_snip_to_id):
     max_num_cols_check_flg = 3
 
     output = {}
-    output['choice_label'] = str(choice.label)
+    if dedup_text:
+        output['label_id'] = text_id(str(choice.label))
+    else:
+        output['choice_label'] = str(choice.label)
     output['snip_id'] = int(dict_snip_to_id[choice.snippet])
     output['next_snip_id'] = int(dict_snip_to_id[choice.next_snippet])
     
@@ -156,9 +156,12 @@ class Snippet():
         return sql, data
 
 
-    def generate_chain_sql(self, insert_method='timid'):
+    def generate_chain_sql(self, insert_method='timid', backend=None,
+                           bundle=None, dedup_text=False):
         from .compiler import snippet_chain_to_sql_data
-        for query, data in snippet_chain_to_sql_data(self, insert_method):
+        for query, data in snippet_chain_to_sql_data(self, insert_method,
+                                                     backend, bundle,
+                                                     dedup_text):
             yield query, data
 
 
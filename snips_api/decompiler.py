@@ -0,0 +1,278 @@
+"""
+Decompiler from the database back to the parser's script format.
+
+decompile() writes a revision of a stored story (by default the live one)
+as a script that snips_parser reads: directives, one line per snippet with
+its snip_id as reference number, its choices indented below it with an
+explicit "-> (snip_id)" target, and the choices' flag operations indented
+below those ("Requires ..." for checks). Texts and labels stored by
+reference (text_id/label_id) are written out in full.
+
+The script declares REF_NUMS_ARE_SNIP_IDS and OVERWRITE_DB_SNIP_IDS, so
+compiling it again adds a revision to the same story that shares every
+unchanged row, and the script of a story can be diffed against the one it
+was compiled from. If the story has snip_ids below its root's (which must
+have the lowest reference number), they are renumbered instead and a
+compile creates a new story.
+
+Snippets and choices are streamed in snip_id order from two server-side
+cursors and merged, so memory use does not grow with the story. The
+parser only accepts a snippet without choices as the last one in the
+script; the single such snippet is held back and written last.
+
+Strings whose braces are not valid placeholders for the story (e.g. texts
+stored before placeholders existed) get their braces doubled, which
+renders them the same. Strings the format cannot hold (line breaks, "->"
+in a label, ...) raise DecompilerError.
+
+Usage:
+    with open('story.txt', 'w', encoding='utf-8') as f:
+        decompile(123, f)
+
+    $ python -m snips_api.decompiler 123 -o story.txt
+    $ python -m snips_api.decompiler 123 --revision 4 > story-4.txt
+"""
+
+import argparse
+import sys
+
+from . import compiler
+from .exceptions import DecompilerError
+from .flags import parse_flag_op
+from .snips_parser import DIRECTIVE_IDENT_STR
+from .templates import CONTEXT_VARIABLES, TemplateError, compile_template
+from db_tools.backends import get_backend
+from db_tools.revisions import live_revision
+
+CHOICE_INDENT = ' ' * 4
+FLAG_INDENT = ' ' * 8
+CHECK_COLUMNS = ('check_flg_1', 'check_flg_2', 'check_flg_3')
+MOD_COLUMNS = ('mod_flg_1', 'mod_flg_2', 'mod_flg_3')
+STREAM_BATCH_SIZE = 2000
+
+# Rows of one revision of a story, in the order they are written
+VISIBLE = """{0}story_id = %s AND {0}added_in <= %s
+             AND ({0}removed_in IS NULL OR {0}removed_in > %s)"""
+SNIPPETS_QUERY = """SELECT s.snip_id, COALESCE(s.game_text, t.body)
+                    FROM snippets s
+                    LEFT JOIN texts t ON t.text_id = s.text_id
+                    WHERE {} ORDER BY s.snip_id""".format(
+    VISIBLE.format('s.'))
+CHOICES_QUERY = """SELECT c.snip_id, COALESCE(c.choice_label, t.body),
+                          c.next_snip_id, {}
+                   FROM choices c
+                   LEFT JOIN texts t ON t.text_id = c.label_id
+                   WHERE {} ORDER BY c.snip_id, c.choice_id""".format(
+    ', '.join('c.' + col for col in CHECK_COLUMNS + MOD_COLUMNS),
+    VISIBLE.format('c.'))
+MIN_SNIPID_QUERY = """SELECT min(snip_id) FROM snippets
+                      WHERE {}""".format(VISIBLE.format(''))
+USES_TEXTS_QUERY = """SELECT 1 FROM snippets WHERE {0} AND text_id IS NOT NULL
+                      UNION ALL
+                      SELECT 1 FROM choices WHERE {0} AND label_id IS NOT NULL
+                      LIMIT 1""".format(VISIBLE.format(''))
+FLAG_EXPRESSIONS_QUERY = """SELECT DISTINCT {{0}} FROM choices
+                            WHERE {} AND {{0}} IS NOT NULL""".format(
+    VISIBLE.format(''))
+
+
+def decompile(story_id, out, revision=None, backend=None):
+    """Writes a revision of a story to `out` as a parser script.
+
+    Args:
+        story_id: Story to write.
+
+        out: Text file object to write to.
+
+        revision: Revision to write. Default: the live revision
+
+        backend: StorageBackend to read from. Default: the configured one
+
+    Returns:
+        Number of snippets written.
+
+    Raises:
+        DecompilerError if the story or revision does not exist, or cannot
+        be written in the script format.
+    """
+    backend = get_backend() if backend is None else backend
+    if revision is None:
+        revision = live_revision(story_id, backend)
+        if revision is None:
+            raise DecompilerError('Story {} does not exist'.format(story_id))
+    visible = (story_id, revision, revision)
+
+    min_snip_id = backend.query(MIN_SNIPID_QUERY, visible)[0][0]
+    if min_snip_id is None:
+        raise DecompilerError('Story {} has no revision {}'.format(
+            story_id, revision))
+    orphans = compiler.find_orphans(story_id, backend, revision)
+    if orphans:
+        raise DecompilerError(
+            'Snippets {} of story {} cannot be reached from its root, which '
+            'the parser does not accept'.format(
+                ', '.join(str(snip_id) for snip_id in orphans[:10]),
+                story_id))
+
+    keep_snip_ids = min_snip_id >= story_id
+    if keep_snip_ids:
+        ref_num = lambda snip_id: snip_id
+    else:
+        # The root needs the lowest reference number
+        ref_num = lambda snip_id: (0 if snip_id == story_id
+                                   else snip_id - min_snip_id + 1)
+    placeholders = set(CONTEXT_VARIABLES).union(
+        story_flag_names(story_id, revision, backend))
+
+    out.write(directive('ROOT_SNIP_ID', story_id))
+    if keep_snip_ids:
+        out.write(directive('REF_NUMS_ARE_SNIP_IDS'))
+        out.write(directive('OVERWRITE_DB_SNIP_IDS'))
+    if backend.query(USES_TEXTS_QUERY, visible * 2):
+        out.write(directive('DEDUPLICATE_TEXT'))
+
+    snippets = iter_rows(backend, SNIPPETS_QUERY, visible, 'decompile_snips')
+    choices = iter_rows(backend, CHOICES_QUERY, visible, 'decompile_choices')
+    choice = next(choices, None)
+    terminal = None
+    count = 0
+    # The parser reads a blank line right after the directives as a snippet
+    separator = ''
+    for snip_id, text in snippets:
+        snip_choices = []
+        while choice is not None and choice[0] <= snip_id:
+            if choice[0] < snip_id:
+                raise DecompilerError('Choices of story {} come from snip_id '
+                                      '{}, which it does not have'.format(
+                                          story_id, choice[0]))
+            snip_choices.append(choice)
+            choice = next(choices, None)
+
+        lines = snippet_lines(ref_num, snip_id, text, snip_choices,
+                              placeholders)
+        if not snip_choices:
+            if terminal is not None:
+                raise DecompilerError(
+                    'Snippets {} and {} of story {} both have no choices; '
+                    'the script format allows one'.format(
+                        terminal[0], snip_id, story_id))
+            terminal = (snip_id, lines)
+        else:
+            out.write(separator)
+            out.writelines(lines)
+            separator = '\n'
+        count += 1
+
+    if choice is not None:
+        raise DecompilerError('Choices of story {} come from snip_id {}, '
+                              'which it does not have'.format(story_id,
+                                                              choice[0]))
+    if terminal is not None:
+        out.write(separator)
+        out.writelines(terminal[1])
+    return count
+
+
+def iter_rows(backend, sql, data, name):
+    for batch in backend.iter_query_batches(sql, data, STREAM_BATCH_SIZE,
+                                            name):
+        yield from batch
+
+
+def story_flag_names(story_id, revision, backend):
+    """Returns the names of the flags a revision's choices use"""
+    names = set()
+    for col in CHECK_COLUMNS + MOD_COLUMNS:
+        for row in backend.query(FLAG_EXPRESSIONS_QUERY.format(col),
+                                 (story_id, revision, revision)):
+            names.add(parse_flag_op(row[0])[0])
+    return names
+
+
+def directive(name, arg=None):
+    if arg is None:
+        return '{}{}\n'.format(DIRECTIVE_IDENT_STR, name)
+    return '{}{} {}\n'.format(DIRECTIVE_IDENT_STR, name, arg)
+
+
+def snippet_lines(ref_num, snip_id, text, choices, placeholders):
+    """Formats a snippet row and its choice rows as script lines"""
+    lines = ['{}. {}\n'.format(ref_num(snip_id),
+                               script_string(text, placeholders, snip_id))]
+    for row in choices:
+        label, next_snip_id = row[1], row[2]
+        label = script_string(label, placeholders, snip_id)
+        if not label or '->' in label:
+            raise DecompilerError('Choice label {} of snip_id {} cannot be '
+                                  'written (empty or contains "->")'.format(
+                                      repr(label), snip_id))
+        if next_snip_id is None:
+            raise DecompilerError('A choice of snip_id {} has no '
+                                  'next_snip_id'.format(snip_id))
+        lines.append('{}{} -> ({})\n'.format(CHOICE_INDENT, label,
+                                              ref_num(next_snip_id)))
+
+        checks = row[3:3 + len(CHECK_COLUMNS)]
+        modifies = row[3 + len(CHECK_COLUMNS):]
+        for expr in modifies:
+            if expr is None:
+                continue
+            if expr.startswith('Req'):
+                # The parser would read it as a check
+                raise DecompilerError('Flag operation {} of snip_id {} '
+                                      'cannot be written'.format(
+                                          repr(expr), snip_id))
+            lines.append('{}{}\n'.format(FLAG_INDENT, expr))
+        for expr in checks:
+            if expr is not None:
+                lines.append('{}Requires {}\n'.format(FLAG_INDENT, expr))
+    return lines
+
+
+def script_string(s, placeholders, snip_id):
+    """Returns a text or label as the parser has to read it.
+
+    Braces that do not form placeholders from `placeholders` are doubled.
+
+    Raises:
+        DecompilerError if the string cannot be written on one line.
+    """
+    s = (s or '').strip()
+    if '\n' in s or '\r' in s:
+        raise DecompilerError('Text {} of snip_id {} has a line break, which '
+                              'the script format cannot hold'.format(
+                                  repr(s[:40]), snip_id))
+    try:
+        if compile_template(s).names <= placeholders:
+            return s
+    except TemplateError:
+        pass
+    return s.replace('{', '{{').replace('}', '}}')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m snips_api.decompiler',
+        description='Writes a stored story as a parser script.')
+    parser.add_argument('story_id', type=int)
+    parser.add_argument('--revision', type=int,
+                        help='revision to write (default: the live one)')
+    parser.add_argument('-o', '--output', metavar='PATH',
+                        help='file to write to (default: stdout)')
+    args = parser.parse_args(argv)
+
+    try:
+        if args.output:
+            with open(args.output, 'w', encoding='utf-8') as f:
+                count = decompile(args.story_id, f, args.revision)
+        else:
+            count = decompile(args.story_id, sys.stdout, args.revision)
+    except DecompilerError as e:
+        print('Error: {}'.format(e), file=sys.stderr)
+        return 1
+    print('Wrote {} snippets'.format(count), file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -84,3 +84,12 @@ class ParserError(Exception):
             hint = ('Something went wrong while parsing your input text.')
         super(ParserError, self).__init__(hint)
 
+
+
+class DecompilerError(Exception):
+    """A stored story cannot be written as a parser script"""
+    def __init__(self, hint=None):
+        if hint is None:
+            hint = ('Something went wrong while writing the story as a '
+                    'script.')
+        super(DecompilerError, self).__init__(hint)
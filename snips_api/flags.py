@@ -0,0 +1,277 @@
+"""
+Pre-parsed flag operations.
+
+Choices store their flag checks and modifications as expression strings such
+as "skin_thickness >= 5" or "patient_deaths += 1" (see Choice.parse_expression).
+This module turns them into (flag_name, operator, value) tuples once, so that
+they can be evaluated against a player's flag state without re-parsing.
+
+Flags that a player has never set count as 0.
+
+A player's flag state is saved as one packed array of 64-bit ints
+(saved_games.flags), one slot per flag in the flag_registry table. The
+compiler registers every flag name a story uses; slots are appended in
+first-seen order and never reused, so saved states stay readable as stories
+gain flags (slots past the end of an older state read as 0).
+
+Usage:
+    check = parse_flag_op('skin_thickness >= 5')
+    passes_checks([check], {'skin_thickness': 7})        # True
+    apply_modifications([parse_flag_op('x += 1')], {})   # {'x': 1}
+
+    registry = FlagRegistry.from_rows(backend.query(FLAG_REGISTRY_QUERY))
+    blob = registry.pack({'x': 1})                       # 8 bytes per flag
+    registry.unpack(blob)                                # {'x': 1, ...}
+
+    # Once, for games saved when flags were a JSON object (stop the player
+    # servers first)
+    $ python -m snips_api.flags convert-json
+"""
+
+import argparse
+import json
+import operator
+import struct
+import sys
+
+from .components import VALID_OPERATORS_ASSIGNMENT, VALID_OPERATORS_COMPARISON
+
+COMPARISON_OPERATORS = VALID_OPERATORS_COMPARISON.split()
+ASSIGNMENT_OPERATORS = VALID_OPERATORS_ASSIGNMENT.split()
+
+# Stable numbering used by compact encodings (e.g. the story bundle)
+OPERATORS = COMPARISON_OPERATORS + ASSIGNMENT_OPERATORS
+OPERATOR_CODES = {op: code for code, op in enumerate(OPERATORS)}
+
+FLAG_REGISTRY_QUERY = """SELECT flag_id, flag_name FROM flag_registry
+                         ORDER BY flag_id"""
+FLAG_SLOT_SIZE = 8
+
+SAVED_FLAGS_QUERY = """SELECT game_id, flags FROM saved_games
+                       WHERE flags IS NOT NULL ORDER BY game_id"""
+SAVE_FLAGS_QUERY = """UPDATE saved_games SET flags = %s WHERE game_id = %s"""
+
+_COMPARE = {
+    '==': operator.eq,
+    '!=': operator.ne,
+    '<=': operator.le,
+    '>=': operator.ge,
+    '<': operator.lt,
+    '>': operator.gt,
+}
+
+
+def _divide(current, value):
+    # Flags are ints; dividing by zero leaves the flag unchanged
+    return current // value if value else current
+
+
+_ASSIGN = {
+    '=': lambda current, value: value,
+    '+=': operator.add,
+    '-=': operator.sub,
+    '*=': operator.mul,
+    '/=': _divide,
+}
+
+
+def parse_flag_op(expr):
+    """Splits an expression string into a (flag_name, operator, value) tuple.
+
+    Expressions are expected to have been validated by Choice.parse_expression
+    already. Raises ValueError if the expression is malformed.
+    """
+    flag_name, oper, value = str(expr).split()
+    if oper not in OPERATOR_CODES:
+        raise ValueError('unknown flag operator {}'.format(repr(oper)))
+    return flag_name, oper, int(value)
+
+
+def passes_checks(checks, state):
+    """Checks if every (flag_name, operator, value) in `checks` holds."""
+    for flag_name, oper, value in checks:
+        if not _COMPARE[oper](state.get(flag_name, 0), value):
+            return False
+    return True
+
+
+def apply_modifications(modifications, state):
+    """Returns a copy of `state` with each modification applied in order."""
+    state = dict(state)
+    for flag_name, oper, value in modifications:
+        state[flag_name] = _ASSIGN[oper](state.get(flag_name, 0), value)
+    return state
+
+
+def flag_names(ops):
+    """Yields the flag names referenced by an iterable of flag op tuples."""
+    for flag_name, _, _ in ops:
+        yield flag_name
+
+
+def story_flag_names(snips):
+    """Lists the flag names the choices of `snips` use, in first-seen order"""
+    names = {}
+    for snip in snips:
+        for choice in snip.choices:
+            for expr in choice.check_flags + choice.modifies_flags:
+                names.setdefault(str(expr).split()[0], None)
+    return list(names)
+
+
+def generate_sql_for_flags(names, backend=None):
+    """Compiles the registration of flag names in the flag_registry table.
+
+    Names that are already registered keep their slot; new ones get the
+    next free slots in the given order. The table is locked against other
+    registrations until the transaction ends, so that two of them can't
+    hand out the same slots, and a name registered meanwhile is skipped.
+
+    `backend` is the db_tools.backends.StorageBackend the statements are
+    for. Defaults to the configured backend.
+
+    Returns a list of (sql, values) tuples, empty if `names` is.
+    """
+    if not names:
+        return []
+    if backend is None:
+        from db_tools.backends import get_backend
+        backend = get_backend()
+    sql = ("""INSERT INTO flag_registry(flag_id, flag_name) """
+           """SELECT (SELECT COALESCE(MAX(flag_id), -1) FROM flag_registry) """
+           """+ ROW_NUMBER() OVER (ORDER BY v.column1), v.column2 """
+           """FROM (VALUES {}) AS v """
+           """WHERE v.column2 NOT IN (SELECT flag_name FROM flag_registry) """
+           """ON CONFLICT (flag_name) DO NOTHING"""
+           ).format(', '.join(['(%s, %s)'] * len(names)))
+    values = []
+    for i, name in enumerate(names):
+        values.append(i)
+        values.append(name)
+    return backend.lock_table_statements('flag_registry') + [(sql, values)]
+
+
+
+class FlagRegistry():
+    """Slot numbers of flag names, for packing flag states"""
+    def __init__(self, names=()):
+        # names[slot] is the flag name of that slot, or None for a gap
+        self.names = list(names)
+        self.slots = {name: i for i, name in enumerate(self.names)
+                      if name is not None}
+        self._struct = struct.Struct('<{}q'.format(len(self.names)))
+
+
+    @classmethod
+    def from_rows(cls, rows):
+        """Builds a registry from the rows of FLAG_REGISTRY_QUERY"""
+        rows = [(row['flag_id'], row['flag_name']) for row in rows]
+        names = [None] * (max(slot for slot, _ in rows) + 1 if rows else 0)
+        for slot, name in rows:
+            names[slot] = name
+        return cls(names)
+
+
+    def __len__(self):
+        return len(self.names)
+
+
+    @property
+    def size(self):
+        """Length in bytes of a packed state"""
+        return self._struct.size
+
+
+    def can_pack(self, state):
+        """Checks that every flag in the state dict has a slot"""
+        return self.slots.keys() >= state.keys()
+
+
+    def can_unpack(self, blob):
+        """Checks that a packed state has no slots beyond this registry"""
+        return blob is None or len(blob) <= self.size
+
+
+    def pack(self, state):
+        """Packs a flag state dict into bytes.
+
+        Raises:
+            KeyError if a flag is not registered.
+        """
+        if not self.can_pack(state):
+            raise KeyError('Unregistered flag(s) {}'.format(', '.join(
+                sorted(set(state) - set(self.slots)))))
+        return self._struct.pack(*[state.get(name, 0) for name in self.names])
+
+
+    def unpack(self, blob):
+        """Unpacks bytes from pack() (or None) into a flag state dict.
+
+        Raises:
+            ValueError if the state has more slots than the registry.
+        """
+        if not blob:
+            return {}
+        blob = bytes(blob)
+        if len(blob) % FLAG_SLOT_SIZE or not self.can_unpack(blob):
+            raise ValueError('Packed flag state of {} bytes does not fit a '
+                             'registry of {} flags'.format(len(blob),
+                                                           len(self)))
+        if len(blob) < self.size:
+            blob += bytes(self.size - len(blob))
+        state = dict(zip(self.names, self._struct.unpack(blob)))
+        state.pop(None, None)
+        return state
+
+
+
+def convert_json_states(backend):
+    """Packs flag states that were saved as JSON objects.
+
+    Registers the flags the states use, then in one transaction changes a
+    PostgreSQL json/jsonb flags column to bytea and rewrites the states.
+    Packed states are left alone, so converting again does nothing. Games
+    saved while it runs may lose their flags; stop the player servers
+    first.
+
+    Returns:
+        Number of saved games converted.
+    """
+    column_type = dict(backend.table_columns('saved_games')).get('flags')
+    states = {}
+    for row in backend.query(SAVED_FLAGS_QUERY):
+        value = row['flags']
+        if isinstance(value, str):
+            value = json.loads(value)
+        if isinstance(value, dict):
+            states[row['game_id']] = {name: int(flag)
+                                      for name, flag in value.items()}
+
+    names = sorted({name for state in states.values() for name in state})
+    backend.execute_statements(generate_sql_for_flags(names, backend))
+    registry = FlagRegistry.from_rows(backend.query(FLAG_REGISTRY_QUERY))
+    statements = []
+    if column_type in ('json', 'jsonb'):
+        statements.append(("""ALTER TABLE saved_games ALTER COLUMN flags """
+                           """TYPE bytea USING NULL""", ()))
+    statements.extend((SAVE_FLAGS_QUERY, (registry.pack(state), game_id))
+                      for game_id, state in sorted(states.items()))
+    backend.execute_statements(statements)
+    return len(states)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m snips_api.flags',
+        description='Converts saved flag states to the packed format.')
+    parser.add_argument('action', choices=['convert-json'])
+    parser.parse_args(argv)
+
+    from db_tools.backends import get_backend
+    converted = convert_json_states(get_backend())
+    print('Converted the flags of {} saved game(s)'.format(converted),
+          file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,191 @@
+"""
+On-disk cache of parsed scripts.
+
+snips_parser.parse_text() looks scripts up here before lexing them. Entries
+hold the linked snippet graph and the directives as zlib-compressed JSON,
+keyed by the SHA-256 of the script text and PARSER_VERSION, so editing a
+script or upgrading the parser never returns a stale graph. A hit rebuilds
+the Snippet and Choice objects without re-lexing or re-linking.
+
+The cache is a directory of <key>.parse files. Each hit refreshes the
+file's modification time; when the files add up to more than the size
+limit, the least recently used ones are deleted. Failing to read or write
+the cache only costs a re-parse.
+
+Settings (environment variables):
+    SNIPS_PARSE_CACHE_DIR  -- cache directory. Default:
+                              $XDG_CACHE_HOME/snips_api or ~/.cache/snips_api
+    SNIPS_PARSE_CACHE_SIZE -- size limit in bytes. Default: 64 MiB
+
+Usage:
+    snips_parser.parse_text(text)                    # uses the cache
+    snips_parser.parse_text(text, use_cache=False)   # bypasses it
+
+    $ python -m snips_api script.txt --no-cache
+"""
+
+import hashlib
+import json
+import logging
+import os
+import os.path
+import tempfile
+import zlib
+
+from .components import Choice, Snippet
+
+logger = logging.getLogger(__name__)
+
+DIR_ENVVAR = 'SNIPS_PARSE_CACHE_DIR'
+SIZE_ENVVAR = 'SNIPS_PARSE_CACHE_SIZE'
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+SUFFIX = '.parse'
+FORMAT_VERSION = 1
+
+
+def cache_key(text, parser_version):
+    """Returns the hex digest identifying a script for a parser version"""
+    h = hashlib.sha256('{}\0'.format(parser_version).encode('utf-8'))
+    h.update(text.encode('utf-8'))
+    return h.hexdigest()
+
+
+def encode_parse(snippets, directives):
+    """Serializes parse_text() output into bytes.
+
+    Snippets are stored in script order as
+    [ref_num, text, snip_id or None, choices], and each choice as
+    [label, target ref_num, check_flags, modifies_flags].
+    """
+    ref_nums = {id(snip): ref_num
+                for ref_num, (snip, _) in snippets.items()}
+    records = []
+    for ref_num, (snip, choices) in snippets.items():
+        snip_id = None if snip.snip_id == 'pending' else snip.snip_id
+        records.append([ref_num, snip.text, snip_id, [
+            [c.label, ref_nums[id(c.next_snippet)], c.check_flags,
+             c.modifies_flags] for c in choices]])
+    doc = dict(v=FORMAT_VERSION, directives=directives, snippets=records)
+    return zlib.compress(json.dumps(doc, separators=(',', ':'))
+                         .encode('utf-8'))
+
+
+def decode_parse(data):
+    """Rebuilds parse_text() output from encode_parse() bytes.
+
+    Raises:
+        ValueError if the data is not a cache entry of this format.
+    """
+    try:
+        doc = json.loads(zlib.decompress(data).decode('utf-8'))
+    except (zlib.error, UnicodeDecodeError) as e:
+        raise ValueError('Corrupt parse cache entry ({})'.format(e))
+    if doc.get('v') != FORMAT_VERSION:
+        raise ValueError('Parse cache entry has format {} (expected '
+                         '{})'.format(doc.get('v'), FORMAT_VERSION))
+
+    snippets = {}
+    for ref_num, text, snip_id, _ in doc['snippets']:
+        snippets[ref_num] = (Snippet(text, snip_id), [])
+    for ref_num, _, _, choices in doc['snippets']:
+        snip, snip_choices = snippets[ref_num]
+        for label, target, checks, mods in choices:
+            # Flag expressions were validated and normalized when parsed
+            choice = Choice(label, snippets[target][0])
+            choice.check_flags = checks
+            choice.modifies_flags = mods
+            choice.set_source_snip(snip)
+            snip.choices.append(choice)
+            snip_choices.append(choice)
+    return snippets, doc['directives']
+
+
+
+class ParseCache():
+    """Directory of parse results with LRU eviction by total size"""
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + SUFFIX)
+
+
+    def get(self, key):
+        """Returns (snippets, directives) for `key`, or None on a miss"""
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            result = decode_parse(data)
+            os.utime(path)
+            return result
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logger.warning("Discarding parse cache entry %s: %s", path, e)
+            self._remove(path)
+            return None
+
+
+    def put(self, key, snippets, directives):
+        """Stores a parse result, then evicts entries over the size limit"""
+        data = encode_parse(snippets, directives)
+        if len(data) > self.max_bytes:
+            return
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory,
+                                            prefix='.tmp-')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(data)
+                os.replace(tmp_path, self._path(key))
+            except BaseException:
+                self._remove(tmp_path)
+                raise
+            self.evict()
+        except OSError as e:
+            logger.warning("Could not write to parse cache %s: %s",
+                           self.directory, e)
+
+
+    def evict(self):
+        """Deletes least recently used entries until under the size limit"""
+        entries = []
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.name.endswith(SUFFIX):
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    entries.append((stat.st_mtime_ns, stat.st_size,
+                                    entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            self._remove(path)
+            total -= size
+
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+
+
+def default_cache():
+    """Returns a ParseCache configured from the environment"""
+    directory = os.environ.get(DIR_ENVVAR)
+    if not directory:
+        base = os.environ.get('XDG_CACHE_HOME') or os.path.join(
+            os.path.expanduser('~'), '.cache')
+        directory = os.path.join(base, 'snips_api')
+    max_bytes = int(os.environ.get(SIZE_ENVVAR, DEFAULT_MAX_BYTES))
+    return ParseCache(directory, max_bytes)
@@ -0,0 +1,213 @@
+"""
+Per-phase profiling for the parser and compiler.
+
+The parser and compiler mark their phases with `profiling.phase(name)` and
+bump counters with `profiling.count(name)`. Both are no-ops unless a Profiler
+is active in the current thread, so unprofiled runs pay almost nothing.
+
+Phases recorded by snips_parser.parse_text():
+    parse_cache, directives, interpret, link, orphan_check, placeholders
+Phases recorded by compiler.snippet_chain_to_sql_data():
+    snippets_tree, assign_ids, revision, generate_sql
+Counters:
+    lines, snippets, choices, flag_ops, db_calls, allocated_ids, statements,
+    parse_cache_hits, parse_cache_misses
+
+Usage:
+    from snips_api import profiling, snips_parser
+
+    with profiling.profile() as prof:
+        statements = list(snips_parser.parse(text))
+
+    prof.report()         # dict, e.g. for json.dump()
+    prof.format_report()  # human-readable table
+"""
+
+import contextlib
+import threading
+import time
+import tracemalloc
+from collections import OrderedDict
+
+_local = threading.local()
+
+
+class PhaseStats():
+    """Accumulated measurements for a single named phase"""
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.seconds = 0.0
+        self.allocated_bytes = None
+        self.peak_bytes = None
+        self.counts = OrderedDict()
+
+
+    def as_dict(self):
+        return OrderedDict([
+            ('name', self.name),
+            ('calls', self.calls),
+            ('seconds', self.seconds),
+            ('allocated_bytes', self.allocated_bytes),
+            ('peak_bytes', self.peak_bytes),
+            ('counts', dict(self.counts)),
+        ])
+
+
+
+class Profiler():
+    """Records wall time, allocations and counters for each phase.
+
+    Args:
+        trace_allocations: Whether to measure memory with tracemalloc. This
+                           slows the profiled code down considerably.
+                           Default: False
+
+    Attributes:
+        phases   -- OrderedDict of {phase name: PhaseStats}, in the order the
+                    phases were first entered.
+        counters -- OrderedDict of {counter name: total count}.
+    """
+    def __init__(self, trace_allocations=False):
+        self.trace_allocations = trace_allocations
+        self.phases = OrderedDict()
+        self.counters = OrderedDict()
+        self._stack = []
+        self._started_tracing = False
+        self._start = None
+        self._elapsed = 0.0
+
+
+    def start(self):
+        if self.trace_allocations and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+        self._start = time.perf_counter()
+
+
+    def stop(self):
+        self._elapsed += time.perf_counter() - self._start
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Context manager that attributes the enclosed work to `name`"""
+        stats = self.phases.get(name)
+        if stats is None:
+            stats = self.phases[name] = PhaseStats(name)
+        self._stack.append(stats)
+
+        tracing = self.trace_allocations and tracemalloc.is_tracing()
+        if tracing:
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+            mem_before = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        try:
+            yield stats
+        finally:
+            stats.seconds += time.perf_counter() - start
+            stats.calls += 1
+            if tracing:
+                current, peak = tracemalloc.get_traced_memory()
+                stats.allocated_bytes = ((stats.allocated_bytes or 0) +
+                                         current - mem_before)
+                stats.peak_bytes = max(stats.peak_bytes or 0,
+                                       peak - mem_before)
+            self._stack.pop()
+
+
+    def count(self, name, n=1):
+        """Adds n to the counter `name`, also attributing it to the phase"""
+        self.counters[name] = self.counters.get(name, 0) + n
+        if self._stack:
+            counts = self._stack[-1].counts
+            counts[name] = counts.get(name, 0) + n
+
+
+    def report(self):
+        """Returns the measurements as a JSON-serializable dict"""
+        return OrderedDict([
+            ('total_seconds', self._elapsed),
+            ('phases', [s.as_dict() for s in self.phases.values()]),
+            ('counters', dict(self.counters)),
+        ])
+
+
+    def format_report(self):
+        """Returns the measurements as a human-readable table"""
+        lines = ['{:<14} {:>6} {:>10} {:>12}  {}'.format(
+            'phase', 'calls', 'seconds', 'allocated', 'counts')]
+        for s in self.phases.values():
+            alloc = '-'
+            if s.allocated_bytes is not None:
+                alloc = '{:.1f} KiB'.format(s.allocated_bytes / 1024)
+            counts = ', '.join('{}={}'.format(k, v)
+                               for k, v in s.counts.items())
+            lines.append('{:<14} {:>6} {:>10.4f} {:>12}  {}'.format(
+                s.name, s.calls, s.seconds, alloc, counts))
+        lines.append('total: {:.4f}s'.format(self._elapsed))
+        return '\n'.join(lines)
+
+
+
+def active_profiler():
+    """Returns the Profiler active in this thread, or None"""
+    return getattr(_local, 'profiler', None)
+
+
+@contextlib.contextmanager
+def profile(trace_allocations=False, profiler=None):
+    """Activates a Profiler in this thread for the duration of the context.
+
+    Args:
+        trace_allocations: See Profiler.
+                           Default: False
+
+        profiler: Existing Profiler to resume recording into. A new one is
+                  created if not given.
+                  Default: None
+
+    Yields:
+        The active Profiler.
+    """
+    if profiler is None:
+        profiler = Profiler(trace_allocations=trace_allocations)
+    previous = active_profiler()
+    _local.profiler = profiler
+    profiler.start()
+    try:
+        yield profiler
+    finally:
+        profiler.stop()
+        _local.profiler = previous
+
+
+def phase(name):
+    """Marks a phase on the active Profiler; does nothing if none is active"""
+    profiler = active_profiler()
+    if profiler is None:
+        return _NULL_PHASE
+    return profiler.phase(name)
+
+
+def count(name, n=1):
+    """Bumps a counter on the active Profiler, if any"""
+    profiler = active_profiler()
+    if profiler is not None:
+        profiler.count(name, n)
+
+
+
+class _NullPhase():
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *args):
+        return False
+
+
+_NULL_PHASE = _NullPhase()
@@ -0,0 +1,634 @@
+"""
+Player-facing lookups of compiled stories.
+
+A story source answers "give me snippet X of story S and its choices" for
+the webapp, either from a memory-mapped story bundle (see bundle.py) or
+from the database through a db_tools storage backend. A story's id is the
+snip_id of its root snippet, and snip_ids are unique within a story. Both
+sources return snippets in the same shape:
+
+    {
+        'story_id': 1,
+        'revision': 2,
+        'snip_id': 123,
+        'game_text': '...',
+        'choices': [
+            {'choice_index': 0, 'label': '...', 'next_snip_id': 124,
+             'check_flags': [('skin_thickness', '>=', 5)],
+             'modifies_flags': [('bm_patient', '+=', 1)]},
+            ...
+        ]
+    }
+
+Snippets come from the story's live revision (see db_tools/revisions.py),
+and database snippets carry its number as 'revision', which changes
+whenever another revision goes live; bundles hold a single version of the
+story and have no 'revision'. choice_index is the position of the choice
+within its snippet, in compile order. Texts and labels stored by reference
+(see texts.py) are resolved through a TextCache shared by all lookups of
+the source; get_story_source() returns the same DatabaseSource to every
+request of the process, so hot strings stay cached across requests. Snippets are
+returned as stored; player_view() fills in {placeholders} (see templates.py)
+for a particular player.
+
+Player progress lives in saved_games: the story and snippet the player is
+on (story_id, current_snip_id; a new game picks its story with its first
+choice) and their flag state (flags, packed by the FlagRegistry; see
+flags.py). choose() applies a choice to that state; the
+caller persists the result with SAVE_GAME_QUERY, which updates nothing if
+another request moved the game on since it was loaded (report that with
+stale_save_error()). The queries use psycopg2
+"%s" placeholders; asynchronous drivers can convert them with
+to_numbered_params().
+
+Prefetching: a player view can carry the views that its visible choices
+lead to, so that the front end can switch pages without waiting for the
+choose request (see prefetch()). Each visible choice gets a 'next' key
+holding the player view after picking it, rendered with the flag state the
+choice would leave behind, down to the requested depth. Views are added
+level by level until the byte budget runs out; a choice without 'next' was
+not prefetched. Each level is looked up with one get_snippets() call, i.e.
+one batched round of queries per level on the database (snippets, choices
+and any texts missing from the shared TextCache) and none on a bundle.
+
+Settings (environment variables):
+    STORY_BUNDLE         -- path to a bundle file. If set, the webapp serves
+                            snippets from it instead of querying the
+                            database.
+    PREFETCH_MAX_DEPTH   -- largest prefetch depth a request may ask for.
+                            Default: 3
+    PREFETCH_MAX_BYTES   -- budget for the prefetched views of one response,
+                            measured as compact JSON. Default: 32768
+
+Usage:
+    source = get_story_source()
+    snippet = source.get_snippet(1, 123)
+    view = play_choice(source, backend, game_id, 123, 0, prefetch_depth=2)
+"""
+
+import json
+import os
+import re
+import threading
+import weakref
+
+from .flags import (FLAG_REGISTRY_QUERY, FlagRegistry, apply_modifications,
+                    generate_sql_for_flags, parse_flag_op, passes_checks)
+from .templates import TemplateCache
+from .texts import TEXTS_QUERY, TextCache
+
+BUNDLE_ENVVAR = 'STORY_BUNDLE'
+MAX_FLAG_COLUMNS = 3
+DEFAULT_PREFETCH_MAX_DEPTH = 3
+DEFAULT_PREFETCH_MAX_BYTES = 32 * 1024
+
+# Rows of the story's live revision (see db_tools/revisions.py). The
+# snippet query reads the revision; the choices query is given the same
+# one, so a snippet and its choices always come from one revision.
+SNIPPET_QUERY = """SELECT s.story_id, s.snip_id, s.game_text, s.text_id,
+                          st.live_revision AS revision
+                   FROM snippets s JOIN stories st ON st.story_id = s.story_id
+                   WHERE s.story_id = %s AND s.snip_id = %s
+                     AND s.added_in <= st.live_revision
+                     AND (s.removed_in IS NULL
+                          OR s.removed_in > st.live_revision)"""
+CHOICES_QUERY = """SELECT choice_label, label_id, next_snip_id,
+                          mod_flg_1, mod_flg_2, mod_flg_3,
+                          check_flg_1, check_flg_2, check_flg_3
+                   FROM choices WHERE story_id = %s AND snip_id = %s
+                     AND added_in <= %s
+                     AND (removed_in IS NULL OR removed_in > %s)
+                   ORDER BY choice_id"""
+# Batched versions of the above; format with one "%s" per snip_id
+SNIPPETS_QUERY = """SELECT s.story_id, s.snip_id, s.game_text, s.text_id,
+                           st.live_revision AS revision
+                    FROM snippets s JOIN stories st ON st.story_id = s.story_id
+                    WHERE s.story_id = %s
+                      AND s.added_in <= st.live_revision
+                      AND (s.removed_in IS NULL
+                           OR s.removed_in > st.live_revision)
+                      AND s.snip_id IN ({})"""
+CHOICES_OF_SNIPPETS_QUERY = """SELECT snip_id, choice_label, label_id,
+                                      next_snip_id, mod_flg_1, mod_flg_2,
+                                      mod_flg_3, check_flg_1, check_flg_2,
+                                      check_flg_3
+                               FROM choices
+                               WHERE story_id = %s AND added_in <= %s
+                                 AND (removed_in IS NULL OR removed_in > %s)
+                                 AND snip_id IN ({})
+                               ORDER BY snip_id, choice_id"""
+
+LOAD_GAME_QUERY = """SELECT game_id, my_name, my_fruit, story_id,
+                            current_snip_id, flags
+                     FROM saved_games WHERE game_id = %s"""
+# Only saves over the position that was checked, so that of two concurrent
+# choices on one game the second updates nothing
+SAVE_GAME_QUERY = """UPDATE saved_games SET story_id = %s, current_snip_id = %s,
+                                            flags = %s,
+                                            saved_at = CURRENT_TIMESTAMP
+                     WHERE game_id = %s
+                       AND story_id IS NOT DISTINCT FROM %s
+                       AND current_snip_id IS NOT DISTINCT FROM %s"""
+
+# Compiled {placeholder} templates, shared by all story sources
+template_cache = TemplateCache()
+
+# {backend: FlagRegistry}, reloaded when a story registers new flags
+_flag_registries = weakref.WeakKeyDictionary()
+_flag_registries_lock = threading.Lock()
+
+
+class GameError(Exception):
+    """Invalid player action, e.g. picking a choice that is not visible"""
+    def __init__(self, msg, status=400):
+        super(GameError, self).__init__(msg)
+        self.status = status
+
+
+def to_numbered_params(sql):
+    """Converts "%s" placeholders to "$1", "$2", ... (e.g. for asyncpg)"""
+    counter = iter(range(1, sql.count('%s') + 1))
+    return re.sub(r'%s', lambda m: '${}'.format(next(counter)), sql)
+
+
+def get_flag_registry(backend, refresh=False):
+    """Returns the FlagRegistry of a backend, loading it on first use"""
+    registry = _flag_registries.get(backend)
+    if registry is None or refresh:
+        registry = FlagRegistry.from_rows(backend.query(FLAG_REGISTRY_QUERY))
+        with _flag_registries_lock:
+            _flag_registries[backend] = registry
+    return registry
+
+
+def decode_flags(backend, value):
+    """Converts a saved_games.flags value into a dict"""
+    registry = get_flag_registry(backend)
+    if not registry.can_unpack(value):
+        # Saved after a story registered more flags than we have loaded
+        registry = get_flag_registry(backend, refresh=True)
+    return registry.unpack(value)
+
+
+def encode_flags(backend, state):
+    """Converts a flag state dict into a value for saved_games.flags.
+
+    Flags that are not registered yet (e.g. of a story compiled before the
+    flag registry existed) are registered first.
+    """
+    registry = get_flag_registry(backend)
+    if not registry.can_pack(state):
+        registry = get_flag_registry(backend, refresh=True)
+    if not registry.can_pack(state):
+        backend.execute_statements(generate_sql_for_flags(
+            sorted(set(state) - set(registry.slots)), backend))
+        registry = get_flag_registry(backend, refresh=True)
+    return registry.pack(state)
+
+
+def visible_choices(snippet, state):
+    """Returns the snippet's choices whose flag checks pass for `state`"""
+    return [c for c in snippet['choices']
+            if passes_checks(c['check_flags'], state)]
+
+
+def player_view(snippet, state, game=None, cache=None):
+    """Strips a snippet down to what the player sees given their state
+
+    Placeholders in the text and the visible labels are rendered for the
+    player; `game` is their saved_games row (for {my_name} and the like).
+    """
+    if cache is None:
+        cache = template_cache
+    compiled = cache.get(snippet)
+    choices = visible_choices(snippet, state)
+    text, labels = compiled.render(compiled.context(game, state),
+                                   [c['choice_index'] for c in choices])
+    return dict(
+        story_id=snippet['story_id'],
+        snip_id=snippet['snip_id'],
+        game_text=text,
+        choices=[dict(choice_index=c['choice_index'], label=label,
+                      next_snip_id=c['next_snip_id'])
+                 for c, label in zip(choices, labels)],
+    )
+
+
+def prefetch_steps(view, snippet, state, game=None, depth=1,
+                   max_bytes=DEFAULT_PREFETCH_MAX_BYTES):
+    """Adds prefetched views to `view`, one level at a time.
+
+    A generator, so that synchronous and asynchronous sources can drive it:
+    it yields the list of snip_ids that the next level needs and expects
+    the dict of {snip_id: snippet dict} for them to be sent back. Use
+    prefetch() for a source with get_snippets().
+
+    Args:
+        view: player_view() of `snippet`; modified in place.
+
+        snippet, state, game: As for player_view().
+
+        depth: Number of choices ahead to prefetch.
+
+        max_bytes: Budget for the added views as compact JSON. Levels are
+            filled breadth-first, so running out leaves the nearest views.
+    """
+    frontier = [(view, snippet, state)]
+    fetched = {snippet['snip_id']: snippet}
+    for _ in range(depth):
+        pending = []
+        for parent, parent_snippet, parent_state in frontier:
+            choices = {c['choice_index']: c
+                       for c in parent_snippet['choices']}
+            for choice_view in parent['choices']:
+                choice = choices[choice_view['choice_index']]
+                pending.append((choice_view, choice['next_snip_id'],
+                                apply_modifications(choice['modifies_flags'],
+                                                    parent_state)))
+        missing = sorted({snip_id for _, snip_id, _ in pending
+                          if snip_id not in fetched})
+        if missing:
+            fetched.update((yield missing))
+
+        frontier = []
+        for choice_view, snip_id, next_state in pending:
+            next_snippet = fetched.get(snip_id)
+            if next_snippet is None:
+                continue
+            next_view = player_view(next_snippet, next_state, game)
+            size = len(json.dumps(next_view, separators=(',', ':')))
+            if size > max_bytes:
+                return
+            max_bytes -= size
+            choice_view['next'] = next_view
+            frontier.append((next_view, next_snippet, next_state))
+        if not frontier:
+            return
+
+
+def prefetch(source, view, snippet, state, game=None, depth=1,
+             max_bytes=DEFAULT_PREFETCH_MAX_BYTES):
+    """Runs prefetch_steps() against a story source. Returns `view`
+
+    Each level is one get_snippets() call. On a DatabaseSource that is one
+    batched query for the level's snippets, one for their choices and, for
+    texts stored by reference, one for the texts its TextCache is missing.
+    """
+    steps = prefetch_steps(view, snippet, state, game, depth, max_bytes)
+    try:
+        snip_ids = next(steps)
+        while True:
+            snip_ids = steps.send(source.get_snippets(snippet['story_id'],
+                                                      snip_ids))
+    except StopIteration:
+        pass
+    return view
+
+
+def prefetch_limits(requested):
+    """Parses a request's prefetch depth and caps it by the settings.
+
+    Args:
+        requested: Depth from the request (a string or int), or None.
+
+    Returns:
+        Tuple of (depth, max_bytes); depth is 0 if prefetching is off.
+
+    Raises:
+        GameError if `requested` is not a number.
+    """
+    if requested in (None, ''):
+        return 0, 0
+    try:
+        depth = int(requested)
+    except (TypeError, ValueError):
+        raise GameError('prefetch must be a number of choices, not '
+                        '{}'.format(repr(requested)))
+    max_depth = int(os.environ.get('PREFETCH_MAX_DEPTH',
+                                   DEFAULT_PREFETCH_MAX_DEPTH))
+    max_bytes = int(os.environ.get('PREFETCH_MAX_BYTES',
+                                   DEFAULT_PREFETCH_MAX_BYTES))
+    return max(0, min(depth, max_depth)), max_bytes
+
+
+def choose(snippet, choice_index, state):
+    """Applies the player's choice.
+
+    Args:
+        snippet: Snippet dict the player is on.
+
+        choice_index: choice_index of the picked choice.
+
+        state: Player's flag state before the choice.
+
+    Returns:
+        Tuple of (next_snip_id, new flag state).
+
+    Raises:
+        GameError if the choice does not exist or its checks do not pass.
+    """
+    for choice in snippet['choices']:
+        if choice['choice_index'] == choice_index:
+            break
+    else:
+        raise GameError('Snippet {} has no choice {}'.format(
+            snippet['snip_id'], choice_index))
+
+    if not passes_checks(choice['check_flags'], state):
+        raise GameError('Choice {} of snippet {} is not available'.format(
+            choice_index, snippet['snip_id']), status=403)
+    return (choice['next_snip_id'],
+            apply_modifications(choice['modifies_flags'], state))
+
+
+def game_story_id(game_row, story_id=None):
+    """Returns the story_id a saved game plays.
+
+    A game that has not started plays `story_id`, the story requested with
+    its first choice; a started game stays in its story.
+
+    Raises:
+        GameError if there is no story to play or `story_id` is another one.
+    """
+    saved = game_row['story_id']
+    if saved is None:
+        if story_id is None:
+            raise GameError('Game {} has not started; pass the story_id to '
+                            'play'.format(game_row['game_id']))
+        return story_id
+    if story_id is not None and story_id != saved:
+        raise GameError('Game {} is in story {}, not {}'.format(
+            game_row['game_id'], saved, story_id), status=409)
+    return saved
+
+
+def check_position(game_row, snip_id):
+    """Raises GameError unless the saved game is on (or may start at) snip_id"""
+    current = game_row['current_snip_id']
+    if current is not None and current != snip_id:
+        raise GameError('Game {} is on snippet {}, not {}'.format(
+            game_row['game_id'], current, snip_id), status=409)
+
+
+def stale_save_error(game_id, snip_id):
+    """The GameError for a SAVE_GAME_QUERY that updated no row"""
+    return GameError('Game {} moved on from snippet {} while the choice was '
+                     'made'.format(game_id, snip_id), status=409)
+
+
+def referenced_text_ids(snippet_row, choice_rows):
+    """Lists the text_ids that a snippet's rows store by reference"""
+    ids = []
+    if snippet_row['game_text'] is None:
+        ids.append(snippet_row['text_id'])
+    ids.extend(row['label_id'] for row in choice_rows
+               if row['choice_label'] is None)
+    return ids
+
+
+def choice_from_row(index, row, texts=None):
+    """Converts a row from CHOICES_QUERY into a choice dict
+
+    `texts` is a dict of {text_id: string} for labels stored by reference.
+    """
+    label = row['choice_label']
+    if label is None:
+        label = texts[row['label_id']]
+    return dict(
+        choice_index=index,
+        label=label,
+        next_snip_id=row['next_snip_id'],
+        check_flags=[parse_flag_op(row['check_flg_{}'.format(i)])
+                     for i in range(1, MAX_FLAG_COLUMNS + 1)
+                     if row['check_flg_{}'.format(i)]],
+        modifies_flags=[parse_flag_op(row['mod_flg_{}'.format(i)])
+                        for i in range(1, MAX_FLAG_COLUMNS + 1)
+                        if row['mod_flg_{}'.format(i)]],
+    )
+
+
+def group_choice_rows(choice_rows):
+    """Splits CHOICES_OF_SNIPPETS_QUERY rows into {snip_id: [rows]}"""
+    grouped = {}
+    for row in choice_rows:
+        grouped.setdefault(row['snip_id'], []).append(row)
+    return grouped
+
+
+def snippet_from_rows(snippet_row, choice_rows, texts=None):
+    """Builds a snippet dict from a SNIPPET_QUERY row and its choice rows
+
+    `texts` must map every id from referenced_text_ids() to its string.
+    """
+    game_text = snippet_row['game_text']
+    if game_text is None:
+        game_text = texts[snippet_row['text_id']]
+    return dict(
+        story_id=snippet_row['story_id'],
+        revision=snippet_row['revision'],
+        snip_id=snippet_row['snip_id'],
+        game_text=game_text,
+        choices=[choice_from_row(i, row, texts)
+                 for i, row in enumerate(choice_rows)],
+    )
+
+
+
+class DatabaseSource():
+    """Reads snippets from a db_tools storage backend
+
+    Snippets may come from a read replica; saved games never do, so a
+    player's next request always sees their last choice.
+    """
+    def __init__(self, backend=None, text_cache=None):
+        self._backend = backend
+        self.text_cache = TextCache() if text_cache is None else text_cache
+
+
+    @property
+    def backend(self):
+        """The backend given, or else the configured one at the time"""
+        if self._backend is None:
+            from db_tools.backends import get_backend
+            return get_backend()
+        return self._backend
+
+
+    def get_snippet(self, story_id, snip_id):
+        rows = self.backend.query(SNIPPET_QUERY, (story_id, snip_id),
+                                  replica=True)
+        if not rows:
+            return None
+        revision = rows[0]['revision']
+        choice_rows = self.backend.query(
+            CHOICES_QUERY, (story_id, snip_id, revision, revision),
+            replica=True)
+        texts = self.text_cache.get_many(
+            referenced_text_ids(rows[0], choice_rows), self._fetch_texts)
+        return snippet_from_rows(rows[0], choice_rows, texts)
+
+
+    def get_snippets(self, story_id, snip_ids):
+        """Returns {snip_id: snippet dict} for the story's snip_ids that exist
+
+        Makes two queries however many snippets are asked for, plus one for
+        referenced texts that are not in the text cache.
+        """
+        if not snip_ids:
+            return {}
+        params = ', '.join(['%s'] * len(snip_ids))
+        rows = self.backend.query(SNIPPETS_QUERY.format(params),
+                                  [story_id] + list(snip_ids), replica=True)
+        if not rows:
+            return {}
+        revision = rows[0]['revision']
+        choices = group_choice_rows(self.backend.query(
+            CHOICES_OF_SNIPPETS_QUERY.format(params),
+            [story_id, revision, revision] + list(snip_ids), replica=True))
+        ids = []
+        for row in rows:
+            ids.extend(referenced_text_ids(row,
+                                           choices.get(row['snip_id'], [])))
+        texts = self.text_cache.get_many(ids, self._fetch_texts)
+        return {row['snip_id']: snippet_from_rows(
+                    row, choices.get(row['snip_id'], []), texts)
+                for row in rows}
+
+
+    def _fetch_texts(self, ids):
+        return self.backend.query(
+            TEXTS_QUERY.format(', '.join(['%s'] * len(ids))), ids,
+            replica=True)
+
+
+
+class BundleSource():
+    """Reads snippets from a bundle file, following atomic file swaps
+
+    A bundle holds one story; other stories have no snippets.
+    """
+    def __init__(self, path):
+        self.path = path
+
+
+    def get_snippet(self, story_id, snip_id):
+        from .bundle import open_bundle
+        story = open_bundle(self.path)
+        if story.story_id != story_id:
+            return None
+        return story.get_snippet(snip_id)
+
+
+    def get_snippets(self, story_id, snip_ids):
+        from .bundle import open_bundle
+        story = open_bundle(self.path)
+        if story.story_id != story_id:
+            return {}
+        snippets = {}
+        for snip_id in snip_ids:
+            snippet = story.get_snippet(snip_id)
+            if snippet is not None:
+                snippets[snip_id] = snippet
+        return snippets
+
+
+
+def play_choice(source, backend, game_id, snip_id, choice_index,
+                prefetch_depth=0, prefetch_bytes=DEFAULT_PREFETCH_MAX_BYTES,
+                story_id=None):
+    """Applies a choice for a saved game and saves the result.
+
+    Args:
+        source: Story source to read snippets from.
+
+        backend: db_tools storage backend holding saved_games.
+
+        game_id, snip_id, choice_index: The player's action.
+
+        prefetch_depth, prefetch_bytes: Passed to prefetch(). Default: no
+            prefetching.
+
+        story_id: Story the choice is in; see game_story_id(). Only needed
+            for a game's first choice.
+
+    Returns:
+        Player view of the next snippet, with the new flag state applied.
+
+    Raises:
+        GameError for unknown games/snippets and invalid choices, and with
+        status 409 if the game is elsewhere, or another choice moved it on
+        before this one was saved.
+    """
+    rows = backend.query(LOAD_GAME_QUERY, (game_id,))
+    if not rows:
+        raise GameError('No saved game {}'.format(game_id), status=404)
+    game = rows[0]
+    story_id = game_story_id(game, story_id)
+    check_position(game, snip_id)
+
+    snippet = source.get_snippet(story_id, snip_id)
+    if snippet is None:
+        raise GameError('No snippet {} in story {}'.format(snip_id, story_id),
+                        status=404)
+    next_snip_id, state = choose(snippet, choice_index,
+                                 decode_flags(backend, game['flags']))
+
+    next_snippet = source.get_snippet(story_id, next_snip_id)
+    if next_snippet is None:
+        raise GameError('No snippet {} in story {}'.format(next_snip_id,
+                                                           story_id),
+                        status=404)
+    saved = backend.execute_statements([(SAVE_GAME_QUERY, (
+        story_id, next_snip_id, encode_flags(backend, state), game_id,
+        game['story_id'], game['current_snip_id']))])
+    if not saved[0]:
+        raise stale_save_error(game_id, snip_id)
+    view = player_view(next_snippet, state, game)
+    if prefetch_depth:
+        prefetch(source, view, next_snippet, state, game, prefetch_depth,
+                 prefetch_bytes)
+    return view
+
+
+def game_view(source, backend, game_id, prefetch_depth=0,
+              prefetch_bytes=DEFAULT_PREFETCH_MAX_BYTES):
+    """Returns the saved game and the player view of its current snippet.
+
+    The snippet is None if the game has not started yet. prefetch_depth and
+    prefetch_bytes are passed to prefetch().
+    """
+    rows = backend.query(LOAD_GAME_QUERY, (game_id,))
+    if not rows:
+        raise GameError('No saved game {}'.format(game_id), status=404)
+    game = rows[0]
+    state = decode_flags(backend, game['flags'])
+    snippet = None
+    if game['current_snip_id'] is not None:
+        snippet = source.get_snippet(game['story_id'],
+                                     game['current_snip_id'])
+    view = None
+    if snippet is not None:
+        view = player_view(snippet, state, game)
+        if prefetch_depth:
+            prefetch(source, view, snippet, state, game, prefetch_depth,
+                     prefetch_bytes)
+    return dict(
+        game_id=game['game_id'],
+        my_name=game['my_name'],
+        story_id=game['story_id'],
+        snippet=view,
+    )
+
+
+# The configured backend's source, shared by all requests so that they share
+# its TextCache (text_ids are content hashes, so entries never go stale)
+database_source = DatabaseSource()
+
+
+def get_story_source():
+    """Returns a BundleSource if STORY_BUNDLE is set, else the shared
+    DatabaseSource"""
+    path = os.environ.get(BUNDLE_ENVVAR)
+    if path:
+        return BundleSource(path)
+    return database_source
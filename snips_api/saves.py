@@ -0,0 +1,233 @@
+"""
+Saved-game lookup for the load page.
+
+Players find their saves by name. Every lookup is one range scan of an
+index on saved_games, so it stays fast however many saves there are:
+    - find_players(): names starting with a prefix, in name order, with
+      each player's number of saves and latest save time
+    - player_saves(): one player's saves, most recently saved first
+    - list_saves():   all saves, most recently saved first
+    - recent_players(): the players who saved last, cached for
+      SAVES_RECENT_TTL seconds since every visitor of the load page asks
+
+Names are compared by code point, so lookups are case-sensitive and names
+sort in code point order ("Zoe" before "adam").
+
+Listings are keyset-paginated: each page comes with a `next` cursor, an
+opaque string to pass back as `after` for the following page, or None on
+the last page. Unlike OFFSET, a page costs the same however deep it is,
+and saves made while paging do not shift later pages.
+
+Reads go to a read replica if one is configured (see db_tools.replicas).
+
+Settings (environment variables):
+    SAVES_RECENT_TTL -- seconds the recent players list is cached.
+                        Default: 10
+
+Usage:
+    page = find_players(backend, 'Pat')
+    page = player_saves(backend, 'Patsy', after=page['next'])
+    recent_players(backend)
+"""
+
+import base64
+import json
+import os
+import threading
+import time
+import weakref
+
+from .runtime import GameError
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+DEFAULT_RECENT_TTL = 10.0
+RECENT_PLAYERS = 20
+# Newest saves scanned for recent_players()
+RECENT_SCAN = 1000
+
+SAVE_COLUMNS = """game_id, my_name, story_id, current_snip_id, saved_at"""
+PLAYERS_QUERY = """SELECT my_name, count(*) AS saves,
+                          max(saved_at) AS last_saved_at
+                   FROM saved_games
+                   WHERE my_name >= %s {}
+                   GROUP BY my_name ORDER BY my_name LIMIT %s"""
+PLAYER_SAVES_QUERY = """SELECT {} FROM saved_games
+                        WHERE my_name = %s {}
+                        ORDER BY saved_at DESC, game_id DESC
+                        LIMIT %s""".format(SAVE_COLUMNS, '{}')
+SAVES_QUERY = """SELECT {} FROM saved_games {}
+                 ORDER BY saved_at DESC, game_id DESC
+                 LIMIT %s""".format(SAVE_COLUMNS, '{}')
+RECENT_QUERY = """SELECT my_name, saved_at FROM saved_games
+                  ORDER BY saved_at DESC, game_id DESC LIMIT %s"""
+# Keyset condition for the (saved_at DESC, game_id DESC) order
+BEFORE_SAVE = """(saved_at, game_id) < (%s, %s)"""
+
+
+def encode_cursor(values):
+    """Turns the sort key of a page's last row into a `next` cursor"""
+    data = json.dumps([str(v) if not isinstance(v, (int, str)) else v
+                       for v in values], separators=(',', ':'))
+    return base64.urlsafe_b64encode(data.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor, length):
+    """Reads a cursor from encode_cursor().
+
+    Raises:
+        GameError (400) if the cursor is malformed.
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(
+            cursor.encode('ascii')).decode('utf-8'))
+    except (ValueError, UnicodeError):
+        values = None
+    if not isinstance(values, list) or len(values) != length:
+        raise GameError('Invalid cursor {}'.format(repr(cursor)))
+    return values
+
+
+def page_size(limit):
+    """Clamps a requested page size (None or a string) to 1..MAX_PAGE_SIZE"""
+    try:
+        limit = int(limit) if limit is not None else DEFAULT_PAGE_SIZE
+    except ValueError:
+        raise GameError('limit must be an integer')
+    return max(1, min(MAX_PAGE_SIZE, limit))
+
+
+def prefix_upper_bound(prefix):
+    """Returns the smallest string above every string starting with
+    `prefix`, or None if there is none"""
+    while prefix:
+        last = ord(prefix[-1])
+        if last < 0x10ffff:
+            bumped = last + 1
+            if 0xd800 <= bumped <= 0xdfff:
+                # Skip the surrogates, which no stored name contains
+                bumped = 0xe000
+            return prefix[:-1] + chr(bumped)
+        prefix = prefix[:-1]
+    return None
+
+
+def save_dict(row):
+    return dict(game_id=row['game_id'], my_name=row['my_name'],
+                story_id=row['story_id'],
+                current_snip_id=row['current_snip_id'],
+                saved_at=str(row['saved_at']))
+
+
+def find_players(backend, prefix, after=None, limit=None):
+    """Lists the players whose names start with `prefix`.
+
+    Returns:
+        Dict of players, a list of dicts of my_name, saves and
+        last_saved_at in name order, and next.
+    """
+    limit = page_size(limit)
+    conditions, data = [], [prefix]
+    upper = prefix_upper_bound(prefix)
+    if upper is not None:
+        conditions.append('AND my_name < %s')
+        data.append(upper)
+    if after:
+        conditions.append('AND my_name > %s')
+        data.extend(decode_cursor(after, 1))
+    rows = backend.query(PLAYERS_QUERY.format(' '.join(conditions)),
+                         data + [limit + 1], replica=True)
+    players = [dict(my_name=row['my_name'], saves=row['saves'],
+                    last_saved_at=str(row['last_saved_at']))
+               for row in rows[:limit]]
+    next_cursor = None
+    if len(rows) > limit:
+        next_cursor = encode_cursor([players[-1]['my_name']])
+    return dict(players=players, next=next_cursor)
+
+
+def player_saves(backend, my_name, after=None, limit=None):
+    """Lists a player's saves, most recently saved first.
+
+    Returns:
+        Dict of saves, a list of dicts of game_id, my_name, story_id,
+        current_snip_id and saved_at, and next.
+    """
+    limit = page_size(limit)
+    data = [my_name]
+    condition = ''
+    if after:
+        condition = 'AND ' + BEFORE_SAVE
+        data.extend(decode_cursor(after, 2))
+    rows = backend.query(PLAYER_SAVES_QUERY.format(condition),
+                         data + [limit + 1], replica=True)
+    return saves_page(rows, limit)
+
+
+def list_saves(backend, after=None, limit=None):
+    """Lists all saves, most recently saved first; see player_saves()"""
+    limit = page_size(limit)
+    data = []
+    condition = ''
+    if after:
+        condition = 'WHERE ' + BEFORE_SAVE
+        data.extend(decode_cursor(after, 2))
+    rows = backend.query(SAVES_QUERY.format(condition), data + [limit + 1],
+                         replica=True)
+    return saves_page(rows, limit)
+
+
+def saves_page(rows, limit):
+    saves = [save_dict(row) for row in rows[:limit]]
+    next_cursor = None
+    if len(rows) > limit:
+        last = rows[limit - 1]
+        next_cursor = encode_cursor([last['saved_at'], last['game_id']])
+    return dict(saves=saves, next=next_cursor)
+
+
+
+class RecentPlayersCache():
+    """The players who saved last, re-read at most every `ttl` seconds"""
+    def __init__(self, ttl=None):
+        if ttl is None:
+            ttl = float(os.environ.get('SAVES_RECENT_TTL',
+                                       DEFAULT_RECENT_TTL))
+        self.ttl = ttl
+        self._players = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+
+    def get(self, backend):
+        """Returns dicts of my_name and last_saved_at, most recent first"""
+        now = time.monotonic()
+        with self._lock:
+            cached = self._players.get(backend)
+            if cached is not None and now - cached[0] < self.ttl:
+                return cached[1]
+
+        # Several threads may refresh at once; the last one wins
+        players, seen = [], set()
+        for row in backend.query(RECENT_QUERY, (RECENT_SCAN,), replica=True):
+            if row['my_name'] not in seen:
+                seen.add(row['my_name'])
+                players.append(dict(my_name=row['my_name'],
+                                    last_saved_at=str(row['saved_at'])))
+                if len(players) == RECENT_PLAYERS:
+                    break
+        with self._lock:
+            self._players[backend] = (now, players)
+        return players
+
+
+    def clear(self):
+        with self._lock:
+            self._players.clear()
+
+
+_recent_cache = RecentPlayersCache()
+
+
+def recent_players(backend):
+    """Returns the RECENT_PLAYERS players who saved last, from the cache"""
+    return _recent_cache.get(backend)
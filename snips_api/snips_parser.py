@@ -15,14 +15,21 @@ The main steps for this process are:
 
     3.  Verify that all snippets are linkable (no 'orphaned' snippets, i.e.
         all snippets are reachable from the 'root snippet', the first snippet
-        defined in the input text)
+        defined in the input text), and that {placeholders} in texts and
+        labels name known variables or flags (see templates.py)
 
     4.  Generate and yield SQL, data pairs for execution into database
+
+The result of steps 0-3 is cached on disk by script content (see
+parse_cache.py); bump PARSER_VERSION whenever a change to the parser or
+components changes what they produce.
 """
 
 
 import re
 
+from . import parse_cache, profiling
+from .templates import TemplateError, validate_snippets
 from .components import Choice, Snippet
 from .exceptions import ParserError
 
@@ -32,36 +39,77 @@ DIRECTIVES = {
     ,'REF_NUMS_ARE_SNIP_IDS': None
     ,'OVERWRITE_DB_SNIP_IDS': None  # REF_NUMS_ARE_SNIP_IDS must be active too
     ,'COMMENT_MARKER': str
+    ,'DEDUPLICATE_TEXT': None  # Store texts/labels once in the texts table
 }
 DIRECTIVE_ARG_SEPARATOR = ' '
 DIRECTIVE_IDENT_STR = r'directive:'  # This is regex
+PARSER_VERSION = 1  # Part of the parse cache key
 
 
-def parse(text):
+def parse(text, backend=None, bundle=None, use_cache=True):
     """Takes a plaintext string and parses its contents into SQL statements
 
     Intended to be the entry-point to the module.
     This function bridges the conversion of Snippets to their (query, data)
     representation for execution to the database.
+
+    `backend` is the db_tools.backends.StorageBackend that snip_ids are
+    resolved against. Defaults to the one configured by DATABASE_URL.
+
+    If `bundle` (a bundle.StagedBundle) is given, the compiled story is also
+    staged in it once the generator is consumed; commit it after the
+    statements are committed.
+
+    Set `use_cache` to False to bypass the parse cache (see parse_text()).
     """
-    snippets, directives = parse_text(text)
+    snippets, directives = parse_text(text, use_cache)
     
     root_snip = snippets[min(snippets.keys())][0]
-    root_snip.set_snip_id(directives['ROOT_SNIP_ID'])
+    # With REF_NUMS_ARE_SNIP_IDS the root already has its ref_num as snip_id
+    if root_snip.snip_id != directives['ROOT_SNIP_ID']:
+        root_snip.set_snip_id(directives['ROOT_SNIP_ID'])
 
     insert_method = 'timid'
     if directives.get('OVERWRITE_DB_SNIP_IDS', None):
         # Note: This directive also implies REF_NUMS_ARE_SNIP_IDS
         insert_method = 'rough'
     
-    for sql, data in root_snip.generate_chain_sql(insert_method):
+    dedup_text = bool(directives.get('DEDUPLICATE_TEXT', None))
+    for sql, data in root_snip.generate_chain_sql(insert_method, backend,
+                                                  bundle, dedup_text):
         yield sql, data 
 
 
-def parse_text(text):
-    """Converts text into snippets and directives."""
-    textlines = text.strip().splitlines()
-    textlines, directives = get_directives(textlines)
+def parse_text(text, use_cache=True):
+    """Converts text into snippets and directives.
+
+    Results are cached on disk by the text's content hash (see
+    parse_cache.py); a cache hit skips lexing and linking. Set `use_cache`
+    to False to always parse.
+    """
+    if not use_cache:
+        return _parse_text(text)
+
+    cache = parse_cache.default_cache()
+    with profiling.phase('parse_cache'):
+        key = parse_cache.cache_key(text, PARSER_VERSION)
+        cached = cache.get(key)
+    if cached is not None:
+        profiling.count('parse_cache_hits')
+        return cached
+
+    profiling.count('parse_cache_misses')
+    snippets, directives = _parse_text(text)
+    with profiling.phase('parse_cache'):
+        cache.put(key, snippets, directives)
+    return snippets, directives
+
+
+def _parse_text(text):
+    with profiling.phase('directives'):
+        textlines = text.strip().splitlines()
+        profiling.count('lines', len(textlines))
+        textlines, directives = get_directives(textlines)
     
     first_line_num = get_ref_num(textlines[0])
     comment_marker = directives.get('COMMENT_MARKER', None)
@@ -69,42 +117,53 @@ def parse_text(text):
     snippets = dict()
 
     # Ensure ref_nums in the text are unique
-    parse_data = [(ref_num, game_text, choices)
-                  for ref_num, game_text, choices
-                  in interpret(textlines, comment_marker)]
-
-    for ref_num, game_text, choices in parse_data:
-        if ref_num in snippets:
-            msg = ('Multiple snippets in your text have reference number {}'
-                  ).format(ref_num)
-            raise ParserError(msg)
-        #print(game_text)
-        snip = Snippet(game_text)
-        if directives.get('REF_NUMS_ARE_SNIP_IDS', None):
-            snip.set_snip_id(ref_num)
-        snippets[ref_num] = (snip, choices)
-        
-    # Link up choices and snippet objects
-    for snip, choices in snippets.values():
-        for choice in choices:
-            choice.set_source_snip(snip)
-            snip.choices.append(choice)
-            tgt_ref_num = choice.next_snippet
-            if tgt_ref_num not in snippets:
-                msg = ('Invalid snippet reference number {} for the choice '
-                       '"{}"').format(tgt_ref_num, choice.label)
+    with profiling.phase('interpret'):
+        parse_data = [(ref_num, game_text, choices)
+                      for ref_num, game_text, choices
+                      in interpret(textlines, comment_marker)]
+        profiling.count('snippets', len(parse_data))
+
+    with profiling.phase('link'):
+        for ref_num, game_text, choices in parse_data:
+            if ref_num in snippets:
+                msg = ('Multiple snippets in your text have reference '
+                       'number {}').format(ref_num)
                 raise ParserError(msg)
-            choice.next_snippet = snippets[tgt_ref_num][0]
+            #print(game_text)
+            snip = Snippet(game_text)
+            if directives.get('REF_NUMS_ARE_SNIP_IDS', None):
+                snip.set_snip_id(ref_num)
+            snippets[ref_num] = (snip, choices)
+            
+        # Link up choices and snippet objects
+        for snip, choices in snippets.values():
+            profiling.count('choices', len(choices))
+            for choice in choices:
+                choice.set_source_snip(snip)
+                snip.choices.append(choice)
+                tgt_ref_num = choice.next_snippet
+                if tgt_ref_num not in snippets:
+                    msg = ('Invalid snippet reference number {} for the '
+                           'choice "{}"').format(tgt_ref_num, choice.label)
+                    raise ParserError(msg)
+                choice.next_snippet = snippets[tgt_ref_num][0]
 
     # Attempt to detect orphaned snippets
-    root_snip = snippets[min(snippets.keys())][0]
-    reachable_snippets = root_snip.get_snippets_tree()
-    if len(snippets) != len(reachable_snippets):
-        msg = ('Number of total snippets (count: {}) not equal to number '
-               'of snippets reachable from the snippet with lowest '
-               'reference number (count: {})'
-              ).format(len(snippets), len(reachable_snippets))
-        raise ParserError(msg)
+    with profiling.phase('orphan_check'):
+        root_snip = snippets[min(snippets.keys())][0]
+        reachable_snippets = root_snip.get_snippets_tree()
+        if len(snippets) != len(reachable_snippets):
+            msg = ('Number of total snippets (count: {}) not equal to number '
+                   'of snippets reachable from the snippet with lowest '
+                   'reference number (count: {})'
+                  ).format(len(snippets), len(reachable_snippets))
+            raise ParserError(msg)
+
+    with profiling.phase('placeholders'):
+        try:
+            validate_snippets(reachable_snippets)
+        except TemplateError as e:
+            raise ParserError(str(e))
 
     return snippets, directives
 
@@ -210,6 +269,7 @@ def interpret(textlines, comment_marker=None):
             if choice_whitespace and get_indent(line) != choice_whitespace:
                 latest_choice = choices[-1]
                 method, expr = parse_flag(i+1, line)
+                profiling.count('flag_ops')
                 try:
                     if method is 'check':
                         latest_choice.add_check_flag(expr)
@@ -0,0 +1,251 @@
+"""
+Placeholders in snippet texts and choice labels.
+
+Game text can refer to the player's state with {placeholders}, e.g.
+"Admitted on {date} {time}" or "You have lost {patient_deaths} patients".
+A placeholder names either a context variable (see CONTEXT_VARIABLES) or a
+flag that the story's choices check or modify; flags render as their value
+for the player (0 if never set). Use {{ and }} for literal braces.
+
+Each string is compiled once into a Template of literal and placeholder
+segments, so rendering for a player is a lookup per placeholder and a
+join. Compiled snippets are cached by (story_id, snip_id, version), where
+the version is the story revision the snippet was read from (see
+db_tools/revisions.py), or for bundles a fingerprint of the snippet's
+strings: a recompiled story, a rollback or a swapped bundle gets new cache
+entries instead of stale segments, and stories never share entries.
+
+The parser and compiler call validate_snippets() so that unknown names and
+unbalanced braces are reported when a story is compiled, not when a player
+reaches the snippet. Strings stored before placeholders existed are
+rendered verbatim if they do not compile.
+
+Usage:
+    cache = TemplateCache()
+    compiled = cache.get(snippet)
+    text, labels = compiled.render(compiled.context(game, flag_state))
+"""
+
+import datetime
+import re
+import threading
+from collections import OrderedDict
+
+from .flags import story_flag_names
+
+DEFAULT_CACHE_SIZE = 10000
+DATE_FORMAT = '%d %b %Y'
+TIME_FORMAT = '%H:%M'
+
+# Placeholder name -> function of (saved_games row, now) giving its text
+CONTEXT_VARIABLES = {
+    'date': lambda game, now: now.strftime(DATE_FORMAT),
+    'time': lambda game, now: now.strftime(TIME_FORMAT),
+    'my_name': lambda game, now: game['my_name'] if game else '',
+    'my_fruit': lambda game, now: game['my_fruit'] if game else '',
+}
+
+_TOKEN = re.compile(r'\{\{|\}\}|\{([A-Za-z_][A-Za-z0-9_]*)\}|[{}]')
+
+
+class TemplateError(ValueError):
+    """A string has unbalanced braces or an unknown placeholder"""
+
+
+
+class Template():
+    """A string compiled into literal and placeholder segments.
+
+    `parts` is a list of literal strings with None in each placeholder's
+    position; `slots` lists (position, name) for the placeholders.
+    """
+    __slots__ = ('source', 'parts', 'slots', 'names')
+
+    def __init__(self, source, parts, slots):
+        self.source = source
+        self.parts = parts
+        self.slots = slots
+        self.names = frozenset(name for _, name in slots)
+
+
+    def render(self, values):
+        """Fills in the placeholders from a dict of {name: string}"""
+        if not self.slots:
+            return self.parts[0]
+        parts = list(self.parts)
+        for i, name in self.slots:
+            parts[i] = values[name]
+        return ''.join(parts)
+
+
+    def __repr__(self):
+        return '<Template {}>'.format(repr(self.source))
+
+
+
+def compile_template(text):
+    """Splits `text` into a Template.
+
+    Raises:
+        TemplateError for a lone "{" or "}" or a malformed placeholder.
+    """
+    parts, slots, literal = [], [], []
+    pos = 0
+    for m in _TOKEN.finditer(text):
+        literal.append(text[pos:m.start()])
+        pos = m.end()
+        token = m.group()
+        if token in ('{{', '}}'):
+            literal.append(token[0])
+        elif m.group(1):
+            # Empty literals are dropped so that rendering joins fewer parts
+            if any(literal):
+                parts.append(''.join(literal))
+            literal = []
+            slots.append((len(parts), m.group(1)))
+            parts.append(None)
+        else:
+            raise TemplateError('Unbalanced "{}" at position {} of {}'.format(
+                token, m.start(), repr(text)))
+    literal.append(text[pos:])
+    if any(literal) or not parts:
+        parts.append(''.join(literal))
+    return Template(text, parts, slots)
+
+
+def compile_lenient(text):
+    """Like compile_template(), but returns a verbatim Template on errors"""
+    try:
+        return compile_template(text)
+    except TemplateError:
+        return Template(text, [text], [])
+
+
+def validate_snippets(snips):
+    """Checks the placeholders of components.Snippet objects.
+
+    Every placeholder must name a context variable or a flag used by one of
+    the choices of `snips`.
+
+    Raises:
+        TemplateError naming the first offending string.
+    """
+    allowed = set(CONTEXT_VARIABLES).union(story_flag_names(snips))
+    for snip in snips:
+        strings = [snip.text] + [choice.label for choice in snip.choices]
+        for s in strings:
+            template = compile_template(s)
+            unknown = sorted(template.names - allowed)
+            if unknown:
+                raise TemplateError(
+                    'Unknown placeholder(s) {} in {} (expected one of {} or '
+                    'a flag used by the story)'.format(
+                        ', '.join('{' + n + '}' for n in unknown), repr(s),
+                        ', '.join(sorted(CONTEXT_VARIABLES))))
+
+
+def snippet_version(snippet):
+    """Fingerprints the strings of a snippet dict"""
+    return hash((snippet['game_text'],)
+                + tuple(c['label'] for c in snippet['choices']))
+
+
+
+class CompiledSnippet():
+    """Templates for a snippet's text and all of its choice labels"""
+    __slots__ = ('text', 'labels', 'names')
+
+    def __init__(self, snippet):
+        self.text = compile_lenient(snippet['game_text'])
+        self.labels = [compile_lenient(c['label'])
+                       for c in snippet['choices']]
+        self.names = self.text.names.union(*[t.names for t in self.labels])
+
+
+    def context(self, game, state, now=None):
+        """Resolves the placeholders used anywhere in the snippet.
+
+        Args:
+            game: saved_games row (a mapping) or None.
+
+            state: Player's flag state dict.
+
+            now: datetime for {date} and {time}. Default: now.
+
+        Returns:
+            Dict of {name: string}.
+        """
+        values = {}
+        for name in self.names:
+            variable = CONTEXT_VARIABLES.get(name)
+            if variable is not None:
+                if now is None:
+                    now = datetime.datetime.now()
+                value = variable(game, now)
+            elif name in state:
+                value = state[name]
+            else:
+                value = 0
+            values[name] = str(value)
+        return values
+
+
+    def render(self, values, indexes=None):
+        """Renders the text and the labels in one pass.
+
+        Args:
+            values: Dict from context().
+
+            indexes: choice_indexes of the labels to render. Default: all.
+
+        Returns:
+            Tuple of (text, list of labels).
+        """
+        labels = self.labels
+        if indexes is not None:
+            labels = [labels[i] for i in indexes]
+        return (self.text.render(values),
+                [t.render(values) for t in labels])
+
+
+
+class TemplateCache():
+    """Thread-safe LRU cache of {(story_id, snip_id, version):
+    CompiledSnippet}"""
+    def __init__(self, maxsize=DEFAULT_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._compiled = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+
+    def __len__(self):
+        return len(self._compiled)
+
+
+    def get(self, snippet, version=None):
+        """Returns the CompiledSnippet of a snippet dict.
+
+        `version` defaults to the snippet's revision if it has one, else to
+        snippet_version(snippet).
+        """
+        if version is None:
+            version = snippet.get('revision')
+        if version is None:
+            version = snippet_version(snippet)
+        key = (snippet.get('story_id'), snippet['snip_id'], version)
+        with self._lock:
+            compiled = self._compiled.get(key)
+            if compiled is not None:
+                self._compiled.move_to_end(key)
+                self.hits += 1
+                return compiled
+            self.misses += 1
+
+        compiled = CompiledSnippet(snippet)
+        with self._lock:
+            self._compiled[key] = compiled
+            while len(self._compiled) > self.maxsize:
+                self._compiled.popitem(last=False)
+        return compiled
@@ -13,11 +13,22 @@ Usage:
 """
 
 
+import io
+import json
 import unittest
 import os
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
-from . import snips_parser, pprint_generator
+from . import bundle, compile_service, compiler, decompiler, flags, \
+              parse_cache, profiling, runtime, saves, snips_parser, \
+              templates, texts, pprint_generator
 from .components import *
+from .exceptions import (CompilerError, DecompilerError, ParserError,
+                         TimidError)
+from db_tools import revisions
+from db_tools.backends import SQLiteBackend
 
 SAMPLE_TEXT = """
 directive:COMMENT_MARKER //
@@ -38,6 +49,50 @@ directive:ROOT_SNIP_ID 123
 31. This is going to be a long day...
 """
 
+SAMPLE_PARSE_OUTPUT = [
+    (
+        'INSERT INTO story_revisions(story_id, revision, source) VALUES (%s, %s, %s)',
+        [123, 1, 'compile']
+    ), (
+        'INSERT INTO snippets(story_id, snip_id, game_text, text_id, added_in) VALUES (%s, %s, %s, %s, %s), (%s, %s, %s, %s, %s), (%s, %s, %s, %s, %s), (%s, %s, %s, %s, %s)', 
+        [
+            123, 123, 'Introducing myself, I took a chair and sat beside John.', None, 1,
+            123, 124, 'John: “Ah, doctor. Not too good…”', None, 1,
+            123, 125, 'John: “What?”', None, 1,
+            123, 126, 'This is going to be a long day...', None, 1
+        ]
+    ), (
+        'INSERT INTO choices(story_id, snip_id, choice_label, label_id, next_snip_id, mod_flg_1, mod_flg_2, mod_flg_3, check_flg_1, check_flg_2, check_flg_3, added_in) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s), (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s), (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s), (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)',
+        [
+            123, 123, 'How are you feeling?', None, 124, None, None, None, None, None, None, 1,
+            123, 123, 'You’re looking good today.', None, 125, 'bm_patient += 1', None, None, 'skin_thickness >= 5', None, None, 1,
+            123, 124, 'Next', None, 126, None, None, None, None, None, None, 1,
+            123, 125, 'Next', None, 126, None, None, None, None, None, None, 1
+        ]
+    ), (
+        'INSERT INTO stories(story_id, live_revision) VALUES (%s, %s) ON CONFLICT (story_id) DO UPDATE SET live_revision = excluded.live_revision',
+        [123, 1]
+    ), (
+        'INSERT INTO flag_registry(flag_id, flag_name) SELECT (SELECT COALESCE(MAX(flag_id), -1) FROM flag_registry) + ROW_NUMBER() OVER (ORDER BY v.column1), v.column2 FROM (VALUES (%s, %s), (%s, %s)) AS v WHERE v.column2 NOT IN (SELECT flag_name FROM flag_registry) ON CONFLICT (flag_name) DO NOTHING',
+        [0, 'skin_thickness', 1, 'bm_patient']
+    )
+]
+
+
+
+_cache_dir = None
+
+
+def setUpModule():
+    # Keep the parse cache of test runs out of the user's cache directory
+    global _cache_dir
+    _cache_dir = tempfile.TemporaryDirectory()
+    os.environ[parse_cache.DIR_ENVVAR] = _cache_dir.name
+
+
+def tearDownModule():
+    del os.environ[parse_cache.DIR_ENVVAR]
+    _cache_dir.cleanup()
 
 
 def _setup_dburl():
@@ -94,33 +149,770 @@ class ParsingTestCase(unittest.TestCase):
         _setup_dburl()
 
     def test_parse(self):
-        parse_output = [
-            (
-                'INSERT INTO snippets(snip_id, game_text) VALUES (%s, %s), (%s, %s), (%s, %s), (%s, %s)', 
-                [
-                    'John: “Ah, doctor. Not too good…”', 124, 
-                    'John: “What?”', 125, 
-                    'This is going to be a long day...', 126, 
-                    'Introducing myself, I took a chair and sat beside John.', 123
-                ]
-            ), (
-                'INSERT INTO choices(choice_label, snip_id, next_snip_id, mod_flg_1, mod_flg_2, mod_flg_3, check_flg_1, check_flg_2, check_flg_3) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)',
-                ['How are you feeling?', 123, 124, None, None, None, None, None, None]
-            ), (
-                'INSERT INTO choices(choice_label, snip_id, next_snip_id, mod_flg_1, mod_flg_2, mod_flg_3, check_flg_1, check_flg_2, check_flg_3) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)', 
-                ['You’re looking good today.', 123, 125, 'bm_patient += 1', None, None, 'skin_thickness >= 5', None, None]
-            ), (
-                'INSERT INTO choices(choice_label, snip_id, next_snip_id, mod_flg_1, mod_flg_2, mod_flg_3, check_flg_1, check_flg_2, check_flg_3) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)', 
-                ['Next', 124, 126, None, None, None, None, None, None]
-            ), (
-                'INSERT INTO choices(choice_label, snip_id, next_snip_id, mod_flg_1, mod_flg_2, mod_flg_3, check_flg_1, check_flg_2, check_flg_3) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)', 
-                ['Next', 125, 126, None, None, None, None, None, None]
-            )
-        ]
         output = [x for x in snips_parser.parse(SAMPLE_TEXT)]
-        self.assertEqual(output, parse_output, 'bad parser output')
+        self.assertEqual(output, SAMPLE_PARSE_OUTPUT, 'bad parser output')
+
+
+
+
+
+
+    def test_parse_sqlite(self):
+        backend = SQLiteBackend()
+        backend.init_schema()
+        output = list(snips_parser.parse(SAMPLE_TEXT, backend=backend))
+        self.assertEqual(output, SAMPLE_PARSE_OUTPUT, 'bad parser output')
+
+        backend.execute_statements(output)
+        self.assertEqual(len(backend.fetch_table('snippets')), 5)
+        self.assertEqual(len(backend.fetch_table('choices')), 5)
+
+        # Root snip_id 123 now exists, so a timid insert must refuse
+        with self.assertRaises(TimidError):
+            list(snips_parser.parse(SAMPLE_TEXT, backend=backend))
+
+
+class BundleTestCase(unittest.TestCase):
+    def setUp(self):
+        self.backend = SQLiteBackend()
+        self.backend.init_schema()
+        fd, self.path = tempfile.mkstemp(suffix='.bundle')
+        os.close(fd)
+
+    def tearDown(self):
+        os.unlink(self.path)
+
+    def test_bundle_matches_database(self):
+        with bundle.StagedBundle(self.path) as staged:
+            statements = list(snips_parser.parse(
+                SAMPLE_TEXT, backend=self.backend, bundle=staged))
+            self.backend.execute_statements(statements)
+            staged.commit()
+
+        story = bundle.StoryBundle(self.path)
+        self.assertEqual(story.root_snip_id, 123)
+        self.assertEqual(list(story.snip_ids()), [123, 124, 125, 126])
+        self.assertIsNone(story.get_snippet(999))
+
+        db = runtime.DatabaseSource(self.backend)
+        for snip_id in story.snip_ids():
+            # Bundles hold one version of the story and have no revision
+            snippet = db.get_snippet(123, snip_id)
+            self.assertEqual(snippet.pop('revision'), 1)
+            self.assertEqual(story.get_snippet(snip_id), snippet)
+        self.assertEqual(story.get_snippet(123)['choices'][1]['check_flags'],
+                         [('skin_thickness', '>=', 5)])
+        story.close()
+
+    def test_staged_bundle_waits_for_commit(self):
+        with bundle.StagedBundle(self.path) as staged:
+            statements = list(snips_parser.parse(
+                SAMPLE_TEXT, backend=self.backend, bundle=staged))
+            # The compile's transaction fails
+            with self.assertRaises(Exception):
+                self.backend.execute_statements(
+                    statements + [('INSERT INTO nowhere VALUES (1)', ())])
+        # The old (empty) file is untouched and nothing is left behind
+        self.assertEqual(os.path.getsize(self.path), 0)
+        self.assertEqual([name for name in os.listdir(
+                              os.path.dirname(self.path))
+                          if name.startswith('.bundle-')], [])
+
+    def test_open_bundle_follows_swap(self):
+        root = RootSnippet(1, 'Old')
+        root.add_choice('Next', next_snippet=TerminalSnippet('End', 2))
+        snips = root.get_snippets_tree()
+        bundle.write_bundle(self.path, 1, snips, {s: s.snip_id for s in snips})
+        self.assertEqual(bundle.open_bundle(self.path).get_snippet(1)
+                         ['game_text'], 'Old')
+
+        root.text = 'New'
+        bundle.write_bundle(self.path, 1, snips, {s: s.snip_id for s in snips})
+        self.assertEqual(bundle.open_bundle(self.path).get_snippet(1)
+                         ['game_text'], 'New')
+
+
+class FlagsTestCase(unittest.TestCase):
+    def test_checks_and_modifications(self):
+        check = flags.parse_flag_op('skin_thickness >= 5')
+        self.assertFalse(flags.passes_checks([check], {}))
+        self.assertTrue(flags.passes_checks([check], {'skin_thickness': 5}))
+
+        mods = [flags.parse_flag_op(e) for e in ('a = 4', 'a *= 3', 'a /= 5',
+                                                 'b -= 1')]
+        state = {'c': 1}
+        self.assertEqual(flags.apply_modifications(mods, state),
+                         {'a': 2, 'b': -1, 'c': 1})
+        self.assertEqual(state, {'c': 1})
+
+
+    def test_flag_registry_packing(self):
+        old = flags.FlagRegistry(['a', 'b'])
+        blob = old.pack({'b': -3})
+        self.assertEqual(len(blob), 2 * flags.FLAG_SLOT_SIZE)
+        self.assertEqual(old.unpack(blob), {'a': 0, 'b': -3})
+        with self.assertRaises(KeyError):
+            old.pack({'c': 1})
+
+        # Registering a flag keeps older states readable
+        new = flags.FlagRegistry.from_rows([
+            dict(flag_id=0, flag_name='a'), dict(flag_id=1, flag_name='b'),
+            dict(flag_id=2, flag_name='c')])
+        self.assertEqual(new.unpack(blob), {'a': 0, 'b': -3, 'c': 0})
+        self.assertFalse(old.can_unpack(new.pack({'c': 1})))
+
+
+class RuntimeTestCase(unittest.TestCase):
+    def setUp(self):
+        self.backend = SQLiteBackend()
+        self.backend.init_schema()
+        self.backend.execute_statements(
+            snips_parser.parse(SAMPLE_TEXT, backend=self.backend))
+        self.backend.execute_statements([(
+            "INSERT INTO saved_games(game_id, my_name, my_fruit) "
+            "VALUES (%s, %s, %s)", (1, 'Patsy', 'coconut'))])
+        self.source = runtime.DatabaseSource(self.backend)
+
+    def test_play_choice(self):
+        game = runtime.game_view(self.source, self.backend, 1)
+        self.assertIsNone(game['snippet'])
+
+        # Choice 1 requires skin_thickness >= 5
+        view = self.source.get_snippet(123, 123)
+        self.assertEqual([c['choice_index'] for c in 
+                          runtime.player_view(view, {})['choices']], [0])
+        with self.assertRaises(runtime.GameError) as cm:
+            runtime.play_choice(self.source, self.backend, 1, 123, 1,
+                                story_id=123)
+        self.assertEqual(cm.exception.status, 403)
+
+        # The first choice names the story to play
+        with self.assertRaises(runtime.GameError) as cm:
+            runtime.play_choice(self.source, self.backend, 1, 123, 0)
+        self.assertEqual(cm.exception.status, 400)
+        view = runtime.play_choice(self.source, self.backend, 1, 123, 0,
+                                   story_id=123)
+        self.assertEqual((view['story_id'], view['snip_id']), (123, 124))
+        game = runtime.game_view(self.source, self.backend, 1)
+        self.assertEqual(game['snippet'], view)
+
+        # The game has moved on from 123
+        with self.assertRaises(runtime.GameError) as cm:
+            runtime.play_choice(self.source, self.backend, 1, 123, 0)
+        self.assertEqual(cm.exception.status, 409)
+        with self.assertRaises(runtime.GameError) as cm:
+            runtime.play_choice(self.source, self.backend, 1, 124, 0,
+                                story_id=124)
+        self.assertEqual(cm.exception.status, 409)
+
+    def test_save_from_stale_position(self):
+        runtime.play_choice(self.source, self.backend, 1, 123, 0,
+                            story_id=123)
+        query = self.backend.query
+
+        def load_then_move(sql, data=(), replica=False):
+            # Another request saves right after this one loaded the game
+            rows = query(sql, data, replica)
+            if sql == runtime.LOAD_GAME_QUERY:
+                self.backend.execute_statements([(
+                    'UPDATE saved_games SET current_snip_id = %s', (125,))])
+            return rows
+
+        self.backend.query = load_then_move
+        with self.assertRaises(runtime.GameError) as cm:
+            runtime.play_choice(self.source, self.backend, 1, 124, 0)
+        self.assertEqual(cm.exception.status, 409)
+        del self.backend.query
+        rows = self.backend.query(runtime.LOAD_GAME_QUERY, (1,))
+        self.assertEqual(rows[0]['current_snip_id'], 125)
+
+    def test_stories_share_snip_ids(self):
+        # Story 124's root has the snip_id of a snippet in story 123
+        self.backend.execute_statements(snips_parser.parse(
+            "directive:ROOT_SNIP_ID 124\n1. Other start\n    Go\n"
+            "2. Other end", backend=self.backend))
+        self.assertEqual(self.source.get_snippet(124, 124)['game_text'],
+                         'Other start')
+        self.assertEqual(self.source.get_snippet(123, 124)['game_text'],
+                         'John: “Ah, doctor. Not too good…”')
+        self.assertIsNone(self.source.get_snippet(124, 126))
+
+        self.assertEqual(compiler.find_orphans(123, self.backend), [])
+        self.backend.execute_statements([(
+            'DELETE FROM choices WHERE story_id = %s AND next_snip_id = %s',
+            [123, 125])])
+        self.assertEqual(compiler.find_orphans(123, self.backend), [125])
+        self.assertEqual(compiler.find_orphans(124, self.backend), [])
+
+    def test_flags_saved_packed(self):
+        self.backend.execute_statements([(
+            'UPDATE saved_games SET story_id = %s, current_snip_id = %s',
+            [123, 125])])
+        registry = runtime.get_flag_registry(self.backend)
+        self.assertEqual(registry.names, ['skin_thickness', 'bm_patient'])
+
+        # Another story registers a flag after the registry was loaded
+        self.backend.execute_statements(snips_parser.parse(
+            "directive:ROOT_SNIP_ID 200\n1. Start\n    Go\n"
+            "        bm_patient += 2\n        johndoe_death = 1\n"
+            "2. End", backend=self.backend))
+        runtime.play_choice(self.source, self.backend, 1, 125, 0)
+        self.backend.execute_statements([(
+            'UPDATE saved_games SET story_id = %s, current_snip_id = %s',
+            [200, 200])])
+        runtime.play_choice(self.source, self.backend, 1, 200, 0)
+
+        blob = self.backend.query('SELECT flags FROM saved_games')[0]['flags']
+        self.assertEqual(len(blob), 3 * flags.FLAG_SLOT_SIZE)
+        self.assertEqual(runtime.decode_flags(self.backend, blob),
+                         {'skin_thickness': 0, 'bm_patient': 2,
+                          'johndoe_death': 1})
+
+    def test_unregistered_flags(self):
+        # Saved before the compiler registered the story's flags
+        blob = runtime.encode_flags(self.backend, {'late_flag': 4})
+        self.assertEqual(runtime.decode_flags(self.backend, blob),
+                         {'skin_thickness': 0, 'bm_patient': 0,
+                          'late_flag': 4})
+
+    def test_convert_json_states(self):
+        self.backend.execute_statements([(
+            'UPDATE saved_games SET flags = %s',
+            ['{"bm_patient": 2, "old_flag": 1}'])])
+        self.assertEqual(flags.convert_json_states(self.backend), 1)
+        blob = self.backend.query('SELECT flags FROM saved_games')[0]['flags']
+        self.assertEqual(runtime.decode_flags(self.backend, blob),
+                         {'skin_thickness': 0, 'bm_patient': 2,
+                          'old_flag': 1})
+        self.assertEqual(flags.convert_json_states(self.backend), 0)
+
+    def test_prefetch(self):
+        self.backend.execute_statements([(
+            'UPDATE saved_games SET story_id = %s, current_snip_id = %s',
+            [123, 123])])
+        queries = []
+        query = self.backend.query
+        def counting_query(sql, data=(), replica=False):
+            queries.append(sql)
+            return query(sql, data, replica)
+        self.backend.query = counting_query
+
+        view = runtime.game_view(self.source, self.backend, 1,
+                                 prefetch_depth=3)['snippet']
+        first = view['choices'][0]['next']
+        self.assertEqual(first['snip_id'], 124)
+        self.assertEqual(first['choices'][0]['next']['snip_id'], 126)
+        self.assertEqual(first['choices'][0]['next']['choices'], [])
+        # Two batched lookups per level reached, after the game and snippet
+        self.assertEqual(len(queries), 2 + 2 + 2 * 2)
+
+        # Prefetched views follow the flag state each choice leaves behind
+        snippet = self.source.get_snippet(123, 123)
+        state = {'skin_thickness': 5}
+        view = runtime.prefetch(self.source,
+                                runtime.player_view(snippet, state),
+                                snippet, state, depth=1)
+        self.assertEqual([c['next']['snip_id'] for c in view['choices']],
+                         [124, 125])
+
+        # Running out of bytes keeps the nearest views
+        budget = len(json.dumps(runtime.player_view(
+            self.source.get_snippet(123, 124), {}), separators=(',', ':')))
+        view = runtime.game_view(self.source, self.backend, 1,
+                                 prefetch_depth=3,
+                                 prefetch_bytes=budget)['snippet']
+        first = view['choices'][0]['next']
+        self.assertEqual(first['snip_id'], 124)
+        self.assertNotIn('next', first['choices'][0])
+        self.assertEqual(runtime.prefetch_limits('99'),
+                         (runtime.DEFAULT_PREFETCH_MAX_DEPTH,
+                          runtime.DEFAULT_PREFETCH_MAX_BYTES))
+
+    def test_to_numbered_params(self):
+        self.assertEqual(runtime.to_numbered_params(runtime.SAVE_GAME_QUERY)
+                         .split(), 'UPDATE saved_games SET story_id = $1, '
+                         'current_snip_id = $2, flags = $3, '
+                         'saved_at = CURRENT_TIMESTAMP WHERE game_id = $4 '
+                         'AND story_id IS NOT DISTINCT FROM $5 '
+                         'AND current_snip_id IS NOT DISTINCT FROM $6'
+                         .split())
+
+
+class RevisionsTestCase(unittest.TestCase):
+    SCRIPT = """directive:ROOT_SNIP_ID 10
+directive:REF_NUMS_ARE_SNIP_IDS
+directive:OVERWRITE_DB_SNIP_IDS
+10. Start
+    Left -> (11)
+    Right -> (12)
+11. Left
+    Next -> (13)
+12. Right
+    Next -> (13)
+13. End
+"""
+
+    def setUp(self):
+        self.backend = SQLiteBackend()
+        self.backend.init_schema()
+        self.source = runtime.DatabaseSource(self.backend)
+
+    def compile(self, text):
+        self.backend.execute_statements(snips_parser.parse(
+            text, backend=self.backend))
+
+    def count(self, table):
+        return len(self.backend.fetch_table(table)) - 1
+
+    def test_recompile_shares_unchanged_rows(self):
+        self.compile(self.SCRIPT)
+        self.compile(self.SCRIPT.replace('12. Right', '12. Right again'))
+        self.assertEqual(revisions.live_revision(10, self.backend), 2)
+        # One new snippet row; the choices are all shared
+        self.assertEqual((self.count('snippets'), self.count('choices')),
+                         (5, 4))
+        snippet = self.source.get_snippet(10, 12)
+        self.assertEqual((snippet['game_text'], snippet['revision']),
+                         ('Right again', 2))
+        self.assertEqual(self.backend.search('again')['total'], 1)
+
+        # Rolling back only moves the pointer
+        revisions.set_live_revision(10, 1, self.backend)
+        snippet = self.source.get_snippet(10, 12)
+        self.assertEqual((snippet['game_text'], snippet['revision']),
+                         ('Right', 1))
+        self.assertEqual(self.count('snippets'), 5)
+        # Search follows the live revision
+        self.assertEqual(self.backend.search('again')['total'], 0)
+        revisions.set_live_revision(10, 2, self.backend)
+        self.assertEqual(self.backend.search('again')['total'], 1)
+        revisions.set_live_revision(10, 1, self.backend)
+        with self.assertRaises(ValueError):
+            revisions.set_live_revision(10, 3, self.backend)
+
+        # The next revision still builds on the latest one
+        self.compile(self.SCRIPT.replace('12. Right', '12. Right again')
+                     .replace('    Left -> (11)', '    Go left -> (11)'))
+        self.assertEqual([(r['revision'], r['live']) for r in
+                          revisions.list_revisions(10, self.backend)],
+                         [(1, False), (2, False), (3, True)])
+        snippet = self.source.get_snippet(10, 10)
+        self.assertEqual([c['label'] for c in snippet['choices']],
+                         ['Go left', 'Right'])
+        self.assertEqual(self.source.get_snippet(10, 12)['game_text'],
+                         'Right again')
+        self.assertEqual(self.count('choices'), 6)
+
+    def test_upload_adds_revision(self):
+        self.compile(self.SCRIPT)
+        csv = self.backend.download_table('snippets').replace(
+            '|End|', '|The end|')
+        statements, revs = revisions.upload_statements(
+            'snippets', io.StringIO(csv), self.backend)
+        self.backend.execute_statements(statements)
+        self.assertEqual(revs, {10: 2})
+        self.assertEqual(self.source.get_snippet(10, 13)['game_text'],
+                         'The end')
+        self.assertEqual(len(self.source.get_snippet(10, 10)['choices']), 2)
+        self.assertEqual(self.count('snippets'), 5)
+
+
+class SavesTestCase(unittest.TestCase):
+    def setUp(self):
+        self.backend = SQLiteBackend()
+        self.backend.init_schema()
+        rows = [('Patsy', '2020-01-01 10:00:00'),
+                ('Pat', '2020-01-02 10:00:00'),
+                ('Patsy', '2020-01-03 10:00:00'),
+                ('Arthur', '2020-01-03 10:00:00'),
+                ('Patsy', '2020-01-03 10:00:00'),
+                ('patrick', '2020-01-04 10:00:00')]
+        self.backend.execute_statements([
+            ('INSERT INTO saved_games(my_name, my_fruit, saved_at) '
+             'VALUES (%s, %s, %s)', [name, 'coconut', saved_at])
+            for name, saved_at in rows])
+
+    def test_find_players(self):
+        page = saves.find_players(self.backend, 'Pat', limit=1)
+        self.assertEqual(page['players'], [dict(
+            my_name='Pat', saves=1, last_saved_at='2020-01-02 10:00:00')])
+        page = saves.find_players(self.backend, 'Pat', after=page['next'])
+        self.assertEqual([p['my_name'] for p in page['players']], ['Patsy'])
+        self.assertEqual(page['players'][0]['saves'], 3)
+        self.assertIsNone(page['next'])
+        self.assertEqual(saves.prefix_upper_bound('Pa\U0010ffff'), 'Pb')
+
+    def test_player_saves_keyset(self):
+        page = saves.player_saves(self.backend, 'Patsy', limit=1)
+        self.assertEqual([s['game_id'] for s in page['saves']], [5])
+        seen = [5]
+        while page['next']:
+            page = saves.player_saves(self.backend, 'Patsy',
+                                      after=page['next'], limit=1)
+            seen.extend(s['game_id'] for s in page['saves'])
+        self.assertEqual(seen, [5, 3, 1])
+
+        listing = saves.list_saves(self.backend, limit=3)
+        self.assertEqual([s['game_id'] for s in listing['saves']], [6, 5, 4])
+        with self.assertRaises(runtime.GameError):
+            saves.list_saves(self.backend, after='bogus')
+
+    def test_recent_players_cached(self):
+        cache = saves.RecentPlayersCache(ttl=60)
+        self.assertEqual([p['my_name'] for p in cache.get(self.backend)],
+                         ['patrick', 'Patsy', 'Arthur', 'Pat'])
+        self.backend.execute_statements([
+            ('INSERT INTO saved_games(my_name, my_fruit) VALUES (%s, %s)',
+             ['Lancelot', 'coconut'])])
+        self.assertEqual(len(cache.get(self.backend)), 4)
+        cache.clear()
+        self.assertEqual(cache.get(self.backend)[0]['my_name'], 'Lancelot')
+
+
+class DecompilerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.backend = SQLiteBackend()
+        self.backend.init_schema()
+        self.backend.execute_statements(snips_parser.parse(
+            SAMPLE_TEXT.replace('directive:ROOT_SNIP_ID 123',
+                                'directive:ROOT_SNIP_ID 123\n'
+                                'directive:DEDUPLICATE_TEXT'),
+            backend=self.backend))
+
+    def decompile(self, **kwargs):
+        out = io.StringIO()
+        decompiler.decompile(123, out, backend=self.backend, **kwargs)
+        return out.getvalue()
+
+    def test_roundtrip(self):
+        script = self.decompile()
+        self.assertTrue(script.startswith(
+            'directive:ROOT_SNIP_ID 123\n'
+            'directive:REF_NUMS_ARE_SNIP_IDS\n'
+            'directive:OVERWRITE_DB_SNIP_IDS\n'
+            'directive:DEDUPLICATE_TEXT\n'
+            '123. Introducing myself, I took a chair and sat beside John.\n'
+            '    How are you feeling? -> (124)\n'))
+        self.assertIn('        bm_patient += 1\n'
+                      '        Requires skin_thickness >= 5\n', script)
+        self.assertTrue(script.endswith(
+            '\n126. This is going to be a long day...\n'))
+
+        # Compiling the script again changes nothing but the revision
+        rows = len(self.backend.fetch_table('snippets'))
+        self.backend.execute_statements(snips_parser.parse(
+            script, backend=self.backend))
+        self.assertEqual(revisions.live_revision(123, self.backend), 2)
+        self.assertEqual(len(self.backend.fetch_table('snippets')), rows)
+        self.assertEqual(self.decompile(), script)
+        self.assertEqual(self.decompile(revision=1), script)
+
+    def test_unrepresentable_strings(self):
+        # Texts stored before placeholders existed keep rendering the same
+        self.backend.execute_statements([
+            ('UPDATE snippets SET text_id = NULL, game_text = %s '
+             'WHERE snip_id = %s', ['{x} and {', 124])])
+        self.assertIn('\n124. {{x}} and {{\n', self.decompile())
+
+        self.backend.execute_statements([
+            ('UPDATE snippets SET game_text = %s WHERE snip_id = %s',
+             ['two\nlines', 124])])
+        with self.assertRaises(DecompilerError):
+            self.decompile()
+
+
+class TextDedupTestCase(unittest.TestCase):
+    def test_dedup_matches_inline(self):
+        inline = SQLiteBackend()
+        inline.init_schema()
+        inline.execute_statements(snips_parser.parse(SAMPLE_TEXT, 
+                                                     backend=inline))
+
+        dedup = SQLiteBackend()
+        dedup.init_schema()
+        dedup_text = SAMPLE_TEXT.replace(
+            'directive:ROOT_SNIP_ID 123', 
+            'directive:ROOT_SNIP_ID 123\ndirective:DEDUPLICATE_TEXT')
+        dedup.execute_statements(snips_parser.parse(dedup_text,
+                                                    backend=dedup))
+
+        # 4 snippet texts, 3 distinct labels ("Next" is stored once)
+        self.assertEqual(len(dedup.fetch_table('texts')) - 1, 7)
+        self.assertEqual(dedup.query('SELECT COUNT(*) AS n FROM snippets '
+                                     'WHERE game_text IS NULL')[0]['n'], 4)
+
+        source = runtime.DatabaseSource(dedup)
+        for snip_id in (123, 124, 125, 126):
+            self.assertEqual(source.get_snippet(123, snip_id), 
+                             runtime.DatabaseSource(inline).get_snippet(
+                                 123, snip_id))
+        self.assertEqual(source.text_cache.misses, 7)
+        source.get_snippet(123, 124)
+        self.assertEqual(source.text_cache.misses, 7)
+
+    def serve_dedup_story(self):
+        """Points the webapp at a deduplicated sample story. Returns the
+        list that texts queries are appended to"""
+        from db_tools.backends import set_backend
+
+        backend = SQLiteBackend()
+        backend.init_schema()
+        backend.execute_statements(snips_parser.parse(SAMPLE_TEXT.replace(
+            'directive:ROOT_SNIP_ID 123', 
+            'directive:ROOT_SNIP_ID 123\ndirective:DEDUPLICATE_TEXT'),
+            backend=backend))
+        text_queries = []
+        query = backend.query
+        def counting_query(sql, *args, **kwargs):
+            if 'FROM texts' in sql:
+                text_queries.append(sql)
+            return query(sql, *args, **kwargs)
+        backend.query = counting_query
+        backend.execute_statements([(
+            "INSERT INTO saved_games(game_id, my_name, my_fruit) "
+            "VALUES (%s, %s, %s)", (1, 'Patsy', 'coconut'))])
+        backend.execute_statements([(
+            'UPDATE saved_games SET story_id = %s, current_snip_id = %s',
+            [123, 123])])
+
+        set_backend(backend)
+        self.addCleanup(set_backend, None)
+        runtime.database_source.text_cache.clear()
+        self.addCleanup(runtime.database_source.text_cache.clear)
+        return text_queries
+
+    def test_webapp_requests_share_text_cache(self):
+        import webapp
+        text_queries = self.serve_dedup_story()
+        client = webapp.app.test_client()
+        first = client.get('/api/story/123/snippet/124')
+        second = client.get('/api/story/123/snippet/124')
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(first.get_json(), second.get_json())
+        self.assertEqual(len(text_queries), 1)
+
+    def test_prefetch_shares_text_cache(self):
+        import webapp
+        text_queries = self.serve_dedup_story()
+        client = webapp.app.test_client()
+        first = client.get('/api/game/1?prefetch=3')
+        view = first.get_json()['snippet']
+        self.assertEqual(view['choices'][0]['next']['snip_id'], 124)
+        # At most one texts query per level: the game's snippet and 2 more
+        self.assertLessEqual(len(text_queries), 3)
+        del text_queries[:]
+        second = client.get('/api/game/1?prefetch=3')
+        self.assertEqual(first.get_json(), second.get_json())
+        self.assertEqual(text_queries, [])
+
+
+    def test_cache_evicts_least_recently_used(self):
+        cache = texts.TextCache(maxsize=2)
+        cache.add([(1, 'a'), (2, 'b')])
+        self.assertEqual(cache.lookup([1]), ({1: 'a'}, []))
+        cache.add([(3, 'c')])
+        self.assertEqual(cache.lookup([1, 2, 3]), ({1: 'a', 3: 'c'}, [2]))
+        self.assertEqual(texts.text_id('Next'), texts.text_id('Next'))
+        self.assertNotEqual(texts.text_id('Next'), texts.text_id('next'))
+
+
+class TemplatesTestCase(unittest.TestCase):
+    def test_compile_and_render(self):
+        t = templates.compile_template('{my_name}: {{x}} is {x}')
+        self.assertEqual(t.parts, [None, ': {x} is ', None])
+        self.assertEqual(t.render({'my_name': 'Patsy', 'x': '3'}),
+                         'Patsy: {x} is 3')
+        with self.assertRaises(templates.TemplateError):
+            templates.compile_template('a { b')
+        self.assertEqual(templates.compile_lenient('a { b').render({}),
+                         'a { b')
+
+    def test_validated_at_compile_time(self):
+        text = SAMPLE_TEXT.replace('What?', 'What, {my_name}? {bm_patient}')
+        snippets, _ = snips_parser.parse_text(text)
+        with self.assertRaises(ParserError):
+            snips_parser.parse_text(text.replace('{bm_patient}', '{typo}'))
+
+        snip = RootSnippet(1, 'Hello {nobody}')
+        snip.add_choice('Bye', TerminalSnippet('The end'))
+        with self.assertRaises(CompilerError):
+            list(snip.generate_chain_sql(backend=SQLiteBackend()))
+
+    def test_player_view_renders_for_player(self):
+        snippet = dict(story_id=1, snip_id=5, game_text='{my_name} has {x} on {date}',
+                       choices=[dict(choice_index=0, label='Add {x}',
+                                     next_snip_id=6, check_flags=[],
+                                     modifies_flags=[])])
+        game = dict(my_name='Patsy', my_fruit='coconut')
+        cache = templates.TemplateCache()
+        view = runtime.player_view(snippet, {'x': 2}, game, cache)
+        self.assertTrue(view['game_text'].startswith('Patsy has 2 on '))
+        self.assertEqual(view['choices'][0]['label'], 'Add 2')
+
+        runtime.player_view(snippet, {}, game, cache)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        # A changed text is a new version of the snippet
+        snippet['game_text'] = 'Bye'
+        self.assertEqual(runtime.player_view(snippet, {}, None, cache)
+                         ['game_text'], 'Bye')
+        self.assertEqual(cache.misses, 2)
+
+
+class ParseCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cache = parse_cache.ParseCache(self.tmpdir.name)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def compile(self, snippets, directives):
+        root = snippets[min(snippets)][0]
+        root.set_snip_id(directives['ROOT_SNIP_ID'])
+        backend = SQLiteBackend()
+        backend.init_schema()
+        return list(root.generate_chain_sql(backend=backend))
+
+    def test_hit_rebuilds_graph(self):
+        key = parse_cache.cache_key(SAMPLE_TEXT, snips_parser.PARSER_VERSION)
+        self.assertIsNone(self.cache.get(key))
+        parsed = snips_parser.parse_text(SAMPLE_TEXT, use_cache=False)
+        self.cache.put(key, *parsed)
+
+        cached = self.cache.get(key)
+        self.assertEqual(cached[1], parsed[1])
+        self.assertEqual(self.compile(*cached), SAMPLE_PARSE_OUTPUT)
+        self.assertNotEqual(key, parse_cache.cache_key(
+            SAMPLE_TEXT, snips_parser.PARSER_VERSION + 1))
+
+        # Through parse_text(): the second call is a hit
+        os.environ[parse_cache.DIR_ENVVAR] = os.path.join(self.tmpdir.name,
+                                                          'default')
+        self.addCleanup(os.environ.__setitem__, parse_cache.DIR_ENVVAR,
+                        _cache_dir.name)
+        with profiling.profile() as prof:
+            snips_parser.parse_text(SAMPLE_TEXT)
+            snips_parser.parse_text(SAMPLE_TEXT)
+        counters = prof.report()['counters']
+        self.assertEqual(counters['parse_cache_hits'], 1)
+        self.assertEqual(counters['parse_cache_misses'], 1)
+
+    def test_evicts_least_recently_used(self):
+        parsed = snips_parser.parse_text(SAMPLE_TEXT, use_cache=False)
+        size = len(parse_cache.encode_parse(*parsed))
+        self.cache.max_bytes = 2 * size
+        for key in ('a', 'b'):
+            self.cache.put(key, *parsed)
+        os.utime(os.path.join(self.tmpdir.name, 'a.parse'), (0, 0))
+        self.assertIsNotNone(self.cache.get('a'))  # now more recent than b
+        self.cache.put('c', *parsed)
+        self.assertEqual(sorted(os.listdir(self.tmpdir.name)),
+                         ['a.parse', 'c.parse'])
+
+        # Corrupt entries count as misses and are removed
+        with open(os.path.join(self.tmpdir.name, 'c.parse'), 'wb') as f:
+            f.write(b'not a cache entry')
+        with self.assertLogs(parse_cache.logger, 'WARNING'):
+            self.assertIsNone(self.cache.get('c'))
+        self.assertEqual(os.listdir(self.tmpdir.name), ['a.parse'])
+
+
+class ProfilingTestCase(unittest.TestCase):
+    def test_parse_text_phases(self):
+        with profiling.profile() as prof:
+            snips_parser.parse_text(SAMPLE_TEXT, use_cache=False)
+        report = prof.report()
+        phases = [p['name'] for p in report['phases']]
+        self.assertEqual(phases, ['directives', 'interpret', 'link', 
+                                  'orphan_check', 'placeholders'])
+        self.assertEqual(report['counters']['snippets'], 4)
+        self.assertEqual(report['counters']['choices'], 4)
+        self.assertEqual(report['counters']['flag_ops'], 2)
+
+    def test_inactive_profiler_is_noop(self):
+        self.assertIsNone(profiling.active_profiler())
+        with profiling.phase('nothing') as stats:
+            profiling.count('nothing')
+        self.assertIsNone(stats)
+
+
+class CompileServiceTestCase(unittest.TestCase):
+    def setUp(self):
+        self.backend = SQLiteBackend()
+        self.backend.init_schema()
+        self.service = compile_service.CompileService(
+            ThreadPoolExecutor(max_workers=1), backend=self.backend)
+
+    def tearDown(self):
+        self.service.shutdown()
+
+    def test_compile_and_commit(self):
+        job = self.service.submit(SAMPLE_TEXT)
+        self.assertIs(self.service.submit(SAMPLE_TEXT), job)
+        self.assertTrue(job.wait(5))
+        self.assertEqual(job.status, compile_service.DONE)
+        self.assertEqual(len(self.backend.fetch_table('snippets')), 1)
+
+        report = job.as_dict()
+        self.assertIn('assign_ids', [p['name'] for p in report['phases']])
+        self.assertEqual(report['counters']['statements'], 5)
+
+        self.service.commit(job.job_id)
+        self.assertEqual(job.status, compile_service.COMMITTED)
+        self.assertEqual(len(self.backend.fetch_table('snippets')), 5)
+        self.assertEqual(job.as_dict()['phases'][-1]['name'], 'commit')
+        with self.assertRaises(compile_service.JobStateError):
+            self.service.commit(job.job_id)
 
+        # Committed jobs are not reused; the script compiles again
+        again = self.service.submit(SAMPLE_TEXT, commit=True)
+        self.assertIsNot(again, job)
+        self.assertTrue(again.wait(5))
+        self.assertEqual(again.as_dict()['error']['type'], 'TimidError')
 
+    def test_script_errors(self):
+        job = self.service.submit('28. No directives')
+        self.assertTrue(job.wait(5))
+        self.assertEqual(job.status, compile_service.FAILED)
+        self.assertEqual(job.as_dict()['error']['type'], 'ParserError')
 
+    def test_process_pool_commits_off_result_thread(self):
+        import db_tools
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        path = os.path.join(tmp.name, 'story.db')
+        backend = SQLiteBackend(path)
+        backend.init_schema()
+        commit_threads = []
+        execute = backend.execute_statements
+        def recording_execute(statements):
+            commit_threads.append(threading.current_thread().name)
+            return execute(statements)
+        backend.execute_statements = recording_execute
 
+        # Worker processes open the same database through DATABASE_URL
+        environ = {'DATABASE_URL': 'sqlite:///' + path,
+                   'COMPILE_WORKERS': '1'}
+        saved = {name: os.environ.get(name) for name in environ}
+        def restore():
+            for name, value in saved.items():
+                if value is None:
+                    os.environ.pop(name, None)
+                else:
+                    os.environ[name] = value
+            db_tools.reset_config()
+        self.addCleanup(restore)
+        os.environ.update(environ)
+        db_tools.reset_config()
 
+        service = compile_service.CompileService(backend=backend)
+        self.assertIsInstance(service.executor, ProcessPoolExecutor)
+        try:
+            job = service.submit(SAMPLE_TEXT, commit=True)
+            self.assertTrue(job.wait(60))
+        finally:
+            service.shutdown()
+        self.assertEqual(job.status, compile_service.COMMITTED)
+        self.assertEqual(len(backend.fetch_table('snippets')), 5)
+        self.assertEqual(len(commit_threads), 1)
+        self.assertTrue(commit_threads[0].startswith('compile-commit'))
@@ -0,0 +1,135 @@
+"""
+Content-addressed storage for snippet texts and choice labels.
+
+With the DEDUPLICATE_TEXT directive, the compiler stores every distinct
+string once in the texts table, keyed by text_id(string), and snippets and
+choices reference it (snippets.text_id, choices.label_id) instead of holding
+the string inline. Rows written without the directive keep their text in
+game_text/choice_label, so both kinds of row can live in the same tables.
+
+A text_id is the first 8 bytes of the string's SHA-256 as a signed bigint.
+The same string always gets the same id, so recompiling a story or another
+story reusing a line ("Next", a recurring dialogue line) adds no new rows.
+Texts are never modified in place, so cached lookups never go stale.
+
+Usage:
+    text_id('Next')                        # same value on every run
+
+    cache = TextCache(maxsize=10000)
+    found = cache.get_many([id1, id2], fetch=lambda ids: backend.query(
+        TEXTS_QUERY.format(', '.join(['%s'] * len(ids))), ids))
+"""
+
+import hashlib
+import threading
+from collections import OrderedDict
+
+TEXTS_QUERY = """SELECT text_id, body FROM texts WHERE text_id IN ({})"""
+DEFAULT_CACHE_SIZE = 10000
+
+
+def text_id(s):
+    """Returns the content address (a signed 64-bit int) of string `s`"""
+    digest = hashlib.sha256(s.encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big', signed=True)
+
+
+def generate_sql_for_texts(strings):
+    """Compiles an insert of `strings` into the texts table.
+
+    Strings that are already stored are skipped by the database.
+
+    Returns a single (sql, values) tuple, or None if `strings` is empty.
+    """
+    unique = OrderedDict((text_id(s), s) for s in strings)
+    if not unique:
+        return None
+    sql = ("""INSERT INTO texts(text_id, body) VALUES {} """
+           """ON CONFLICT (text_id) DO NOTHING""").format(
+        ', '.join(['(%s, %s)'] * len(unique)))
+    values = []
+    for tid, s in unique.items():
+        values.append(tid)
+        values.append(s)
+    return (sql, values)
+
+
+
+class TextCache():
+    """Thread-safe LRU cache of {text_id: string}.
+
+    Hot strings (labels like "Next", the current chapter's text) stay in
+    memory; misses are fetched in one query per lookup.
+    """
+    def __init__(self, maxsize=DEFAULT_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._strings = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+
+    def __len__(self):
+        return len(self._strings)
+
+
+    def lookup(self, ids):
+        """Returns ({text_id: string} for cached ids, [uncached ids])"""
+        found, missing = {}, []
+        with self._lock:
+            for tid in ids:
+                if tid in found:
+                    continue
+                s = self._strings.get(tid)
+                if s is None:
+                    if tid not in missing:
+                        missing.append(tid)
+                    continue
+                self._strings.move_to_end(tid)
+                found[tid] = s
+            self.hits += len(found)
+            self.misses += len(missing)
+        return found, missing
+
+
+    def add(self, rows):
+        """Caches (text_id, string) pairs, evicting the least recently used"""
+        with self._lock:
+            for tid, s in rows:
+                self._strings[tid] = s
+                self._strings.move_to_end(tid)
+            while len(self._strings) > self.maxsize:
+                self._strings.popitem(last=False)
+
+
+    def clear(self):
+        with self._lock:
+            self._strings.clear()
+            self.hits = self.misses = 0
+
+
+    def get_many(self, ids, fetch):
+        """Resolves text_ids to strings.
+
+        Args:
+            ids: Iterable of text_ids.
+
+            fetch: Called with the list of uncached text_ids; returns rows
+                with text_id and body keys (e.g. the rows of TEXTS_QUERY).
+
+        Returns:
+            Dict of {text_id: string}.
+
+        Raises:
+            KeyError if a text_id is not in the texts table.
+        """
+        found, missing = self.lookup(ids)
+        if missing:
+            fetched = [(row['text_id'], row['body']) for row in fetch(missing)]
+            self.add(fetched)
+            found.update(fetched)
+            for tid in missing:
+                if tid not in found:
+                    raise KeyError('text_id {} is not in the texts '
+                                   'table'.format(tid))
+        return found
@@ -0,0 +1,85 @@
+/* Game Player Functions */
+/* Plays a saved game inside <div id="game" data-game-id="...">. Responses
+   from /api/game carry the views that the visible choices lead to
+   (choice.next, see snips_api/runtime.py), so a click switches pages at
+   once and the choice is saved in the background. Choices are POSTed one
+   after another, in the order they were clicked. */
+$(document).ready(function(){
+
+    var PREFETCH_DEPTH = 2;
+
+    var game = $("#game");
+    if (game.length === 0) {
+        return;
+    }
+    var game_id = game.data("game-id");
+    var current = null;     // view on screen
+    var queue = $.when();   // choose requests, chained in click order
+    var unsaved = 0;        // choices clicked but not saved yet
+    var generation = 0;     // bumped when a failed save reloads the game
+
+    function api_url(path) {
+        return "/api/game/" + game_id + path + "?prefetch=" + PREFETCH_DEPTH;
+    }
+
+    function render(view) {
+        current = view;
+        game.removeClass("loading");
+        game.empty();
+        $("<p>", {"class": "game_text"}).text(view.game_text).appendTo(game);
+        var choices = $("<div>", {"class": "choices"}).appendTo(game);
+        $.each(view.choices, function(i, choice) {
+            $("<button>", {"type": "button",
+                           "class": "btn btn-outline-secondary rounded-0 choice"})
+                .text(choice.label)
+                .click(function() { choose(choice); })
+                .appendTo(choices);
+        });
+    }
+
+    function load() {
+        game.addClass("loading");
+        $.getJSON(api_url("")).done(function(data) {
+            if (data.snippet) {
+                render(data.snippet);
+            }
+        });
+    }
+
+    function choose(choice) {
+        if (game.hasClass("loading")) {
+            return;
+        }
+        var body = JSON.stringify({story_id: current.story_id,
+                                   snip_id: current.snip_id,
+                                   choice_index: choice.choice_index});
+        if (choice.next) {
+            render(choice.next);
+        } else {
+            game.addClass("loading");
+        }
+
+        var sent_in = generation;
+        unsaved++;
+        queue = queue.then(function() {
+            return $.ajax({url: api_url("/choose"), method: "POST",
+                           contentType: "application/json", data: body});
+        }).then(function(view) {
+            unsaved--;
+            // Only the last save knows the prefetched views from here on
+            if (unsaved === 0 && sent_in === generation) {
+                render(view);
+            }
+        }, function() {
+            // The server has the last saved position; start over from it
+            if (sent_in === generation) {
+                generation++;
+                unsaved = 0;
+                queue = $.when();
+                load();
+            }
+        });
+    }
+
+    load();
+});
@@ -3,18 +3,70 @@ import os
 import os.path
 
 # Third-party modules
-from flask import Flask, jsonify, make_response, redirect, render_template, \
-                  request, url_for
+from flask import Flask, abort, jsonify, make_response, redirect, \
+                  render_template, request, url_for
 import click
 
 # Local modules
+from db_tools import admission, columnar, metrics, replicas, \
+    request_profiler, validation
 from db_tools.db_downup import download_table, fetch_table, upload_table
+from db_tools.backends import get_backend
+from snips_api import compile_service, runtime, saves
+from snips_api.runtime import get_story_source
 
 
 # Init app
 app = Flask(__name__)
 
 
+@app.before_request
+def begin_profile():
+    """Profiles sampled requests (see db_tools/request_profiler.py)"""
+    request_profiler.begin_request(request.endpoint, request.method,
+                                   request.path, request.headers)
+
+
+@app.before_request
+def label_db_metrics():
+    """Attributes queries made while handling a request to its route"""
+    metrics.set_source(request.endpoint)
+
+
+@app.before_request
+def begin_db_request():
+    """Reads made while handling a request see the request's own writes"""
+    replicas.begin_request()
+
+
+# Routes that read or write whole tables run in the bulk lane, so they
+# cannot take over the worker threads and connections of player routes
+BULK_ENDPOINTS = frozenset(['debug_database', 'debug_database_upload',
+                            'debug_database_download'])
+
+
+@app.before_request
+def admit_request():
+    """Queues the request in its lane (see db_tools/admission.py)"""
+    admission.enter(admission.BULK if request.endpoint in BULK_ENDPOINTS
+                    else admission.PLAYER)
+
+
+@app.teardown_request
+def leave_lane(exc=None):
+    admission.leave()
+
+
+@app.teardown_request
+def unlabel_db_metrics(exc=None):
+    metrics.set_source(None)
+
+
+@app.teardown_request
+def end_profile(exc=None):
+    request_profiler.end_request()
+
+
 @app.route('/')
 def main_page():
     return render_template('title_page.html')
@@ -25,6 +77,226 @@ def load():
     return render_template('load_account_page.html')
 
 
+@app.route('/api/story/<int:story_id>/snippet/<int:snip_id>')
+def api_snippet(story_id, snip_id):
+    """Fetches a snippet of a story and its choices.
+
+    Served from the story bundle at STORY_BUNDLE if set, otherwise from the
+    database.
+
+    Returns:
+        JSON object with story_id, snip_id, game_text and choices.
+    """
+    snippet = get_story_source().get_snippet(story_id, snip_id)
+    if snippet is None:
+        abort(404)
+    return jsonify(snippet)
+
+
+@app.route('/api/game/<int:game_id>')
+def api_game(game_id):
+    """Fetches a saved game and the snippet the player is on.
+
+    Takes an optional ?prefetch=<depth> to include the snippets that the
+    visible choices lead to (see snips_api/runtime.py).
+
+    Returns:
+        JSON object with game_id, my_name and snippet (null if the game has
+        not started).
+    """
+    depth, max_bytes = runtime.prefetch_limits(request.args.get('prefetch'))
+    return jsonify(runtime.game_view(get_story_source(), get_backend(),
+                                     game_id, depth, max_bytes))
+
+
+@app.route('/api/game/<int:game_id>/choose', methods=['POST'])
+def api_choose(game_id):
+    """Applies a choice to a saved game and saves the new flag state.
+
+    Expects a JSON body with snip_id (the snippet the player is on) and
+    choice_index, plus story_id for the first choice of a new game. Takes an
+    optional ?prefetch=<depth> like api_game().
+
+    Returns:
+        JSON object of the next snippet, with only the choices visible to the
+        player.
+    """
+    body = request.get_json(force=True, silent=True) or {}
+    try:
+        snip_id = int(body['snip_id'])
+        choice_index = int(body['choice_index'])
+        story_id = body.get('story_id')
+        story_id = None if story_id is None else int(story_id)
+    except (KeyError, TypeError, ValueError):
+        raise runtime.GameError('Expected JSON with snip_id and choice_index')
+    depth, max_bytes = runtime.prefetch_limits(request.args.get('prefetch'))
+    return jsonify(runtime.play_choice(get_story_source(), get_backend(),
+                                       game_id, snip_id, choice_index,
+                                       depth, max_bytes, story_id))
+
+
+@app.route('/api/saves')
+def api_saves():
+    """Looks up saved games for the load page (see snips_api/saves.py).
+
+    Query parameters:
+        prefix: List the players whose names start with this, in name
+                order.
+        name: List this player's saves, most recently saved first.
+        after: `next` cursor of the previous page.
+        limit: Page size, at most saves.MAX_PAGE_SIZE. Default: 20
+
+    Without prefix or name, all saves are listed, most recently saved first.
+
+    Returns:
+        JSON object with next (cursor of the next page, null on the last)
+        and either players (my_name, saves, last_saved_at) or saves
+        (game_id, my_name, story_id, current_snip_id, saved_at).
+    """
+    args = request.args
+    backend = get_backend()
+    if 'prefix' in args:
+        return jsonify(saves.find_players(backend, args['prefix'],
+                                          args.get('after'),
+                                          args.get('limit')))
+    if 'name' in args:
+        return jsonify(saves.player_saves(backend, args['name'],
+                                          args.get('after'),
+                                          args.get('limit')))
+    return jsonify(saves.list_saves(backend, args.get('after'),
+                                    args.get('limit')))
+
+
+@app.route('/api/saves/recent')
+def api_recent_players():
+    """Lists the players who saved last, cached for a few seconds.
+
+    Returns:
+        JSON object with players (my_name, last_saved_at), most recent first.
+    """
+    return jsonify(players=saves.recent_players(get_backend()))
+
+
+SEARCH_MAX_PER_PAGE = 100
+
+
+@app.route('/api/search')
+def api_search():
+    """Full-text search over snippet texts and choice labels.
+
+    Query parameters:
+        q: Words to search for. Required.
+        page: 1-based page number. Default: 1
+        per_page: Results per page, at most SEARCH_MAX_PER_PAGE. Default: 20
+
+    Returns:
+        JSON object with query, page, per_page, total and results, ranked
+        best first. Each result has story_id, snip_id, rank, headline and
+        labels as HTML: escaped text with matched words wrapped in <b></b>.
+    """
+    q = request.args.get('q', '').strip()
+    try:
+        page = max(1, int(request.args.get('page', 1)))
+        per_page = min(SEARCH_MAX_PER_PAGE,
+                       max(1, int(request.args.get('per_page', 20))))
+    except ValueError:
+        return jsonify(error='page and per_page must be integers'), 400
+    if not q:
+        return jsonify(error='Missing search query "q"'), 400
+
+    found = get_backend().search(q, limit=per_page,
+                                 offset=(page - 1) * per_page)
+    return jsonify(query=q, page=page, per_page=per_page, **found)
+
+
+COMPILE_MAX_BYTES = 16 * 1024 * 1024
+
+
+@app.route('/api/compile', methods=['POST'])
+def api_compile():
+    """Compiles scripts in the background (see snips_api/compile_service.py).
+
+    Accepts either a JSON body with script (the script text) or a
+    multipart form with one or more script files as "file". Identical
+    scripts share a job.
+
+    Query parameters:
+        commit: 1 to commit the statements once compiled. Default: 0
+
+    Returns:
+        202 with a JSON object of jobs, a list of job objects (see
+        api_compile_job()) in the order the scripts were given.
+    """
+    if (request.content_length or 0) > COMPILE_MAX_BYTES:
+        return jsonify(error='Scripts are limited to {} bytes'.format(
+            COMPILE_MAX_BYTES)), 413
+    if request.files:
+        try:
+            scripts = [f.read().decode('utf-8')
+                       for f in request.files.getlist('file')]
+        except UnicodeDecodeError:
+            return jsonify(error='Script files must be UTF-8'), 400
+    else:
+        body = request.get_json(force=True, silent=True) or {}
+        scripts = [body['script']] if body.get('script') else []
+    if not scripts:
+        return jsonify(error='Expected JSON with script or files as '
+                             '"file"'), 400
+
+    commit = request.args.get('commit') == '1'
+    service = compile_service.get_service()
+    jobs = [service.submit(text, commit) for text in scripts]
+    return jsonify(jobs=[job.as_dict() for job in jobs]), 202
+
+
+@app.route('/api/compile/<job_id>')
+def api_compile_job(job_id):
+    """Fetches a compile job.
+
+    Returns:
+        JSON object with job_id, status, submitted_at, finished_at,
+        statements (count, once compiled), phases (name, calls and seconds
+        of each compile phase, then the commit), counters and error (type
+        and message, e.g. of a ParserError; null unless failed).
+    """
+    job = compile_service.get_service().job(job_id)
+    if job is None:
+        abort(404)
+    return jsonify(job.as_dict())
+
+
+@app.route('/api/compile/<job_id>/commit', methods=['POST'])
+def api_compile_commit(job_id):
+    """Executes a compiled job's statements in one transaction.
+
+    Returns:
+        The job (see api_compile_job()); 409 if it is not compiled yet,
+        failed or already committed.
+    """
+    service = compile_service.get_service()
+    try:
+        job = service.commit(job_id)
+    except KeyError:
+        abort(404)
+    except compile_service.JobStateError as e:
+        return jsonify(error=str(e)), 409
+    return jsonify(job.as_dict())
+
+
+@app.errorhandler(runtime.GameError)
+def game_error(e):
+    return jsonify(error=str(e)), e.status
+
+
+@app.errorhandler(admission.LaneFull)
+def lane_full(e):
+    """The request's lane was full, or it ran out of database connections"""
+    response = jsonify(error=str(e))
+    response.status_code = 503
+    response.headers['Retry-After'] = str(e.retry_after)
+    return response
+
+
 @app.route('/database')
 @app.route('/database/<table_name>')
 def debug_database(table_name=None):
@@ -47,6 +319,14 @@ def debug_database(table_name=None):
 def debug_database_upload(table_name=None):
     """Accepts csv file to replace into target table.
 
+    Files ending in .parquet, .arrow or .feather are bulk-loaded with
+    db_tools.columnar instead, keeping the table definition. An upload of
+    snippets or choices, in either format, adds a live revision to each
+    story in the file instead of replacing rows (see db_tools/revisions.py).
+    Uploads are validated first; one with problems, or that cannot be read,
+    changes nothing and gets status 400 with JSON error and violations (see
+    db_tools/validation.py).
+
     Args:
         table_name: Name of the table to upload and replace into.
                     Default: None
@@ -60,7 +340,16 @@ def debug_database_upload(table_name=None):
     
     f = request.files['file']
     print('get file:', f.filename)
-    upload_table(table_name, f)
+    try:
+        if os.path.splitext(f.filename)[1].lower() in columnar.EXTENSIONS:
+            columnar.import_table(table_name, f.stream,
+                                  columnar.format_for_path(f.filename))
+        else:
+            upload_table(table_name, f)
+    except validation.UploadValidationError as e:
+        return jsonify(error=str(e), violations=e.violations), 400
+    except ValueError as e:
+        return jsonify(error=str(e), violations=[]), 400
     # return json response to trigger JavaScript `done` callback
     return jsonify([f.filename])
 
@@ -73,12 +362,22 @@ def debug_database_download(table_name=None):
         table_name: Name of the table to downlaod from.
                     Default: None
 
+    Query parameters:
+        format: 'parquet' or 'arrow' to download a typed columnar file
+                instead (see db_tools.columnar).
+
     Returns:
         302 Redirect to download the generated file.
     """
     if (not table_name):
         return redirect(url_for('debug_database', table_name=table_name))    
     
+    fmt = request.args.get('format')
+    if fmt in columnar.FORMATS:
+        fname = '{}.{}'.format(table_name, fmt)
+        columnar.export_table(table_name, os.path.join('static', fname), fmt)
+        return redirect(url_for('static', filename=fname))
+
     output = download_table(table_name)
     csv_fname = table_name + '.csv'
     with open(os.path.join('static', csv_fname), 'w', encoding='utf-8') as f:
@@ -86,6 +385,50 @@ def debug_database_download(table_name=None):
     return redirect(url_for('static', filename=csv_fname))
 
 
+@app.route('/metrics')
+def db_metrics():
+    """Serves database query and request lane metrics in Prometheus text
+    format."""
+    response = make_response(metrics.render_prometheus() +
+                             admission.render_prometheus())
+    response.headers['Content-Type'] = 'text/plain; version=0.0.4'
+    return response
+
+
+@app.route('/debug/profiles')
+def debug_profiles():
+    """Serves the slowest sampled request profiles of each route.
+
+    Needs PROFILE_TOKEN, in the X-Profile-Token header or ?token=; 404 if
+    no token is configured.
+
+    Query parameters:
+        route: Only profiles of this endpoint, e.g. api_game.
+        format: 'folded' for merged folded stacks (flamegraph.pl input)
+                instead of JSON.
+
+    Returns:
+        JSON object with interval (seconds between samples) and profiles,
+        slowest first, each with route, method, path, started_at, seconds,
+        sample_count and stacks of {stack, count}.
+    """
+    conf = request_profiler.config()
+    if conf.token is None:
+        abort(404)
+    token = (request.headers.get('X-Profile-Token') or
+             request.args.get('token'))
+    if not conf.check_token(token):
+        abort(403)
+
+    profiles = request_profiler.profiles(request.args.get('route'))
+    if request.args.get('format') == 'folded':
+        response = make_response(request_profiler.folded(profiles))
+        response.headers['Content-Type'] = 'text/plain; charset=utf-8'
+        return response
+    return jsonify(interval=conf.interval,
+                   profiles=[p.as_dict() for p in profiles])
+
+
 @app.cli.command(with_appcontext=True)
 def render():
     """Pre-renders templates into a folder for easy preview